@@ -2,18 +2,43 @@
 import argparse
 import logging
 import math
-import matplotlib as mp
-mp.use('GTK3Agg')
-from matplotlib.text import OffsetFrom
-import matplotlib.patches as patches
-from matplotlib.widgets import Button, CheckButtons, Slider
-import matplotlib.pyplot as plt
-import numpy as np
-import scipy.signal as signal
+import os
 import sys
 
-import dragonradio
-import drlog
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+import startup
+import stageprof
+
+timer = startup.StartupTimer.from_argv()
+
+# Stage profiler, enabled by --profile
+prof = stageprof.Profiler(enabled=False)
+
+def import_gui():
+    """Import the plotting and log modules.
+
+    They take most of our startup time, so they are only imported once the
+    arguments have been parsed, and not at all for --help or bad arguments.
+    """
+    global mp, OffsetFrom, patches, Button, CheckButtons, Slider, plt, np
+    global h5py, drlog, specpyramid, spectral, decode_snapshot, log_node_id, SlotStore
+
+    import matplotlib as mp
+    mp.use('GTK3Agg')
+    from matplotlib.text import OffsetFrom
+    import matplotlib.patches as patches
+    from matplotlib.widgets import Button, CheckButtons, Slider
+    import matplotlib.pyplot as plt
+    import h5py
+    import numpy as np
+
+    import drlog
+
+    import specpyramid
+    import spectral
+    from hdf5_utils import decode_snapshot, node_id as log_node_id
+    from slotstore import SlotStore
 
 # Create signal variable at file scope
 iqsig = None
@@ -91,7 +116,7 @@ def addCheckboxWidget(fig, lines):
     return check
 
 class SpecgramPlot:
-    def __init__(self, fig, ax, nfft=256, scale=1e3, cmap=plt.get_cmap('viridis')):
+    def __init__(self, fig, ax, nfft=256, scale=1e3, cmap='viridis'):
         self.fig = fig
         self.ax = ax
         self.scale = scale # kHz
@@ -106,8 +131,17 @@ class SpecgramPlot:
         self.ax.clear()
         if self.cb:
             self.cb.remove()
-        pxx, freq, t, cax = self.ax.specgram(w, NFFT=self.nfft, Fs=Fs, cmap=self.cmap)
-        self.cb = self.fig.colorbar(cax, ax=self.ax)
+        # Same image as ax.specgram, but computed in single precision on
+        # all cores
+        noverlap = self.nfft//2
+        with prof.span('specgram.fft', nbytes=w.nbytes) as s:
+            freq, t, pxx = spectral.spectrogram(w, Fs, nfft=self.nfft, noverlap=noverlap)
+            s.set(count=len(t))
+        with prof.span('specgram.image', nbytes=pxx.nbytes):
+            pad = (self.nfft - noverlap)/Fs/2
+            extent = (t[0] - pad, t[-1] + pad, freq[0], freq[-1]) if len(t) else None
+            cax = self.ax.imshow(np.flipud(spectral.db(pxx)), cmap=self.cmap, extent=extent)
+            self.cb = self.fig.colorbar(cax, ax=self.ax)
         self.cb.set_label('Intensity (dB)')
         self.ax.set_aspect('auto')
         self.ax.set_xlabel('Time (sec)')
@@ -161,7 +195,10 @@ class PSDPlot:
         xticks = mp.ticker.FuncFormatter(lambda x, pos: '{0:g}'.format(x/self.scale))
 
         self.ax.clear()
-        self.ax.psd(sig, NFFT=self.nfft, Fs=Fs)
+        freq, pxx = spectral.welch(sig, Fs, nfft=self.nfft)
+        self.ax.plot(freq, spectral.db(pxx))
+        self.ax.set_ylabel('Power Spectral Density (dB/Hz)')
+        self.ax.grid(True)
         if title:
             self.ax.set_title(title)
         self.ax.set_xlabel('Frequency (kHz)')
@@ -243,6 +280,10 @@ class ReceivePlot:
             return recv[recv.header_valid == True]
 
     def plot(self, idx):
+        with prof.span('rx.plot', index=idx):
+            self._plot(idx)
+
+    def _plot(self, idx):
         recv = self.received(self.node.node_id)
 
         if idx >= 0 and idx < len(recv):
@@ -250,12 +291,20 @@ class ReceivePlot:
             self.pkt = recv.iloc[idx]
             self.spos.set_val(idx)
 
-            slots = self.log.findSlots(self.node, self.pkt)
+            with prof.span('rx.findSlots') as s:
+                if self.viewer is not None:
+                    slots = self.viewer.findSlots(self.node, self.pkt)
+                else:
+                    slots = self.log.findSlots(self.node, self.pkt)
+                if slots != None:
+                    s.set(count=len(slots.ts), nbytes=slots.sig.nbytes)
             if slots == None:
                 logging.warning("Cannot find slots for packet at timestamp %f", self.pkt.timestamp)
                 return
 
-            sig = slots.sigrange(self.pkt.start_samples, self.pkt.end_samples)
+            with prof.span('rx.sigrange') as s:
+                sig = slots.sigrange(self.pkt.start_samples, self.pkt.end_samples)
+                s.set(nbytes=sig.nbytes)
 
             if not self.pkt.header_valid:
                 msg = 'INVALID HEADER'
@@ -269,27 +318,35 @@ class ReceivePlot:
 
             t0 = slots.ts[0]
 
-            self.specgram.plot(slots.bw, slots.sig, t0)
+            with prof.span('rx.specgram'):
+                self.specgram.plot(slots.bw, slots.sig, t0)
 
             # Mark all packets in the current specgram
             #self.markPacket(self.pkt, self.specgram.ax)
-            pkts = self.log.findReceivedPackets(self.node, t0, t0+len(slots.sig)/slots.bw)
-            if not self.show_header_invalid:
-                pkts = pkts[pkts.header_valid == True]
-
-            for (_, pkt) in pkts.iterrows():
-                self.bracketPacket(pkt, t0, self.specgram.ax)
-
-            # Mark all slots in the current specgram
-            for t in slots.ts:
-                self.markSlot(self.specgram.ax, t-t0)
-
-            self.constellation.plot(self.pkt.iq_data)
-            self.waveform.plot(sig)
-            self.psd.plot(slots.bw, sig)
-            self.papr.plot(sig)
-
-            self.fig.canvas.draw()
+            with prof.span('rx.overlay') as s:
+                pkts = self.log.findReceivedPackets(self.node, t0, t0+len(slots.sig)/slots.bw)
+                if not self.show_header_invalid:
+                    pkts = pkts[pkts.header_valid == True]
+
+                for (_, pkt) in pkts.iterrows():
+                    self.bracketPacket(pkt, t0, self.specgram.ax)
+
+                # Mark all slots in the current specgram
+                for t in slots.ts:
+                    self.markSlot(self.specgram.ax, t-t0)
+                s.set(count=len(pkts) + len(slots.ts))
+
+            with prof.span('rx.constellation', count=len(self.pkt.iq_data)):
+                self.constellation.plot(self.pkt.iq_data)
+            with prof.span('rx.waveform', count=len(sig)):
+                self.waveform.plot(sig)
+            with prof.span('rx.psd', nbytes=sig.nbytes):
+                self.psd.plot(slots.bw, sig)
+            with prof.span('rx.papr', count=len(sig)):
+                self.papr.plot(sig)
+
+            with prof.span('rx.draw'):
+                self.fig.canvas.draw()
 
     def update_slider(self, val):
         idx = int(val)
@@ -412,6 +469,10 @@ class SendPlot:
         self.viewer.txFigs[self.node.node_id] = self
 
     def plot(self, idx):
+        with prof.span('tx.plot', index=idx):
+            self._plot(idx)
+
+    def _plot(self, idx):
         send = self.log.sent[self.node.node_id]
 
         if idx >= 0 and idx < len(send):
@@ -422,12 +483,18 @@ class SendPlot:
             self.fig.canvas.set_window_title('Node {} Sent Packets'.format(self.node.node_id))
             self.fig.suptitle('Packet {} to node {}'.format(self.pkt.seq, self.pkt.dest))
 
-            self.constellation.plot(self.pkt.iq_data)
-            self.waveform.plot(self.pkt.iq_data)
-            self.psd.plot(self.pkt.bw, self.pkt.iq_data)
-            self.papr.plot(self.pkt.iq_data)
+            n = len(self.pkt.iq_data)
+            with prof.span('tx.constellation', count=n):
+                self.constellation.plot(self.pkt.iq_data)
+            with prof.span('tx.waveform', count=n):
+                self.waveform.plot(self.pkt.iq_data)
+            with prof.span('tx.psd', count=n):
+                self.psd.plot(self.pkt.bw, self.pkt.iq_data)
+            with prof.span('tx.papr', count=n):
+                self.papr.plot(self.pkt.iq_data)
 
-            self.fig.canvas.draw()
+            with prof.span('tx.draw'):
+                self.fig.canvas.draw()
 
     def update_slider(self, val):
         idx = int(val)
@@ -487,45 +554,59 @@ class SnapshotPlot:
         return self.log.snapshots[self.node.node_id]
 
     def plot(self, idx):
+        with prof.span('snapshot.plot', index=idx):
+            self._plot(idx)
+
+    def _plot(self, idx):
         if idx >= 0 and idx < len(self.snapshots):
             self.snapshotidx = idx
 
             snapshot = self.snapshots.iloc[idx]
             self.spos.set_val(idx)
 
-            sig = dragonradio.decompressFLAC(snapshot.iq_data)
+            with prof.span('snapshot.decode', nbytes=np.asarray(snapshot.iq_data).nbytes) as s:
+                sig = decode_snapshot(snapshot.iq_data, threads=4)
+                s.set(count=len(sig))
 
             self.fig.canvas.set_window_title('Snapshot at {}'.format(str(snapshot.timestamp)))
 
-            self.specgram.plot(snapshot.fs, sig, snapshot.timestamp)
-            self.psd.plot(snapshot.fs, sig, title=None)
+            with prof.span('snapshot.specgram'):
+                self.specgram.plot(snapshot.fs, sig, snapshot.timestamp)
+            with prof.span('snapshot.psd', nbytes=sig.nbytes):
+                self.psd.plot(snapshot.fs, sig, title=None)
 
             # Plot self-transmissions
-            df = self.log.selftx[self.node.node_id]
-            selftx = df[df.timestamp == snapshot.timestamp]
-            fs = snapshot.fs
-
-            for _, e in selftx.iterrows():
-                start = e.start/fs
-                end = e.end/fs
-                f_bot = e.fc-0.5*e.fs
-                f_height = e.fs
-
-                if e.is_local:
-                    color = 'b'
-                else:
-                    color = 'r'
-
-                rect = patches.Rectangle((start, f_bot),
-                                         end-start,
-                                         f_height,
-                                         linewidth=0.4,
-                                         edgecolor=color,
-                                         facecolor=color,
-                                         alpha=0.3)
-                self.specgram.ax.add_patch(rect)
+            with prof.span('snapshot.selftx') as s:
+                self._plot_selftx(snapshot)
+                s.set(count=len(self.specgram.ax.patches))
+
+            with prof.span('snapshot.draw'):
+                self.fig.canvas.draw()
+
+    def _plot_selftx(self, snapshot):
+        df = self.log.selftx[self.node.node_id]
+        selftx = df[df.timestamp == snapshot.timestamp]
+        fs = snapshot.fs
+
+        for _, e in selftx.iterrows():
+            start = e.start/fs
+            end = e.end/fs
+            f_bot = e.fc-0.5*e.fs
+            f_height = e.fs
+
+            if e.is_local:
+                color = 'b'
+            else:
+                color = 'r'
 
-            self.fig.canvas.draw()
+            rect = patches.Rectangle((start, f_bot),
+                                     end-start,
+                                     f_height,
+                                     linewidth=0.4,
+                                     edgecolor=color,
+                                     facecolor=color,
+                                     alpha=0.3)
+            self.specgram.ax.add_patch(rect)
 
     def update_slider(self, val):
         idx = int(val)
@@ -538,6 +619,74 @@ class SnapshotPlot:
     def prev_snapshot(self, event):
         self.plot(self.snapshotidx-1)
 
+class WaterfallPlot:
+    """Pan and zoom across a whole run using a spectrogram tile pyramid.
+
+    Only the tiles of the pyramid level matching the visible time span are
+    read, so this stays responsive on hours of recording. Build the pyramid
+    first with utils/specpyramid.py.
+    """
+    def __init__(self, path, source='slots', max_cols=2048, scale=1e3, cmap='viridis'):
+        self.reader = specpyramid.PyramidReader(path, source)
+        self.max_cols = max_cols
+        self.scale = scale # kHz
+        self.cmap = cmap
+        self.level = None
+
+        self.fig = plt.figure()
+        self.ax = self.fig.add_subplot(1,1,1)
+        self.im = None
+        self.cb = None
+
+        self.fig.canvas.mpl_connect('scroll_event', zoom_factory(self.fig, self.ax, base_scale=2.0))
+        self.fig.canvas.mpl_connect('close_event', self.on_close)
+
+    def plot(self, tmin=None, tmax=None):
+        if tmin is None:
+            tmin = self.reader.tstart
+        if tmax is None:
+            tmax = self.reader.tend
+
+        yticks = mp.ticker.FuncFormatter(lambda x, pos: '{0:g}'.format(x/self.scale))
+        freqs = self.reader.freqs
+
+        self.im = self.ax.imshow(np.zeros((1, 1)), aspect='auto', origin='lower',
+                                 interpolation='nearest', cmap=self.cmap,
+                                 extent=(tmin, tmax, freqs[0], freqs[-1]))
+        self.cb = self.fig.colorbar(self.im, ax=self.ax)
+        self.cb.set_label('Intensity (dB)')
+        self.ax.set_xlabel('Time (sec)')
+        self.ax.set_ylabel('Frequency (kHz)')
+        self.ax.yaxis.set_major_formatter(yticks)
+        self.ax.set_xlim(tmin, tmax)
+        self.update(tmin, tmax)
+
+        self.ax.callbacks.connect('xlim_changed', self.on_xlim_changed)
+
+    def update(self, tmin, tmax):
+        level, t, P = self.reader.read(tmin, tmax, max_cols=self.max_cols)
+        if len(t) == 0:
+            return
+
+        width = self.reader.dt*2**level
+        freqs = self.reader.freqs
+
+        self.level = level
+        self.im.set_data(P.T)
+        self.im.set_extent((t[0], t[-1] + width, freqs[0], freqs[-1]))
+        finite = P[np.isfinite(P)]
+        if len(finite):
+            self.im.set_clim(np.min(finite), np.max(finite))
+        self.fig.canvas.manager.set_window_title('Waterfall (level {}, {} columns)'.format(level, len(t)))
+
+    def on_xlim_changed(self, ax):
+        tmin, tmax = ax.get_xlim()
+        self.update(tmin, tmax)
+        self.fig.canvas.draw_idle()
+
+    def on_close(self, event):
+        self.reader.close()
+
 class MetricPlot:
     def __init__(self, log, metric):
         self.log = log
@@ -585,7 +734,8 @@ class MetricPlot:
             else:
                 raise ValueError('Cannot plot {}'.format(metric))
 
-            l = ax.scatter(x, y, label='{}'.format(node_id), s=5, alpha=0.3)
+            with prof.span('metric.scatter', count=len(x), node=node_id):
+                l = ax.scatter(x, y, label='{}'.format(node_id), s=5, alpha=0.3)
             lines.append(l)
 
         addCheckboxWidget(self.fig, lines)
@@ -603,15 +753,41 @@ class MetricPlot:
         ax.legend(handles=lines)
 
     def plot(self):
-        self.fig.canvas.draw()
+        with prof.span('metric.draw', metric=self.metric):
+            self.fig.canvas.draw()
 
 class LogViewer:
-    def __init__(self, log):
+    def __init__(self, log, paths=()):
         self.log = log
+        self.paths = list(paths)
+        self.stores = {}
         self.rxFigs = {}
         self.txFigs = {}
         self.snapshotFigs = {}
         self.metricFigs = {}
+        self.waterfallFigs = {}
+
+    def slotStore(self, node):
+        """The slot store of a node's log (see utils/slotstore.py), or None
+        if none of our logs is the node's or it has no slots"""
+        if node.node_id not in self.stores:
+            self.stores[node.node_id] = None
+            for path in self.paths:
+                if log_node_id(path) == node.node_id:
+                    with prof.span('rx.slotstore', node=node.node_id):
+                        store = SlotStore.open(path)
+                    if len(store):
+                        self.stores[node.node_id] = store
+                    break
+        return self.stores[node.node_id]
+
+    def findSlots(self, node, pkt):
+        """The slots around a received packet, as views into the node's slot
+        store, or from the log if the node has no store"""
+        store = self.slotStore(node)
+        if store is None:
+            return self.log.findSlots(node, pkt)
+        return store.window(store.find(pkt.timestamp), before=1, after=1)
 
     def rxFig(self, node, nfft=256, show_header_invalid=False):
         if node.node_id in self.rxFigs:
@@ -638,6 +814,15 @@ class LogViewer:
             fig.fig.show()
             return fig
 
+    def waterfallFig(self, path, source='slots'):
+        if (path, source) in self.waterfallFigs:
+            return self.waterfallFigs[(path, source)]
+        else:
+            fig = WaterfallPlot(specpyramid.pyramid_path(path), source=source)
+            self.waterfallFigs[(path, source)] = fig
+            fig.fig.show()
+            return fig
+
     def metricFig(self, metric):
         if metric in self.metricFigs:
             return self.metricFigs[metric]
@@ -648,7 +833,7 @@ class LogViewer:
             return fig
 
 def main():
-    global viewer
+    global viewer, prof
 
     parser = argparse.ArgumentParser(description='Show received packets.')
     parser.add_argument('-d', '--debug', action='store_true',
@@ -662,6 +847,12 @@ def main():
     parser.add_argument('--snapshots', action='append', type=int, default=[], dest='snapshots',
                         metavar='NODE',
                         help='view snapshot log for given node')
+    parser.add_argument('--waterfall', action='append', default=[], dest='waterfall',
+                        metavar='LOG',
+                        help='view whole-run waterfall for given log (see utils/specpyramid.py)')
+    parser.add_argument('--waterfall-source', action='store',
+                        default='slots', dest='waterfall_source',
+                        help='dataset to show in waterfall view')
     parser.add_argument('--demod-latency', action='store_true',
                         dest='demod_latency',
                         help='plot demodulation latency')
@@ -685,11 +876,25 @@ def main():
                         help='set number of FFT points')
     parser.add_argument('--show-invalid-headers', action='store_true', default=False, dest='show_invalid_headers',
                         help='show invalid headers when displaying RX log')
+    startup.add_arguments(parser)
+    stageprof.add_arguments(parser)
     parser.add_argument('paths', nargs='*')
     args = parser.parse_args()
+    timer.mark('arguments')
+
+    prof = stageprof.from_args(args)
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.DEBUG if args.debug else logging.INFO)
+
+    import_gui()
+    timer.mark('imports')
+
+    if args.waterfall_source not in specpyramid.SOURCES:
+        parser.error('--waterfall-source must be one of: ' + ', '.join(specpyramid.SOURCES))
 
     log = drlog.Log()
-    viewer = LogViewer(log)
+    viewer = LogViewer(log, args.paths)
 
     for path in args.paths:
         log.load(path)
@@ -718,6 +923,10 @@ def main():
             snap = viewer.snapshotFig(node, nfft=args.nfft)
             snap.plot(0)
 
+    for path in args.waterfall:
+        waterfall = viewer.waterfallFig(path, source=args.waterfall_source)
+        waterfall.plot()
+
     if args.demod_latency:
         metric = viewer.metricFig('demod_latency')
         metric.plot()
@@ -742,7 +951,16 @@ def main():
         metric = viewer.metricFig('sent_ms')
         metric.plot()
 
+    # Figures are built; showing them is the user's time, not startup's
+    timer.mark('figures')
+    if args.startup_report is not None:
+        timer.ready(args.startup_report)
+        if args.startup_exit:
+            stageprof.finish(prof, args)
+            return
+
     plt.show()
+    stageprof.finish(prof, args)
 
     with open('iqdatatest.txt','a+') as f:
         for i in range(0,np.real(iqsig).size):
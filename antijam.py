@@ -0,0 +1,307 @@
+# ADAPTIVE CHANNEL AVOIDANCE
+#
+# Asyncio control task for the radio launcher. Spectrum snapshots are pushed
+# onto a queue as they are captured, each one is scored per channel with the
+# jammer detector from utils/jamdetect.py, and when the set of jammed
+# channels changes a new nchannels x nslots schedule that leaves them empty
+# is built with schedule.py and installed with radio.installMACSchedule.
+#
+# Channel state has hysteresis so the schedule does not flap: a channel is
+# blocked only after its smoothed score stays above `block` for `hold_on`
+# snapshots, and unblocked only after it stays below `unblock` for
+# `hold_off` snapshots. Reinstalls are also at least `min_interval` seconds
+# apart.
+#
+# Every reinstall records the time from the arrival of the snapshot that
+# triggered it to the schedule being installed; the initial install, which
+# no snapshot triggered, is not counted.
+#
+# Run `python antijam.py` to exercise the controller against LocalRadio, a
+# stand-in for dragon.radio.Radio with a synthetic jammer.
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+import jamdetect
+import schedule
+
+logger = logging.getLogger('antijam')
+
+Snapshot = collections.namedtuple('Snapshot', ['timestamp', 'fs', 'iq', 'selftx', 'arrival'])
+Snapshot.__doc__ = """A spectrum snapshot queued for the controller.
+
+    timestamp   Snapshot timestamp
+    fs          Sample rate
+    iq          complex64 samples
+    selftx      Structured array of known transmissions (start, end, fc, fs,
+                is_local) or None
+    arrival     time.monotonic() when the snapshot was queued
+"""
+
+Reinstall = collections.namedtuple('Reinstall', ['arrival', 'installed', 'blocked', 'schedule'])
+
+SELFTX_DTYPE = np.dtype([('start', '<i8'), ('end', '<i8'), ('fc', '<f8'),
+                         ('fs', '<f8'), ('is_local', 'u1')])
+
+class ChannelAvoidance:
+    """Score channels from spectrum snapshots and reinstall the MAC schedule.
+
+    Parameters:
+        radio       Radio (or stand-in) with channels, net.nodes and
+                    installMACSchedule
+        queue       asyncio.Queue of Snapshot
+        nslots      Number of time slots in the schedule
+        block       Smoothed score at or above which a channel is jammed
+        unblock     Smoothed score at or below which a channel is clear
+        hold_on     Snapshots a channel must stay jammed before blocking
+        hold_off    Snapshots a channel must stay clear before unblocking
+        min_interval    Minimum seconds between schedule reinstalls
+        smoothing   EWMA weight of the newest score
+        detector    jamdetect.JamDetector (default: over radio.channels)
+        schedule_fn Function (nodes, nchannels, nslots, blocked) -> schedule
+        nodes       Node IDs to schedule (default: radio.net.nodes)
+    """
+    def __init__(self, radio, queue, nslots=10, block=0.5, unblock=0.1,
+                 hold_on=2, hold_off=5, min_interval=1.0, smoothing=0.5,
+                 detector=None, schedule_fn=schedule.tdma, nodes=None):
+        self.radio = radio
+        self.queue = queue
+        self._nodes = None if nodes is None else list(nodes)
+        self.nslots = nslots
+        self.block = block
+        self.unblock = unblock
+        self.hold_on = hold_on
+        self.hold_off = hold_off
+        self.min_interval = min_interval
+        self.smoothing = smoothing
+        self.schedule_fn = schedule_fn
+
+        channels = [jamdetect.Channel(c.fc, c.bw) for c in radio.channels]
+        self.nchannels = len(channels)
+        self.detector = detector or jamdetect.JamDetector(channels=channels)
+
+        self.score = np.zeros(self.nchannels)
+        self.blocked = set()
+        self._over = np.zeros(self.nchannels, dtype=int)
+        self._under = np.zeros(self.nchannels, dtype=int)
+        self._last_install = None
+
+        self.reinstalls = []
+
+    @property
+    def nodes(self):
+        if self._nodes is not None:
+            return self._nodes
+        return sorted(self.radio.net.nodes)
+
+    def update(self, snapshot):
+        """Score a snapshot and return the new set of blocked channels"""
+        det = self.detector.process(snapshot.timestamp, snapshot.fs,
+                                    snapshot.iq, snapshot.selftx)
+        if len(det.t) == 0:
+            return self.blocked
+
+        # Fraction of detection windows in which each channel was jammed
+        score = det.jammed.mean(axis=0)
+        self.score = self.smoothing*score + (1 - self.smoothing)*self.score
+
+        over = self.score >= self.block
+        under = self.score <= self.unblock
+        self._over = np.where(over, self._over + 1, 0)
+        self._under = np.where(under, self._under + 1, 0)
+
+        blocked = set(self.blocked)
+        blocked |= set(np.flatnonzero(self._over >= self.hold_on).tolist())
+        blocked -= set(np.flatnonzero(self._under >= self.hold_off).tolist())
+
+        # Never block every channel; keep the least jammed one
+        if len(blocked) == self.nchannels:
+            blocked.discard(int(np.argmin(self.score)))
+
+        return blocked
+
+    def install(self, blocked, arrival=None):
+        """Compute and install a schedule avoiding blocked channels. arrival
+        is that of the snapshot that triggered the install, or None for an
+        install of our own, like the initial schedule."""
+        sched = self.schedule_fn(self.nodes, self.nchannels, self.nslots, blocked)
+        self.radio.installMACSchedule(sched)
+
+        installed = time.monotonic()
+        self.blocked = blocked
+        self._last_install = installed
+        self.reinstalls.append(Reinstall(arrival, installed, sorted(blocked), sched))
+
+        if arrival is None:
+            logger.info('Installed schedule avoiding channels %s', sorted(blocked))
+        else:
+            logger.info('Installed schedule avoiding channels %s (%.3f ms after snapshot)',
+                        sorted(blocked), 1e3*(installed - arrival))
+
+    async def run(self):
+        """Consume snapshots until cancelled"""
+        try:
+            while True:
+                snapshot = await self.queue.get()
+                blocked = self.update(snapshot)
+
+                if blocked != self.blocked:
+                    now = time.monotonic()
+                    if self._last_install is None or now - self._last_install >= self.min_interval:
+                        self.install(blocked, snapshot.arrival)
+        except asyncio.CancelledError:
+            return
+
+    def latency_report(self):
+        """Snapshot-arrival-to-reinstall latency statistics in milliseconds,
+        over the reinstalls snapshots triggered"""
+        lat = np.array([1e3*(r.installed - r.arrival) for r in self.reinstalls
+                        if r.arrival is not None])
+        if len(lat) == 0:
+            return {'reinstalls': 0}
+
+        return {'reinstalls': len(lat),
+                'latency_p50_ms': float(np.percentile(lat, 50)),
+                'latency_p95_ms': float(np.percentile(lat, 95)),
+                'latency_max_ms': float(np.max(lat))}
+
+def snapshot_parts(snapshot):
+    """Convert a dragonradio snapshot to (fs, list of slot sample arrays,
+    selftx), without copying the samples"""
+    slots = list(snapshot.slots)
+    fs = slots[0].fs if slots else 0
+    selftx = np.array([(e.start, e.end, e.fc, e.fs, e.is_local) for e in snapshot.selftx],
+                      dtype=SELFTX_DTYPE)
+    return fs, [np.asarray(s.data, dtype=np.complex64) for s in slots], selftx
+
+async def snapshot_source(radio, queue, period, duration, ring=None, log_snapshots=-1):
+    """Collect snapshots from the radio and hand each one to every consumer.
+
+    This stands in for radio.snapshotLogger() when channel avoidance or the
+    snapshot ring is on. Each snapshot is queued as a Snapshot for the
+    controller if queue is not None, published to ring (a
+    snapring.SnapshotPublisher) if it is not None, and logged if the radio
+    has a logger and fewer than log_snapshots have been logged (all if
+    negative, none if 0).
+    """
+    count = 0
+    try:
+        while True:
+            await asyncio.sleep(period)
+            radio.snapshot_collector.start()
+            await asyncio.sleep(duration)
+            snapshot = radio.snapshot_collector.finish()
+            if snapshot is None:
+                continue
+
+            # Converted once for all consumers
+            fs, iqs, selftx = snapshot_parts(snapshot)
+
+            if queue is not None:
+                iq = np.concatenate(iqs) if iqs else np.empty(0, np.complex64)
+                queue.put_nowait(Snapshot(snapshot.timestamp, fs, iq, selftx, time.monotonic()))
+
+            if ring is not None:
+                ring.publish(snapshot.timestamp, fs, iqs, selftx)
+
+            if getattr(radio, 'logger', None) and (log_snapshots < 0 or count < log_snapshots):
+                radio.logger.logSnapshot(snapshot)
+                count += 1
+    except asyncio.CancelledError:
+        return
+
+class LocalRadio:
+    """Stand-in for dragon.radio.Radio for exercising the controller.
+
+    Provides channels, net.addNode/net.nodes, installMACSchedule and
+    my_schedule, and synthesizes snapshots with a tone jammer on a chosen
+    channel.
+    """
+    LocalChannel = collections.namedtuple('LocalChannel', ['fc', 'bw'])
+
+    class Net:
+        def __init__(self):
+            self.nodes = {}
+
+        def addNode(self, node_id):
+            self.nodes[node_id] = node_id
+            return node_id
+
+    def __init__(self, nchannels=10, fs=1e6, seed=0):
+        bw = fs/nchannels
+        self.fs = fs
+        self.channels = [self.LocalChannel(-fs/2 + (i + 0.5)*bw, bw) for i in range(nchannels)]
+        self.net = LocalRadio.Net()
+        self.my_schedule = None
+        self.schedules = []
+        self.jammed_channel = None
+        self.rng = np.random.default_rng(seed)
+
+    def installMACSchedule(self, sched):
+        self.my_schedule = np.asarray(sched)
+        self.schedules.append(self.my_schedule)
+
+    def snapshot(self, timestamp, nsamples=65536):
+        """Synthesize a snapshot: noise plus a tone on jammed_channel"""
+        iq = 0.01*(self.rng.standard_normal(nsamples) + 1j*self.rng.standard_normal(nsamples))
+        if self.jammed_channel is not None:
+            fc = self.channels[self.jammed_channel].fc
+            iq += np.exp(2j*np.pi*fc/self.fs*np.arange(nsamples))
+        return Snapshot(timestamp, self.fs, iq.astype(np.complex64), None, time.monotonic())
+
+async def _demo(radio, controller, nsnapshots, period, jam_at, jam_channel):
+    task = asyncio.ensure_future(controller.run())
+    for i in range(nsnapshots):
+        if i == jam_at:
+            radio.jammed_channel = jam_channel
+        controller.queue.put_nowait(radio.snapshot(i*period))
+        await asyncio.sleep(period)
+    task.cancel()
+    await task
+
+def main():
+    parser = argparse.ArgumentParser(description='Exercise channel avoidance against a local stand-in radio.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', action='store', type=int, dest='num_nodes', default=3,
+                        help='set number of nodes in network')
+    parser.add_argument('--channels', action='store', type=int, default=10,
+                        help='number of channels')
+    parser.add_argument('--snapshots', action='store', type=int, default=40,
+                        help='number of snapshots to feed')
+    parser.add_argument('--period', action='store', type=float, default=0.01,
+                        help='seconds between snapshots')
+    parser.add_argument('--jam-channel', action='store', type=int, default=3,
+                        help='channel the jammer sits on')
+    parser.add_argument('--jam-at', action='store', type=int, default=10,
+                        help='snapshot at which the jammer turns on')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    radio = LocalRadio(nchannels=args.channels)
+    for i in range(args.num_nodes):
+        radio.net.addNode(i+1)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    controller = ChannelAvoidance(radio, asyncio.Queue(), min_interval=0)
+    controller.install(set())
+    loop.run_until_complete(_demo(radio, controller, args.snapshots, args.period,
+                                  args.jam_at, args.jam_channel))
+    loop.close()
+
+    print(radio.my_schedule)
+    print(controller.latency_report())
+
+    return 0 if args.jam_channel in controller.blocked else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
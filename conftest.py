@@ -0,0 +1,2 @@
+# The radio launcher, not a test
+collect_ignore = ['test_radio.py']
@@ -0,0 +1,419 @@
+# ASYNCIO CONSOLE
+#
+# A Python console served by the launcher's event loop, so the radio's
+# control tasks (snapshot logger, channel avoidance, ...) keep running while
+# someone inspects radio.my_schedule or installs a new schedule.
+# IPython.embed() instead stops the loop for as long as the shell is open.
+#
+# The console reads stdin, or clients of a Unix socket, from the loop
+# without blocking. Each complete statement is compiled and run on the loop
+# thread between task steps, so it can touch the radio and asyncio objects
+# without locks. On Python 3.8+ statements may use top-level await:
+#
+#   >>> await asyncio.sleep(5)      # tasks keep running meanwhile
+#
+# A statement holds the loop for as long as it runs without awaiting; that
+# is the jitter the console adds to the other tasks. Every statement (and
+# every step of an awaiting statement) is timed, summary() reports the
+# distribution and the bench command measures the lag a periodic task sees
+# with and without an operator typing.
+#
+# Ctrl-C discards the current input or cancels an awaiting statement. It
+# cannot interrupt a statement stuck in a loop that never awaits, since the
+# loop runs signal handlers between callbacks.
+#
+# Usage:
+#   python3 test_radio.py --console
+#   python3 test_radio.py --console-socket /tmp/radio.sock
+#   socat READLINE UNIX-CONNECT:/tmp/radio.sock
+#   python console.py bench
+import argparse
+import ast
+import asyncio
+import builtins
+import code
+import contextlib
+import logging
+import os
+import sys
+import time
+import traceback
+import types
+
+import numpy as np
+
+logger = logging.getLogger('console')
+
+BANNER = 'Python {} console on the radio event loop; control tasks keep running.\n' \
+         'Names: {}'
+
+PS1 = '>>> '
+PS2 = '... '
+
+# Available from Python 3.8
+TOP_LEVEL_AWAIT = getattr(ast, 'PyCF_ALLOW_TOP_LEVEL_AWAIT', 0)
+
+class _Output:
+    """File-like object passing writes to a session's write function"""
+    def __init__(self, write):
+        self.write = write
+
+    def flush(self):
+        pass
+
+class _Stepper:
+    """Coroutine wrapper that redirects output to the session and times each
+    step of an awaiting statement"""
+    __slots__ = ['coro', 'console']
+
+    def __init__(self, coro, console):
+        self.coro = coro
+        self.console = console
+
+    def send(self, value):
+        with self.console.running():
+            return self.coro.send(value)
+
+    def throw(self, *args):
+        with self.console.running():
+            return self.coro.throw(*args)
+
+    def close(self):
+        return self.coro.close()
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+class Console(code.InteractiveConsole):
+    """One console session.
+
+    Parameters:
+        namespace   Globals for the session's statements
+        write       Function writing session output
+        blocked     List to append each statement's blocking time to
+    """
+    def __init__(self, namespace, write, blocked=None):
+        # FunctionType, unlike exec, does not add builtins to the globals
+        namespace.setdefault('__builtins__', builtins)
+        # For top-level await, as in the usage above
+        namespace.setdefault('asyncio', asyncio)
+        super().__init__(namespace)
+        self.compile.compiler.flags |= TOP_LEVEL_AWAIT
+        self.out = _Output(write)
+        self.blocked = [] if blocked is None else blocked
+        self.pending = None
+        self.exited = False
+
+    def write(self, data):
+        self.out.write(data)
+
+    def showtraceback(self):
+        """Display the exception that just occurred, from the statement on.
+
+        This module's frames (runcode, and the _Stepper an awaiting
+        statement runs in) are left out.
+        """
+        typ, value, tb = sys.exc_info()
+        while tb is not None and tb.tb_frame.f_code.co_filename == __file__:
+            tb = tb.tb_next
+        sys.last_type, sys.last_value, sys.last_traceback = typ, value, tb
+        if sys.excepthook is sys.__excepthook__:
+            self.write(''.join(traceback.format_exception(typ, value, tb)))
+        else:
+            sys.excepthook(typ, value, tb)
+
+    @contextlib.contextmanager
+    def running(self):
+        """Run code on behalf of the session, timing it and redirecting its
+        output"""
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(self.out), contextlib.redirect_stderr(self.out):
+                yield
+        finally:
+            self.blocked.append(time.perf_counter() - start)
+
+    def runcode(self, code):
+        func = types.FunctionType(code, self.locals)
+        try:
+            with self.running():
+                result = func()
+        except SystemExit:
+            self.exited = True
+        except BaseException:
+            self.showtraceback()
+        else:
+            if asyncio.iscoroutine(result):
+                self.pending = asyncio.ensure_future(_Stepper(result, self))
+
+    async def _wait_pending(self):
+        try:
+            await self.pending
+        except asyncio.CancelledError:
+            # Interrupted by Ctrl-C, or the launcher is shutting down
+            if not self.pending.cancelled():
+                raise
+            self.write('KeyboardInterrupt\n')
+        except SystemExit:
+            self.exited = True
+        except BaseException:
+            self.showtraceback()
+        finally:
+            self.pending = None
+
+    def interrupt(self):
+        """Handle Ctrl-C: cancel an awaiting statement or discard input"""
+        if self.pending is not None:
+            self.pending.cancel()
+        else:
+            self.resetbuffer()
+            self.write('\nKeyboardInterrupt\n' + PS1)
+
+    async def interact(self, reader, banner=None):
+        """Run the session until EOF or exit() on reader, a StreamReader"""
+        if banner:
+            self.write(banner + '\n')
+        more = False
+        try:
+            while not self.exited:
+                self.write(PS2 if more else PS1)
+                line = await reader.readline()
+                if not line:
+                    self.write('\n')
+                    break
+                more = self.push(line.decode(errors='replace').rstrip('\r\n'))
+                if self.pending is not None:
+                    await self._wait_pending()
+        except asyncio.CancelledError:
+            if self.pending is not None:
+                self.pending.cancel()
+            return
+
+def stdin_reader(loop, fd=0):
+    """StreamReader fed from fd by the loop.
+
+    Uses add_reader rather than connect_read_pipe, which would make the
+    terminal non-blocking for stdout too, and large prints would then fail.
+    """
+    reader = asyncio.StreamReader(loop=loop)
+
+    def readable():
+        data = os.read(fd, 65536)
+        if data:
+            reader.feed_data(data)
+        else:
+            loop.remove_reader(fd)
+            reader.feed_eof()
+
+    loop.add_reader(fd, readable)
+    return reader
+
+def _ms(x):
+    if len(x) == 0:
+        return {}
+    x = 1e3*np.asarray(x)
+    return {'p50_ms': float(np.percentile(x, 50)),
+            'p99_ms': float(np.percentile(x, 99)),
+            'max_ms': float(x.max())}
+
+class ConsoleServer:
+    """Console sessions on stdin and/or a Unix socket, served by the loop.
+
+    Parameters:
+        loop        Event loop
+        namespace   Names available in every session
+        stdin       Serve a session on stdin
+        path        Serve sessions to clients of a Unix socket at path
+        on_exit     Called when the stdin session ends (EOF or exit())
+    """
+    def __init__(self, loop, namespace, stdin=True, path=None, on_exit=None):
+        self.loop = loop
+        self.namespace = namespace
+        self.stdin = stdin
+        self.path = path
+        self.on_exit = on_exit
+        self.blocked = []
+        self.sessions = set()
+        self.tasks = []
+        self.server = None
+        self.console = None
+
+    def banner(self):
+        names = ', '.join(sorted(k for k in self.namespace if not k.startswith('_')))
+        return BANNER.format(sys.version.split()[0], names)
+
+    def start(self):
+        if self.stdin:
+            self.console = Console(self.namespace, self._write_stdout, self.blocked)
+            self.tasks.append(asyncio.ensure_future(self._stdin_session(), loop=self.loop))
+        if self.path:
+            self.tasks.append(asyncio.ensure_future(self._serve(), loop=self.loop))
+
+    @staticmethod
+    def _write_stdout(data):
+        sys.__stdout__.write(data)
+        sys.__stdout__.flush()
+
+    async def _stdin_session(self):
+        reader = stdin_reader(self.loop)
+        try:
+            await self.console.interact(reader, self.banner())
+        finally:
+            self.loop.remove_reader(0)
+        # The operator left (rather than the session being cancelled): stop
+        # the radio, as leaving IPython.embed() does
+        if (self.console.exited or reader.at_eof()) and self.on_exit is not None:
+            self.on_exit()
+
+    async def _serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._client, path=self.path)
+        logger.info('Console listening on %s', self.path)
+
+    async def _client(self, reader, writer):
+        console = Console(self.namespace, lambda data: writer.write(data.encode()),
+                          self.blocked)
+        self.sessions.add(console)
+        try:
+            await console.interact(reader, self.banner())
+        finally:
+            self.sessions.discard(console)
+            writer.close()
+
+    def interrupt(self):
+        """Ctrl-C: interrupt the stdin session"""
+        if self.console is not None:
+            self.console.interrupt()
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for console in list(self.sessions):
+            if console.pending is not None:
+                console.pending.cancel()
+        if self.server is not None:
+            self.server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.server = None
+
+    def summary(self):
+        """How long statements held the loop"""
+        return dict(statements=len(self.blocked), **_ms(self.blocked))
+
+def add_arguments(parser):
+    """Add the launcher's console options to an argparse parser"""
+    parser.add_argument('--console', action='store_true',
+        help='run a Python console on stdin alongside the event loop')
+    parser.add_argument('--console-socket', action='store',
+        default=None, dest='console_socket', metavar='PATH',
+        help='serve Python consoles to clients of a Unix socket at PATH')
+
+def from_config(loop, config, namespace, on_exit=None):
+    """Create a ConsoleServer from the launcher's console options, or None"""
+    if not config.console and not config.console_socket:
+        return None
+    return ConsoleServer(loop, namespace, stdin=config.console,
+                         path=config.console_socket, on_exit=on_exit)
+
+#
+# Jitter benchmark
+#
+
+# What an operator might type, one statement every `pace` seconds
+SCRIPT = [
+    'import schedule',
+    'sched = schedule.tdma(range(1, 51), 10, 10)',
+    'sched',
+    'sched.shape, (sched == 3).sum()',
+    'sched = schedule.hybrid(range(1, 51), 10, 10, blocked=[2, 5])',
+    'schedule.validate(sched, range(1, 51), blocked=[2, 5])',
+    'import numpy as np',
+    'x = np.random.standard_normal(1 << 16)',
+    'abs(np.fft.fft(x)).max()',
+    'await asyncio.sleep(0.2)',
+    'for i in range(3):',
+    '    print(i, sched[:, i])',
+    '',
+    'sorted(k for k in globals() if not k.startswith("_"))[:5]',
+]
+
+async def _periodic(period, late):
+    """Periodic task on absolute deadlines, recording how late it wakes"""
+    loop = asyncio.get_event_loop()
+    due = loop.time()
+    try:
+        while True:
+            due += period
+            await asyncio.sleep(due - loop.time())
+            late.append(max(loop.time() - due, 0.0))
+    except asyncio.CancelledError:
+        return
+
+async def _operator(reader, pace, repeat):
+    for _ in range(repeat):
+        for line in SCRIPT:
+            await asyncio.sleep(pace)
+            reader.feed_data((line + '\n').encode())
+    reader.feed_eof()
+
+def bench(duration=10.0, period=0.01, pace=0.1):
+    """Lag of a periodic task without and with an operator typing into the
+    console, and how long the operator's statements held the loop"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = {}
+    for name, typing in [('idle', False), ('console', True)]:
+        late = []
+        tasks = [asyncio.ensure_future(_periodic(period, late))]
+        blocked = []
+        if typing:
+            reader = asyncio.StreamReader()
+            console = Console({'asyncio': asyncio}, lambda data: None, blocked)
+            repeat = max(1, int(duration/(pace*len(SCRIPT))))
+            tasks.append(asyncio.ensure_future(_operator(reader, pace, repeat)))
+            tasks.append(asyncio.ensure_future(console.interact(reader)))
+        loop.run_until_complete(asyncio.sleep(duration))
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        results[name] = {'lag': _ms(late), 'blocked': dict(statements=len(blocked), **_ms(blocked))}
+    loop.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the task jitter caused by the event loop console.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    p = subparsers.add_parser('bench', help='measure periodic task lag with and without console use',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-t', '--duration', type=float, default=10.0,
+                   help='seconds per run')
+    p.add_argument('--period', type=float, default=0.01,
+                   help='period of the measured task (s)')
+    p.add_argument('--pace', type=float, default=0.1,
+                   help='seconds between operator statements')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    results = bench(args.duration, args.period, args.pace)
+    for name, r in results.items():
+        print('{:<8} task lag p50 {:6.2f} ms  p99 {:6.2f} ms  max {:6.2f} ms'.format(name,
+            r['lag']['p50_ms'], r['lag']['p99_ms'], r['lag']['max_ms']))
+    b = results['console']['blocked']
+    print('{} statements held the loop p50 {:.2f} ms  p99 {:.2f} ms  max {:.2f} ms'.format(
+        b['statements'], b['p50_ms'], b['p99_ms'], b['max_ms']))
+
+if __name__ == '__main__':
+    main()
@@ -3,25 +3,34 @@
 import argparse
 import asyncio
 from concurrent.futures import CancelledError
-import IPython
-from itertools import chain,cycle,starmap
 import logging
 import os
-import random
 import signal
 import sys
 import pdb
 
-import dragonradio
-import dragon.radio
+import startup
 
-import numpy as np
+# Start timing before the heavy imports. Everything not needed by every run
+# (IPython) is imported where it is used.
+timer = startup.StartupTimer.from_argv()
+
+# --sim swaps the radio for the radiosim network simulator. Like the
+# startup flags it is looked for by hand, since it decides what to import.
+if '--sim' in sys.argv[1:]:
+	import radiosim as radiolib
+else:
+	import dragon.radio as radiolib
+
+import console
+import loopmon
+import periodic
 
 async def cancel_tasks(loop):
-	tasks = [t for t in asyncio.Task.all_tasks() if t is not asyncio.Task.current_task()]
+	tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
 	for task in tasks:
 		task.cancel()
-		await task
+	await asyncio.gather(*tasks, return_exceptions=True)
 
 	loop.stop()
 
@@ -30,7 +39,8 @@ def cancel_loop():
 	loop.create_task(cancel_tasks(loop))
 
 def main():
-	config = dragon.radio.Config()
+	timer.mark('imports')
+	config = radiolib.Config()
 	
 	parser = argparse.ArgumentParser(description='Run dragonradio.',
 		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -41,21 +51,28 @@ def main():
 	parser.add_argument('--aloha', action='store_true', dest='aloha',
 		default=False,
 		help='use slotted ALOHA MAC')
+	parser.add_argument('--sim', action='store_true', dest='sim',
+		help='run against the radiosim network simulator instead of the radio')
 	parser.add_argument('--interactive',
 		action='store_true', dest='interactive',
-		help='enter interactive shell after radio is configured')
+		help='enter IPython after radio is configured (stops the event loop; see --console)')
 	parser.add_argument('--cycle-tx-gain', action='store',
 		choices=['sequential', 'discontinuous', 'random'],
 		help='enable TX gain cycling')
 	parser.add_argument('--cycle-tx-gain-period', type=float,
 		default=10,
 		help='TX gain cycling period')
+	console.add_arguments(parser)
+	loopmon.add_arguments(parser)
+	periodic.add_arguments(parser)
+	startup.add_arguments(parser)
 
 	# Parse arguments
 	try:
 		parser.parse_args(namespace=config)
 	except SystemExit as ex:
 		return ex.code
+	timer.mark('arguments')
 	
 	logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
 		level=config.loglevel)
@@ -64,7 +81,8 @@ def main():
 		config.log_sources += ['log_recv_packets','log_sent_packets','log_events']
 	
 	# Create radio object
-	radio = dragon.radio.Radio(config)
+	radio = radiolib.Radio(config)
+	timer.mark('radio')
 
 	# Configure MAC objects
 	# The schedule will be nchannels x nslots, so each row represents
@@ -100,6 +118,7 @@ def main():
 		radio.configureALOHA()
 	else:
 		radio.configureSimpleMACSchedule()
+	timer.mark('schedule')
 
 
 	#
@@ -107,25 +126,74 @@ def main():
 	# event loop.
 	#
 	if config.interactive:
+		import IPython
+
+		if config.startup_report is not None:
+			timer.ready(config.startup_report)
 		IPython.embed()
 	else:
 		loop = asyncio.get_event_loop()
 
+		# Instrument the loop. The launcher's own tasks are started with
+		# spawn, so the monitor times each of their steps.
+		monitor = loopmon.from_config(loop, config)
+		if monitor is not None:
+			monitor.install()
+			spawn = monitor.create_task
+		else:
+			spawn = loop.create_task
+
+		# The simulator advances in real time on the loop, like the radio
+		# would on its own threads
+		if config.sim:
+			loop.create_task(radio.start())
+
 		if config.log_snapshots != 0:
-			loop.create_task(radio.snapshotLogger())
+			spawn(radio.snapshotLogger())
+
+		# Periodic control actions run at absolute deadlines on slot
+		# boundaries rather than from sleep loops, which drift
+		periodic_sched = periodic.from_config(loop, config)
+		periodic.add_cycle_tx_gain(periodic_sched, radio, config)
 
-#		if config.cycle_tx_gain is not None:
-#			loop.create_task(cycle_tx_gain(radio,
-#				config.cycle_tx_gain_period,
-#				cycle_algorithm(config.cycle_tx_gain)))
+		# Serve a console from the loop, so the tasks above keep running while
+		# someone inspects the radio
+		shell = console.from_config(loop, config, {'radio': radio, 'config': config,
+			'loop': loop, 'monitor': monitor, 'periodic': periodic_sched},
+			on_exit=cancel_loop)
+		if shell is not None:
+			shell.start()
 
 		for sig in [signal.SIGINT, signal.SIGTERM]:
 			loop.add_signal_handler(sig, cancel_loop)
+		# Ctrl-C belongs to the console; SIGTERM still stops the radio
+		if shell is not None and config.console:
+			loop.add_signal_handler(signal.SIGINT, shell.interrupt)
+
+		# The radio is transmit-ready once the loop starts running its tasks
+		if config.startup_report is not None:
+			loop.call_soon(timer.ready, config.startup_report,
+				cancel_loop if config.startup_exit else None)
 
 		try:
 			loop.run_forever()
 		finally:
+			if shell is not None:
+				shell.close()
+			if monitor is not None:
+				monitor.close()
+			periodic_sched.close()
 			loop.close()
+			if config.sim:
+				radio.close()
+
+		if config.sim:
+			logging.info('Simulation: %s', radio.stats())
+		if shell is not None:
+			logging.info('Console: %s', shell.summary())
+		if monitor is not None:
+			logging.info('Event loop: %s', monitor.summary())
+		logging.info('Periodic jobs: %s', periodic_sched.summary())
 
 	return 0
 
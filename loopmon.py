@@ -0,0 +1,586 @@
+# EVENT LOOP INSTRUMENTATION
+#
+# Instrumentation for the radio launcher's asyncio loop:
+#
+#   loop lag        a probe task asks to wake every `probe` seconds and
+#                   records how late it actually woke; a wakeup `slow`
+#                   seconds or more late is counted as a stall, since
+#                   something held the loop that long
+#   task steps      tasks the launcher starts with mon.create_task (the
+#                   snapshot logger, the controller) are wrapped so each step
+#                   (the code between two awaits) is timed, and so is the
+#                   wakeup delay from the future it waited on completing to
+#                   the task running again; a step taking `slow` seconds or
+#                   more is counted and logged as a slow callback
+#   sampling        optionally, a sampler thread looks at the loop every
+#                   `sample` seconds and counts which task (or callback) is
+#                   running, which gives every task's share of wall time to
+#                   within the sampling error, and names the other slow
+#                   callbacks: one seen in consecutive samples for `slow`
+#                   seconds or more (to within one sample period)
+#
+# Nothing else on the loop is wrapped or patched, so other tasks and
+# callbacks run at full speed; the cost is the lag probe, the steps of the
+# launcher's own tasks, which are few, and, if sampling, the sampler
+# thread's wakeups. A callback is identified by the frame of the
+# Handle._run call running it: the same frame object in consecutive samples
+# is the same callback still running.
+#
+# Tasks are grouped by the qualified name of their coroutine, e.g.
+# Radio.snapshotLogger or snapshot_source, so snapshot logging shows up as
+# its own row.
+#
+# Every `interval` seconds the statistics of the last interval are appended
+# to a JSON lines file, or written as a Prometheus text file (replaced
+# atomically, for the node exporter's textfile collector) if the path ends
+# in .prom. The monitor's overhead is the time the probe, the task wrapper
+# and the writer spend on the loop plus the CPU time of the sampler thread,
+# as a fraction of wall time.
+#
+# Usage:
+#   mon = loopmon.LoopMonitor(loop, 'loop.jsonl')
+#   mon.install()        # from the loop's thread
+#   mon.create_task(radio.snapshotLogger())
+#   loop.run_forever()
+#   mon.close()
+#
+#   python loopmon.py    CPU cost of the monitor on a synthetic workload
+import asyncio
+import asyncio.events
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import weakref
+
+import numpy as np
+
+logger = logging.getLogger('loopmon')
+
+# Code of the method running every callback and task step
+_HANDLE_RUN = asyncio.events.Handle._run.__code__
+
+class _Stats:
+    """Per-task-name statistics for one interval plus running totals. run,
+    wakeup and steps are only kept for tasks started with create_task."""
+    __slots__ = ['samples', 'samples_total', 'slow', 'slow_max',
+                 'run', 'wakeup', 'steps', 'run_total', 'steps_total']
+
+    def __init__(self):
+        self.samples = 0
+        self.samples_total = 0
+        self.slow = 0
+        self.slow_max = 0.0
+        self.run = []
+        self.wakeup = []
+        self.steps = 0
+        self.run_total = 0.0
+        self.steps_total = 0
+
+    def reset(self):
+        self.samples = 0
+        self.slow = 0
+        self.slow_max = 0.0
+        self.run = []
+        self.wakeup = []
+        self.steps = 0
+
+class _TimedCoroutine:
+    """Coroutine wrapper timing each step and the wakeup delay before it"""
+    __slots__ = ['coro', 'mon', 'name', 'stats', 'ready']
+
+    def __init__(self, coro, mon, name):
+        self.coro = coro
+        self.mon = mon
+        self.name = name
+        self.stats = mon.stats[name]
+        self.ready = None
+
+    def _done(self, fut):
+        self.ready = time.perf_counter()
+
+    def _step(self, fn, *args):
+        t0 = time.perf_counter()
+        if self.ready is not None:
+            self.stats.wakeup.append(t0 - self.ready)
+            self.ready = None
+        start = time.perf_counter()
+        try:
+            result = fn(*args)
+        finally:
+            end = time.perf_counter()
+            stats = self.stats
+            stats.run.append(end - start)
+            stats.steps += 1
+            if end - start >= self.mon.slow:
+                self.mon._slow(self.name, end - start)
+        # A future yielded to the task wakes it when done
+        if isinstance(result, asyncio.Future):
+            result.add_done_callback(self._done)
+        self.mon.own += (start - t0) + (time.perf_counter() - end)
+        return result
+
+    def send(self, value):
+        return self._step(self.coro.send, value)
+
+    def throw(self, *args):
+        return self._step(self.coro.throw, *args)
+
+    def close(self):
+        return self.coro.close()
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def __repr__(self):
+        return repr(self.coro)
+
+def _callback_name(frame):
+    """Name of the callback running under Handle._run, and that call's frame,
+    from the loop thread's innermost frame; (None, None) if the loop is not
+    running a callback"""
+    child = None
+    while frame is not None:
+        if frame.f_code is _HANDLE_RUN:
+            if child is None:
+                return '<builtin>', frame
+            code = child.f_code
+            return getattr(code, 'co_qualname', code.co_name), frame
+        child = frame
+        frame = frame.f_back
+    return None, None
+
+class LoopMonitor:
+    """Measure loop lag, the steps of the launcher's tasks and, by sampling,
+    per-task busy time, and write them out periodically.
+
+    Parameters:
+        loop        Event loop
+        path        Metrics file (.prom for Prometheus text, else JSON lines)
+        interval    Seconds between metrics writes
+        probe       Seconds between loop lag probes
+        slow        Callbacks or task steps at least this long are slow
+        sample      Seconds between samples of what the loop is running, or
+                    None not to sample
+    """
+    def __init__(self, loop, path=None, interval=5.0, probe=0.1, slow=0.05,
+                 sample=None):
+        self.loop = loop
+        self.path = path
+        self.interval = interval
+        self.probe = probe
+        self.slow = slow
+        self.sample = sample
+
+        self.stats = collections.defaultdict(_Stats)
+        self.lag = []
+        self.lag_max_total = 0.0
+        self.slow_callbacks = collections.Counter()
+        self.slow_total = 0
+        self.stalls = 0
+        self.stalls_total = 0
+        self.samples = 0
+        self.idle = 0
+        # Time spent on the loop thread, and CPU time of the sampler thread
+        self.own = 0.0
+        self.sampler_cpu = 0.0
+        self.start = None
+        self.last = None
+        self.tasks = []
+
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+        self._tid = None
+        # Names of timed tasks, whose coroutine is the wrapper
+        self._names = weakref.WeakKeyDictionary()
+        # Callback in progress: (Handle._run frame, name, first seen, last seen)
+        self._current = None
+
+    def _slow(self, name, dt):
+        # Called from the sampler with the lock held, and from the loop
+        self.stats[name].slow += 1
+        self.stats[name].slow_max = max(self.stats[name].slow_max, dt)
+        self.slow_callbacks[name] += 1
+        self.slow_total += 1
+        # Log each offender once per interval
+        if self.slow_callbacks[name] == 1:
+            logger.warning('Slow callback %s took %.1f ms', name, 1e3*dt)
+
+    def install(self):
+        """Start the monitor. Call from the thread that runs the loop."""
+        self.start = self.last = time.perf_counter()
+        self._tid = threading.get_ident()
+        self.tasks = [asyncio.ensure_future(self._probe_lag(), loop=self.loop),
+                      asyncio.ensure_future(self._writer(), loop=self.loop)]
+        self._stopping = False
+        if self.sample:
+            self._thread = threading.Thread(target=self._sampler, name='loopmon', daemon=True)
+            self._thread.start()
+
+    def create_task(self, coro):
+        """Create a task on the loop whose steps and wakeups are timed"""
+        name = getattr(coro, '__qualname__', None) or type(coro).__name__
+        task = self.loop.create_task(_TimedCoroutine(coro, self, name))
+        self._names[task] = name
+        return task
+
+    def uninstall(self):
+        if self._thread is not None:
+            self._stopping = True
+            self._thread.join()
+            self._thread = None
+        self._current = None
+
+    def _sampler(self):
+        cpu0 = time.thread_time()
+        while not self._stopping:
+            time.sleep(self.sample)
+            frame = sys._current_frames().get(self._tid)
+            task = asyncio.current_task(self.loop)
+            now = time.perf_counter()
+            name, run = _callback_name(frame)
+            del frame
+            # Steps of timed tasks are checked by their wrapper
+            timed = False
+            if task is not None:
+                name = self._names.get(task)
+                timed = name is not None
+                if name is None:
+                    coro = task.get_coro()
+                    name = getattr(coro, '__qualname__', None) or type(coro).__name__
+
+            with self._lock:
+                self.samples += 1
+                cur = self._current
+                if cur is not None and run is not cur[0]:
+                    # The previous callback finished since the last sample.
+                    # Seen more than once it ran at least as long as it was
+                    # seen for, and less than one sample period longer.
+                    if cur[3] > cur[2] and cur[3] - cur[2] + self.sample >= self.slow:
+                        self._slow(cur[1], cur[3] - cur[2] + self.sample)
+                    cur = self._current = None
+                if run is None:
+                    self.idle += 1
+                else:
+                    self.stats[name].samples += 1
+                    if timed:
+                        pass
+                    elif cur is None:
+                        self._current = (run, name, now, now)
+                    else:
+                        self._current = (run, name, cur[2], now)
+                self.sampler_cpu = time.thread_time() - cpu0
+
+    async def _probe_lag(self):
+        loop = self.loop
+        try:
+            while True:
+                due = loop.time() + self.probe
+                await asyncio.sleep(self.probe)
+                t = time.perf_counter()
+                lag = max(loop.time() - due, 0.0)
+                self.lag.append(lag)
+                self.lag_max_total = max(self.lag_max_total, lag)
+                if lag >= self.slow:
+                    self.stalls += 1
+                    self.stalls_total += 1
+                self.own += time.perf_counter() - t
+        except asyncio.CancelledError:
+            return
+
+    async def _writer(self):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                self.write()
+        except asyncio.CancelledError:
+            return
+
+    def overhead(self, now=None):
+        """Monitor cost as a fraction of wall time since install()"""
+        now = time.perf_counter() if now is None else now
+        elapsed = now - self.start
+        return (self.own + self.sampler_cpu)/elapsed if elapsed > 0 else 0.0
+
+    def snapshot(self):
+        """Statistics since the last snapshot; resets the interval stats"""
+        t0 = time.perf_counter()
+        now = t0
+        elapsed = now - self.last
+        self.last = now
+
+        def pct(x):
+            if len(x) == 0:
+                return {}
+            x = 1e3*np.asarray(x)
+            return {'p50_ms': float(np.percentile(x, 50)),
+                    'p99_ms': float(np.percentile(x, 99)),
+                    'max_ms': float(x.max())}
+
+        with self._lock:
+            samples = max(self.samples, 1)
+            tasks = {}
+            for name, s in self.stats.items():
+                t = tasks[name] = {'slow': s.slow,
+                                   'slow_max_ms': 1e3*s.slow_max}
+                if self.sample:
+                    s.samples_total += s.samples
+                    t.update({'samples': s.samples,
+                              'busy': s.samples/samples,
+                              'samples_total': s.samples_total})
+                if s.steps_total or s.steps:
+                    run = float(sum(s.run))
+                    s.run_total += run
+                    s.steps_total += s.steps
+                    t.update({'steps': s.steps,
+                              'run_s': run,
+                              'run': pct(s.run),
+                              'wakeup': pct(s.wakeup),
+                              'run_total_s': s.run_total,
+                              'steps_total': s.steps_total})
+                s.reset()
+            m = {'time': time.time(),
+                 'elapsed': elapsed,
+                 'lag': pct(self.lag),
+                 'lag_max_total_ms': 1e3*self.lag_max_total,
+                 'stalls': self.stalls,
+                 'stalls_total': self.stalls_total,
+                 'slow_callbacks': dict(self.slow_callbacks),
+                 'slow_total': self.slow_total,
+                 'tasks': tasks}
+            if self.sample:
+                m.update({'busy': 1 - self.idle/samples,
+                          'samples': self.samples})
+            self.samples = 0
+            self.idle = 0
+            self.stalls = 0
+            self.slow_callbacks.clear()
+        self.lag = []
+
+        self.own += time.perf_counter() - t0
+        m['overhead'] = self.overhead(now)
+        return m
+
+    def write(self):
+        """Write the current interval's metrics"""
+        m = self.snapshot()
+        if self.path is None:
+            return m
+        t0 = time.perf_counter()
+        if self.path.endswith('.prom'):
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(prometheus(m))
+            os.replace(tmp, self.path)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(m) + '\n')
+        self.own += time.perf_counter() - t0
+        return m
+
+    def close(self):
+        """Stop sampling and write the final metrics"""
+        self.uninstall()
+        return self.write()
+
+    def summary(self):
+        """Totals over the whole run for logging at exit"""
+        tasks = {}
+        for name, s in self.stats.items():
+            t = tasks[name] = {}
+            if self.sample:
+                t['busy_s'] = round(s.samples_total*self.sample, 3)
+            if s.steps_total:
+                t.update(steps=s.steps_total, run_s=round(s.run_total, 6))
+        elapsed = time.perf_counter() - self.start
+        return {'elapsed_s': elapsed,
+                'lag_max_ms': 1e3*self.lag_max_total,
+                'stalls_total': self.stalls_total,
+                'slow_total': self.slow_total,
+                'overhead': self.overhead(),
+                'tasks': tasks}
+
+def _label(s):
+    return s.replace('\\', '\\\\').replace('"', '\\"')
+
+def prometheus(m):
+    """Format a metrics snapshot as Prometheus text exposition"""
+    lines = []
+
+    def gauge(name, value, labels=None, help=None):
+        if help:
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} gauge'.format(name))
+        if value is None:
+            return
+        lbl = ''
+        if labels:
+            lbl = '{' + ','.join('{}="{}"'.format(k, _label(v)) for k, v in labels.items()) + '}'
+        lines.append('{}{} {}'.format(name, lbl, value))
+
+    gauge('loop_lag_p50_seconds', m['lag'].get('p50_ms', 0)/1e3, help='Event loop lag median')
+    gauge('loop_lag_p99_seconds', m['lag'].get('p99_ms', 0)/1e3, help='Event loop lag 99th percentile')
+    gauge('loop_lag_max_seconds', m['lag'].get('max_ms', 0)/1e3, help='Event loop lag maximum')
+    gauge('loop_slow_callbacks_total', m['slow_total'], help='Callbacks slower than the threshold')
+    gauge('loop_monitor_overhead_ratio', m['overhead'], help='Fraction of wall time spent in the monitor')
+
+    gauge('loop_stalls_total', m['stalls_total'], help='Lag probe wakeups late by the slow threshold or more')
+    if 'busy' in m:
+        gauge('loop_busy_ratio', m['busy'], help='Fraction of samples the loop was running a callback')
+
+    for key, help in [('busy', 'Fraction of wall time running the task'),
+                      ('samples_total', 'Total samples that found the task running'),
+                      ('slow', 'Slow steps of the task in the interval'),
+                      ('run_total_s', 'Total task run time'),
+                      ('steps_total', 'Total task steps')]:
+        name = 'loop_task_' + (key[:-2] + '_seconds' if key.endswith('_s') else key)
+        gauge(name, None, help=help)
+        for task, t in m['tasks'].items():
+            if key in t:
+                gauge(name, t[key], {'task': task})
+
+    for key in ['run', 'wakeup']:
+        for q in ['p50', 'p99', 'max']:
+            name = 'loop_task_{}_{}_seconds'.format(key, q)
+            gauge(name, None, help='Task {} time {}'.format(key, q))
+            for task, t in m['tasks'].items():
+                if q + '_ms' in t.get(key, {}):
+                    gauge(name, t[key][q + '_ms']/1e3, {'task': task})
+
+    return '\n'.join(lines) + '\n'
+
+def add_arguments(parser):
+    """Add the launcher's --instrument options to an argparse parser"""
+    parser.add_argument('--instrument', action='store', nargs='?',
+        const='', default=None, metavar='PATH',
+        help='write event loop metrics to PATH (.prom for Prometheus text, '
+             'else JSON lines; default loopmon.jsonl in the log directory)')
+    parser.add_argument('--instrument-interval', type=float,
+        default=5.0, dest='instrument_interval',
+        help='seconds between event loop metrics writes')
+    parser.add_argument('--instrument-slow', type=float,
+        default=0.05, dest='instrument_slow',
+        help='seconds after which a callback or task step is slow')
+    parser.add_argument('--instrument-sample', type=float,
+        default=None, dest='instrument_sample', metavar='SECONDS',
+        help='sample what the event loop is running every SECONDS, for '
+             'per-task busy time and the names of all slow callbacks')
+
+def from_config(loop, config):
+    """Create a LoopMonitor from the launcher's --instrument options, or None"""
+    if config.instrument is None:
+        return None
+    path = config.instrument or os.path.join(getattr(config, 'log_directory', None) or '.',
+                                             'loopmon.jsonl')
+    return LoopMonitor(loop, path, interval=config.instrument_interval,
+                       slow=config.instrument_slow, sample=config.instrument_sample)
+
+async def _workload(ntasks, period, work):
+    async def periodic(i):
+        x = np.random.default_rng(i).standard_normal(work)
+        try:
+            while True:
+                await asyncio.sleep(period)
+                np.fft.fft(x)
+        except asyncio.CancelledError:
+            return
+
+    return [asyncio.ensure_future(periodic(i)) for i in range(ntasks)]
+
+async def _logger(period, work):
+    """Stand-in for the snapshot logger, the task the launcher times"""
+    x = np.random.default_rng().standard_normal(work)
+    try:
+        while True:
+            await asyncio.sleep(period)
+            np.fft.fft(x)
+    except asyncio.CancelledError:
+        return
+
+def _run_workload(instrument, duration, ntasks, period, work, sample=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    mon = LoopMonitor(loop, None, sample=sample) if instrument else None
+    if mon:
+        mon.install()
+    tasks = loop.run_until_complete(_workload(ntasks, period, work))
+    create_task = mon.create_task if mon else loop.create_task
+    tasks.append(create_task(_logger(1.0, 16*work)))
+    t0 = time.process_time()
+    loop.run_until_complete(asyncio.sleep(duration))
+    cpu = time.process_time() - t0
+    for task in tasks + (mon.tasks if mon else []):
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks))
+    own = None
+    if mon:
+        mon.uninstall()
+        own = mon.summary()
+    loop.close()
+    return cpu, own
+
+def bench(duration=2.0, ntasks=20, period=0.01, work=4096, rounds=10, sample=None):
+    """CPU time of a synthetic launcher workload with and without the
+    monitor. Pairs of runs of `duration` seconds alternate which goes first,
+    and the median of the paired differences is the measured cost, which
+    keeps drifting load on the machine out of the comparison. Returns the
+    median CPU seconds per second without the monitor, the median and
+    standard error of the extra CPU seconds per second with it, and the
+    median overhead the monitor reported."""
+    base = []
+    extra = []
+    overhead = []
+    for i in range(rounds):
+        order = (False, True) if i % 2 == 0 else (True, False)
+        cpu = {}
+        for instrument in order:
+            cpu[instrument], summary = _run_workload(instrument, duration, ntasks, period,
+                                                     work, sample)
+            if summary:
+                overhead.append(summary['overhead'])
+        base.append(cpu[False]/duration)
+        extra.append((cpu[True] - cpu[False])/duration)
+    return (float(np.median(base)), float(np.median(extra)),
+            float(np.std(extra)/np.sqrt(rounds)), float(np.median(overhead)))
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Measure event loop monitor overhead on a synthetic workload.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-t', '--duration', type=float, default=2.0,
+                        help='seconds of each run')
+    parser.add_argument('--rounds', type=int, default=10,
+                        help='pairs of runs without and with the monitor')
+    parser.add_argument('--tasks', type=int, default=20,
+                        help='number of periodic tasks')
+    parser.add_argument('--period', type=float, default=0.01,
+                        help='task period (s)')
+    parser.add_argument('--work', type=int, default=4096,
+                        help='FFT size computed by each task step')
+    parser.add_argument('--sample', type=float,
+                        help='also sample the loop every SAMPLE seconds')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    base, extra, err, overhead = bench(args.duration, args.tasks, args.period, args.work,
+                                      args.rounds, args.sample)
+    print('Workload CPU:      {:.1f} ms/s'.format(1e3*base))
+    print('Reported overhead: {:.2f} ms/s ({:.2%} of the workload)'.format(
+        1e3*overhead, overhead/base))
+    print('Measured overhead: {:+.2f} ms/s +/- {:.2f} ({:+.2%} of the workload)'.format(
+        1e3*extra, 1e3*err, extra/base))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,716 @@
+# LIVE METRICS COLLECTION
+#
+# Link health for a whole multi-node run in one place, while it runs. Each
+# node logs to its own radio.h5; an agent on the node tails that log (and
+# optionally loopmon's JSON lines) and pushes compact binary deltas to one
+# collector, which merges all nodes into an in-memory time series:
+#
+#   links       per (src, dest) received packets, valid payloads and the
+#               sums and sums of squares of EVM and RSSI over the interval
+#   sent        per destination packets and bytes sent
+#   gauges      named values: loopmon's loop lag, task busy fraction and
+#               overhead, or anything the launcher sets (queue depth, ...)
+#
+# A delta only holds what changed in the last interval, as packed records
+# (26 bytes per active link); gauge names are sent once per connection and
+# referred to by number after that.
+#
+#   connection  every agent keeps one persistent TCP connection to the
+#               collector, reconnected on failure
+#   acks        the collector acks each delta; an agent keeps unacked
+#               deltas in a bounded backlog and resends them after a
+#               reconnect, and the collector drops any it has already seen
+#   retention   the collector keeps each series for a bounded time and
+#               number of points
+#
+# Usage:
+#   python metricsnet.py collect --port 5556 --print 5
+#   python metricsnet.py agent node-001/radio.h5 --collector 10.10.10.1:5556 [--loopmon loop.jsonl]
+#   python metricsnet.py test -n 4 --duration 10
+#
+# In a launcher, an Agent can run on the radio's own loop, with
+# agent.gauge('netq', len(queue)) for values that are not in the log.
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import re
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import h5py
+import numpy as np
+
+from schedist import FRAME, frame, read_frame
+
+logger = logging.getLogger('metricsnet')
+
+DEFAULT_PORT = 5556
+
+HELLO = 1
+NAMES = 2
+DELTA = 3
+ACK = 4
+
+# HELLO payload: node ID, boot ID (distinguishes agent restarts)
+HELLO_BODY = struct.Struct('<HQ')
+# ACK payload: highest delta sequence number the collector holds
+ACK_BODY = struct.Struct('<Q')
+# NAMES payload: count, then per name its ID, length and UTF-8 bytes
+NAMES_HEADER = struct.Struct('<H')
+NAME = struct.Struct('<HB')
+# DELTA payload: sequence number, wall time at the end of the interval,
+# interval length, numbers of link, sent and gauge records
+DELTA_HEADER = struct.Struct('<QddHHH')
+
+LINK = np.dtype([('src', 'u1'), ('dest', 'u1'), ('n', '<u4'), ('valid', '<u4'),
+                 ('evm_sum', '<f4'), ('evm_sq', '<f4'),
+                 ('rssi_sum', '<f4'), ('rssi_sq', '<f4')])
+SENT = np.dtype([('dest', 'u1'), ('n', '<u4'), ('bytes', '<u4')])
+GAUGE = np.dtype([('id', '<u2'), ('value', '<f4')])
+
+RECV_FIELDS = ['header_valid', 'payload_valid', 'src', 'dest', 'evm', 'rssi']
+SEND_FIELDS = ['dest', 'size']
+
+def encode_delta(seq, t, interval, links, sent, gauges):
+    return frame(DELTA, DELTA_HEADER.pack(seq, t, interval, len(links), len(sent), len(gauges)) +
+                 links.tobytes() + sent.tobytes() + gauges.tobytes())
+
+def decode_delta(payload):
+    seq, t, interval, nlinks, nsent, ngauges = DELTA_HEADER.unpack_from(payload)
+    off = DELTA_HEADER.size
+    links = np.frombuffer(payload, LINK, nlinks, off)
+    off += nlinks*LINK.itemsize
+    sent = np.frombuffer(payload, SENT, nsent, off)
+    off += nsent*SENT.itemsize
+    gauges = np.frombuffer(payload, GAUGE, ngauges, off)
+    return seq, t, interval, links, sent, gauges
+
+def encode_names(names):
+    """NAMES frame for a list of (id, name)"""
+    body = [NAMES_HEADER.pack(len(names))]
+    for i, name in names:
+        b = name.encode()[:255]
+        body.append(NAME.pack(i, len(b)) + b)
+    return frame(NAMES, b''.join(body))
+
+def decode_names(payload):
+    n, = NAMES_HEADER.unpack_from(payload)
+    off = NAMES_HEADER.size
+    out = {}
+    for _ in range(n):
+        i, size = NAME.unpack_from(payload, off)
+        off += NAME.size
+        out[i] = payload[off:off + size].decode()
+        off += size
+    return out
+
+def link_stats(recv):
+    """LINK records of a batch of 'recv' rows with valid headers"""
+    recv = recv[recv['header_valid'] != 0]
+    if len(recv) == 0:
+        return np.zeros(0, LINK)
+    key = recv['src'].astype(np.int64)*256 + recv['dest']
+    keys, inv = np.unique(key, return_inverse=True)
+    out = np.zeros(len(keys), LINK)
+    out['src'] = keys // 256
+    out['dest'] = keys % 256
+    out['n'] = np.bincount(inv, minlength=len(keys))
+    out['valid'] = np.bincount(inv, recv['payload_valid'] != 0, len(keys))
+    for k in ('evm', 'rssi'):
+        x = recv[k].astype(np.float64)
+        out[k + '_sum'] = np.bincount(inv, x, len(keys))
+        out[k + '_sq'] = np.bincount(inv, x*x, len(keys))
+    return out
+
+def sent_stats(send):
+    """SENT records of a batch of 'send' rows"""
+    if len(send) == 0:
+        return np.zeros(0, SENT)
+    dests, inv = np.unique(send['dest'], return_inverse=True)
+    out = np.zeros(len(dests), SENT)
+    out['dest'] = dests
+    out['n'] = np.bincount(inv, minlength=len(dests))
+    out['bytes'] = np.bincount(inv, send['size'].astype(np.float64), len(dests))
+    return out
+
+class LogTail:
+    """Rows appended to a log's 'recv' and 'send' datasets since the last
+    poll. The radio keeps its log open for writing, so the file is opened
+    without locking and a poll that catches it mid-write is retried on the
+    next one."""
+    def __init__(self, path):
+        self.path = path
+        self.pos = {'recv': 0, 'send': 0}
+        self.errors = 0
+
+    def poll(self, max_rows=1 << 20):
+        out = {}
+        try:
+            with h5py.File(self.path, 'r', locking=False) as f:
+                for name, fields in (('recv', RECV_FIELDS), ('send', SEND_FIELDS)):
+                    if name not in f:
+                        out[name] = None
+                        continue
+                    ds = f[name]
+                    n = min(ds.shape[0], self.pos[name] + max_rows)
+                    out[name] = ds.fields(fields)[self.pos[name]:n]
+        except (OSError, KeyError, ValueError, RuntimeError) as err:
+            self.errors += 1
+            logger.debug('Cannot read %s yet: %s', self.path, err)
+            return None, None
+        for name, rows in out.items():
+            if rows is not None:
+                self.pos[name] += len(rows)
+        return out['recv'], out['send']
+
+def _flatten(m, prefix=''):
+    """Numeric leaves of a nested dict as dotted names"""
+    for k, v in m.items():
+        name = prefix + str(k)
+        if isinstance(v, dict):
+            yield from _flatten(v, name + '.')
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            yield name, float(v)
+
+class JsonlTail:
+    """Numeric fields of the last new line of a JSON lines file (loopmon)"""
+    SKIP = ('time', 'elapsed')
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def poll(self):
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except OSError:
+            return {}
+        end = data.rfind(b'\n')
+        if end < 0:
+            return {}
+        self.offset += end + 1
+        lines = data[:end].splitlines()
+        try:
+            m = json.loads(lines[-1])
+        except ValueError:
+            return {}
+        return {'loop.' + k: v for k, v in _flatten(m) if k not in self.SKIP}
+
+def _guess_node(path):
+    m = re.search(r'node-0*(\d+)', path)
+    return int(m.group(1)) if m else 0
+
+class Agent:
+    """Push deltas of a node's metrics to the collector.
+
+    Parameters:
+        logpath     Node log to tail
+        collector   (host, port) of the collector
+        node        Node ID (default: from a node-NNN directory in logpath)
+        interval    Seconds between deltas
+        loopmon     loopmon JSON lines file to take gauges from
+        backlog     Maximum number of unacked deltas kept for resending
+        retry       Seconds between reconnection attempts
+    """
+    def __init__(self, logpath, collector, node=None, interval=1.0, loopmon=None,
+                 backlog=600, retry=0.5):
+        self.tail = LogTail(logpath)
+        self.collector = collector
+        self.node = node if node is not None else _guess_node(logpath)
+        self.interval = interval
+        self.loopmon = JsonlTail(loopmon) if loopmon else None
+        self.retry = retry
+        self.boot = time.time_ns()
+
+        self.seq = 0
+        self.backlog = collections.deque(maxlen=backlog)
+        self.acked = 0
+        self.dropped = 0
+        self.wake = asyncio.Event()
+
+        self.names = {}
+        self._gauges = {}
+        self._changed = set()
+
+        self.frames = 0
+        self.bytes = 0
+        self.tasks = []
+
+    def gauge(self, name, value):
+        """Set a gauge; it is sent with the next delta if it changed"""
+        if self._gauges.get(name) != value:
+            self._gauges[name] = value
+            self._changed.add(name)
+
+    def start(self):
+        self.tasks = [asyncio.ensure_future(self._poll()),
+                      asyncio.ensure_future(self._link())]
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def _delta(self, recv, send, interval):
+        """Queue the delta of an interval; returns whether there was one"""
+        links = link_stats(recv) if recv is not None and len(recv) else np.zeros(0, LINK)
+        sent = sent_stats(send) if send is not None and len(send) else np.zeros(0, SENT)
+        if self.loopmon is not None:
+            for name, value in self.loopmon.poll().items():
+                self.gauge(name, value)
+
+        gauges = np.zeros(len(self._changed), GAUGE)
+        for i, name in enumerate(sorted(self._changed)):
+            gauges[i] = (self.names.setdefault(name, len(self.names)), self._gauges[name])
+        self._changed.clear()
+
+        if not len(links) and not len(sent) and not len(gauges):
+            return False
+        self.seq += 1
+        if len(self.backlog) == self.backlog.maxlen:
+            self.dropped += 1
+        self.backlog.append((self.seq, max(self.names.values(), default=-1),
+                             encode_delta(self.seq, time.time(), interval, links, sent, gauges)))
+        self.wake.set()
+        return True
+
+    async def _poll(self):
+        loop = asyncio.get_event_loop()
+        last = time.perf_counter()
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                recv, send = await loop.run_in_executor(None, self.tail.poll)
+                now = time.perf_counter()
+                self._delta(recv, send, now - last)
+                last = now
+        except asyncio.CancelledError:
+            return
+
+    async def _link(self):
+        try:
+            while True:
+                try:
+                    reader, writer = await asyncio.open_connection(*self.collector)
+                except OSError as err:
+                    logger.debug('Cannot connect to collector: %s', err)
+                    await asyncio.sleep(self.retry)
+                    continue
+                try:
+                    await self._session(reader, writer)
+                except (asyncio.IncompleteReadError, ConnectionError) as err:
+                    logger.warning('Lost connection to collector: %s', err)
+                finally:
+                    writer.close()
+        except asyncio.CancelledError:
+            return
+
+    async def _session(self, reader, writer):
+        writer.write(frame(HELLO, HELLO_BODY.pack(self.node, self.boot)))
+        kind, payload = await read_frame(reader)
+        self._ack(ACK_BODY.unpack(payload)[0])
+        # Names are per connection; resend what was sent before
+        sent_names = -1
+        sent = self.acked
+
+        receiver = asyncio.ensure_future(self._receive(reader))
+        try:
+            while True:
+                for seq, max_name, data in list(self.backlog):
+                    if seq <= sent:
+                        continue
+                    if max_name > sent_names:
+                        writer.write(encode_names([(i, n) for n, i in self.names.items()
+                                                   if sent_names < i <= max_name]))
+                        sent_names = max_name
+                    writer.write(data)
+                    self.frames += 1
+                    self.bytes += len(data)
+                    sent = seq
+                await writer.drain()
+                if receiver.done():
+                    receiver.result()
+                self.wake.clear()
+                waiter = asyncio.ensure_future(self.wake.wait())
+                await asyncio.wait([waiter, receiver], return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+        finally:
+            receiver.cancel()
+
+    async def _receive(self, reader):
+        while True:
+            kind, payload = await read_frame(reader)
+            if kind == ACK:
+                self._ack(ACK_BODY.unpack(payload)[0])
+
+    def _ack(self, seq):
+        self.acked = max(self.acked, seq)
+        while self.backlog and self.backlog[0][0] <= self.acked:
+            self.backlog.popleft()
+
+class Series:
+    """Time series with bounded retention"""
+    __slots__ = ['points', 'retention']
+
+    def __init__(self, retention, max_points):
+        self.points = collections.deque(maxlen=max_points)
+        self.retention = retention
+
+    def add(self, t, value):
+        self.points.append((t, value))
+        while self.points and self.points[0][0] < t - self.retention:
+            self.points.popleft()
+
+    def since(self, t):
+        return [v for ts, v in self.points if ts >= t]
+
+    def last(self):
+        return self.points[-1] if self.points else None
+
+class Collector:
+    """Merge the deltas of many agents into one in-memory view.
+
+    Parameters:
+        retention   Seconds of history kept per series
+        max_points  Maximum points kept per series
+    """
+    def __init__(self, retention=600.0, max_points=3600):
+        self.retention = retention
+        self.max_points = max_points
+        # (receiving node, src, dest) -> Series of LINK records
+        self.links = {}
+        # (node, dest) -> Series of SENT records
+        self.sent = {}
+        # (node, name) -> Series of values
+        self.gauges = {}
+        # node -> [boot, highest seq]
+        self.seen = {}
+        self.names = {}
+        self.latency = collections.deque(maxlen=10000)
+        self.deltas = 0
+        self.duplicates = 0
+        self.bytes = 0
+        self.server = None
+        self.writers = set()
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Listen for agents; returns the port"""
+        self.server = await asyncio.start_server(self._client, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        self.drop_connections()
+
+    def drop_connections(self):
+        """Close every agent connection (agents reconnect)"""
+        for writer in list(self.writers):
+            writer.close()
+
+    def _series(self, table, key):
+        s = table.get(key)
+        if s is None:
+            s = table[key] = Series(self.retention, self.max_points)
+        return s
+
+    async def _client(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            kind, payload = await read_frame(reader)
+            if kind != HELLO:
+                return
+            node, boot = HELLO_BODY.unpack(payload)
+            seen = self.seen.get(node)
+            if seen is None or seen[0] != boot:
+                seen = self.seen[node] = [boot, 0]
+                self.names[node] = {}
+            writer.write(frame(ACK, ACK_BODY.pack(seen[1])))
+            names = self.names[node]
+            while True:
+                kind, payload = await read_frame(reader)
+                self.bytes += FRAME.size + len(payload)
+                if kind == NAMES:
+                    names.update(decode_names(payload))
+                elif kind == DELTA:
+                    seq = self._apply(node, names, seen, payload)
+                    writer.write(frame(ACK, ACK_BODY.pack(seq)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def _apply(self, node, names, seen, payload):
+        seq, t, interval, links, sent, gauges = decode_delta(payload)
+        if seq <= seen[1]:
+            self.duplicates += 1
+            return seen[1]
+        seen[1] = seq
+        self.deltas += 1
+        self.latency.append(time.time() - t)
+        for r in links:
+            self._series(self.links, (node, int(r['src']), int(r['dest']))).add(t, r)
+        for r in sent:
+            self._series(self.sent, (node, int(r['dest']))).add(t, r)
+        for r in gauges:
+            name = names.get(int(r['id']), str(int(r['id'])))
+            self._series(self.gauges, (node, name)).add(t, float(r['value']))
+        return seq
+
+    def totals(self, since=0.0):
+        """Summed link and sent records per key since a time"""
+        links = {}
+        for key, s in self.links.items():
+            recs = s.since(since)
+            if recs:
+                a = np.array(recs, LINK)
+                links[key] = {k: float(a[k].sum()) for k in ('n', 'valid', 'evm_sum', 'evm_sq',
+                                                              'rssi_sum', 'rssi_sq')}
+        sent = {}
+        for key, s in self.sent.items():
+            recs = s.since(since)
+            if recs:
+                a = np.array(recs, SENT)
+                sent[key] = {'n': int(a['n'].sum()), 'bytes': int(a['bytes'].sum())}
+        return links, sent
+
+    def view(self, window=10.0):
+        """Per-link rows over the last window seconds: packets sent and
+        received, delivery ratio, EVM and RSSI mean and standard deviation"""
+        links, sent = self.totals(time.time() - window)
+        rows = []
+        for (rx, src, dest), s in sorted(links.items()):
+            n = s['n']
+            row = {'rx': rx, 'src': src, 'dest': dest, 'recv': int(n),
+                   'valid': int(s['valid'])}
+            tx = sent.get((src, dest))
+            row['sent'] = tx['n'] if tx else None
+            row['delivery'] = s['valid']/tx['n'] if tx and tx['n'] else None
+            for k in ('evm', 'rssi'):
+                mean = s[k + '_sum']/n
+                row[k] = mean
+                row[k + '_std'] = max(s[k + '_sq']/n - mean*mean, 0.0)**0.5
+            rows.append(row)
+        gauges = {key: s.last()[1] for key, s in self.gauges.items() if s.last()}
+        return rows, gauges
+
+    def report(self, window=10.0):
+        rows, gauges = self.view(window)
+        lines = ['{:>3} {:>4}->{:<4} {:>7} {:>7} {:>8} {:>8} {:>8}'.format(
+                 'rx', 'src', 'dest', 'sent', 'recv', 'delivery', 'evm', 'rssi')]
+        for r in rows:
+            lines.append('{:>3} {:>4}->{:<4} {:>7} {:>7} {:>8} {:>8.1f} {:>8.1f}'.format(
+                r['rx'], r['src'], r['dest'], '-' if r['sent'] is None else r['sent'],
+                r['recv'], '-' if r['delivery'] is None else '{:.3f}'.format(r['delivery']),
+                r['evm'], r['rssi']))
+        for (node, name), value in sorted(gauges.items()):
+            lines.append('node {} {} = {:g}'.format(node, name, value))
+        return '\n'.join(lines)
+
+#
+# Test against local agent processes
+#
+
+def _write_synthetic(paths, nodes, duration, rate, stop, seed=0):
+    """Append traffic between nodes to their logs every 100 ms for duration
+    seconds, as a running radio would"""
+    import radiosim
+
+    # The logged dtypes without IQ, which the agents do not read
+    RECV_DTYPE, SEND_DTYPE = [np.dtype([(n, dt[n]) for n in dt.names if n != 'iq_data'])
+                              for dt in (radiosim.RECV_DTYPE, radiosim.SEND_DTYPE)]
+    rng = np.random.default_rng(seed)
+    for path in paths.values():
+        with h5py.File(path, 'w') as f:
+            for name, dtype in (('recv', RECV_DTYPE), ('send', SEND_DTYPE)):
+                f.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True)
+
+    t0 = time.time()
+    step = 0.1
+    while time.time() - t0 < duration and not stop.is_set():
+        now = time.time() - t0
+        for node, path in paths.items():
+            sends = []
+            recvs = []
+            for dest in nodes:
+                if dest == node:
+                    continue
+                n = rng.poisson(rate*step)
+                s = np.zeros(n, SEND_DTYPE)
+                s['timestamp'] = now
+                s['src'] = s['curhop'] = node
+                s['dest'] = dest
+                s['size'] = 1000
+                sends.append(s)
+            for src in nodes:
+                if src == node:
+                    continue
+                n = rng.poisson(rate*step*0.9)
+                r = np.zeros(n, RECV_DTYPE)
+                r['timestamp'] = now
+                r['header_valid'] = 1
+                r['payload_valid'] = rng.random(n) < 0.95
+                r['src'] = src
+                r['dest'] = node
+                r['evm'] = rng.normal(-20, 1, n)
+                r['rssi'] = rng.normal(-30 - src, 1, n)
+                recvs.append(r)
+            with h5py.File(path, 'a', locking=False) as f:
+                for name, rows in (('send', sends), ('recv', recvs)):
+                    rows = np.concatenate(rows)
+                    ds = f[name]
+                    m = ds.shape[0]
+                    ds.resize(m + len(rows), axis=0)
+                    ds[m:] = rows
+        time.sleep(max(0.0, step - (time.time() - t0 - now)))
+
+async def _test(n, duration, rate, interval):
+    collector = Collector()
+    port = await collector.start()
+
+    tmp = tempfile.mkdtemp()
+    nodes = list(range(1, n + 1))
+    paths = {node: os.path.join(tmp, 'node-{:03d}'.format(node), 'radio.h5') for node in nodes}
+    for path in paths.values():
+        os.makedirs(os.path.dirname(path))
+
+    stop = threading.Event()
+    writer = threading.Thread(target=_write_synthetic, args=(paths, nodes, duration, rate, stop))
+    writer.start()
+    await asyncio.sleep(0.2)
+
+    agents = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'agent', path,
+                                '--collector', '127.0.0.1:{}'.format(port),
+                                '--interval', str(interval)])
+              for path in paths.values()]
+
+    # Drop every connection halfway through; agents must resend what was
+    # not acked
+    await asyncio.sleep(duration/2)
+    collector.drop_connections()
+
+    while writer.is_alive():
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(3*interval + 1)
+    print(collector.report(window=duration + 10))
+
+    for p in agents:
+        p.terminate()
+    for p in agents:
+        p.wait()
+    collector.close()
+
+    # Everything in the logs must have arrived exactly once
+    links, sent = collector.totals()
+    ok = True
+    for node, path in paths.items():
+        with h5py.File(path, 'r') as f:
+            recv = f['recv'].fields(RECV_FIELDS)[:]
+            send = f['send'].fields(SEND_FIELDS)[:]
+        for r in link_stats(recv):
+            got = links.get((node, int(r['src']), int(r['dest'])), {}).get('n')
+            if got != r['n']:
+                logger.error('node %d link %d->%d: %s received, log has %d',
+                             node, r['src'], r['dest'], got, r['n'])
+                ok = False
+        for s in sent_stats(send):
+            got = sent.get((node, int(s['dest'])), {}).get('n')
+            if got != s['n']:
+                logger.error('node %d sent to %d: %s, log has %d', node, s['dest'], got, s['n'])
+                ok = False
+
+    lat = 1e3*np.array(collector.latency)
+    print('{} agents: {} deltas ({} resent duplicates), {:.0f} bytes/delta, '
+          'latency p50 {:.1f} ms p95 {:.1f} ms'.format(
+          n, collector.deltas, collector.duplicates, collector.bytes/max(collector.deltas, 1),
+          np.percentile(lat, 50), np.percentile(lat, 95)))
+    print('totals match logs' if ok else 'TOTALS DO NOT MATCH LOGS')
+    return ok
+
+def _addr(s):
+    host, _, port = s.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+def main():
+    parser = argparse.ArgumentParser(description='Collect live metrics from every node.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    p = subparsers.add_parser('agent', help='tail a node log and push deltas to the collector',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('log', help='node log (radio.h5)')
+    p.add_argument('--collector', type=_addr, default=('127.0.0.1', DEFAULT_PORT),
+                   help='collector address as host:port')
+    p.add_argument('--node', type=int, default=None,
+                   help='node ID (default: from a node-NNN directory in the path)')
+    p.add_argument('--interval', type=float, default=1.0,
+                   help='seconds between deltas')
+    p.add_argument('--loopmon', default=None,
+                   help='loopmon JSON lines file to report loop stats from')
+
+    p = subparsers.add_parser('collect', help='merge the deltas of every agent',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--bind', default='0.0.0.0',
+                   help='address to listen on')
+    p.add_argument('--port', type=int, default=DEFAULT_PORT,
+                   help='port to listen on')
+    p.add_argument('--retention', type=float, default=600.0,
+                   help='seconds of history kept')
+    p.add_argument('--print', type=float, default=5.0, dest='print_interval',
+                   help='seconds between printed views')
+    p.add_argument('--window', type=float, default=10.0,
+                   help='seconds summarized by each view')
+
+    p = subparsers.add_parser('test', help='run local agents against synthetic growing logs',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-n', type=int, default=4,
+                   help='number of nodes')
+    p.add_argument('--duration', type=float, default=10.0,
+                   help='seconds of traffic')
+    p.add_argument('--rate', type=float, default=200.0,
+                   help='packets per second per link')
+    p.add_argument('--interval', type=float, default=0.5,
+                   help='seconds between deltas')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    loop = asyncio.get_event_loop()
+
+    if args.command == 'test':
+        return 0 if loop.run_until_complete(_test(args.n, args.duration, args.rate, args.interval)) else 1
+
+    if args.command == 'agent':
+        agent = Agent(args.log, args.collector, args.node, args.interval, args.loopmon)
+        agent.start()
+    else:
+        collector = Collector(args.retention)
+        loop.run_until_complete(collector.start(args.bind, args.port))
+
+        async def show():
+            while True:
+                await asyncio.sleep(args.print_interval)
+                print(collector.report(args.window), flush=True)
+        asyncio.ensure_future(show())
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
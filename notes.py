@@ -9,6 +9,9 @@
 #  channelizer -> controller -> PacketCompressor.radio -> FlowPerformance.radio -> tun/tap
 # Packet path from tun/tap to synthesizer is:
 #  tun/tap -> NetFilter -> FlowPerformance.net -> NetFirewall -> PacketCompressor.net -> NetQueue -> controller -> synthesizer
+#
+# utils/channelizer.py does the Channelizer stage offline, splitting logged
+# snapshots and slot IQ into the configured channels (radio.chan.h5).
 
 
 # READING LOG FILES
@@ -93,6 +96,8 @@ radio.installMACSchedule(sched)     # Install the schedule for this node
 
 # Try it out by e.g. running an iperf session
 # [1] !iperf -ui 1 -c 10.10.10.1 -b 200k -t 10
+# or measure it with traffic.py (run `python traffic.py recv -o results.json` on 10.10.10.1):
+# [1] !python traffic.py send --dest 10.10.10.1 --flow cbr:rate=200k -t 10
 # Check the FFT on another node to see the magic happen.
 
 
@@ -106,6 +111,8 @@ radio.installMACSchedule(sched)     # Install the schedule for this node
 # object (supplied) to output the data. The writer object comes from the Client 
 # or Server, when its open() method is called. 
 #
+# schedist.py pushes versioned delta updates to every node concurrently instead;
+# `python schedist.py bench` times it against local stand-in nodes.
 # 
 
 
@@ -0,0 +1,449 @@
+# PERIODIC CONTROL SCHEDULER
+#
+# Runs the launcher's periodic control actions (TX gain cycling, schedule
+# refreshes, snapshot captures) on the event loop at precise times. A loop
+# of `await asyncio.sleep(period)` drifts by the run time of every step and
+# by every late wakeup, and its jitter grows with the loop's load. Here:
+#
+#   deadlines   job runs are at absolute times epoch + k*period, so late
+#               runs never push later ones back and nothing accumulates;
+#               with align, the epoch is a multiple of align (e.g. the slot
+#               size) so runs land on slot boundaries
+#   wakeups     one timer for all jobs, armed for the earliest deadline.
+#               Loop timers fire late by a roughly constant amount, which
+#               is learned (EWMA) and corrected for by arming that much
+#               earlier; the last `spin` seconds are busy-waited
+#   misses      a run more than `tolerance` late counts as a missed
+#               deadline; if a job falls a whole period behind, the runs in
+#               between are skipped (and counted) rather than run back to
+#               back, and a coroutine job still running at its next
+#               deadline is an overrun and that run is skipped
+#   jitter      the lateness of every run goes into a per-job histogram,
+#               logged every report interval with p50/p99/max
+#
+# Usage:
+#   sched = periodic.PeriodicScheduler(loop)
+#   sched.add('cycle_tx_gain', set_next_gain, period=10.0, align=slot_size,
+#             offset=periodic.clock_offset(loop, radio))
+#   sched.add('snapshot', capture, period=0.5, phase=0.01)   # fn or coroutine fn
+#   ...
+#   sched.close()
+#
+#   python periodic.py bench --jobs 50 --period 0.01 --load 0.002
+import asyncio
+import heapq
+import logging
+import math
+import time
+
+import numpy as np
+
+logger = logging.getLogger('periodic')
+
+# Lateness histogram bin edges in microseconds; the last bin is open-ended
+BINS_US = np.array([0, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                    10000, 20000, 50000, 100000])
+
+# Most lateness samples kept between reports
+MAX_SAMPLES = 100000
+
+class Job:
+    """A periodic job. Created by PeriodicScheduler.add."""
+    def __init__(self, sched, name, fn, period, epoch, tolerance):
+        self.sched = sched
+        self.name = name
+        self.fn = fn
+        self.is_coroutine = asyncio.iscoroutinefunction(fn)
+        self.period = period
+        self.epoch = epoch
+        self.tolerance = tolerance
+        self.k = 0
+        self.task = None
+        self.cancelled = False
+
+        self.runs = 0
+        self.missed = 0
+        self.skipped = 0
+        self.overruns = 0
+        self.errors = 0
+        self.late = []
+        self.late_max = 0.0
+        self._last = {}
+
+    @property
+    def deadline(self):
+        """Loop time of the next run"""
+        return self.epoch + self.k*self.period
+
+    def cancel(self):
+        self.cancelled = True
+        if self.task is not None:
+            self.task.cancel()
+
+    def _record(self, late):
+        self.runs += 1
+        if len(self.late) >= MAX_SAMPLES:
+            del self.late[:MAX_SAMPLES//2]
+        self.late.append(late)
+        self.late_max = max(self.late_max, late)
+        if late > self.tolerance:
+            self.missed += 1
+
+    def totals(self):
+        return {'runs': self.runs, 'missed': self.missed, 'skipped': self.skipped,
+                'overruns': self.overruns, 'errors': self.errors}
+
+    def stats(self, reset=True):
+        """Counts, lateness (us) and lateness histogram since the last reset"""
+        totals = self.totals()
+        s = {k: v - self._last.get(k, 0) for k, v in totals.items()}
+        late = 1e6*np.array(self.late)
+        if len(late):
+            s['late_p50_us'] = float(np.percentile(late, 50))
+            s['late_p99_us'] = float(np.percentile(late, 99))
+            s['late_max_us'] = float(late.max())
+        bins = np.maximum(np.searchsorted(BINS_US, late, 'right') - 1, 0)
+        s['hist'] = {int(BINS_US[b]): int(n) for b, n in zip(*np.unique(bins, return_counts=True))}
+        if reset:
+            self.late = []
+            self._last = totals
+        return s
+
+class PeriodicScheduler:
+    """Run many periodic jobs at absolute deadlines on an asyncio loop.
+
+    Parameters:
+        loop            Event loop (default: the current loop)
+        spin            Seconds before a deadline to stop sleeping and busy-wait
+        report          Seconds between jitter reports in the log (0 for none)
+        gain            EWMA gain of the timer lateness estimate
+    """
+    def __init__(self, loop=None, spin=0.0005, report=60.0, gain=0.1):
+        self.loop = loop or asyncio.get_event_loop()
+        self.spin = spin
+        self.gain = gain
+        self.jobs = []
+        self._heap = []
+        self._seq = 0
+        self._handle = None
+        self._armed = None
+        # Learned lateness of loop timers, corrected for when arming
+        self.advance = 0.0
+        self.wakeups = 0
+        self.spun = 0.0
+        if report:
+            self.add('periodic.report', self.log_report, report, tolerance=math.inf)
+
+    def add(self, name, fn, period, phase=0.0, align=None, offset=0.0, tolerance=None):
+        """Run fn every period seconds; returns the Job.
+
+        fn is a function or a coroutine function taking no arguments. The
+        first run is at the next multiple of align (if given, in a clock
+        that is offset seconds ahead of the loop's, e.g. the radio's) plus
+        phase. A run more than tolerance seconds late (default: a tenth of
+        the period, at most 5 ms) counts as a missed deadline.
+        """
+        now = self.loop.time()
+        if align:
+            epoch = math.ceil((now + offset)/align)*align - offset + phase
+        else:
+            epoch = now + period + phase
+        if tolerance is None:
+            tolerance = min(period/10, 0.005)
+        job = Job(self, name, fn, period, epoch, tolerance)
+        self.jobs.append(job)
+        self._push(job)
+        return job
+
+    def close(self):
+        for job in self.jobs:
+            job.cancel()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _push(self, job):
+        self._seq += 1
+        heapq.heappush(self._heap, (job.deadline, self._seq, job))
+        self._arm()
+
+    def _arm(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return
+        when = self._heap[0][0] - self.advance - self.spin
+        if self._handle is not None:
+            if self._armed <= when:
+                return
+            self._handle.cancel()
+        self._armed = when
+        self._handle = self.loop.call_at(when, self._wake)
+
+    def _wake(self):
+        loop = self.loop
+        now = loop.time()
+        self._handle = None
+        self.wakeups += 1
+        # Timers fire late by about the same amount every time; learn it
+        self.advance += self.gain*((now - self._armed) - self.advance)
+        self.advance = max(self.advance, 0.0)
+
+        if self._heap:
+            deadline = self._heap[0][0]
+            wait = deadline - now
+            if wait > 2*self.spin + self.advance:
+                # Woke far too early (the loop clock jumped or a job was
+                # cancelled); sleep again
+                self._arm()
+                return
+            if wait > 0:
+                start = time.perf_counter()
+                while loop.time() < deadline:
+                    pass
+                self.spun += time.perf_counter() - start
+                now = loop.time()
+
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, job = heapq.heappop(self._heap)
+            if job.cancelled:
+                continue
+            self._run(job, deadline, now)
+            now = loop.time()
+        self._arm()
+
+    def _run(self, job, deadline, now):
+        job._record(now - deadline)
+        if job.is_coroutine:
+            if job.task is not None and not job.task.done():
+                job.overruns += 1
+            else:
+                job.task = self.loop.create_task(self._call(job))
+        else:
+            try:
+                job.fn()
+            except Exception:
+                job.errors += 1
+                logger.exception('Periodic job %s failed', job.name)
+
+        # Next deadline; skip any that have already passed
+        job.k += 1
+        behind = self.loop.time() - job.deadline
+        if behind >= 0:
+            n = int(behind // job.period) + 1
+            job.k += n
+            job.skipped += n
+        self._push(job)
+
+    async def _call(self, job):
+        try:
+            await job.fn()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            job.errors += 1
+            logger.exception('Periodic job %s failed', job.name)
+
+    def report(self, reset=True):
+        """Per-job statistics since the last report"""
+        return {job.name: job.stats(reset) for job in self.jobs if not job.cancelled}
+
+    def log_report(self):
+        for name, s in self.report().items():
+            if name == 'periodic.report':
+                continue
+            logger.info('%s: %d runs, %d missed, %d skipped, %d overruns; late p50 %.0f us '
+                        'p99 %.0f us max %.0f us; histogram (us) %s',
+                        name, s['runs'], s['missed'], s['skipped'], s['overruns'],
+                        s.get('late_p50_us', 0.0), s.get('late_p99_us', 0.0), s.get('late_max_us', 0.0),
+                        ' '.join('{}:{}'.format(b, n) for b, n in s['hist'].items()))
+
+    def summary(self):
+        """Totals for logging at exit"""
+        return {'jobs': {job.name: dict(job.totals(), late_max_us=round(1e6*job.late_max, 1))
+                         for job in self.jobs if job.name != 'periodic.report'},
+                'advance_us': round(1e6*self.advance, 1),
+                'spin_s': round(self.spun, 6)}
+
+def add_arguments(parser):
+    """Add the launcher's periodic scheduler options to an argparse parser"""
+    parser.add_argument('--jitter-report', type=float,
+        default=60.0, dest='jitter_report',
+        help='seconds between periodic job jitter reports in the log (0 for none)')
+    parser.add_argument('--periodic-spin', type=float,
+        default=0.0005, dest='periodic_spin',
+        help='seconds before a periodic job deadline to busy-wait instead of sleep')
+
+def from_config(loop, config):
+    """Create a PeriodicScheduler from the launcher's options"""
+    return PeriodicScheduler(loop, spin=config.periodic_spin, report=config.jitter_report)
+
+def clock_offset(loop, radio):
+    """Seconds the radio's clock is ahead of the loop's, the offset for
+    add(align=slot_size) to land runs on the radio's slot boundaries.
+
+    A radio with a clock_offset method (radiosim) says itself. dragonradio
+    sets the USRP's time, which its slots are multiples of, from the system
+    clock.
+    """
+    if hasattr(radio, 'clock_offset'):
+        return radio.clock_offset(loop)
+    return time.time() - loop.time()
+
+#
+# TX gain cycling for the launchers
+#
+
+def cycle_algorithm(name, min_gain=0, max_gain=25, step=5):
+    """Endless sequence of TX gains (dB) in min_gain..max_gain.
+
+    sequential steps up through the levels and wraps, discontinuous
+    alternates between the lowest and highest remaining levels, and random
+    picks a level uniformly each time.
+    """
+    import itertools
+    import random
+
+    levels = list(range(min_gain, max_gain+1, step))
+    if name == 'sequential':
+        return itertools.cycle(levels)
+    elif name == 'discontinuous':
+        order = [x for pair in zip(levels, reversed(levels)) for x in pair][:len(levels)]
+        return itertools.cycle(order)
+    elif name == 'random':
+        return (random.choice(levels) for _ in itertools.count())
+    else:
+        raise ValueError('Unknown TX gain cycling algorithm: {}'.format(name))
+
+def cycle_tx_gain(radio, gains):
+    """Periodic job setting the next TX gain from gains"""
+    def step():
+        gain = next(gains)
+        radio.usrp.tx_gain = gain
+        logger.debug('TX gain: %g dB', gain)
+
+    return step
+
+def add_cycle_tx_gain(sched, radio, config):
+    """Cycle the TX gain as the launcher's --cycle-tx-gain options say, on
+    the radio's slot boundaries; returns the Job, or None if not cycling"""
+    if config.cycle_tx_gain is None:
+        return None
+    return sched.add('cycle_tx_gain',
+                     cycle_tx_gain(radio, cycle_algorithm(config.cycle_tx_gain)),
+                     config.cycle_tx_gain_period,
+                     align=config.slot_size,
+                     offset=clock_offset(sched.loop, radio))
+
+#
+# Benchmark against sleep loops
+#
+
+async def _load(busy):
+    """Keep the loop busy: callbacks that block it for up to busy seconds"""
+    rng = np.random.default_rng(0)
+    try:
+        while True:
+            await asyncio.sleep(float(rng.exponential(busy)))
+            end = time.perf_counter() + float(rng.uniform(0, busy))
+            while time.perf_counter() < end:
+                pass
+    except asyncio.CancelledError:
+        return
+
+def _lateness(times, t0, period):
+    """Lateness of each run against the ideal t0 + (k+1)*period"""
+    times = np.array(times)
+    return times - (t0 + period*np.arange(1, len(times) + 1))
+
+def bench(njobs=50, period=0.01, duration=5.0, load=0.002, spin=0.0005):
+    """Lateness of sleep loops and of scheduler jobs under the same load.
+
+    Returns {'sleep': stats, 'scheduler': stats} with lateness p50/p99/max
+    and the final drift in ms.
+    """
+    out = {}
+    for mode in ('sleep', 'scheduler'):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runs = [[] for _ in range(njobs)]
+        t0 = loop.time()
+        tasks = [loop.create_task(_load(load))]
+
+        if mode == 'sleep':
+            async def job(i):
+                try:
+                    while True:
+                        await asyncio.sleep(period)
+                        runs[i].append(loop.time())
+                except asyncio.CancelledError:
+                    return
+            tasks += [loop.create_task(job(i)) for i in range(njobs)]
+        else:
+            sched = PeriodicScheduler(loop, spin=spin, report=0)
+            for i in range(njobs):
+                sched.add('job{}'.format(i), lambda i=i: runs[i].append(loop.time()), period,
+                          align=period, offset=-t0)
+
+        loop.run_until_complete(asyncio.sleep(duration))
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks))
+        if mode == 'scheduler':
+            sched.close()
+            missed = sum(job.missed for job in sched.jobs)
+            skipped = sum(job.skipped for job in sched.jobs)
+            # Ideal times are the deadlines
+            late = np.concatenate([np.array(r) - (sched.jobs[i].epoch +
+                                                  period*np.arange(len(r)))
+                                   for i, r in enumerate(runs) if r])
+            drift = late
+        else:
+            missed = skipped = 0
+            late = np.concatenate([np.diff(np.concatenate([[t0], r])) - period
+                                   for r in runs if r])
+            drift = np.array([_lateness(r, t0, period)[-1] for r in runs if r])
+        loop.close()
+
+        late = 1e3*late
+        out[mode] = {'runs': sum(len(r) for r in runs),
+                     'late_p50_ms': float(np.percentile(late, 50)),
+                     'late_p99_ms': float(np.percentile(late, 99)),
+                     'late_max_ms': float(np.max(late)),
+                     'drift_ms': float(1e3*np.max(drift[-njobs:])),
+                     'missed': missed, 'skipped': skipped}
+    return out
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark periodic job jitter.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    p = subparsers.add_parser('bench', help='compare sleep loops and the scheduler under load',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--jobs', type=int, default=50,
+                   help='number of periodic jobs')
+    p.add_argument('--period', type=float, default=0.01,
+                   help='job period (s)')
+    p.add_argument('-t', '--duration', type=float, default=5.0,
+                   help='seconds per run')
+    p.add_argument('--load', type=float, default=0.002,
+                   help='mean length (s) of the blocking callbacks loading the loop')
+    p.add_argument('--spin', type=float, default=0.0005,
+                   help='scheduler busy-wait before each deadline (s)')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    r = bench(args.jobs, args.period, args.duration, args.load, args.spin)
+    for mode, s in r.items():
+        print('{:<9} {:6d} runs  late p50 {:6.3f} ms  p99 {:6.3f} ms  max {:6.3f} ms  '
+              'drift {:8.1f} ms  missed {} skipped {}'.format(
+              mode, s['runs'], s['late_p50_ms'], s['late_p99_ms'], s['late_max_ms'],
+              s['drift_ms'], s['missed'], s['skipped']))
+
+if __name__ == '__main__':
+    main()
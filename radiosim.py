@@ -0,0 +1,739 @@
+# DISCRETE-EVENT RADIO NETWORK SIMULATOR
+#
+# A pure-Python stand-in for dragon.radio so MAC and anti-jamming strategies
+# can be compared offline instead of on grid hardware. It exposes the parts
+# of the dragon.radio API the launcher scripts use:
+#
+#   config = radiosim.Config()
+#   config.addArguments(parser)
+#   radio = radiosim.Radio(config)
+#   radio.net.addNode(node_id)
+#   radio.channels, radio.my_schedule
+#   radio.configureALOHA(), radio.configureSimpleMACSchedule()
+#   radio.installMACSchedule(sched)
+#   radio.usrp.tx_gain = gain
+#   loop.create_task(radio.snapshotLogger())
+#
+# One Radio simulates the whole network: every node added with net.addNode
+# follows the installed schedule, just as every dragonradio node installs the
+# same schedule and transmits where the cell holds its own ID.
+#
+# Time advances slot by slot. In each slot every node with a grant sends up
+# to slot_packets packets from its queue on each channel it was granted. A
+# cell with more than one transmitter (ALOHA) is a collision and a cell hit
+# by the jammer loses packets with probability jam_per. Other timed actions
+# (jammer changes, schedule installs, snapshot windows) are events on a heap
+# processed in time order with the slots.
+#
+# With a log directory, each node gets node-NNN/radio.h5 with the event,
+# recv, send, selftx, slots and snapshots datasets in the dragonradio
+# layout (see notes.py). Snapshots, as seen by config.node_id, go to that
+# node's log and are stored as raw complex64 IQ rather than FLAC;
+# hdf5_utils.decode_snapshot reads either. With --log-slots (or --log-iq)
+# the wideband IQ of every slot goes to every node's slots dataset, and recv
+# start_samples/end_samples locate each packet in it.
+#
+# Run `python radiosim.py -n 50 --jammer sweep` to simulate a network
+# offline as fast as possible, or `python test_radio.py --sim ...` (or
+# debug-radio.py) to run a launcher against it in real time.
+import argparse
+import asyncio
+import collections
+import heapq
+import logging
+import os
+import sys
+import time
+
+import h5py
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import schedule
+
+logger = logging.getLogger('radiosim')
+
+Channel = collections.namedtuple('Channel', ['fc', 'bw'])
+
+IQ_DTYPE = h5py.vlen_dtype(np.complex64)
+
+EVENT_DTYPE = np.dtype([('timestamp', '<f8'), ('event', h5py.string_dtype())])
+
+RECV_DTYPE = np.dtype({
+    'names': ['timestamp', 'start_samples', 'end_samples', 'header_valid',
+              'payload_valid', 'curhop', 'nexthop', 'seq', 'src', 'dest', 'crc',
+              'fec0', 'fec1', 'ms', 'evm', 'rssi', 'cfo', 'fc', 'bw',
+              'demod_latency', 'size', 'iq_data'],
+    'formats': ['<f8', '<i4', '<i4', 'u1', 'u1', 'u1', 'u1', '<u2', 'u1', 'u1',
+                '<i4', '<i4', '<i4', '<i4', '<f4', '<f4', '<f4', '<f4', '<f4',
+                '<f4', '<u4', IQ_DTYPE]})
+
+SEND_DTYPE = np.dtype({
+    'names': ['timestamp', 'curhop', 'nexthop', 'seq', 'src', 'dest', 'crc',
+              'fec0', 'fec1', 'ms', 'fc', 'bw', 'size', 'iq_data'],
+    'formats': ['<f8', 'u1', 'u1', '<u2', 'u1', 'u1', '<i4', '<i4', '<i4',
+                '<i4', '<f4', '<f4', '<u4', IQ_DTYPE]})
+
+SELFTX_DTYPE = np.dtype([('timestamp', '<f8'), ('is_local', 'u1'),
+                         ('start', '<i8'), ('end', '<i8'),
+                         ('fc', '<f4'), ('fs', '<f4')])
+
+SLOTS_DTYPE = np.dtype([('timestamp', '<f8'), ('bw', '<f4'), ('iq_data', IQ_DTYPE)])
+
+SNAPSHOTS_DTYPE = np.dtype([('timestamp', '<f8'), ('fs', '<f8'), ('iq_data', IQ_DTYPE)])
+
+class Config:
+    """Simulation configuration, mirroring the dragon.radio.Config fields the
+    launcher uses plus the simulation parameters."""
+    def __init__(self):
+        self.loglevel = logging.INFO
+        self.node_id = 1
+        self.log_directory = None
+        self.log_sources = []
+        self.log_snapshots = 0
+        self.log_iq = False
+        self.log_slots = False
+        self.snapshot_period = 1.0
+        self.snapshot_duration = 0.05
+
+        self.num_channels = 10
+        self.channel_bandwidth = 100e3
+        self.slot_size = 0.035
+        self.slot_packets = 4
+        self.packet_size = 1500
+        self.queue_limit = 1000
+
+        self.traffic_rate = 50.0
+        self.aloha_p = 0.1
+        self.base_per = 0.01
+        self.jam_per = 0.9
+
+        self.jammer = None
+        self.jammer_channel = 0
+        self.jammer_dwell = 10
+        self.jammer_period = 20
+        self.jammer_duty = 0.5
+        self.jammer_start = 0.0
+
+        self.seed = 0
+
+    @property
+    def rx_rate(self):
+        return self.num_channels*self.channel_bandwidth
+
+    def addArguments(self, parser):
+        group = parser.add_argument_group('Simulation')
+        group.add_argument('-i', '--node-id', action='store', type=int, dest='node_id',
+                           help='node whose snapshots are logged')
+        group.add_argument('-d', '--log-directory', action='store', dest='log_directory',
+                           help='specify directory for log files')
+        group.add_argument('--log-snapshots', action='store', type=int, dest='log_snapshots',
+                           help='number of snapshots to log (0 for none)')
+        group.add_argument('--log-iq', action='store_true', dest='log_iq',
+                           help='log synthetic packet IQ and slot IQ')
+        group.add_argument('--log-slots', action='store_true', dest='log_slots',
+                           help='log the wideband IQ of every slot')
+        group.add_argument('--snapshot-period', action='store', type=float, dest='snapshot_period',
+                           help='seconds between snapshots')
+        group.add_argument('--snapshot-duration', action='store', type=float, dest='snapshot_duration',
+                           help='snapshot length in seconds')
+        group.add_argument('--num-channels', action='store', type=int, dest='num_channels',
+                           help='number of channels')
+        group.add_argument('--channel-bandwidth', action='store', type=float, dest='channel_bandwidth',
+                           help='channel bandwidth (Hz)')
+        group.add_argument('--slot-size', action='store', type=float, dest='slot_size',
+                           help='slot length in seconds')
+        group.add_argument('--slot-packets', action='store', type=int, dest='slot_packets',
+                           help='packets a node can send per channel per slot')
+        group.add_argument('--traffic-rate', action='store', type=float, dest='traffic_rate',
+                           help='offered packets per second per node')
+        group.add_argument('--aloha-p', action='store', type=float, dest='aloha_p',
+                           help='ALOHA transmit probability per slot')
+        group.add_argument('--jammer', action='store', dest='jammer',
+                           choices=['tone', 'sweep', 'pulsed', 'barrage'],
+                           help='jammer model')
+        group.add_argument('--jammer-channel', action='store', type=int, dest='jammer_channel',
+                           help='channel for tone and pulsed jammers')
+        group.add_argument('--jammer-start', action='store', type=float, dest='jammer_start',
+                           help='time the jammer turns on')
+        group.add_argument('--seed', action='store', type=int, dest='seed',
+                           help='random seed')
+
+class Jammer:
+    """Channel-level jammer model.
+
+    Parameters:
+        kind        'tone', 'sweep', 'pulsed' or 'barrage'
+        nchannels   Number of channels
+        channel     Channel of a tone or pulsed jammer
+        dwell       Slots a sweep jammer stays on each channel
+        period      Pulse period in slots
+        duty        Fraction of the period a pulsed jammer is on
+        start       Time the jammer turns on
+    """
+    def __init__(self, kind, nchannels, channel=0, dwell=10, period=20, duty=0.5, start=0.0):
+        if kind not in ('tone', 'sweep', 'pulsed', 'barrage'):
+            raise ValueError('Unknown jammer {}'.format(kind))
+        self.kind = kind
+        self.nchannels = nchannels
+        self.channel = channel
+        self.dwell = dwell
+        self.period = period
+        self.duty = duty
+        self.start = start
+
+    def jammed(self, slot, t):
+        """Boolean array of jammed channels in a slot"""
+        jam = np.zeros(self.nchannels, dtype=bool)
+        if t < self.start:
+            return jam
+
+        if self.kind == 'tone':
+            jam[self.channel] = True
+        elif self.kind == 'sweep':
+            jam[(slot // self.dwell) % self.nchannels] = True
+        elif self.kind == 'pulsed':
+            jam[self.channel] = (slot % self.period) < self.duty*self.period
+        else:
+            jam[:] = True
+        return jam
+
+class NodeLog:
+    """Buffered writer for one node's HDF5 log"""
+    DATASETS = [('event', EVENT_DTYPE), ('recv', RECV_DTYPE), ('send', SEND_DTYPE),
+                ('selftx', SELFTX_DTYPE), ('slots', SLOTS_DTYPE),
+                ('snapshots', SNAPSHOTS_DTYPE)]
+
+    def __init__(self, path, flush_rows=4096):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.f = h5py.File(path, 'w')
+        self.flush_rows = flush_rows
+        self.rows = {name: [] for name, _ in self.DATASETS}
+        self.dtypes = dict(self.DATASETS)
+        for name, dtype in self.DATASETS:
+            self.f.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True)
+
+    def append(self, name, row):
+        rows = self.rows[name]
+        rows.append(row)
+        if len(rows) >= self.flush_rows:
+            self.flush(name)
+
+    def flush(self, name=None):
+        names = [name] if name else list(self.rows)
+        for name in names:
+            rows = self.rows[name]
+            if not rows:
+                continue
+            ds = self.f[name]
+            n = ds.shape[0]
+            ds.resize(n + len(rows), axis=0)
+            ds[n:] = np.array(rows, dtype=self.dtypes[name])
+            self.rows[name] = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+class Node:
+    """A simulated node with its packet queue and counters"""
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.queue = collections.deque()
+        self.seq = 0
+        self.offered = 0
+        self.dropped = 0
+        self.sent = 0
+        self.delivered = 0
+        self.collided = 0
+        self.jammed = 0
+        self.latency = []
+        self.log = None
+
+class Net:
+    """Network of simulated nodes"""
+    def __init__(self, radio):
+        self.radio = radio
+        self.nodes = {}
+
+    def addNode(self, node_id):
+        if node_id not in self.nodes:
+            node = Node(node_id)
+            if self.radio.config.log_directory:
+                path = os.path.join(self.radio.config.log_directory,
+                                    'node-{:03d}'.format(node_id), 'radio.h5')
+                node.log = NodeLog(path)
+            self.nodes[node_id] = node
+        return self.nodes[node_id]
+
+SimSlot = collections.namedtuple('SimSlot', ['data', 'fs', 'timestamp'])
+SimSelfTX = collections.namedtuple('SimSelfTX', ['start', 'end', 'fc', 'fs', 'is_local'])
+SimSnapshot = collections.namedtuple('SimSnapshot', ['timestamp', 'slots', 'selftx'])
+
+class SnapshotCollector:
+    """Collect a wideband snapshot between start() and finish()"""
+    def __init__(self, radio):
+        self.radio = radio
+        self.t0 = None
+        self.tx = []
+
+    def start(self):
+        self.t0 = self.radio.now
+        self.tx = []
+
+    def record(self, t, channel, nsamples, node_id):
+        if self.t0 is not None:
+            self.tx.append((t, channel, nsamples, node_id))
+
+    def finish(self, max_duration=None):
+        if self.t0 is None:
+            return None
+
+        radio = self.radio
+        config = radio.config
+        fs = config.rx_rate
+        duration = max(radio.now - self.t0, 0)
+        if max_duration is not None:
+            duration = min(duration, max_duration)
+        n = int(duration*fs)
+        t0 = self.t0
+        self.t0 = None
+        if n == 0:
+            return None
+
+        iq, selftx = radio._wideband(t0, n, self.tx)
+        return SimSnapshot(t0, [SimSlot(iq, fs, t0)], selftx)
+
+class USRP:
+    """The radio's USRP. Only the TX gain is kept, and it does not change
+    the simulation; setting it logs an event."""
+    def __init__(self, radio):
+        self.radio = radio
+        self._tx_gain = 0.0
+
+    @property
+    def tx_gain(self):
+        return self._tx_gain
+
+    @tx_gain.setter
+    def tx_gain(self, gain):
+        self._tx_gain = gain
+        self.radio.logEvent('TX gain {:g} dB'.format(gain))
+
+class Radio:
+    """Simulated stand-in for dragon.radio.Radio.
+
+    Parameters:
+        config      Config
+    """
+    def __init__(self, config):
+        self.config = config
+        self.rng = np.random.default_rng(config.seed)
+
+        nch = config.num_channels
+        bw = config.channel_bandwidth
+        self.channels = [Channel((i - (nch - 1)/2)*bw, bw) for i in range(nch)]
+        self.channel_bandwidth = bw
+
+        self.net = Net(self)
+        self.my_schedule = None
+        self.aloha = False
+
+        self.jammer = None
+        if config.jammer:
+            self.jammer = Jammer(config.jammer, nch, channel=config.jammer_channel,
+                                 dwell=config.jammer_dwell, period=config.jammer_period,
+                                 duty=config.jammer_duty, start=config.jammer_start)
+
+        self.snapshot_collector = SnapshotCollector(self)
+        self.usrp = USRP(self)
+        self._slot_tx = None
+        # Loop time of simulation time 0 when running on the loop
+        self._t0 = None
+
+        self.now = 0.0
+        self.slot = 0
+        self.events = []
+        self._eventseq = 0
+        self.collisions = 0
+        self.jam_losses = 0
+
+    def logEvent(self, msg):
+        for node in self.net.nodes.values():
+            if node.log:
+                node.log.append('event', (self.now, msg))
+
+    #
+    # MAC configuration
+    #
+    def configureALOHA(self, p=None):
+        """Slotted ALOHA: each backlogged node transmits with probability p
+        on a random channel every slot"""
+        self.aloha = True
+        if p is not None:
+            self.config.aloha_p = p
+        self.logEvent('MAC: configured slotted ALOHA')
+
+    def configureSimpleMACSchedule(self):
+        """TDMA schedule giving every node a slot on every channel"""
+        nodes = sorted(self.net.nodes)
+        self.installMACSchedule(schedule.tdma(nodes, len(self.channels), max(len(nodes), 1)))
+
+    def installMACSchedule(self, sched):
+        sched = np.asarray(sched)
+        if sched.ndim != 2 or sched.shape[0] != len(self.channels):
+            raise ValueError('Schedule must be {} channels x nslots, got shape {}'.format(len(self.channels), sched.shape))
+        self.my_schedule = sched
+        self.aloha = False
+        self.logEvent('MAC: installed schedule {}x{}'.format(*sched.shape))
+
+    #
+    # Event handling
+    #
+    def at(self, t, fn, *args):
+        """Run fn(*args) at simulation time t"""
+        heapq.heappush(self.events, (t, self._eventseq, fn, args))
+        self._eventseq += 1
+
+    def _grants(self, backlog):
+        """(node index, channel) pairs allowed to transmit in the current slot"""
+        nodes = self._node_ids
+        if self.aloha:
+            tx = (self.rng.random(len(nodes)) < self.config.aloha_p) & backlog
+            idx = np.flatnonzero(tx)
+            return idx, self.rng.integers(0, len(self.channels), len(idx))
+
+        if self.my_schedule is None:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+        col = self.my_schedule[:, self.slot % self.my_schedule.shape[1]]
+        # Map node IDs in the schedule column to node indices
+        pos = np.searchsorted(nodes, col)
+        ok = (col != 0) & (pos < len(nodes))
+        ok[ok] &= nodes[pos[ok]] == col[ok]
+        chans = np.flatnonzero(ok)
+        idx = pos[chans]
+        keep = backlog[idx]
+        return idx[keep], chans[keep]
+
+    def _arrivals(self, t0, t1):
+        """Queue the Poisson packet arrivals of every node during [t0, t1)"""
+        config = self.config
+        nodes = self._node_list
+        ids = self._node_ids
+        counts = self.rng.poisson(config.traffic_rate*(t1 - t0), len(nodes))
+        total = int(counts.sum())
+        if total == 0:
+            return
+
+        # Draw every arrival of the slot at once: source, time and a
+        # destination other than the source
+        src = np.repeat(np.arange(len(nodes)), counts)
+        times = self.rng.uniform(t0, t1, total)
+        if len(nodes) > 1:
+            dst = self.rng.integers(0, len(nodes) - 1, total)
+            dst += dst >= src
+        else:
+            dst = src
+        order = np.lexsort((times, src))
+
+        for i, t, d in zip(src[order].tolist(), times[order].tolist(), ids[dst[order]].tolist()):
+            node = nodes[i]
+            node.offered += 1
+            if len(node.queue) >= config.queue_limit:
+                node.dropped += 1
+                continue
+            node.queue.append((t, node.seq, d))
+            node.seq = (node.seq + 1) & 0xffff
+
+    def _wideband(self, t0, n, tx):
+        """n samples of wideband IQ at rx_rate from time t0: noise, the
+        transmissions tx [(time, channel, nsamples, node ID)] and the
+        jammer. Returns (complex64 iq, list of SimSelfTX)."""
+        config = self.config
+        fs = config.rx_rate
+        duration = n/fs
+        rng = self.rng
+        k = np.arange(n)
+        iq = 0.01*(rng.standard_normal(n) + 1j*rng.standard_normal(n))
+        selftx = []
+        for (t, channel, nsamples, node_id) in tx:
+            start = int(round((t - t0)*fs))
+            end = min(start + nsamples, n)
+            start = max(start, 0)
+            if end <= start:
+                continue
+            fc = self.channels[channel].fc
+            iq[start:end] += 0.3*np.exp(2j*np.pi*fc/fs*k[start:end])
+            selftx.append(SimSelfTX(start, end, fc, config.channel_bandwidth,
+                                    int(node_id == config.node_id)))
+
+        # The jammer can change channel every slot, so add it slot by slot
+        jammer = self.jammer
+        if jammer is not None:
+            first = int(t0/config.slot_size)
+            for slot in range(first, int((t0 + duration)/config.slot_size) + 1):
+                ts = slot*config.slot_size
+                start = max(int((ts - t0)*fs), 0)
+                end = min(int((ts + config.slot_size - t0)*fs), n)
+                if end <= start:
+                    continue
+                seg = k[start:end]
+                if jammer.kind == 'barrage':
+                    if jammer.jammed(slot, ts).any():
+                        iq[start:end] += 0.3*(rng.standard_normal(len(seg)) + 1j*rng.standard_normal(len(seg)))
+                    continue
+                for c in np.flatnonzero(jammer.jammed(slot, ts)):
+                    iq[start:end] += np.exp(2j*np.pi*self.channels[c].fc/fs*seg)
+
+        return iq.astype(np.complex64), selftx
+
+    def _transmit(self, t):
+        config = self.config
+        nodes = self._node_list
+        backlog = np.array([len(n.queue) > 0 for n in nodes], dtype=bool)
+        idx, chans = self._grants(backlog)
+        if len(idx) == 0:
+            return
+
+        jam = self.jammer.jammed(self.slot, t) if self.jammer else np.zeros(len(self.channels), dtype=bool)
+        busy = np.bincount(chans, minlength=len(self.channels))
+        fs = config.channel_bandwidth
+        # Packet length in samples of the wideband slot signal; recv
+        # start_samples/end_samples are offsets into the slot, as in
+        # dragonradio logs
+        pkt_samples = int(config.slot_size*config.rx_rate/config.slot_packets)
+
+        for i, c in zip(idx, chans):
+            node = nodes[i]
+            collided = busy[c] > 1
+            jammed = jam[c]
+            fc = self.channels[c].fc
+            for k in range(min(config.slot_packets, len(node.queue))):
+                arrival, seq, dest = node.queue.popleft()
+                tx = t + k*config.slot_size/config.slot_packets
+                node.sent += 1
+                self.snapshot_collector.record(tx, c, pkt_samples, node.node_id)
+                if self._slot_tx is not None:
+                    self._slot_tx.append((tx, c, pkt_samples, node.node_id))
+
+                if node.log:
+                    node.log.append('send', (tx, node.node_id, dest, seq, node.node_id, dest,
+                                             0, 0, 0, 1, fc, fs, config.packet_size,
+                                             np.empty(0, dtype=np.complex64)))
+
+                if collided:
+                    node.collided += 1
+                    self.collisions += 1
+                    continue
+                if jammed and self.rng.random() < config.jam_per:
+                    node.jammed += 1
+                    self.jam_losses += 1
+                    continue
+                if self.rng.random() < config.base_per:
+                    continue
+
+                node.delivered += 1
+                done = tx + config.slot_size/config.slot_packets
+                node.latency.append(done - arrival)
+
+                rx = self.net.nodes.get(dest)
+                if rx is not None and rx.log:
+                    evm = -20 + (8 if jammed else 0) + self.rng.normal()
+                    rssi = -30 + self.rng.normal()
+                    iq = self._packet_iq(evm) if config.log_iq else np.empty(0, dtype=np.complex64)
+                    rx.log.append('recv', (tx, k*pkt_samples, (k + 1)*pkt_samples, 1, 1,
+                                           node.node_id, dest, seq, node.node_id, dest, 0, 0, 0, 1,
+                                           evm, rssi, 0, fc, fs, 0.001, config.packet_size, iq))
+
+    def _packet_iq(self, evm, nsym=256):
+        sym = ((self.rng.integers(0, 2, nsym)*2 - 1) + 1j*(self.rng.integers(0, 2, nsym)*2 - 1))/np.sqrt(2)
+        sigma = 10**(evm/20)/np.sqrt(2)
+        return (sym + sigma*(self.rng.standard_normal(nsym) + 1j*self.rng.standard_normal(nsym))).astype(np.complex64)
+
+    def step(self):
+        """Advance the simulation by one slot"""
+        t0 = self.now
+        t1 = t0 + self.config.slot_size
+
+        while self.events and self.events[0][0] < t1:
+            t, _, fn, args = heapq.heappop(self.events)
+            self.now = max(t, t0)
+            fn(*args)
+
+        self.now = t0
+        self._node_list = [self.net.nodes[k] for k in sorted(self.net.nodes)]
+        self._node_ids = np.array(sorted(self.net.nodes), dtype=int)
+        # Packets arriving during the slot wait for the next one
+        if self.config.log_slots or self.config.log_iq:
+            self._slot_tx = []
+        self._transmit(t0)
+        if self._slot_tx is not None:
+            self._log_slot(t0)
+        self._arrivals(t0, t1)
+
+        self.slot += 1
+        self.now = t1
+
+    def _log_slot(self, t0):
+        """Log the wideband IQ of the slot starting at t0 to every node's
+        log. There is no geometry, so every node hears the same signal."""
+        config = self.config
+        iq, _ = self._wideband(t0, int(round(config.slot_size*config.rx_rate)), self._slot_tx)
+        self._slot_tx = None
+        for node in self._node_list:
+            if node.log:
+                node.log.append('slots', (t0, config.rx_rate, iq))
+
+    def run(self, until):
+        """Run the simulation as fast as possible until simulation time until"""
+        while self.now < until:
+            self.step()
+
+    def clock_offset(self, loop):
+        """Seconds simulation time is ahead of loop time when running on the
+        loop (at speedup 1). Fixes the loop time the simulation starts at if
+        it has not started yet."""
+        if self._t0 is None:
+            self._t0 = loop.time()
+        return -self._t0
+
+    async def start(self, speedup=1.0):
+        """Run the simulation on the event loop at speedup times real time"""
+        loop = asyncio.get_event_loop()
+        if self._t0 is None:
+            self._t0 = loop.time()
+        t0 = self._t0
+        try:
+            while True:
+                target = (loop.time() - t0)*speedup
+                while self.now + self.config.slot_size <= target:
+                    self.step()
+                await asyncio.sleep(self.config.slot_size/speedup)
+        except asyncio.CancelledError:
+            return
+
+    async def snapshotLogger(self):
+        """Log config.log_snapshots snapshots (or forever if negative)"""
+        config = self.config
+        count = 0
+        try:
+            while config.log_snapshots < 0 or count < config.log_snapshots:
+                await asyncio.sleep(config.snapshot_period)
+                self.snapshot_collector.start()
+                await asyncio.sleep(config.snapshot_duration)
+                self.logSnapshot(self.snapshot_collector.finish(config.snapshot_duration))
+                count += 1
+        except asyncio.CancelledError:
+            return
+
+    def logSnapshot(self, snapshot):
+        """Log a snapshot and its self-transmissions to config.node_id's log"""
+        node = self.net.nodes.get(self.config.node_id)
+        if snapshot is None or node is None or node.log is None:
+            return
+        iq = np.concatenate([s.data for s in snapshot.slots])
+        node.log.append('snapshots', (snapshot.timestamp, self.config.rx_rate, iq))
+        for e in snapshot.selftx:
+            node.log.append('selftx', (snapshot.timestamp, e.is_local, e.start, e.end, e.fc, e.fs))
+
+    @property
+    def logger(self):
+        return self if self.config.log_directory else None
+
+    def close(self):
+        for node in self.net.nodes.values():
+            if node.log:
+                node.log.close()
+                node.log = None
+
+    def stats(self):
+        """Network-wide counters and latency percentiles"""
+        nodes = list(self.net.nodes.values())
+        offered = sum(n.offered for n in nodes)
+        sent = sum(n.sent for n in nodes)
+        delivered = sum(n.delivered for n in nodes)
+        lat = np.concatenate([np.asarray(n.latency) for n in nodes]) if nodes else np.empty(0)
+        return {'sim_time': self.now,
+                'offered': offered,
+                'sent': sent,
+                'delivered': delivered,
+                'dropped': sum(n.dropped for n in nodes),
+                'collisions': self.collisions,
+                'jam_losses': self.jam_losses,
+                'delivery_ratio': delivered/offered if offered else float('nan'),
+                'goodput_bps': 8*self.config.packet_size*delivered/self.now if self.now else 0.0,
+                'latency_p50': float(np.percentile(lat, 50)) if len(lat) else float('nan'),
+                'latency_p95': float(np.percentile(lat, 95)) if len(lat) else float('nan')}
+
+def main():
+    config = Config()
+
+    parser = argparse.ArgumentParser(description='Simulate a dragonradio network.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    config.addArguments(parser)
+    parser.add_argument('-n', action='store', type=int, dest='num_nodes',
+        default=50,
+        help='set number of nodes in network')
+    parser.add_argument('--aloha', action='store_true', dest='aloha',
+        default=False,
+        help='use slotted ALOHA MAC')
+    parser.add_argument('--schedule', action='store', choices=['simple', 'tdma', 'fdma', 'hybrid'],
+        default='hybrid',
+        help='schedule to install when not using ALOHA')
+    parser.add_argument('--slots', action='store', type=int, default=10,
+        help='number of slots in the installed schedule')
+    parser.add_argument('--duration', action='store', type=float, default=60.0,
+        help='simulated seconds')
+
+    try:
+        parser.parse_args(namespace=config)
+    except SystemExit as ex:
+        return ex.code
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+        level=config.loglevel)
+
+    radio = Radio(config)
+    for i in range(0, config.num_nodes):
+        radio.net.addNode(i+1)
+
+    nodes = range(1, config.num_nodes+1)
+    nchannels = len(radio.channels)
+    if config.aloha:
+        radio.configureALOHA()
+    elif config.schedule == 'simple':
+        radio.configureSimpleMACSchedule()
+    elif config.schedule == 'tdma':
+        radio.installMACSchedule(schedule.tdma(nodes, nchannels, config.slots))
+    elif config.schedule == 'fdma':
+        radio.installMACSchedule(schedule.fdma(nodes, nchannels, config.slots))
+    else:
+        radio.installMACSchedule(schedule.hybrid(nodes, nchannels, config.slots))
+
+    # Snapshots need a running event loop, so in offline mode take them as
+    # simulation events instead
+    if config.log_snapshots:
+        def snapshot(count):
+            radio.snapshot_collector.start()
+            radio.at(radio.now + config.snapshot_duration, finish, count)
+        def finish(count):
+            radio.logSnapshot(radio.snapshot_collector.finish(config.snapshot_duration))
+            if config.log_snapshots < 0 or count + 1 < config.log_snapshots:
+                radio.at(radio.now + config.snapshot_period, snapshot, count + 1)
+        radio.at(config.snapshot_period, snapshot, 0)
+
+    start = time.perf_counter()
+    radio.run(config.duration)
+    elapsed = time.perf_counter() - start
+    radio.close()
+
+    stats = radio.stats()
+    stats['wall_time'] = elapsed
+    stats['speedup'] = radio.now/elapsed if elapsed else float('inf')
+    print(', '.join('{} {:g}'.format(k, v) for k, v in stats.items()))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
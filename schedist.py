@@ -0,0 +1,493 @@
+# SCHEDULE DISTRIBUTION
+#
+# Pushes MAC schedules from the controller to every node. The existing path
+# (see notes.py) sends the full schedule through sendSchedule() and the
+# protobuf send() decorator to one node at a time; for channel avoidance we
+# want every node switched as quickly as possible after a reinstall.
+#
+#   versions    every pushed schedule gets the next version number, counting
+#               up from a random epoch the distributor picks when it
+#               starts; nodes ack the version they have installed
+#   deltas      a node is sent only the cells that changed since the version
+#               it already has (or will have, once the frames in flight
+#               arrive), or the full schedule if that is smaller, the shape
+#               changed or its version is no longer in the history
+#   batching    pushes made while a node's link is busy are coalesced into
+#               one delta to the latest version
+#   links       one persistent TCP connection per node, kept in a pool and
+#               reconnected on failure; all links send concurrently
+#
+# On connecting, a node announces the version it holds, so after a
+# reconnect it gets a delta rather than the full schedule. A version from a
+# distributor that has since restarted carries another epoch, so it is
+# never taken for one of the new distributor's versions; the node gets the
+# full schedule. A node that
+# receives a delta against a version it does not hold asks for a resync and
+# is sent the full schedule.
+#
+# The distributor records push-to-all-acked latency for every version.
+# NodeServer is the node side; given radio.installMACSchedule as install,
+# it is what a node runs, and with the default it is a stand-in for testing.
+#
+# Usage:
+#   dist = schedist.Distributor({1: ('10.10.10.1', 5555), ...})
+#   dist.start()
+#   version = dist.push(sched)
+#   await dist.wait(version)
+#
+#   python schedist.py bench -n 50 --updates 200
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import struct
+import time
+
+import numpy as np
+
+import schedule
+
+logger = logging.getLogger('schedist')
+
+DEFAULT_PORT = 5555
+
+# Frame header: payload length, kind
+FRAME = struct.Struct('<IB')
+FULL = 1
+DELTA = 2
+ACK = 3
+
+# FULL payload: version, nchannels, nslots, then nchannels*nslots cells
+FULL_HEADER = struct.Struct('<QHH')
+# DELTA payload: version, base version, nchannels, nslots, number of cells,
+# then the flat cell indices followed by their new values
+DELTA_HEADER = struct.Struct('<QQHHI')
+# ACK payload: version held, status
+ACK_BODY = struct.Struct('<QB')
+ACK_OK = 0
+ACK_RESYNC = 1
+
+CELL = np.dtype('<u2')
+INDEX = np.dtype('<u4')
+
+class Resync(Exception):
+    """A delta was received against a version the node does not hold"""
+    pass
+
+def frame(kind, payload):
+    return FRAME.pack(len(payload), kind) + payload
+
+async def read_frame(reader):
+    """Read one frame as (kind, payload)"""
+    n, kind = FRAME.unpack(await reader.readexactly(FRAME.size))
+    return kind, await reader.readexactly(n)
+
+def encode(version, sched, base_version=None, base=None):
+    """Encode sched as a DELTA frame against base, or a FULL frame if that
+    is smaller or there is no usable base"""
+    sched = np.asarray(sched)
+    nchannels, nslots = sched.shape
+    full = frame(FULL, FULL_HEADER.pack(version, nchannels, nslots) +
+                 sched.astype(CELL).tobytes())
+    if base is None or base.shape != sched.shape:
+        return full
+
+    changed = np.flatnonzero(sched.ravel() != base.ravel())
+    if DELTA_HEADER.size + changed.size*(INDEX.itemsize + CELL.itemsize) >= len(full) - FRAME.size:
+        return full
+    return frame(DELTA, DELTA_HEADER.pack(version, base_version, nchannels, nslots, changed.size) +
+                 changed.astype(INDEX).tobytes() +
+                 sched.ravel()[changed].astype(CELL).tobytes())
+
+def decode(kind, payload, version, sched):
+    """Apply a FULL or DELTA payload to the schedule held at version.
+
+    Returns (version, schedule); raises Resync if a delta's base is not the
+    version held.
+    """
+    if kind == FULL:
+        version, nchannels, nslots = FULL_HEADER.unpack_from(payload)
+        cells = np.frombuffer(payload, CELL, nchannels*nslots, FULL_HEADER.size)
+        return version, cells.astype(int).reshape(nchannels, nslots)
+
+    new, base, nchannels, nslots, n = DELTA_HEADER.unpack_from(payload)
+    if base != version or sched is None or sched.shape != (nchannels, nslots):
+        raise Resync(base)
+    idx = np.frombuffer(payload, INDEX, n, DELTA_HEADER.size)
+    vals = np.frombuffer(payload, CELL, n, DELTA_HEADER.size + n*INDEX.itemsize)
+    sched = sched.copy()
+    sched.ravel()[idx] = vals
+    return new, sched
+
+class NodeServer:
+    """Node side of schedule distribution.
+
+    Parameters:
+        install     Called with each new schedule, e.g.
+                    radio.installMACSchedule (default: keep it only)
+        delay       Seconds to wait before acking, to emulate a slow install
+    """
+    def __init__(self, install=None, delay=0.0):
+        self.install = install
+        self.delay = delay
+        self.version = 0
+        self.schedule = None
+        self.installs = 0
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Listen for the distributor; returns the port"""
+        self.server = await asyncio.start_server(self._client, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def _client(self, reader, writer):
+        try:
+            # Announce what we hold so a reconnect can continue with deltas
+            writer.write(frame(ACK, ACK_BODY.pack(self.version, ACK_OK)))
+            while True:
+                kind, payload = await read_frame(reader)
+                try:
+                    self.version, self.schedule = decode(kind, payload, self.version, self.schedule)
+                except Resync:
+                    writer.write(frame(ACK, ACK_BODY.pack(self.version, ACK_RESYNC)))
+                    continue
+                if self.install is not None:
+                    self.install(self.schedule)
+                self.installs += 1
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                writer.write(frame(ACK, ACK_BODY.pack(self.version, ACK_OK)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            pass
+        finally:
+            writer.close()
+
+class _Link:
+    """Persistent connection to one node"""
+    def __init__(self, dist, node, addr):
+        self.dist = dist
+        self.node = node
+        self.addr = addr
+        self.acked = 0
+        self.sent = None
+        self.wake = asyncio.Event()
+        self.connected = False
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    reader, writer = await asyncio.open_connection(*self.addr)
+                except OSError as err:
+                    logger.debug('Cannot connect to node %d: %s', self.node, err)
+                    await asyncio.sleep(self.dist.retry)
+                    continue
+                try:
+                    await self._session(reader, writer)
+                except (asyncio.IncompleteReadError, ConnectionError) as err:
+                    logger.warning('Lost connection to node %d: %s', self.node, err)
+                finally:
+                    self.connected = False
+                    writer.close()
+        except asyncio.CancelledError:
+            return
+
+    async def _session(self, reader, writer):
+        kind, payload = await read_frame(reader)
+        held, _ = ACK_BODY.unpack(payload)
+        # Deltas can continue from what the node holds if we still have it.
+        # Anything else is from before this distributor and needs a full
+        # schedule.
+        if held in self.dist.history:
+            self.sent = held
+            self._ack(held)
+        else:
+            self.sent = None
+        self.connected = True
+        self.wake.set()
+
+        receiver = asyncio.ensure_future(self._receive(reader))
+        sender = asyncio.ensure_future(self._sender(writer))
+        try:
+            done, _ = await asyncio.wait([receiver, sender], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            receiver.cancel()
+            sender.cancel()
+
+    async def _sender(self, writer):
+        dist = self.dist
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            # Everything pushed since we last looked goes out as one frame
+            version = dist.version
+            if version == dist.first or self.sent == version:
+                continue
+            data = dist.encoded(self.sent)
+            writer.write(data)
+            dist.frames += 1
+            dist.bytes += len(data)
+            self.sent = version
+            await writer.drain()
+
+    async def _receive(self, reader):
+        while True:
+            kind, payload = await read_frame(reader)
+            version, status = ACK_BODY.unpack(payload)
+            if status == ACK_RESYNC:
+                logger.info('Node %d needs a resync from version %d', self.node, version)
+                self.sent = None
+                self.wake.set()
+            else:
+                self._ack(version)
+
+    def _ack(self, version):
+        if version > self.acked:
+            self.dist._acked(self.acked, version)
+            self.acked = version
+
+class Distributor:
+    """Push versioned schedules to nodes over persistent connections.
+
+    Parameters:
+        nodes       Dict of node ID to (host, port)
+        history     Number of past schedules kept as delta bases
+        retry       Seconds between reconnection attempts
+    """
+    def __init__(self, nodes, history=64, retry=0.5):
+        self.nodes = dict(nodes)
+        self.retry = retry
+        self.nhistory = history
+        self.history = collections.OrderedDict()
+        # Versions count up from a random epoch in the high 32 bits, so a
+        # restarted distributor never hands out a version a node already
+        # holds for a different schedule
+        self.first = int.from_bytes(os.urandom(4), 'little') << 32
+        self.version = self.first
+        self.links = {}
+        self.tasks = []
+        self.frames = 0
+        self.bytes = 0
+        self.pushed = {}
+        self._encoded = {}
+        self.latency = {}
+        self._waiters = collections.defaultdict(list)
+
+    def start(self):
+        """Connect to every node"""
+        for node, addr in self.nodes.items():
+            link = _Link(self, node, addr)
+            self.links[node] = link
+            self.tasks.append(asyncio.ensure_future(link.run()))
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def push(self, sched):
+        """Queue sched for every node; returns its version"""
+        self.version += 1
+        self.history[self.version] = np.array(sched, dtype=int)
+        while len(self.history) > self.nhistory:
+            self.history.popitem(last=False)
+        self.pushed[self.version] = [time.perf_counter(), 0]
+        self._encoded.clear()
+        for link in self.links.values():
+            link.wake.set()
+        return self.version
+
+    def encoded(self, base_version):
+        """Frame taking a node from base_version to the latest version,
+        encoded once and shared by every link"""
+        data = self._encoded.get(base_version)
+        if data is None:
+            data = encode(self.version, self.history[self.version],
+                          base_version, self.history.get(base_version))
+            self._encoded[base_version] = data
+        return data
+
+    def acked(self):
+        """Highest version every node has acked"""
+        return min((link.acked for link in self.links.values()), default=self.version)
+
+    def _acked(self, old, new):
+        """Count a link's ack moving from version old to new"""
+        now = time.perf_counter()
+        for v in [v for v in self.pushed if old < v <= new]:
+            p = self.pushed[v]
+            p[1] += 1
+            if p[1] == len(self.links):
+                self.latency[v] = now - p[0]
+                del self.pushed[v]
+                for fut in self._waiters.pop(v, ()):
+                    if not fut.done():
+                        fut.set_result(True)
+
+    async def wait(self, version, timeout=None):
+        """Wait until every node has acked version; False on timeout"""
+        if self.acked() >= version:
+            return True
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters[version].append(fut)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    def latency_report(self):
+        """Push-to-all-acked latency statistics in milliseconds"""
+        lat = 1e3*np.array(list(self.latency.values()))
+        if len(lat) == 0:
+            return {'versions': 0}
+        return {'versions': len(lat),
+                'latency_p50_ms': float(np.percentile(lat, 50)),
+                'latency_p95_ms': float(np.percentile(lat, 95)),
+                'latency_max_ms': float(np.max(lat)),
+                'frames': self.frames,
+                'bytes': self.bytes}
+
+#
+# Benchmark against local stand-in nodes
+#
+
+def _schedules(build, nodes, nchannels, nslots, updates, seed):
+    """Schedules a channel avoidance controller might install: one channel
+    is jammed or cleared at a time"""
+    rng = np.random.default_rng(seed)
+    blocked = set()
+    scheds = [build(nodes, nchannels, nslots)]
+    for _ in range(updates):
+        c = int(rng.integers(nchannels))
+        if c in blocked:
+            blocked.discard(c)
+        elif len(blocked) < nchannels - 1:
+            blocked.add(c)
+        scheds.append(build(nodes, nchannels, nslots, sorted(blocked)))
+    return scheds
+
+async def _serial(addrs, scheds):
+    """What we had: the full schedule to one node after another"""
+    conns = []
+    for addr in addrs:
+        reader, writer = await asyncio.open_connection(*addr)
+        await read_frame(reader)
+        conns.append((reader, writer))
+
+    latency = []
+    nbytes = 0
+    for version, sched in enumerate(scheds, 1):
+        start = time.perf_counter()
+        data = encode(version, sched)
+        for reader, writer in conns:
+            writer.write(data)
+            nbytes += len(data)
+            await writer.drain()
+            await read_frame(reader)
+        latency.append(time.perf_counter() - start)
+
+    for _, writer in conns:
+        writer.close()
+    return latency[1:], nbytes
+
+async def _bench(build, n, updates, nchannels, nslots, delay, burst, seed):
+    servers = [NodeServer(delay=delay) for _ in range(n)]
+    ports = [await s.start() for s in servers]
+    addrs = {node: ('127.0.0.1', port) for node, port in zip(range(1, n+1), ports)}
+    scheds = _schedules(build, list(addrs), nchannels, nslots, updates, seed)
+
+    serial, serial_bytes = await _serial(addrs.values(), scheds)
+
+    dist = Distributor(addrs)
+    dist.start()
+    await dist.wait(dist.push(scheds[0]))
+    dist.latency.clear()
+    dist.frames = dist.bytes = 0
+    for i in range(1, len(scheds), burst):
+        for sched in scheds[i:i+burst]:
+            version = dist.push(sched)
+        await dist.wait(version)
+    dist.close()
+
+    for s in servers:
+        assert np.array_equal(s.schedule, scheds[-1])
+        s.close()
+
+    return serial, serial_bytes, dist.latency_report()
+
+def bench(n=50, updates=200, nchannels=10, nslots=10, delay=0.0, burst=1, seed=0,
+          build=schedule.tdma):
+    """Push-to-all-acked latency of serial full pushes and of the
+    distributor, against n local NodeServers"""
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(_bench(build, n, updates, nchannels, nslots, delay, burst, seed))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark schedule distribution against local stand-in nodes.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    p = subparsers.add_parser('bench', help='time pushes to local stand-in nodes',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-n', action='store', type=int, dest='num_nodes', default=50,
+                   help='number of nodes')
+    p.add_argument('--updates', type=int, default=200,
+                   help='number of schedule updates')
+    p.add_argument('--kind', choices=['tdma', 'fdma', 'hybrid'], default='tdma',
+                   help='schedule type')
+    p.add_argument('--channels', type=int, default=10,
+                   help='number of channels')
+    p.add_argument('--slots', type=int, default=10,
+                   help='number of time slots')
+    p.add_argument('--delay', type=float, default=0.0,
+                   help='seconds each node takes to install a schedule')
+    p.add_argument('--burst', type=int, default=1,
+                   help='updates pushed back to back before waiting for acks')
+    p.add_argument('--seed', type=int, default=0,
+                   help='random seed')
+
+    p = subparsers.add_parser('node', help='run a stand-in node',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--bind', default='0.0.0.0',
+                   help='address to listen on')
+    p.add_argument('--port', type=int, default=DEFAULT_PORT,
+                   help='port to listen on')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    if args.command == 'node':
+        loop = asyncio.get_event_loop()
+        node = NodeServer(install=lambda sched: logger.info('Installed version %d:\n%s', node.version, sched))
+        loop.run_until_complete(node.start(args.bind, args.port))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    serial, serial_bytes, report = bench(args.num_nodes, args.updates, args.channels,
+                                         args.slots, args.delay, args.burst, args.seed,
+                                         getattr(schedule, args.kind))
+    serial = 1e3*np.array(serial)
+    print('{} nodes, {} updates of {}x{} {} schedules'.format(args.num_nodes, args.updates,
+                                                             args.channels, args.slots, args.kind))
+    print('serial full:  p50 {:7.2f} ms  p95 {:7.2f} ms  max {:7.2f} ms  {:6.0f} bytes/update'.format(
+        np.percentile(serial, 50), np.percentile(serial, 95), serial.max(),
+        serial_bytes/(args.updates + 1)))
+    print('distributor:  p50 {:7.2f} ms  p95 {:7.2f} ms  max {:7.2f} ms  {:6.0f} bytes/update ({} frames)'.format(
+        report['latency_p50_ms'], report['latency_p95_ms'], report['latency_max_ms'],
+        report['bytes']/args.updates, report['frames']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+# MAC SCHEDULE GENERATION
+#
+# Build nchannels x nslots MAC schedules for radio.installMACSchedule. Each
+# row is a channel and each column a time slot; a cell holds the ID of the
+# node allowed to transmit there, or 0 if nobody transmits (see notes.py).
+#
+#   tdma(nodes, nchannels, nslots)      one node owns every usable channel
+#                                       in a slot
+#   fdma(nodes, nchannels, nslots)      each node owns whole channels
+#   hybrid(nodes, nchannels, nslots)    cells are shared out in streams that
+#                                       hop across channels from slot to slot
+#
+# All three take the same constraints:
+#
+#   blocked     channels that must stay empty (e.g. jammed channels)
+#   weights     per-node airtime weights; each node gets a share of the
+#               usable cells proportional to its weight
+#   min_hop     (hybrid only) minimum channel distance between a node's
+#               transmissions in consecutive slots, the last slot and
+#               the first included
+#
+# and validate() checks a schedule, or the per-node schedules the nodes
+# install, against them and for cells claimed twice. Generation is plain
+# array arithmetic with no per-cell Python loops, so an adaptive controller
+# can regenerate schedules for 100 nodes x 64 channels well inside a
+# millisecond.
+import argparse
+import time
+
+import numpy as np
+
+def _usable(nchannels, blocked):
+    usable = np.ones(nchannels, dtype=bool)
+    blocked = [c for c in blocked if 0 <= c < nchannels]
+    usable[blocked] = False
+    return np.flatnonzero(usable)
+
+def allocate(weights, total):
+    """Split total cells between nodes in proportion to weights.
+
+    Uses largest remainder rounding, so the counts sum to total and no node
+    is more than one cell away from its exact share.
+    """
+    w = np.asarray(weights, dtype=float)
+    if np.any(w < 0) or w.sum() <= 0:
+        raise ValueError('Airtime weights must be non-negative and not all zero')
+
+    share = w/w.sum()*total
+    counts = np.floor(share).astype(int)
+    short = total - counts.sum()
+    if short:
+        counts[np.argsort(counts - share, kind='stable')[:short]] += 1
+    return counts
+
+def _spread(nodes, counts):
+    """Sequence of owners interleaving nodes by their counts.
+
+    Each node's cells are spaced evenly over the sequence instead of being
+    bunched together, which keeps a node's transmit opportunities spread
+    over the schedule period.
+    """
+    owners = np.repeat(np.asarray(nodes), counts)
+    # Position of the k-th cell of a node is (k + 0.5)/count of the way
+    # through the sequence
+    k = np.arange(len(owners)) - np.repeat(np.cumsum(counts) - counts, counts)
+    pos = (k + 0.5)/np.repeat(counts, counts)
+    return owners[np.argsort(pos, kind='stable')]
+
+def tdma(nodes, nchannels, nslots, blocked=(), weights=None):
+    """TDMA schedule: each slot belongs to one node on every usable channel.
+
+    Parameters:
+        nodes       Node IDs (non-zero)
+        nchannels   Number of channels
+        nslots      Number of time slots
+        blocked     Channels that must stay empty
+        weights     Per-node airtime weights (default: equal)
+    """
+    nodes = np.asarray(list(nodes), dtype=int)
+    sched = np.zeros((nchannels, nslots), dtype=int)
+    usable = _usable(nchannels, blocked)
+    if len(nodes) == 0 or len(usable) == 0:
+        return sched
+
+    if weights is None:
+        owners = np.resize(nodes, nslots)
+    else:
+        owners = _spread(nodes, allocate(weights, nslots))
+
+    sched[usable, :] = owners
+    return sched
+
+def fdma(nodes, nchannels, nslots, blocked=(), weights=None):
+    """FDMA schedule: each node owns whole channels for every slot.
+
+    Parameters:
+        nodes       Node IDs (non-zero)
+        nchannels   Number of channels
+        nslots      Number of time slots
+        blocked     Channels that must stay empty
+        weights     Per-node airtime weights (default: equal)
+    """
+    nodes = np.asarray(list(nodes), dtype=int)
+    sched = np.zeros((nchannels, nslots), dtype=int)
+    usable = _usable(nchannels, blocked)
+    if len(nodes) == 0 or len(usable) == 0:
+        return sched
+
+    if len(nodes) > len(usable):
+        raise ValueError('FDMA needs at least as many usable channels ({}) as nodes ({})'.format(len(usable), len(nodes)))
+
+    # Every node gets at least one channel, the rest go by weight
+    counts = np.ones(len(nodes), dtype=int)
+    extra = len(usable) - len(nodes)
+    if extra:
+        counts += allocate(np.ones(len(nodes)) if weights is None else weights, extra)
+
+    sched[usable, :] = np.repeat(nodes, counts)[:, None]
+    return sched
+
+def _cyclic(step, n):
+    """Distance of a step around a cycle of n"""
+    step = np.mod(step, n)
+    return np.minimum(step, n - step)
+
+def hop_step(nusable, nslots, min_hop):
+    """Smallest channel step h for hybrid() that hops at least min_hop
+    channels, including across the wrap from the last slot to the first.
+
+    A stream steps h usable channels between adjacent slots, and
+    -(nslots - 1)*h from the last slot back to the first. A remainder run
+    that crosses from stream j to stream j + 1 does so across the wrap, a
+    step of 1 - (nslots - 1)*h. All three, read as distances around the
+    nusable channels, must be at least min_hop.
+    """
+    if min_hop <= 0:
+        return 0
+    h = np.arange(min_hop, nusable - min_hop + 1)
+    back = (nslots - 1)*h
+    ok = (_cyclic(back, nusable) >= min_hop) & (_cyclic(1 - back, nusable) >= min_hop)
+    if not ok.any():
+        raise ValueError('Cannot hop at least {} channels with {} usable channels and {} slots'.format(
+                         min_hop, nusable, nslots))
+    return int(h[ok][0])
+
+def hybrid(nodes, nchannels, nslots, blocked=(), weights=None, min_hop=0):
+    """Hybrid TDMA/FDMA schedule with optional frequency hopping.
+
+    The usable channels carry nusable streams. Stream j is on usable channel
+    (j + s*h) mod nusable in slot s, where h is the hop step, so a stream
+    moves h usable channels every slot. Nodes are given cells in proportion
+    to their weights: whole streams first, then the remaining cells in
+    contiguous runs along the leftover streams. A remainder run is shorter
+    than nslots, so it only crosses from one stream to the next across the
+    wrap from the last slot back to the first. hop_step() picks h so that
+    the steps within a stream, across the wrap and across such a crossing
+    are all at least min_hop.
+
+    Parameters:
+        nodes       Node IDs (non-zero)
+        nchannels   Number of channels
+        nslots      Number of time slots
+        blocked     Channels that must stay empty
+        weights     Per-node airtime weights (default: equal)
+        min_hop     Minimum channel distance between consecutive slots,
+                    the last slot and the first included
+    """
+    nodes = np.asarray(list(nodes), dtype=int)
+    sched = np.zeros((nchannels, nslots), dtype=int)
+    usable = _usable(nchannels, blocked)
+    nu = len(usable)
+    if len(nodes) == 0 or nu == 0:
+        return sched
+
+    h = hop_step(nu, nslots, min_hop)
+    w = np.ones(len(nodes)) if weights is None else weights
+    full, rest = np.divmod(allocate(w, nu*nslots), nslots)
+    owners = np.concatenate([np.repeat(np.repeat(nodes, full), nslots),
+                             np.repeat(nodes, rest)])
+
+    # Flattened stream-major cell index -> (stream, slot) -> channel
+    j, s = np.divmod(np.arange(nu*nslots), nslots)
+    sched[usable[(j + s*h) % nu], s] = owners
+    return sched
+
+def node_masks(sched, nodes):
+    """Per-node boolean schedules, shape (len(nodes), nchannels, nslots)"""
+    nodes = np.asarray(list(nodes), dtype=int)
+    return np.asarray(sched)[None, :, :] == nodes[:, None, None]
+
+def collisions(masks):
+    """Cells claimed by more than one per-node schedule.
+
+    Nodes each install their own schedule, so a network-wide plan assembled
+    from per-node boolean schedules can double-book a cell.
+
+    Parameters:
+        masks       (nnodes, nchannels, nslots) boolean per-node schedules
+
+    Returns an (n, 2) array of colliding (channel, slot) cells.
+    """
+    return np.argwhere(np.asarray(masks, dtype=np.int32).sum(axis=0) > 1)
+
+def hop_distances(sched):
+    """Channel distance between single-channel transmissions in adjacent slots.
+
+    Returns (nodes, distances) arrays with one entry for every pair of
+    adjacent slots in which a node transmits on exactly one channel. The
+    schedule repeats, so the last slot and the first are adjacent too.
+    """
+    sched = np.asarray(sched)
+    nchannels, nslots = sched.shape
+    ids = np.unique(sched[sched != 0])
+    masks = node_masks(sched, ids)
+
+    per_slot = masks.sum(axis=1)
+    chan = np.argmax(masks, axis=1)
+
+    # Transmissions in slot order for each node; pairs are consecutive
+    # entries of the same node in adjacent slots
+    n, s = np.nonzero(per_slot == 1)
+    c = chan[n, s]
+    pair = (n[1:] == n[:-1]) & (s[1:] == s[:-1] + 1)
+
+    # and a node's last entry with its first, across the wrap
+    first = np.flatnonzero(np.diff(n, prepend=-1))
+    last = np.flatnonzero(np.diff(n, append=len(ids)))
+    wrap = (s[first] == 0) & (s[last] == nslots - 1)
+
+    nodes = np.concatenate([n[1:][pair], n[first][wrap]])
+    dist = np.concatenate([np.abs(np.diff(c))[pair], np.abs(c[last] - c[first])[wrap]])
+    order = np.argsort(nodes, kind='stable')
+    return ids[nodes[order]], dist[order]
+
+def validate(sched, nodes=None, blocked=(), weights=None, min_hop=0,
+             max_channels=None, tolerance=1):
+    """Check a schedule against its constraints.
+
+    Parameters:
+        sched       nchannels x nslots schedule, or (len(nodes), nchannels,
+                    nslots) per-node boolean schedules as each node installs
+                    its own, which must not claim a cell twice
+        nodes       Node IDs allowed in the schedule (default: any), in the
+                    order of the per-node schedules
+        blocked     Channels that must be empty
+        weights     Airtime weights; each node's cell count must be within
+                    tolerance cells of its share
+        min_hop     Minimum distance between single-channel transmissions
+                    of a node in adjacent slots, the last slot and the
+                    first included
+        max_channels    Most channels a node may use in one slot
+        tolerance   Allowed deviation in cells from the weighted share, or
+                    None to skip the airtime check
+
+    Raises ValueError listing every violation.
+    """
+    sched = np.asarray(sched)
+    problems = []
+
+    if sched.ndim == 3:
+        if nodes is None or len(list(nodes)) != len(sched):
+            raise ValueError('Per-node schedules need one node ID each')
+        masks = sched.astype(bool)
+        hit = collisions(masks)
+        if len(hit):
+            problems.append('cells claimed by more than one node {}'.format(hit.tolist()))
+        # The combined schedule; a double-booked cell goes to the highest ID
+        ids = np.asarray(list(nodes), dtype=int)
+        sched = (masks*ids[:, None, None]).max(axis=0) if len(ids) else np.zeros(sched.shape[1:], dtype=int)
+
+    if sched.ndim != 2:
+        raise ValueError('Schedule must be nchannels x nslots, got shape {}'.format(sched.shape))
+
+    nchannels, nslots = sched.shape
+
+    ids = np.unique(sched[sched != 0])
+    if nodes is not None:
+        unknown = np.setdiff1d(ids, np.asarray(list(nodes), dtype=int))
+        if len(unknown):
+            problems.append('unknown nodes {}'.format(unknown.tolist()))
+
+    blocked = [c for c in blocked if 0 <= c < nchannels]
+    if blocked and np.any(sched[blocked] != 0):
+        used = np.array(blocked)[np.any(sched[blocked] != 0, axis=1)]
+        problems.append('blocked channels in use {}'.format(used.tolist()))
+
+    if max_channels is not None and len(ids):
+        per_slot = node_masks(sched, ids).sum(axis=1)
+        over = ids[np.any(per_slot > max_channels, axis=1)]
+        if len(over):
+            problems.append('nodes on more than {} channels in a slot {}'.format(max_channels, over.tolist()))
+
+    if weights is not None and nodes is not None and tolerance is not None:
+        nodes = np.asarray(list(nodes), dtype=int)
+        total = np.count_nonzero(sched)
+        w = np.asarray(weights, dtype=float)
+        share = w/w.sum()*total
+        have = node_masks(sched, nodes).sum(axis=(1, 2))
+        off = nodes[np.abs(have - share) > tolerance]
+        if len(off):
+            problems.append('airtime off weighted share for nodes {}'.format(off.tolist()))
+
+    if min_hop > 0:
+        n, d = hop_distances(sched)
+        short = np.unique(n[d < min_hop])
+        if len(short):
+            problems.append('hops shorter than {} channels for nodes {}'.format(min_hop, short.tolist()))
+
+    if problems:
+        raise ValueError('Invalid schedule: ' + '; '.join(problems))
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate and time MAC schedules.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--kind', choices=['tdma', 'fdma', 'hybrid'], default='hybrid',
+                        help='schedule type')
+    parser.add_argument('-n', action='store', type=int, dest='num_nodes', default=100,
+                        help='number of nodes')
+    parser.add_argument('--channels', action='store', type=int, default=64,
+                        help='number of channels')
+    parser.add_argument('--slots', action='store', type=int, default=10,
+                        help='number of time slots')
+    parser.add_argument('--block', action='append', type=int, default=[],
+                        help='blocked channel (repeatable)')
+    parser.add_argument('--min-hop', action='store', type=int, default=0, dest='min_hop',
+                        help='minimum hop distance (hybrid)')
+    parser.add_argument('--repeat', action='store', type=int, default=1000,
+                        help='timing repetitions')
+    parser.add_argument('--show', action='store_true',
+                        help='print the schedule')
+    args = parser.parse_args()
+
+    nodes = range(1, args.num_nodes+1)
+    weights = np.arange(1, args.num_nodes+1)
+    if args.kind == 'hybrid':
+        build = lambda: hybrid(nodes, args.channels, args.slots, args.block, weights, args.min_hop)
+    elif args.kind == 'fdma':
+        build = lambda: fdma(nodes, args.channels, args.slots, args.block, weights)
+    else:
+        build = lambda: tdma(nodes, args.channels, args.slots, args.block, weights)
+
+    # Report constraints no schedule can meet, like FDMA with more nodes
+    # than channels, as usage errors
+    try:
+        sched = build()
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Check the per-node schedules the nodes would install. TDMA and FDMA
+    # hand out whole slots or channels, so their airtime can be off by a
+    # slot or channel's worth of cells
+    nusable = len(_usable(args.channels, args.block))
+    unit = {'tdma': nusable, 'fdma': args.slots, 'hybrid': 1}[args.kind]
+    validate(node_masks(sched, nodes), nodes=nodes, blocked=args.block, weights=weights,
+             min_hop=args.min_hop, tolerance=unit if args.kind != 'fdma' else None)
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        build()
+    elapsed = (time.perf_counter() - start)/args.repeat
+
+    if args.show:
+        print(sched)
+    print('{} schedule, {} nodes x {} channels x {} slots: {:.1f} us per build'.format(
+          args.kind, args.num_nodes, args.channels, args.slots, 1e6*elapsed))
+
+if __name__ == '__main__':
+    main()
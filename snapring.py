@@ -0,0 +1,374 @@
+# SNAPSHOT RING
+#
+# Streams the radio's IQ snapshots to analysis processes on the same host
+# through a shared memory ring (utils/shmring.py), so live spectrum
+# monitoring or jammer detection sees each snapshot within milliseconds of
+# its capture instead of re-reading it from the HDF5 log.
+#
+# The ring is a ring of bytes; each slot holds one snapshot:
+#
+#   header      timestamp, fs, publish time, number of samples and selftx
+#               entries, samples dropped because the snapshot did not fit,
+#               capacity of the selftx area
+#   selftx      up to max_selftx entries (antijam.SELFTX_DTYPE)
+#   iq          up to max_samples complex64 samples, 64-byte aligned
+#
+# Slots describe their own layout, so readers only need the ring's name.
+# The publisher copies the snapshot's slots straight into the ring slot and
+# commits it; readers get numpy views into shared memory, never copies.
+# Sequence numbers come from the ring: a reader that falls a whole ring
+# behind skips ahead and counts an overrun, and check(seq) after using a
+# snapshot tells whether the publisher overwrote it meanwhile.
+#
+# Usage:
+#   python test_radio.py --snapshot-ring snapshots ...   publish from the launcher
+#
+# The launcher publishes from antijam.snapshot_source, the same task that
+# feeds channel avoidance and logs snapshots.
+#
+#   ring = snapring.SnapshotReader('snapshots')
+#   seq, snap = ring.read()          # antijam.Snapshot of views
+#   ... use snap.iq, snap.selftx ...
+#   ring.check(seq)                  # raises shmring.Overrun if overwritten
+#
+#   python snapring.py watch snapshots
+#   python snapring.py read snapshots -n 1000     consumer throughput
+#   python snapring.py bench --readers 2
+import argparse
+import asyncio
+import logging
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+import shmring
+from antijam import SELFTX_DTYPE, Snapshot, snapshot_parts
+
+logger = logging.getLogger('snapring')
+
+HEADER_DTYPE = np.dtype([('timestamp', '<f8'), ('fs', '<f8'), ('published', '<f8'),
+                         ('nsamples', '<u8'), ('dropped', '<u8'),
+                         ('nselftx', '<u4'), ('max_selftx', '<u4')])
+HEADER_SIZE = 64
+
+def _align(n, a=64):
+    return (n + a - 1)//a*a
+
+def _iq_offset(max_selftx):
+    return HEADER_SIZE + _align(max_selftx*SELFTX_DTYPE.itemsize)
+
+def slot_size(max_samples, max_selftx):
+    """Bytes per ring slot"""
+    return _iq_offset(max_selftx) + max_samples*np.dtype(np.complex64).itemsize
+
+class SnapshotPublisher:
+    """Publish snapshots into a new shared memory ring called name.
+
+    Parameters:
+        name            Ring name (a stale ring of the same name is replaced)
+        nslots          Snapshots held by the ring
+        max_samples     Samples per slot; longer snapshots lose their tail
+        max_selftx      selftx entries per slot; extra entries are dropped
+    """
+    def __init__(self, name, nslots=8, max_samples=1 << 20, max_selftx=64):
+        self.ring = shmring.ShmRing.create(name, nslots, slot_size(max_samples, max_selftx),
+                                           dtype=np.uint8)
+        self.max_samples = max_samples
+        self.max_selftx = max_selftx
+        self.published = 0
+        self.dropped = 0
+        self.publish_time = 0.0
+
+    @property
+    def name(self):
+        return self.ring.name
+
+    def publish(self, timestamp, fs, iq, selftx=None):
+        """Publish one snapshot and return its sequence number.
+
+        iq is an array of complex64 samples or a list of them (a
+        snapshot's slots, copied straight into the ring); selftx a
+        SELFTX_DTYPE array or None.
+        """
+        start = time.perf_counter()
+        seq, slot = self.ring.next_slot()
+        out = slot[_iq_offset(self.max_selftx):].view(np.complex64)
+
+        n = 0
+        dropped = 0
+        for chunk in ([iq] if isinstance(iq, np.ndarray) else iq):
+            k = min(len(chunk), self.max_samples - n)
+            out[n:n+k] = chunk[:k]
+            n += k
+            dropped += len(chunk) - k
+
+        m = 0
+        if selftx is not None:
+            m = min(len(selftx), self.max_selftx)
+            tx = slot[HEADER_SIZE:HEADER_SIZE + self.max_selftx*SELFTX_DTYPE.itemsize].view(SELFTX_DTYPE)
+            tx[:m] = selftx[:m]
+
+        hdr = slot[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)
+        hdr[0] = (timestamp, fs, time.monotonic(), n, dropped, m, self.max_selftx)
+        self.ring.commit(seq)
+
+        self.published += 1
+        if dropped:
+            self.dropped += 1
+            logger.warning('Snapshot %d: %d samples did not fit in the ring', seq, dropped)
+        self.publish_time += time.perf_counter() - start
+        return seq
+
+    def publish_snapshot(self, snapshot):
+        """Publish a dragonradio snapshot"""
+        fs, iqs, selftx = snapshot_parts(snapshot)
+        return self.publish(snapshot.timestamp, fs, iqs, selftx)
+
+    def summary(self):
+        return {'ring': self.name,
+                'published': self.published,
+                'truncated': self.dropped,
+                'publish_ms': round(1e3*self.publish_time/max(self.published, 1), 3)}
+
+    def close(self):
+        self.ring.close()
+
+class SnapshotReader:
+    """Read snapshots from the ring called name.
+
+    Parameters:
+        name        Ring name
+        start       'latest' to start with the next snapshot published,
+                    'oldest' to start with the oldest one still in the ring
+    """
+    def __init__(self, name, start='latest'):
+        self.ring = shmring.ShmRing.attach(name)
+        self.reader = shmring.Reader(self.ring, start)
+
+    @property
+    def overruns(self):
+        return self.reader.overruns
+
+    def snapshot(self, seq):
+        """Snapshot in the slot of seq, as views into shared memory.
+
+        arrival is the publish time (time.monotonic(), which is shared by
+        all processes on the host).
+        """
+        slot = self.ring.slot(seq)
+        hdr = slot[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        off = HEADER_SIZE
+        selftx = slot[off:off + int(hdr['nselftx'])*SELFTX_DTYPE.itemsize].view(SELFTX_DTYPE)
+        off = _iq_offset(int(hdr['max_selftx']))
+        iq = slot[off:off + int(hdr['nsamples'])*8].view(np.complex64)
+        return Snapshot(float(hdr['timestamp']), float(hdr['fs']), iq, selftx,
+                        float(hdr['published']))
+
+    def read(self, timeout=None, latest=False):
+        """Return (seq, Snapshot) of the next snapshot, or None on timeout.
+
+        With latest, skip to the most recent snapshot without counting the
+        skipped ones as overruns.
+        """
+        if latest:
+            self.reader.seq = max(self.reader.seq, self.ring.write_seq - 1)
+        got = self.reader.read(timeout)
+        if got is None:
+            return None
+        seq, _ = got
+        return seq, self.snapshot(seq)
+
+    def valid(self, seq):
+        return self.reader.valid(seq)
+
+    def check(self, seq):
+        """Raise shmring.Overrun if snapshot seq was overwritten while in use"""
+        self.reader.check(seq)
+
+    def close(self):
+        self.ring.close()
+
+#
+# Reader tools and benchmark
+#
+
+def watch(name, duration=None, start='latest'):
+    """Print each snapshot read from ring name with its delivery latency"""
+    ring = SnapshotReader(name, start)
+    t0 = time.monotonic()
+    try:
+        while duration is None or time.monotonic() - t0 < duration:
+            got = ring.read(timeout=1.0)
+            if got is None:
+                continue
+            seq, snap = got
+            latency = time.monotonic() - snap.arrival
+            x = snap.iq.view(np.float32)
+            power = float(np.dot(x, x))/max(len(snap.iq), 1)
+            try:
+                ring.check(seq)
+            except shmring.Overrun:
+                print('{:8d} overwritten while reading'.format(seq))
+                continue
+            print('{:8d} t={:.6f} fs={:.3g} {:8d} samples {:3d} selftx  {:6.2f} dB  '
+                  'latency {:.3f} ms  overruns {}'.format(
+                  seq, snap.timestamp, snap.fs, len(snap.iq), len(snap.selftx),
+                  10*np.log10(power + 1e-30), 1e3*latency, ring.overruns))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ring.close()
+
+def consume(ring, count, timeout=2.0):
+    """Read count snapshots from SnapshotReader ring, touching every sample
+    as an analysis would, and return throughput and latency statistics"""
+    latency = []
+    nbytes = 0
+    nread = 0
+    torn = 0
+    t0 = None
+    while nread < count:
+        got = ring.read(timeout)
+        if got is None:
+            break
+        seq, snap = got
+        if t0 is None:
+            t0 = time.perf_counter()
+        latency.append(time.monotonic() - snap.arrival)
+        x = snap.iq.view(np.float32)
+        float(np.dot(x, x))
+        try:
+            ring.check(seq)
+        except shmring.Overrun:
+            torn += 1
+            continue
+        nbytes += snap.iq.nbytes
+        nread += 1
+        t1 = time.perf_counter()
+    # From the first snapshot read to the last one used, so a final read
+    # timing out does not count
+    elapsed = t1 - t0 if nread else float('nan')
+
+    return {'read': nread, 'bytes': nbytes, 'elapsed': elapsed,
+            'overruns': ring.overruns, 'torn': torn,
+            'latency_p50_ms': 1e3*float(np.percentile(latency, 50)) if latency else float('nan'),
+            'latency_p99_ms': 1e3*float(np.percentile(latency, 99)) if latency else float('nan')}
+
+def bench(nreaders=2, count=2000, samples=1 << 17, nslots=16, rate=None, name='snapring-bench'):
+    """Publish count snapshots of samples each to nreaders reader processes.
+
+    With rate (snapshots/s) the publisher is paced, otherwise it runs flat
+    out. Returns (publisher stats, list of reader stats).
+    """
+    pub = SnapshotPublisher(name, nslots, samples)
+    readers = []
+    try:
+        readers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'read', name,
+                                     '-n', str(count), '--oldest', '--json'],
+                                    stdout=subprocess.PIPE, text=True)
+                   for _ in range(nreaders)]
+        # Readers print a line once they are attached
+        for p in readers:
+            p.stdout.readline()
+
+        rng = np.random.default_rng(0)
+        iq = (rng.standard_normal(samples) + 1j*rng.standard_normal(samples)).astype(np.complex64)
+        selftx = np.zeros(4, dtype=SELFTX_DTYPE)
+        start = time.perf_counter()
+        for k in range(count):
+            if rate:
+                delay = start + k/rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            pub.publish(float(k), 10e6, iq, selftx)
+        elapsed = time.perf_counter() - start
+
+        stats = [json.loads(p.communicate(timeout=60)[0]) for p in readers]
+    finally:
+        for p in readers:
+            if p.poll() is None:
+                p.kill()
+        pub.close()
+
+    return ({'published': count, 'elapsed': elapsed, 'bytes': count*iq.nbytes,
+             'publish_ms': 1e3*pub.publish_time/count}, stats)
+
+def print_reader(label, r):
+    print('{:<8} {:6d} snapshots  {:8.1f} /s  {:7.2f} GB/s  latency p50 {:.3f} ms '
+          'p99 {:.3f} ms  overruns {} torn {}'.format(
+          label, r['read'], r['read']/r['elapsed'], r['bytes']/r['elapsed']/1e9,
+          r['latency_p50_ms'], r['latency_p99_ms'], r['overruns'], r['torn']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Snapshot ring tools.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    p = subparsers.add_parser('watch', help='print snapshots as they are published',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('name', help='ring name')
+    p.add_argument('-t', '--duration', type=float, default=None,
+                   help='seconds to watch (default: until interrupted)')
+    p.add_argument('--oldest', action='store_true',
+                   help='start with the oldest snapshot still in the ring')
+
+    p = subparsers.add_parser('read', help='read snapshots and report throughput and latency',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('name', help='ring name')
+    p.add_argument('-n', '--count', type=int, default=1000,
+                   help='snapshots to read')
+    p.add_argument('--oldest', action='store_true',
+                   help='start with the oldest snapshot still in the ring')
+    p.add_argument('--json', action='store_true',
+                   help='print "attached", then the statistics as JSON')
+
+    p = subparsers.add_parser('bench', help='measure publish and consume throughput',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--readers', type=int, default=2,
+                   help='reader processes')
+    p.add_argument('-n', '--count', type=int, default=2000,
+                   help='snapshots to publish')
+    p.add_argument('--samples', type=int, default=1 << 17,
+                   help='samples per snapshot')
+    p.add_argument('--nslots', type=int, default=16,
+                   help='snapshots held by the ring')
+    p.add_argument('--rate', type=float, default=None,
+                   help='snapshots per second (default: as fast as possible)')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    if args.command == 'watch':
+        watch(args.name, args.duration, 'oldest' if args.oldest else 'latest')
+        return 0
+    if args.command == 'read':
+        ring = SnapshotReader(args.name, 'oldest' if args.oldest else 'latest')
+        if args.json:
+            print('attached', flush=True)
+        try:
+            r = consume(ring, args.count)
+        finally:
+            ring.close()
+        if args.json:
+            print(json.dumps(r))
+        else:
+            print_reader('reader', r)
+        return 0
+
+    pub, readers = bench(args.readers, args.count, args.samples, args.nslots, args.rate)
+    print('publish  {:6d} snapshots  {:8.1f} /s  {:7.2f} GB/s  {:.3f} ms each'.format(
+          pub['published'], pub['published']/pub['elapsed'],
+          pub['bytes']/pub['elapsed']/1e9, pub['publish_ms']))
+    for i, r in enumerate(readers):
+        print_reader('reader {}'.format(i), r)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
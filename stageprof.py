@@ -0,0 +1,228 @@
+# STAGE PROFILING
+#
+# Per-stage timing for interactive tools such as the log viewer, where one
+# user action (next packet, next snapshot) runs a chain of stages (find
+# slots, decode, FFTs, overlays, canvas draw) and we need to know which one
+# the time goes to:
+#
+#   spans       named, nested intervals with a count (packets overlaid,
+#               frames transformed, ...) and a byte size (samples decoded)
+#   trace       Chrome trace-event JSON of every span, for chrome://tracing
+#               or https://ui.perfetto.dev
+#   summary     count, p50, p95, max and total time per stage
+#
+# Usage:
+#   import stageprof
+#   prof = stageprof.Profiler(enabled=args.profile is not None)
+#   with prof.span('rx.decode') as s:
+#       sig = decode(...)
+#       s.set(nbytes=sig.nbytes)
+#   prof.save('trace.json')
+#   print(prof.report())
+#
+# A disabled profiler hands out one shared do-nothing span, so leaving the
+# spans in hot paths costs a method call per stage.
+#
+#   python stageprof.py report trace.json     summary of a saved trace
+#   python stageprof.py bench                 span overhead, enabled and disabled
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger('stageprof')
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **kwargs):
+        pass
+
+_NULL = _NullSpan()
+
+class _Span:
+    __slots__ = ['prof', 'name', 'count', 'nbytes', 'args', 'start']
+
+    def __init__(self, prof, name, count, nbytes, args):
+        self.prof = prof
+        self.name = name
+        self.count = count
+        self.nbytes = nbytes
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        self.prof.spans.append((self.name, self.start, end - self.start,
+                                threading.get_ident(), self.count, self.nbytes,
+                                self.args))
+        return False
+
+    def set(self, count=None, nbytes=None, **args):
+        """Set the span's count, byte size or extra trace arguments"""
+        if count is not None:
+            self.count = count
+        if nbytes is not None:
+            self.nbytes = nbytes
+        if args:
+            self.args = dict(self.args or {}, **args)
+
+def _percentile(xs, q):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(q*(len(xs) - 1))))]
+
+class Profiler:
+    """Records named spans.
+
+    Parameters:
+        enabled     if False, span() records nothing
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.t0 = time.perf_counter_ns()
+        # (name, start ns, duration ns, thread, count, bytes, args)
+        self.spans = []
+
+    def span(self, name, count=0, nbytes=0, **args):
+        """Context manager timing the stage called name"""
+        if not self.enabled:
+            return _NULL
+        return _Span(self, name, count, nbytes, args or None)
+
+    def clear(self):
+        self.spans = []
+
+    def trace_events(self):
+        """The spans as Chrome trace 'complete' events, times in us"""
+        pid = os.getpid()
+        tids = {}
+        events = []
+        for name, start, dur, tid, count, nbytes, args in self.spans:
+            a = {'count': count, 'bytes': nbytes}
+            if args:
+                a.update(args)
+            events.append({'name': name, 'cat': name.split('.', 1)[0], 'ph': 'X',
+                           'ts': (start - self.t0)/1e3, 'dur': dur/1e3,
+                           'pid': pid, 'tid': tids.setdefault(tid, len(tids)),
+                           'args': a})
+        events.sort(key=lambda e: e['ts'])
+        return events
+
+    def save(self, path):
+        """Write a Chrome trace-event JSON file"""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self):
+        return summarize(self.trace_events())
+
+    def report(self):
+        return format_summary(self.summary())
+
+def summarize(events):
+    """Per-stage statistics of trace events: {name: dict}, times in ms"""
+    stages = {}
+    for e in events:
+        if e.get('ph') != 'X':
+            continue
+        s = stages.setdefault(e['name'], {'durs': [], 'count': 0, 'bytes': 0})
+        s['durs'].append(e['dur']/1e3)
+        args = e.get('args', {})
+        s['count'] += args.get('count', 0)
+        s['bytes'] += args.get('bytes', 0)
+
+    out = {}
+    for name, s in stages.items():
+        durs = s['durs']
+        out[name] = {'n': len(durs), 'p50': _percentile(durs, 0.5),
+                     'p95': _percentile(durs, 0.95), 'max': max(durs),
+                     'total': sum(durs), 'count': s['count'], 'bytes': s['bytes']}
+    return out
+
+def format_summary(summary):
+    """Summary table, stages in order of total time"""
+    lines = ['{:<24} {:>6} {:>9} {:>9} {:>9} {:>10} {:>9} {:>10}'.format(
+             'stage', 'n', 'p50 ms', 'p95 ms', 'max ms', 'total ms', 'count', 'MB')]
+    for name, s in sorted(summary.items(), key=lambda x: -x[1]['total']):
+        lines.append('{:<24} {:>6} {:>9.3f} {:>9.3f} {:>9.3f} {:>10.1f} {:>9} {:>10.2f}'.format(
+                     name, s['n'], s['p50'], s['p95'], s['max'], s['total'],
+                     s['count'], s['bytes']/1e6))
+    return '\n'.join(lines)
+
+def add_arguments(parser):
+    """Add the --profile option to a tool's argument parser"""
+    parser.add_argument('--profile', nargs='?', const='', default=None,
+        metavar='PATH', dest='profile',
+        help='time each stage; log a summary on exit, and write a Chrome trace to PATH')
+
+def from_args(args):
+    return Profiler(enabled=args.profile is not None)
+
+def finish(prof, args):
+    """Log the summary table and write the trace, if profiling"""
+    if not prof.enabled:
+        return
+    logger.info('stage profile:\n%s', prof.report())
+    if args.profile:
+        prof.save(args.profile)
+        logger.info('wrote trace to %s', args.profile)
+
+def bench(n=200000):
+    """Per-span cost in ns, disabled and enabled"""
+    out = {}
+    for enabled in (False, True):
+        prof = Profiler(enabled)
+        t = time.perf_counter_ns()
+        for _ in range(n):
+            with prof.span('stage') as s:
+                s.set(nbytes=1)
+        out['enabled' if enabled else 'disabled'] = (time.perf_counter_ns() - t)/n
+    t = time.perf_counter_ns()
+    for _ in range(n):
+        pass
+    out['loop'] = (time.perf_counter_ns() - t)/n
+    return out
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Stage profile tools.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    p = subparsers.add_parser('report', help='summarize a saved trace',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('trace', help='Chrome trace JSON written by --profile')
+
+    p = subparsers.add_parser('bench', help='measure span overhead',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-n', type=int, default=200000,
+                   help='number of spans')
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        with open(args.trace) as f:
+            trace = json.load(f)
+        events = trace['traceEvents'] if isinstance(trace, dict) else trace
+        print(format_summary(summarize(events)))
+    else:
+        r = bench(args.n)
+        loop = r['loop']
+        for key in ('disabled', 'enabled'):
+            print('{:<9} {:7.0f} ns per span'.format(key, r[key] - loop))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
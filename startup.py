@@ -0,0 +1,268 @@
+# STARTUP TIMING
+#
+# Startup timing for the radio launchers. We restart radios constantly
+# during jamming trials, so the launchers import heavy modules (IPython,
+# matplotlib, SciPy, the channel avoidance code) only on the code paths that
+# use them, and this module keeps them honest:
+#
+#   phases      named marks (arguments parsed, radio created, schedule
+#               installed, ...) in seconds since the process was exec'd,
+#               so interpreter startup is included
+#   imports     an -X importtime style tree of every module imported after
+#               the timer was created, with self and cumulative time
+#   ready       the first iteration of the event loop, i.e. the radio is
+#               configured, the MAC schedule installed and the control
+#               tasks are about to run: time to first transmit-ready
+#
+# Usage, in a launcher:
+#   import startup
+#   timer = startup.StartupTimer.from_argv()   # before the heavy imports
+#   ...
+#   startup.add_arguments(parser)
+#   timer.mark('radio')
+#   loop.call_soon(timer.ready, config.startup_report, stop)
+#
+# --startup-report logs the report, --startup-report PATH writes it as JSON
+# and --startup-exit stops the launcher once it is ready. The bench command
+# uses the last two to track time-to-ready across changes:
+#
+#   python startup.py bench -n 10 --save base.json -- python3 test_radio.py -n 2
+#   python startup.py bench -n 10 --baseline base.json -- python3 test_radio.py -n 2
+#
+# and exits with status 1 if the median time to ready regressed by more than
+# the tolerance.
+import builtins
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger('startup')
+
+FLAG = '--startup-report'
+
+def process_age():
+    """Seconds since this process was exec'd, or None if unknown.
+
+    Read from /proc, so the resolution is one clock tick (usually 10 ms).
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # The command name may contain spaces, so split after it
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19])/os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class StartupTimer:
+    """Phase marks and import tree for one process's startup.
+
+    Parameters:
+        trace   record every module imported from now on (main thread only)
+    """
+    def __init__(self, trace=False):
+        self.t0 = time.perf_counter()
+        age = process_age()
+        self.offset = age if age is not None else 0.0
+        self.marks = [('interpreter', self.offset)]
+        self.imports = []
+        self._stack = []
+        self._import = None
+        self._thread = threading.get_ident()
+        if trace:
+            self.trace()
+
+    @classmethod
+    def from_argv(cls, argv=None, flag=FLAG):
+        """Create a timer that traces imports if flag is on the command line.
+
+        Launchers create the timer before argument parsing, which itself may
+        need heavy imports (dragon.radio.Config), so the flag is looked for
+        by hand here and parsed properly later.
+        """
+        argv = sys.argv[1:] if argv is None else argv
+        return cls(trace=any(a == flag or a.startswith(flag + '=') for a in argv))
+
+    def now(self):
+        """Seconds since process start"""
+        return self.offset + time.perf_counter() - self.t0
+
+    def mark(self, name):
+        """Record the end of the phase called name"""
+        self.marks.append((name, self.now()))
+
+    def trace(self):
+        """Start recording imports"""
+        if self._import is None:
+            self._import = builtins.__import__
+            builtins.__import__ = self._hook
+
+    def untrace(self):
+        """Stop recording imports"""
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def _hook(self, name, globals=None, locals=None, fromlist=(), level=0):
+        imp = self._import
+        if level or name in sys.modules or threading.get_ident() != self._thread:
+            return imp(name, globals, locals, fromlist, level)
+
+        # Reserve our slot first so parents are listed before their children
+        i = len(self.imports)
+        self.imports.append(None)
+        depth = len(self._stack)
+        self._stack.append(0.0)
+        t = time.perf_counter()
+        try:
+            return imp(name, globals, locals, fromlist, level)
+        finally:
+            cum = time.perf_counter() - t
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += cum
+            self.imports[i] = (depth, name, cum - children, cum)
+
+    def ready(self, path=None, stop=None):
+        """Mark the process ready, report and optionally stop.
+
+        Meant to be scheduled with loop.call_soon just before run_forever,
+        so it runs on the first iteration of the event loop.
+
+        Parameters:
+            path    None or '' to log the report, otherwise a JSON file
+            stop    called after reporting, e.g. to shut the launcher down
+        """
+        self.mark('ready')
+        self.untrace()
+        if path:
+            with open(path, 'w') as f:
+                json.dump(self.to_dict(), f, indent=1)
+        else:
+            for line in self.report().splitlines():
+                logger.info(line)
+        if stop is not None:
+            stop()
+
+    def to_dict(self):
+        return {'ready': self.marks[-1][1],
+                'marks': self.marks,
+                'imports': [i for i in self.imports if i is not None]}
+
+    def report(self, min_time=1e-3, max_depth=2):
+        """Text report of phases and imports taking at least min_time"""
+        lines = ['{:<24} {:>9} {:>9}'.format('phase', 'at (s)', 'took (s)')]
+        prev = 0.0
+        for name, t in self.marks:
+            lines.append('{:<24} {:9.3f} {:9.3f}'.format(name, t, t - prev))
+            prev = t
+        imports = [i for i in self.imports
+                   if i is not None and i[3] >= min_time and i[0] <= max_depth]
+        if imports:
+            lines.append('{:>9} | {:>9} | imported package'.format('self (ms)', 'cum (ms)'))
+            for depth, name, self_, cum in imports:
+                lines.append('{:9.1f} | {:9.1f} | {}{}'.format(self_*1e3, cum*1e3, '  '*depth, name))
+        return '\n'.join(lines)
+
+def add_arguments(parser):
+    """Add the startup report options to a launcher's argument parser"""
+    parser.add_argument(FLAG, nargs='?', const='', default=None,
+        metavar='PATH', dest='startup_report',
+        help='report startup phase and import times; log them, or write JSON to PATH')
+    parser.add_argument('--startup-exit', action='store_true',
+        dest='startup_exit',
+        help='exit as soon as startup is complete (for startup benchmarks)')
+
+def _percentile(xs, q):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(q*(len(xs) - 1))))]
+
+def bench(cmd, n=10, timeout=120.0):
+    """Run a launcher command n times and collect its time to ready.
+
+    Returns a dict with per-run ready and wall clock times in seconds.
+    """
+    import subprocess
+    import tempfile
+
+    ready = []
+    wall = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'startup.json')
+        for i in range(n):
+            if os.path.exists(path):
+                os.unlink(path)
+            t = time.perf_counter()
+            subprocess.run(cmd + [FLAG, path, '--startup-exit'],
+                stdout=subprocess.DEVNULL, timeout=timeout, check=True)
+            wall.append(time.perf_counter() - t)
+            with open(path) as f:
+                ready.append(json.load(f)['ready'])
+            logger.info('run %d: ready after %.3f s, exited after %.3f s', i, ready[-1], wall[-1])
+
+    return {'cmd': cmd, 'ready': ready, 'wall': wall}
+
+def summarize(result):
+    return {key: {'median': _percentile(result[key], 0.5),
+                  'min': min(result[key]),
+                  'p90': _percentile(result[key], 0.9)}
+            for key in ('ready', 'wall')}
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark launcher time to ready.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    p = subparsers.add_parser('bench', help='run a launcher repeatedly and time its startup',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-n', type=int, default=10,
+                   help='number of runs')
+    p.add_argument('--timeout', type=float, default=120.0,
+                   help='seconds to wait for each run')
+    p.add_argument('--save', metavar='FILE',
+                   help='save results as JSON')
+    p.add_argument('--baseline', metavar='FILE',
+                   help='compare against results saved with --save')
+    p.add_argument('--tolerance', type=float, default=0.1,
+                   help='allowed fractional increase in median time to ready')
+    p.add_argument('cmd', nargs=argparse.REMAINDER,
+                   help='launcher command line, after --')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    cmd = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+    if not cmd:
+        parser.error('no launcher command given')
+
+    result = bench(cmd, args.n, args.timeout)
+    stats = summarize(result)
+    for key in ('ready', 'wall'):
+        print('{:<6} median {:.3f} s  min {:.3f} s  p90 {:.3f} s'.format(key,
+            stats[key]['median'], stats[key]['min'], stats[key]['p90']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            base = summarize(json.load(f))['ready']['median']
+        now = stats['ready']['median']
+        change = now/base - 1
+        print('baseline median {:.3f} s, now {:.3f} s ({:+.1%})'.format(base, now, change))
+        if change > args.tolerance:
+            print('REGRESSION: time to ready exceeds tolerance of {:.0%}'.format(args.tolerance))
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
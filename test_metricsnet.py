@@ -0,0 +1,140 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import metricsnet
+from metricsnet import Agent, Collector, FRAME
+
+RECV = np.dtype([('header_valid', 'u1'), ('payload_valid', 'u1'), ('src', 'u1'), ('dest', 'u1'),
+                 ('evm', 'f4'), ('rssi', 'f4')])
+SEND = np.dtype([('dest', 'u1'), ('size', 'u4')])
+
+def recv_rows(seed, n=200):
+    rng = np.random.default_rng(seed)
+    recv = np.zeros(n, RECV)
+    recv['header_valid'] = rng.random(n) < 0.9
+    recv['payload_valid'] = recv['header_valid'] & (rng.random(n) < 0.8)
+    recv['src'] = rng.integers(1, 4, n)
+    recv['dest'] = rng.integers(1, 4, n)
+    recv['evm'] = rng.normal(-20, 2, n)
+    recv['rssi'] = rng.normal(-50, 3, n)
+    return recv
+
+def send_rows(seed, n=100):
+    rng = np.random.default_rng(seed)
+    send = np.zeros(n, SEND)
+    send['dest'] = rng.integers(1, 4, n)
+    send['size'] = rng.integers(100, 1500, n)
+    return send
+
+def expected(recvs, sends):
+    """Totals per (src, dest) and dest computed row by row"""
+    links = {}
+    for recv in recvs:
+        for r in recv[recv['header_valid'] != 0]:
+            s = links.setdefault((int(r['src']), int(r['dest'])), dict.fromkeys(
+                ('n', 'valid', 'evm_sum', 'evm_sq', 'rssi_sum', 'rssi_sq'), 0.0))
+            s['n'] += 1
+            s['valid'] += r['payload_valid'] != 0
+            for k in ('evm', 'rssi'):
+                s[k + '_sum'] += float(r[k])
+                s[k + '_sq'] += float(r[k])**2
+    sent = {}
+    for send in sends:
+        for r in send:
+            s = sent.setdefault(int(r['dest']), {'n': 0, 'bytes': 0})
+            s['n'] += 1
+            s['bytes'] += int(r['size'])
+    return links, sent
+
+def check_totals(collector, node, recvs, sends):
+    links, sent = collector.totals()
+    elinks, esent = expected(recvs, sends)
+    assert sorted(links) == sorted((node,) + k for k in elinks)
+    for (_, src, dest), s in links.items():
+        assert s == pytest.approx(elinks[src, dest], rel=1e-5)
+    assert sent == {(node, dest): s for dest, s in esent.items()}
+
+def test_delta_round_trip():
+    links = metricsnet.link_stats(recv_rows(0))
+    sent = metricsnet.sent_stats(send_rows(0))
+    gauges = np.array([(0, 1.5), (3, -2.0)], metricsnet.GAUGE)
+    data = metricsnet.encode_delta(7, 123.5, 1.0, links, sent, gauges)
+    size, kind = FRAME.unpack_from(data)
+    assert (kind, size) == (metricsnet.DELTA, len(data) - FRAME.size)
+    seq, t, interval, l, s, g = metricsnet.decode_delta(data[FRAME.size:])
+    assert (seq, t, interval) == (7, 123.5, 1.0)
+    assert l.tobytes() == links.tobytes()
+    assert s.tobytes() == sent.tobytes()
+    assert g.tobytes() == gauges.tobytes()
+
+    names = metricsnet.encode_names([(0, 'loop.lag'), (3, 'netq')])
+    assert metricsnet.decode_names(names[FRAME.size:]) == {0: 'loop.lag', 3: 'netq'}
+
+def test_totals_sum_deltas():
+    collector = Collector()
+    seen = [0, 0]
+    recvs = [recv_rows(i) for i in range(3)]
+    sends = [send_rows(i) for i in range(3)]
+    for seq, (recv, send) in enumerate(zip(recvs, sends), 1):
+        data = metricsnet.encode_delta(seq, float(seq), 1.0, metricsnet.link_stats(recv),
+                                       metricsnet.sent_stats(send), np.zeros(0, metricsnet.GAUGE))
+        assert collector._apply(5, {}, seen, data[FRAME.size:]) == seq
+    # A resent delta is counted once
+    assert collector._apply(5, {}, seen, data[FRAME.size:]) == 3
+    assert (collector.deltas, collector.duplicates) == (3, 1)
+    check_totals(collector, 5, recvs, sends)
+
+    links, sent = collector.totals(since=2.0)
+    elinks, esent = expected(recvs[1:], sends[1:])
+    assert sum(s['n'] for s in links.values()) == sum(s['n'] for s in elinks.values())
+    assert sum(s['bytes'] for s in sent.values()) == sum(s['bytes'] for s in esent.values())
+
+def test_gauges_by_name():
+    collector = Collector()
+    data = metricsnet.encode_delta(1, 1.0, 1.0, np.zeros(0, metricsnet.LINK), np.zeros(0, metricsnet.SENT),
+                                   np.array([(0, 0.25), (1, 4.0)], metricsnet.GAUGE))
+    collector._apply(2, {0: 'loop.lag'}, [0, 0], data[FRAME.size:])
+    assert collector.view()[1] == {(2, 'loop.lag'): 0.25, (2, '1'): 4.0}
+
+def test_agent_to_collector():
+    """Deltas reach the collector once each across a dropped connection"""
+    recvs = [recv_rows(i) for i in range(4)]
+    sends = [send_rows(i) for i in range(4)]
+
+    async def settle(agent, collector):
+        for _ in range(200):
+            if agent.acked == agent.seq and collector.deltas == agent.seq:
+                return
+            await asyncio.sleep(0.01)
+        raise AssertionError('deltas not acked')
+
+    async def run():
+        collector = Collector()
+        port = await collector.start()
+        agent = Agent('unused.h5', ('127.0.0.1', port), node=4, retry=0.01)
+        agent.tasks = [asyncio.ensure_future(agent._link())]
+        try:
+            for recv, send in zip(recvs[:2], sends[:2]):
+                assert agent._delta(recv, send, 1.0)
+            agent.gauge('netq', 3.0)
+            assert agent._delta(None, None, 1.0)
+            await settle(agent, collector)
+
+            collector.drop_connections()
+            for recv, send in zip(recvs[2:], sends[2:]):
+                agent._delta(recv, send, 1.0)
+            await settle(agent, collector)
+            # Nothing changed, so there is nothing to send
+            assert not agent._delta(None, None, 1.0)
+        finally:
+            agent.close()
+            collector.close()
+            await asyncio.gather(*agent.tasks, return_exceptions=True)
+        return collector
+
+    collector = asyncio.run(run())
+    assert collector.deltas == 5
+    check_totals(collector, 4, recvs, sends)
+    assert collector.view()[1] == {(4, 'netq'): 3.0}
@@ -3,24 +3,34 @@
 import argparse
 import asyncio
 from concurrent.futures import CancelledError
-import IPython
-from itertools import chain,cycle,starmap
 import logging
 import os
-import random
 import signal
 import sys
 
-import dragonradio
-import dragon.radio
+import startup
 
-import numpy as np
+# Start timing before the heavy imports. Everything not needed by every run
+# (IPython, channel avoidance) is imported where it is used.
+timer = startup.StartupTimer.from_argv()
+
+# --sim swaps the radio for the radiosim network simulator. Like the
+# startup flags it is looked for by hand, since it decides what to import.
+if '--sim' in sys.argv[1:]:
+	import radiosim as radiolib
+else:
+	import dragon.radio as radiolib
+
+import console
+import loopmon
+import periodic
+import schedule
 
 async def cancel_tasks(loop):
-	tasks = [t for t in asyncio.Task.all_tasks() if t is not asyncio.Task.current_task()]
+	tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
 	for task in tasks:
 		task.cancel()
-		await task
+	await asyncio.gather(*tasks, return_exceptions=True)
 
 	loop.stop()
 
@@ -29,7 +39,8 @@ def cancel_loop():
 	loop.create_task(cancel_tasks(loop))
 
 def main():
-	config = dragon.radio.Config()
+	timer.mark('imports')
+	config = radiolib.Config()
 	
 	parser = argparse.ArgumentParser(description='Run dragonradio.',
 		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -40,21 +51,46 @@ def main():
 	parser.add_argument('--aloha', action='store_true', dest='aloha',
 		default=False,
 		help='use slotted ALOHA MAC')
+	parser.add_argument('--sim', action='store_true', dest='sim',
+		help='run against the radiosim network simulator instead of the radio')
 	parser.add_argument('--interactive',
 		action='store_true', dest='interactive',
-		help='enter interactive shell after radio is configured')
+		help='enter IPython after radio is configured (stops the event loop; see --console)')
 	parser.add_argument('--cycle-tx-gain', action='store',
 		choices=['sequential', 'discontinuous', 'random'],
 		help='enable TX gain cycling')
 	parser.add_argument('--cycle-tx-gain-period', type=float,
 		default=10,
 		help='TX gain cycling period')
+	parser.add_argument('--avoid-jamming', action='store_true',
+		dest='avoid_jamming',
+		help='reinstall MAC schedule to avoid jammed channels')
+	parser.add_argument('--avoid-jamming-period', type=float,
+		default=0.5, dest='avoid_jamming_period',
+		help='seconds between spectrum snapshots for channel avoidance')
+	parser.add_argument('--avoid-jamming-duration', type=float,
+		default=0.05, dest='avoid_jamming_duration',
+		help='length of spectrum snapshots for channel avoidance')
+	parser.add_argument('--snapshot-ring', action='store',
+		default=None, metavar='NAME', dest='snapshot_ring',
+		help='publish snapshots to the shared memory ring NAME for live analysis')
+	parser.add_argument('--snapshot-ring-slots', type=int,
+		default=8, dest='snapshot_ring_slots',
+		help='snapshots held by the snapshot ring')
+	parser.add_argument('--snapshot-ring-samples', type=int,
+		default=1 << 20, dest='snapshot_ring_samples',
+		help='samples per snapshot ring slot')
+	console.add_arguments(parser)
+	loopmon.add_arguments(parser)
+	periodic.add_arguments(parser)
+	startup.add_arguments(parser)
 
 	# Parse arguments
 	try:
 		parser.parse_args(namespace=config)
 	except SystemExit as ex:
 		return ex.code
+	timer.mark('arguments')
 	
 	logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
 		level=config.loglevel)
@@ -63,7 +99,8 @@ def main():
 		config.log_sources += ['log_recv_packets','log_sent_packets','log_events']
 	
 	# Create radio object
-	radio = dragon.radio.Radio(config)
+	radio = radiolib.Radio(config)
+	timer.mark('radio')
 
 	# Configure MAC objects
 	# The schedule will be nchannels x nslots, so each row represents
@@ -76,45 +113,134 @@ def main():
 	#    V   [1,,,2,,,3,,,]
 	nslots = 10
 	nchannels = len(radio.channels)
-	sched = np.array([1,2,3,1,2,3,1,2,3,1]) # nchannels x nslots array
-	schedarray = []
-	for i in range(0,nchannels):
-		schedarray.append(sched)
-	# schedarray is now a list of arrays: [ array([1,2,3...]), array([1,2,3...]), ... ]
-
-	schedstack = np.vstack(sched) # Turn the list of arrays into a vertical stack of the arrays
-	# => array([ [1,2,3...],
-	#			 [1,2,3...],
+	nodes = range(1, config.num_nodes+1)
+	# The simulator plays every node of the network
+	if config.sim:
+		for node in nodes:
+			radio.net.addNode(node)
+	# => array([ [1,2,1,2...],
+	#			 [1,2,1,2...],
 	#			 ...
-	#			 [1,2,3...] ])
+	#			 [1,2,1,2...] ])
+	sched = schedule.tdma(nodes, nchannels, nslots)
 
 	# This calls configureTDMA() and installs the TDMA schedule
-	radio.installMACSchedule(schedstack)
+	radio.installMACSchedule(sched)
+	timer.mark('schedule')
 
 	#
 	# Start IPython shell if we are in interactive mode. Otherwise, run the
 	# event loop.
 	#
 	if config.interactive:
+		import IPython
+
+		if config.startup_report is not None:
+			timer.ready(config.startup_report)
 		IPython.embed()
 	else:
 		loop = asyncio.get_event_loop()
-
-		if config.log_snapshots != 0:
-			loop.create_task(radio.snapshotLogger())
-
-#		if config.cycle_tx_gain is not None:
-#			loop.create_task(cycle_tx_gain(radio,
-#				config.cycle_tx_gain_period,
-#				cycle_algorithm(config.cycle_tx_gain)))
+		controller = None
+		snapshots = None
+
+		# Instrument the loop. The launcher's own tasks are started with
+		# spawn, so the monitor times each of their steps.
+		monitor = loopmon.from_config(loop, config)
+		if monitor is not None:
+			monitor.install()
+			spawn = monitor.create_task
+		else:
+			spawn = loop.create_task
+
+		# The simulator advances in real time on the loop, like the radio
+		# would on its own threads
+		if config.sim:
+			loop.create_task(radio.start())
+
+		# Channel avoidance and the snapshot ring both take snapshots from one
+		# source task, which also logs as many as the snapshot logger would,
+		# so it replaces the snapshot logger
+		queue = None
+		if config.avoid_jamming:
+			import antijam
+
+			queue = asyncio.Queue()
+			controller = antijam.ChannelAvoidance(radio, queue, nslots=nslots,
+				nodes=nodes)
+			spawn(controller.run())
+
+		# Snapshots go to analysis processes through shared memory as they are
+		# captured
+		if config.snapshot_ring:
+			import snapring
+
+			snapshots = snapring.SnapshotPublisher(config.snapshot_ring,
+				config.snapshot_ring_slots, config.snapshot_ring_samples)
+
+		if queue is not None or snapshots is not None:
+			import antijam
+
+			# Channel avoidance sets its own snapshot rate
+			if config.avoid_jamming:
+				period, duration = config.avoid_jamming_period, config.avoid_jamming_duration
+			else:
+				period, duration = config.snapshot_period, config.snapshot_duration
+			spawn(antijam.snapshot_source(radio, queue, period, duration,
+				ring=snapshots, log_snapshots=config.log_snapshots))
+		elif config.log_snapshots != 0:
+			spawn(radio.snapshotLogger())
+
+		# Periodic control actions run at absolute deadlines on slot
+		# boundaries rather than from sleep loops, which drift
+		periodic_sched = periodic.from_config(loop, config)
+
+		periodic.add_cycle_tx_gain(periodic_sched, radio, config)
+
+		# Serve a console from the loop, so the tasks above keep running while
+		# someone inspects the radio
+		shell = console.from_config(loop, config, {'radio': radio, 'config': config,
+			'loop': loop, 'schedule': schedule, 'controller': controller,
+			'snapshots': snapshots, 'monitor': monitor, 'periodic': periodic_sched},
+			on_exit=cancel_loop)
+		if shell is not None:
+			shell.start()
 
 		for sig in [signal.SIGINT, signal.SIGTERM]:
 			loop.add_signal_handler(sig, cancel_loop)
+		# Ctrl-C belongs to the console; SIGTERM still stops the radio
+		if shell is not None and config.console:
+			loop.add_signal_handler(signal.SIGINT, shell.interrupt)
+
+		# The radio is transmit-ready once the loop starts running its tasks
+		if config.startup_report is not None:
+			loop.call_soon(timer.ready, config.startup_report,
+				cancel_loop if config.startup_exit else None)
 
 		try:
 			loop.run_forever()
 		finally:
+			if shell is not None:
+				shell.close()
+			if monitor is not None:
+				monitor.close()
+			periodic_sched.close()
 			loop.close()
+			if config.sim:
+				radio.close()
+			if snapshots is not None:
+				snapshots.close()
+
+		if controller is not None:
+			logging.info('Channel avoidance: %s', controller.latency_report())
+		if snapshots is not None:
+			logging.info('Snapshot ring: %s', snapshots.summary())
+		if config.sim:
+			logging.info('Simulation: %s', radio.stats())
+		if shell is not None:
+			logging.info('Console: %s', shell.summary())
+		if monitor is not None:
+			logging.info('Event loop: %s', monitor.summary())
+		logging.info('Periodic jobs: %s', periodic_sched.summary())
 
 	return 0
 
@@ -0,0 +1,42 @@
+import asyncio
+
+import numpy as np
+
+import schedule
+from schedist import Distributor, NodeServer
+
+NODES = [1, 2, 3]
+
+def test_restart_resyncs_node():
+    """A node holding a schedule from before a distributor restart gets the
+    new distributor's schedule, even when the new versions are pushed the
+    same way"""
+    before = schedule.tdma(NODES, 4, 6)
+    after = schedule.fdma(NODES, 4, 6)
+
+    async def push(addrs, sched):
+        dist = Distributor(addrs, retry=0.01)
+        dist.start()
+        try:
+            assert await dist.wait(dist.push(sched), timeout=5)
+        finally:
+            dist.close()
+            await asyncio.gather(*dist.tasks, return_exceptions=True)
+        return dist
+
+    async def run():
+        node = NodeServer()
+        addrs = {1: ('127.0.0.1', await node.start())}
+        try:
+            first = await push(addrs, before)
+            assert np.array_equal(node.schedule, before)
+            second = await push(addrs, after)
+        finally:
+            node.close()
+        return node, first, second
+
+    node, first, second = asyncio.run(run())
+    assert np.array_equal(node.schedule, after)
+    assert first.version != second.version
+    assert node.version == second.version
+    assert node.installs == 2
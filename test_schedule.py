@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+import schedule
+
+NODES = [1, 2, 3]
+
+@pytest.mark.parametrize('build', [schedule.tdma, schedule.fdma, schedule.hybrid])
+def test_generated_schedules_validate(build):
+    sched = build(NODES, 8, 6, blocked=[2], weights=[1, 1, 2])
+    schedule.validate(sched, NODES, blocked=[2])
+    schedule.validate(schedule.node_masks(sched, NODES), NODES, blocked=[2])
+
+def test_hybrid_min_hop_validates():
+    sched = schedule.hybrid(NODES, 8, 10, min_hop=2)
+    schedule.validate(sched, NODES, min_hop=2)
+
+# nslots*h = 0 (mod 8), and (nslots - 1)*h = 0 (mod 8) for h = 2, where a
+# stream would come back to its first channel across the wrap
+@pytest.mark.parametrize('nslots', [4, 5])
+def test_hybrid_min_hop_across_wrap(nslots):
+    nodes = range(1, 9)
+    sched = schedule.hybrid(nodes, 8, nslots, min_hop=2)
+    schedule.validate(sched, nodes, min_hop=2)
+    n, d = schedule.hop_distances(sched)
+    assert len(n) == 8*nslots
+    assert d.min() >= 2
+
+def test_hop_step():
+    assert schedule.hop_step(8, 4, 2) == 2
+    assert schedule.hop_step(8, 5, 2) == 3
+    with pytest.raises(ValueError, match='Cannot hop at least 2 channels'):
+        schedule.hop_step(8, 1, 2)
+    with pytest.raises(ValueError, match='Cannot hop at least 3 channels'):
+        schedule.hop_step(5, 4, 3)
+
+def test_weighted_share():
+    sched = schedule.tdma(NODES, 4, 8, weights=[1, 1, 2])
+    schedule.validate(sched, NODES, weights=[1, 1, 2])
+    with pytest.raises(ValueError, match='airtime off weighted share'):
+        schedule.validate(sched, NODES, weights=[4, 1, 1])
+
+def test_reports_every_violation():
+    sched = schedule.tdma(NODES, 4, 6)
+    sched[1, 0] = 7
+    with pytest.raises(ValueError) as e:
+        schedule.validate(sched, NODES, blocked=[3], max_channels=1)
+    msg = str(e.value)
+    assert 'unknown nodes [7]' in msg
+    assert 'blocked channels in use [3]' in msg
+    assert 'nodes on more than 1 channels in a slot' in msg
+
+def test_short_hops():
+    sched = np.zeros((4, 3), dtype=int)
+    sched[[0, 1, 3], [0, 1, 2]] = 1
+    n, d = schedule.hop_distances(sched)
+    # The last slot and the first are adjacent too
+    assert n.tolist() == [1, 1, 1]
+    assert d.tolist() == [1, 2, 3]
+    with pytest.raises(ValueError, match=r'hops shorter than 2 channels for nodes \[1\]'):
+        schedule.validate(sched, [1], min_hop=2)
+
+def test_short_hop_across_wrap():
+    # Channels 0, 2, 4, 6, 0: every hop is 2 but the last
+    sched = np.zeros((8, 5), dtype=int)
+    sched[[0, 2, 4, 6, 0], range(5)] = 1
+    schedule.validate(sched[:, :4], [1], min_hop=2)
+    with pytest.raises(ValueError, match=r'hops shorter than 2 channels for nodes \[1\]'):
+        schedule.validate(sched, [1], min_hop=2)
+
+def test_per_node_collisions():
+    masks = schedule.node_masks(schedule.fdma(NODES, 6, 4), NODES)
+    masks[2, 0, 1] = True
+    masks[1, 5, 3] = True
+    assert schedule.collisions(masks).tolist() == [[0, 1], [5, 3]]
+    with pytest.raises(ValueError, match=r'cells claimed by more than one node \[\[0, 1\], \[5, 3\]\]'):
+        schedule.validate(masks, NODES)
+
+def test_per_node_schedules_need_node_ids():
+    masks = schedule.node_masks(schedule.tdma(NODES, 4, 6), NODES)
+    with pytest.raises(ValueError, match='one node ID each'):
+        schedule.validate(masks)
+    with pytest.raises(ValueError, match='one node ID each'):
+        schedule.validate(masks, [1, 2])
+
+def test_infeasible_fdma():
+    with pytest.raises(ValueError, match='FDMA needs at least as many usable channels'):
+        schedule.fdma(NODES, 3, 4, blocked=[0])
@@ -0,0 +1,448 @@
+# UDP TRAFFIC GENERATOR AND MEASUREMENT
+#
+# Asyncio replacement for the manual iperf and ffmpeg/VLC checks. A sender
+# paces UDP packets for any number of flows and a receiver measures them:
+#
+#     cbr       constant bitrate
+#     bursty    on/off bursts with the given mean rate
+#     video     frames at fps with periodic larger I-frames, each frame
+#               split into packets and sent back to back
+#
+# Every packet starts with a header of flow id, sequence number, send time
+# (ns since the epoch), frame number and flags. Pacing is on absolute
+# deadlines from the flow start: each wakeup sends every packet that is due,
+# so sleep overshoot never accumulates into a lower rate, and the send time
+# in the header is the time the packet actually went out.
+#
+# The receiver timestamps every packet on arrival and, per flow, reports
+# goodput, one-way latency percentiles (sender and receiver clocks must
+# agree; they trivially do over loopback), RFC 3550 interarrival jitter,
+# loss, duplicates and reordering. The sender ends each flow with a few FIN
+# packets carrying the number of packets sent, so loss at the tail of a flow
+# is counted.
+#
+# Usage:
+#   python traffic.py recv [--bind 0.0.0.0] [--port 54545] [-o results.json]
+#   python traffic.py send --dest 10.10.10.1 --flow cbr:rate=200k --duration 10
+#   python traffic.py loopback --flow video:rate=2M --flow cbr:rate=200k --flows 10
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import socket
+import struct
+import sys
+import time
+
+import numpy as np
+import scipy.signal
+
+logger = logging.getLogger('traffic')
+
+DEFAULT_PORT = 54545
+
+# flow, seq, send time (ns), frame, flags
+HEADER = struct.Struct('<IQQIH')
+
+FLAG_FIN = 1
+
+# Largest UDP payload that fits a 1500 byte MTU
+MAX_PAYLOAD = 1472
+
+def parse_rate(s):
+    """Parse a bit rate with an optional k/M/G suffix, as iperf does"""
+    if isinstance(s, (int, float)):
+        return float(s)
+    mult = {'k': 1e3, 'm': 1e6, 'g': 1e9}.get(s[-1].lower())
+    return float(s[:-1])*mult if mult else float(s)
+
+def packet_size(size):
+    """Check a packet size in bytes: it must hold the header and fit in one
+    UDP payload"""
+    size = int(size)
+    if not HEADER.size <= size <= MAX_PAYLOAD:
+        raise ValueError('Packet size {} outside [{}, {}] bytes'.format(size, HEADER.size, MAX_PAYLOAD))
+    return size
+
+Flow = collections.namedtuple('Flow', ['kind', 'params'])
+
+def parse_flow(spec):
+    """Parse kind:key=value,... into a Flow"""
+    kind, _, rest = spec.partition(':')
+    if kind not in PATTERNS:
+        raise ValueError('Unknown flow {} (one of {})'.format(kind, ', '.join(PATTERNS)))
+    params = {}
+    for item in filter(None, rest.split(',')):
+        key, _, value = item.partition('=')
+        params[key.strip()] = parse_rate(value) if key.strip() == 'rate' else float(value)
+    if 'size' in params:
+        packet_size(params['size'])
+    return Flow(kind, params)
+
+def cbr(rate=200e3, size=1000, seed=None):
+    """Packets of size bytes every size*8/rate seconds"""
+    size = packet_size(size)
+    interval = size*8/rate
+    k = 0
+    while True:
+        yield k*interval, size, k
+        k += 1
+
+def bursty(rate=200e3, size=1000, on=0.1, off=0.4, seed=None):
+    """Back-to-back CBR bursts at rate*(on+off)/on for on seconds, then off
+    seconds of silence, with exponentially distributed on and off times"""
+    rng = np.random.default_rng(seed)
+    size = packet_size(size)
+    interval = size*8/(rate*(on + off)/on)
+    t = 0.0
+    burst = 0
+    while True:
+        end = t + rng.exponential(on)
+        while t < end:
+            yield t, size, burst
+            t += interval
+        t = end + rng.exponential(off)
+        burst += 1
+
+def video(rate=2e6, fps=30, gop=30, iframe=5, var=0.2, size=MAX_PAYLOAD, seed=None):
+    """Video-like frames: fps frames per second, every gop-th an I-frame
+    iframe times the size of a P-frame, sizes lognormally spread by var,
+    each frame split into packets of at most size bytes sent together"""
+    rng = np.random.default_rng(seed)
+    size = packet_size(size)
+    gop = int(gop)
+    # Mean P-frame size giving the requested mean rate
+    pframe = rate/8/fps*gop/(gop - 1 + iframe)
+    k = 0
+    while True:
+        mean = pframe*(iframe if k % gop == 0 else 1)
+        nbytes = max(int(mean*rng.lognormal(-var**2/2, var)), HEADER.size)
+        t = k/fps
+        while nbytes > 0:
+            n = max(min(nbytes, size), HEADER.size)
+            yield t, n, k
+            nbytes -= n
+        k += 1
+
+PATTERNS = {'cbr': cbr, 'bursty': bursty, 'video': video}
+
+class FlowSender:
+    """Send one flow to dest, paced on absolute deadlines.
+
+    Parameters:
+        flow_id     Flow ID carried in every packet
+        flow        Flow(kind, params)
+        dest        (host, port)
+        duration    Seconds to send for
+        seed        Seed for randomized patterns
+    """
+    def __init__(self, flow_id, flow, dest, duration, seed=None):
+        self.flow_id = flow_id
+        self.flow = flow
+        self.dest = dest
+        self.duration = duration
+        self.pattern = PATTERNS[flow.kind](seed=seed, **flow.params)
+        self.buf = bytearray(MAX_PAYLOAD)
+        self.sent = 0
+        self.bytes = 0
+        self.lateness = []
+        self.frames = []
+
+    def _send(self, transport, seq, size, frame, flags=0):
+        HEADER.pack_into(self.buf, 0, self.flow_id, seq, time.time_ns(), frame, flags)
+        transport.sendto(memoryview(self.buf)[:size])
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol,
+                                                           remote_addr=self.dest)
+        try:
+            start = loop.time()
+            due, size, frame = next(self.pattern)
+            while due < self.duration:
+                now = loop.time() - start
+                if due > now:
+                    await asyncio.sleep(due - now)
+                    now = loop.time() - start
+
+                # Send everything that is due
+                while due <= now and due < self.duration:
+                    self._send(transport, self.sent, size, frame)
+                    self.lateness.append(now - due)
+                    self.frames.append(frame)
+                    self.sent += 1
+                    self.bytes += size
+                    due, size, frame = next(self.pattern)
+
+            for _ in range(3):
+                self._send(transport, self.sent, HEADER.size, 0, FLAG_FIN)
+                await asyncio.sleep(0.01)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            transport.close()
+
+    def report(self):
+        late = 1e3*np.asarray(self.lateness)
+        r = {'flow': self.flow_id,
+             'kind': self.flow.kind,
+             'params': self.flow.params,
+             'sent': self.sent,
+             'bytes': self.bytes,
+             'rate_bps': 8*self.bytes/self.duration}
+        if len(late):
+            r['pacing_p50_ms'] = float(np.percentile(late, 50))
+            r['pacing_p99_ms'] = float(np.percentile(late, 99))
+        return r
+
+class Receiver(asyncio.DatagramProtocol):
+    """Record the header and arrival time of every packet, per flow"""
+    def __init__(self):
+        self.packets = collections.defaultdict(list)
+        self.fin = {}
+        self.bad = 0
+
+    def datagram_received(self, data, addr):
+        rx = time.time_ns()
+        if len(data) < HEADER.size:
+            self.bad += 1
+            return
+        flow, seq, tx, frame, flags = HEADER.unpack_from(data)
+        if flags & FLAG_FIN:
+            self.fin[flow] = seq
+        else:
+            self.packets[flow].append((seq, tx, rx, len(data)))
+
+    def reset(self):
+        self.packets.clear()
+        self.fin.clear()
+        self.bad = 0
+
+    def report(self):
+        flows = sorted(set(self.packets) | set(self.fin))
+        return [flow_stats(flow, self.packets.get(flow, []), self.fin.get(flow))
+                for flow in flows]
+
+def rfc3550_jitter(tx, rx):
+    """Final RFC 3550 interarrival jitter (same units as tx and rx)"""
+    if len(tx) < 2:
+        return 0.0
+    d = np.abs(np.diff(rx) - np.diff(tx))
+    # J += (|D| - J)/16 as a one-pole filter
+    j = scipy.signal.lfilter([1/16], [1, -15/16], d)
+    return float(j[-1])
+
+def flow_stats(flow, packets, sent=None):
+    """Statistics of one flow from (seq, tx_ns, rx_ns, size) in arrival order"""
+    stats = {'flow': flow, 'received': 0}
+    if sent is not None:
+        stats['sent'] = sent
+    if not packets:
+        if sent:
+            stats['loss'] = 1.0
+        return stats
+
+    p = np.array(packets, dtype=np.int64)
+    seq, tx, rx, size = p.T
+
+    _, first = np.unique(seq, return_index=True)
+    unique = np.zeros(len(seq), dtype=bool)
+    unique[first] = True
+    useq, utx, urx, usize = seq[unique], tx[unique], rx[unique], size[unique]
+
+    expected = sent if sent is not None else int(seq.max()) + 1
+    # A packet is reordered if a later sequence number arrived before it
+    prev_max = np.maximum.accumulate(np.r_[-1, useq[:-1]])
+    reordered = int(np.count_nonzero(useq < prev_max))
+
+    latency = (urx - utx)/1e6
+    span = (urx[-1] - urx[0])/1e9
+
+    stats.update({
+        'received': int(len(useq)),
+        'duplicates': int(len(seq) - len(useq)),
+        'loss': float(1 - len(useq)/expected) if expected else 0.0,
+        'reordered': reordered,
+        'reorder_ratio': reordered/len(useq),
+        'bytes': int(usize.sum()),
+        'goodput_bps': float(8*usize[1:].sum()/span) if span > 0 else 0.0,
+        'latency_mean_ms': float(latency.mean()),
+        'latency_p50_ms': float(np.percentile(latency, 50)),
+        'latency_p90_ms': float(np.percentile(latency, 90)),
+        'latency_p99_ms': float(np.percentile(latency, 99)),
+        'latency_max_ms': float(latency.max()),
+        'jitter_ms': rfc3550_jitter(utx, urx)/1e6,
+    })
+    return stats
+
+def frame_stats(frames, seqs):
+    """Return (frames sent, frames received complete).
+
+    frames is the frame number of every packet sent (FlowSender.frames) and
+    seqs the sequence numbers received; a frame is complete when every one
+    of its packets arrived.
+    """
+    frames = np.asarray(frames)
+    if len(frames) == 0:
+        return 0, 0
+    seqs = np.asarray(seqs, dtype=np.int64)
+    got = np.zeros(len(frames), dtype=bool)
+    got[seqs[(seqs >= 0) & (seqs < len(frames))]] = True
+    _, inv = np.unique(frames, return_inverse=True)
+    missing = np.bincount(inv, weights=~got)
+    return int(len(missing)), int(np.count_nonzero(missing == 0))
+
+async def receive(bind, port, duration=None, idle=2.0):
+    """Receive until duration elapses or no packet arrives for idle seconds
+    after FINs for every flow seen"""
+    loop = asyncio.get_event_loop()
+    transport, proto = await loop.create_datagram_endpoint(Receiver, local_addr=(bind, port))
+    _enlarge_rcvbuf(transport)
+    try:
+        start = loop.time()
+        while duration is None or loop.time() - start < duration:
+            await asyncio.sleep(0.1)
+            if proto.fin and set(proto.fin) >= set(proto.packets):
+                await asyncio.sleep(idle)
+                break
+    except asyncio.CancelledError:
+        pass
+    finally:
+        transport.close()
+    return proto
+
+def _enlarge_rcvbuf(transport, size=8 << 20):
+    sock = transport.get_extra_info('socket')
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    except OSError:
+        pass
+
+async def send(flows, dest, duration, nflows=1, seed=None, first_id=0):
+    """Send nflows copies of every flow in flows to dest concurrently"""
+    senders = []
+    for i in range(nflows):
+        for flow in flows:
+            flow_id = first_id + len(senders)
+            senders.append(FlowSender(flow_id, flow, dest, duration,
+                                      None if seed is None else seed + flow_id))
+    await asyncio.gather(*[s.run() for s in senders])
+    return senders
+
+async def loopback(flows, duration, nflows=1, port=DEFAULT_PORT, seed=None, host='127.0.0.1'):
+    """Run sender and receiver in one event loop over host"""
+    recv_task = asyncio.ensure_future(receive(host, port, duration + 10))
+    await asyncio.sleep(0.1)
+    senders = await send(flows, (host, port), duration, nflows, seed)
+    proto = await recv_task
+    return senders, proto
+
+def summarize(sent, received):
+    """Combine per-flow sender and receiver statistics"""
+    by_flow = {r['flow']: dict(r) for r in received}
+    for s in sent:
+        r = by_flow.setdefault(s['flow'], {'flow': s['flow'], 'received': 0, 'loss': 1.0})
+        r['tx'] = s
+    flows = [by_flow[k] for k in sorted(by_flow)]
+
+    def agg(key, fn):
+        vals = [f[key] for f in flows if key in f]
+        return float(fn(vals)) if vals else None
+
+    return {'flows': flows,
+            'total': {'flows': len(flows),
+                      'goodput_bps': agg('goodput_bps', np.sum),
+                      'loss_mean': agg('loss', np.mean),
+                      'loss_max': agg('loss', np.max),
+                      'latency_p99_ms_max': agg('latency_p99_ms', np.max),
+                      'jitter_ms_max': agg('jitter_ms', np.max)}}
+
+def write_results(results, path):
+    if path is None or path == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+def parse_dest(s):
+    host, _, port = s.rpartition(':')
+    if not host:
+        return s, DEFAULT_PORT
+    return host, int(port)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate and measure UDP traffic.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    sub = parser.add_subparsers(dest='cmd')
+
+    def add_send_args(p):
+        p.add_argument('--flow', action='append', type=parse_flow, default=[],
+                       dest='flows', metavar='KIND:KEY=VALUE,...',
+                       help='add a flow ({})'.format(', '.join(PATTERNS)))
+        p.add_argument('--flows', action='store', type=int, default=1, dest='nflows',
+                       help='number of copies of each flow')
+        p.add_argument('-t', '--duration', action='store', type=float, default=10.0,
+                       help='seconds to send for')
+        p.add_argument('--seed', action='store', type=int, default=None,
+                       help='random seed for bursty and video flows')
+
+    p = sub.add_parser('recv', help='receive and measure flows')
+    p.add_argument('--bind', action='store', default='0.0.0.0',
+                   help='address to listen on')
+    p.add_argument('--port', action='store', type=int, default=DEFAULT_PORT,
+                   help='port to listen on')
+    p.add_argument('-t', '--duration', action='store', type=float, default=None,
+                   help='maximum seconds to listen')
+    p.add_argument('-o', '--output', action='store', default=None,
+                   help='JSON results file (default stdout)')
+
+    p = sub.add_parser('send', help='send flows')
+    p.add_argument('--dest', action='store', type=parse_dest, required=True,
+                   help='destination host[:port]')
+    p.add_argument('--first-id', action='store', type=int, default=0,
+                   help='flow ID of the first flow')
+    p.add_argument('-o', '--output', action='store', default=None,
+                   help='JSON sender report (default stdout)')
+    add_send_args(p)
+
+    p = sub.add_parser('loopback', help='send and receive over a local address')
+    p.add_argument('--host', action='store', default='127.0.0.1',
+                   help='address to send to and receive on (e.g. a tap device)')
+    p.add_argument('--port', action='store', type=int, default=DEFAULT_PORT,
+                   help='port to use')
+    p.add_argument('-o', '--output', action='store', default=None,
+                   help='JSON results file (default stdout)')
+    add_send_args(p)
+
+    args = parser.parse_args()
+    if args.cmd is None:
+        parser.error('one of recv, send or loopback is required')
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    if args.cmd != 'recv' and not args.flows:
+        args.flows = [parse_flow('cbr:rate=200k')]
+
+    loop = asyncio.get_event_loop()
+    try:
+        if args.cmd == 'recv':
+            proto = loop.run_until_complete(receive(args.bind, args.port, args.duration))
+            write_results(summarize([], proto.report()), args.output)
+        elif args.cmd == 'send':
+            senders = loop.run_until_complete(send(args.flows, args.dest, args.duration,
+                                                   args.nflows, args.seed, args.first_id))
+            write_results({'flows': [s.report() for s in senders]}, args.output)
+        else:
+            senders, proto = loop.run_until_complete(loopback(args.flows, args.duration,
+                                                              args.nflows, args.port,
+                                                              args.seed, args.host))
+            write_results(summarize([s.report() for s in senders], proto.report()),
+                          args.output)
+    finally:
+        loop.close()
+
+if __name__ == '__main__':
+    main()
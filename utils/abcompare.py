@@ -0,0 +1,529 @@
+# A/B RUN COMPARISON
+""" abcompare
+Compare two groups of dragonradio runs (say TDMA against --aloha, or a run
+with a jammer against one without) link by link, with bootstrap confidence
+intervals on every difference.
+
+A group is one or more runs. A run is a directory holding one radio.h5 per
+node (as written by test_radio.py or radiosim.py -d), or a list of node logs.
+For every link (src -> dest) we compute
+
+    delivery_ratio      packets delivered to dest / packets sent by src
+    goodput_bps         delivered payload bits per second
+    latency_*           first transmission to reception at dest (s)
+    evm_*, rssi_*       of the packets dest received (dB)
+
+where * is mean, p50 and p95, for every time window of every run and over
+the whole group, plus the same for the network as a whole (link 'all').
+Packets are matched on (src, dest, seq) to the latest send before they were
+received, so sequence numbers may wrap; retransmissions of a packet count as
+one send and duplicates as one delivery.
+
+Everything is reduced to per (window, link) sums and per-window histograms
+of latency, EVM and RSSI with bincount. The bootstrap resamples whole
+windows (a block bootstrap, so correlation inside a window is kept): a
+replicate is a vector of multinomial window counts, so the sums of a whole
+batch of replicates are one matrix product and quantiles come from the
+resampled histograms. Batches of replicates run in a process pool. The two
+groups are resampled independently and the interval of B - A is the
+percentile interval of the replicate differences. The intervals are not
+corrected for multiple comparisons: with 90 links and a 95% level, expect a
+handful of links to be flagged by chance.
+
+Usage:
+    python abcompare.py -a runs/tdma -b runs/aloha [--window 10] [-o diff.csv]
+    python abcompare.py -a runs/tdma/node-*/radio.h5 -b ... --windows windows.csv
+    python abcompare.py --bench [--nodes 10] [--duration 3600]
+"""
+import argparse
+import csv
+import glob
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+
+from hdf5_utils import node_id
+
+logger = logging.getLogger('abcompare')
+
+METRICS = ['delivery_ratio', 'goodput_bps',
+           'latency_mean', 'latency_p50', 'latency_p95',
+           'evm_mean', 'evm_p50', 'evm_p95',
+           'rssi_mean', 'rssi_p50', 'rssi_p95']
+
+# Histogram bin edges of the distributions
+BINS = {'latency': np.geomspace(1e-4, 1e3, 281),
+        'evm': np.linspace(-60.0, 10.0, 281),
+        'rssi': np.linspace(-120.0, 20.0, 281)}
+
+SEND_FIELDS = ['timestamp', 'curhop', 'src', 'dest', 'seq', 'size']
+RECV_FIELDS = ['timestamp', 'payload_valid', 'src', 'dest', 'seq', 'size', 'evm', 'rssi']
+
+def find_logs(path):
+    """Node logs of a run directory, or the path itself if it is a log"""
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '**', 'radio.h5'), recursive=True))
+    return [path]
+
+def load_run(paths):
+    """Load the sends and receptions of one run's node logs.
+
+    Returns (send, recv) structured arrays over all nodes; send only holds
+    packets a node originated and recv only packets that reached their
+    destination with a valid payload.
+    """
+    sends = []
+    recvs = []
+    for path in paths:
+        with h5py.File(path, 'r') as f:
+            send = f['send'].fields(SEND_FIELDS)[:] if 'send' in f else None
+            recv = f['recv'].fields(RECV_FIELDS)[:] if 'recv' in f else None
+        node = node_id(path, send if send is not None else ())
+        if send is not None:
+            sends.append(send[send['src'] == send['curhop']])
+        if recv is not None:
+            keep = recv['payload_valid'] != 0
+            if node is not None:
+                keep &= recv['dest'] == node
+            recvs.append(recv[keep])
+
+    send = np.concatenate(sends) if sends else np.empty(0, dtype=[(n, 'f8') for n in SEND_FIELDS])
+    recv = np.concatenate(recvs) if recvs else np.empty(0, dtype=[(n, 'f8') for n in RECV_FIELDS])
+    return send, recv
+
+def match(send, recv, max_latency=30.0):
+    """Match receptions to sends.
+
+    Returns (first, j, latency): the mask of sends that are first
+    transmissions, and for every reception the index of its first
+    transmission in send (-1 if unmatched) and its latency.
+    """
+    skey = (send['src'].astype(np.int64) << 24) | (send['dest'].astype(np.int64) << 16) | send['seq'].astype(np.int64)
+    rkey = (recv['src'].astype(np.int64) << 24) | (recv['dest'].astype(np.int64) << 16) | recv['seq'].astype(np.int64)
+    st = send['timestamp']
+    rt = recv['timestamp']
+
+    # Rank all times together so (key, time) fits in one int64 sort key
+    ranks = np.empty(len(st) + len(rt), dtype=np.int64)
+    ranks[np.argsort(np.concatenate([st, rt]), kind='stable')] = np.arange(len(ranks))
+    n = len(ranks) + 1
+    scomb = skey*n + ranks[:len(st)]
+    rcomb = rkey*n + ranks[len(st):]
+
+    order = np.argsort(scomb, kind='stable')
+    sk = skey[order]
+    stime = st[order]
+
+    # A send repeating the previous one's key soon after is a retransmission
+    first_sorted = np.ones(len(order), dtype=bool)
+    first_sorted[1:] = (sk[1:] != sk[:-1]) | (stime[1:] - stime[:-1] > max_latency)
+    # Each send maps to the first transmission of its packet
+    head = np.maximum.accumulate(np.where(first_sorted, np.arange(len(order)), 0))
+
+    pos = np.searchsorted(scomb[order], rcomb, side='right') - 1
+    ok = pos >= 0
+    ok[ok] = sk[pos[ok]] == rkey[ok]
+    j = np.full(len(rt), -1, dtype=np.int64)
+    j[ok] = order[head[pos[ok]]]
+
+    latency = np.full(len(rt), np.nan)
+    latency[ok] = rt[ok] - st[j[ok]]
+    bad = ok & ((latency < 0) | (latency > max_latency))
+    j[bad] = -1
+    latency[bad] = np.nan
+
+    first = np.zeros(len(st), dtype=bool)
+    first[order[first_sorted]] = True
+    return first, j, latency
+
+def _bin(values, edges):
+    return np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+
+class Group:
+    """Per (window, link) sums of a group of runs.
+
+    Parameters:
+        runs        List of runs, each a list of node log paths
+        window      Window length in seconds
+        links       List of (src, dest) links to report, in order
+    """
+    def __init__(self, runs, window, links=None):
+        self.window = window
+        self.loaded = [load_run(paths) for paths in runs]
+        self.matched = [match(send, recv) for send, recv in self.loaded]
+        self.set_links(self.sent_links() if links is None else links)
+
+    def sent_links(self):
+        """Sorted (src, dest) links with packets sent in any run"""
+        pairs = [np.unique((send['src'].astype(np.int64) << 8) | send['dest'].astype(np.int64))
+                 for send, _ in self.loaded]
+        return [(int(k >> 8), int(k & 0xFF)) for k in np.unique(np.concatenate(pairs or [[]]).astype(np.int64))]
+
+    def set_links(self, links):
+        """Aggregate over the given links (plus 'all') and windows"""
+        self.links = list(links)
+        nl = len(self.links) + 1
+        lut = np.full((256, 256), -1, dtype=np.int64)
+        for i, (s, d) in enumerate(self.links):
+            lut[s, d] = i
+
+        self.run = []
+        self.tstart = []
+        parts = []
+        for r, ((send, recv), (first, j, latency)) in enumerate(zip(self.loaded, self.matched)):
+            t0 = send['timestamp'].min() if len(send) else 0.0
+            tend = max(send['timestamp'].max() if len(send) else t0,
+                       recv['timestamp'].max() if len(recv) else t0)
+            nwin = int((tend - t0)//self.window) + 1
+            self.run += [r]*nwin
+            self.tstart += list(np.arange(nwin)*self.window)
+
+            sl = lut[send['src'].astype(int), send['dest'].astype(int)]
+            rl = lut[recv['src'].astype(int), recv['dest'].astype(int)]
+            sw = ((send['timestamp'] - t0)//self.window).astype(np.int64)
+            rw = np.clip(((recv['timestamp'] - t0)//self.window).astype(np.int64), 0, nwin - 1)
+            parts.append((nwin, first, j, latency, send, recv, sl, rl, sw, rw))
+
+        nwin = sum(p[0] for p in parts)
+        self.nwin = nwin
+        shape = (nwin, nl)
+        self.sums = {k: np.zeros(shape) for k in
+                     ['sent', 'delivered', 'bits', 'latency', 'evm', 'evm_n', 'rssi', 'rssi_n']}
+        self.hists = {k + '_h': np.zeros((nwin, nl, len(e) - 1), dtype=np.float32)
+                      for k, e in BINS.items()}
+
+        w0 = 0
+        for nwin_r, first, j, latency, send, recv, sl, rl, sw, rw in parts:
+            s = first & (sl >= 0)
+            self._add('sent', w0 + sw[s], sl[s])
+
+            # One delivery per packet: keep the first reception of each send
+            ok = (j >= 0) & (rl >= 0)
+            idx = np.flatnonzero(ok)
+            _, u = np.unique(j[idx], return_index=True)
+            d = idx[u]
+            self._add('delivered', w0 + rw[d], rl[d])
+            self._add('bits', w0 + rw[d], rl[d], 8.0*recv['size'][d])
+            self._add('latency', w0 + rw[d], rl[d], latency[d])
+            self._hist('latency', w0 + rw[d], rl[d], latency[d])
+
+            v = rl >= 0
+            for k in ('evm', 'rssi'):
+                x = recv[k].astype(float)
+                m = v & np.isfinite(x)
+                self._add(k, w0 + rw[m], rl[m], x[m])
+                self._add(k + '_n', w0 + rw[m], rl[m])
+                self._hist(k, w0 + rw[m], rl[m], x[m])
+            w0 += nwin_r
+
+        # Network totals
+        for a in self.sums.values():
+            a[:, -1] = a[:, :-1].sum(axis=1)
+        for a in self.hists.values():
+            a[:, -1] = a[:, :-1].sum(axis=1)
+
+        self.tstart = np.array(self.tstart)
+        self.run = np.array(self.run)
+
+    def _add(self, name, w, l, x=None):
+        a = self.sums[name]
+        a += np.bincount(w*a.shape[1] + l, weights=x, minlength=a.size).reshape(a.shape)
+
+    def _hist(self, name, w, l, x):
+        h = self.hists[name + '_h']
+        nb = h.shape[2]
+        idx = (w*h.shape[1] + l)*nb + _bin(x, BINS[name])
+        h += np.bincount(idx, minlength=h.size).reshape(h.shape).astype(np.float32)
+
+    def matrices(self):
+        """(nwin, k) matrices of everything summed over windows"""
+        return {k: v.reshape(self.nwin, -1) for k, v in {**self.sums, **self.hists}.items()}
+
+def _quantile(h, edges, q):
+    """Quantile q of histograms h (..., nbins), interpolating within a bin"""
+    cum = np.cumsum(h, axis=-1)
+    total = cum[..., -1:]
+    target = q*total
+    i = np.minimum((cum < target).sum(axis=-1, keepdims=True), h.shape[-1] - 1)
+    below = np.take_along_axis(cum, i, axis=-1) - np.take_along_axis(h, i, axis=-1)
+    inbin = np.take_along_axis(h, i, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.clip((target - below)/inbin, 0, 1)
+        x = edges[i] + frac*(edges[i + 1] - edges[i])
+    return np.where(total > 0, x, np.nan)[..., 0]
+
+def statistics(S, duration):
+    """Metrics from window sums.
+
+    Parameters:
+        S           Dict of summed matrices; sums (..., nlinks) and
+                    histograms (..., nlinks, nbins)
+        duration    Seconds covered by the sums (..., ) or scalar
+
+    Returns (..., len(METRICS), nlinks).
+    """
+    duration = np.asarray(duration, dtype=float)[..., None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = [S['delivered']/S['sent'],
+               S['bits']/duration,
+               S['latency']/S['delivered'],
+               _quantile(S['latency_h'], BINS['latency'], 0.5),
+               _quantile(S['latency_h'], BINS['latency'], 0.95),
+               S['evm']/S['evm_n'],
+               _quantile(S['evm_h'], BINS['evm'], 0.5),
+               _quantile(S['evm_h'], BINS['evm'], 0.95),
+               S['rssi']/S['rssi_n'],
+               _quantile(S['rssi_h'], BINS['rssi'], 0.5),
+               _quantile(S['rssi_h'], BINS['rssi'], 0.95)]
+    return np.stack(out, axis=-2)
+
+def _weighted(mats, W, nl):
+    """Sums of matrices weighted by window counts W (nrep, nwin)"""
+    S = {}
+    for k, m in mats.items():
+        if k.endswith('_h'):
+            S[k] = (W.astype(np.float32) @ m).reshape(len(W), nl, -1)
+        else:
+            S[k] = W @ m
+    return S
+
+# Matrices of the two groups, set in each worker by _init_worker
+_worker = {}
+
+def _init_worker(mats_a, mats_b, nl, window):
+    _worker.update(a=mats_a, b=mats_b, nl=nl, window=window)
+
+def _replicates(seed, nrep):
+    """Bootstrap statistics of both groups, (2, nrep, nmetrics, nlinks)"""
+    rng = np.random.default_rng(seed)
+    out = []
+    for key in ('a', 'b'):
+        mats = _worker[key]
+        nwin = next(iter(mats.values())).shape[0]
+        W = rng.multinomial(nwin, np.full(nwin, 1.0/nwin), size=nrep).astype(np.float64)
+        out.append(statistics(_weighted(mats, W, _worker['nl']), nwin*_worker['window']))
+    return np.stack(out)
+
+def bootstrap(a, b, nboot=1000, batch=100, jobs=None, seed=0):
+    """Bootstrap replicates of both groups; returns (2, nboot, nmetrics, nlinks)"""
+    args = (a.matrices(), b.matrices(), len(a.links) + 1, a.window)
+    seeds = np.random.SeedSequence(seed).spawn(-(-nboot//batch))
+    sizes = [min(batch, nboot - i*batch) for i in range(len(seeds))]
+    if jobs == 1:
+        _init_worker(*args)
+        parts = [_replicates(s, n) for s, n in zip(seeds, sizes)]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=args) as pool:
+            parts = list(pool.map(_replicates, seeds, sizes))
+    return np.concatenate(parts, axis=1)
+
+def point(group):
+    """Statistics of a whole group, (nmetrics, nlinks)"""
+    W = np.ones((1, group.nwin))
+    return statistics(_weighted(group.matrices(), W, len(group.links) + 1),
+                      group.nwin*group.window)[0]
+
+def per_window(group):
+    """Statistics of every window, (nwin, nmetrics, nlinks)"""
+    S = dict(group.sums)
+    S.update(group.hists)
+    return statistics(S, np.full(group.nwin, group.window))
+
+def compare(runs_a, runs_b, window=10.0, nboot=1000, level=0.95, jobs=None, seed=0):
+    """Compare two groups of runs.
+
+    Parameters:
+        runs_a      Runs of group A, each a list of node log paths
+        runs_b      Runs of group B
+        window      Window length in seconds; also the bootstrap block
+        nboot       Number of bootstrap replicates
+        level       Confidence level of the intervals
+        jobs        Number of worker processes (default: CPU count)
+        seed        Random seed
+
+    Returns (rows, a, b): one dict per link and metric with the A and B
+    estimates, B - A and its confidence interval, and the two Groups.
+    """
+    t = time.perf_counter()
+    a = Group(runs_a, window, links=[])
+    b = Group(runs_b, window, links=[])
+    links = sorted(set(a.sent_links()) | set(b.sent_links()))
+    a.set_links(links)
+    b.set_links(links)
+    logger.info('aggregated %d + %d windows, %d links in %.2f s',
+                a.nwin, b.nwin, len(links), time.perf_counter() - t)
+
+    t = time.perf_counter()
+    reps = bootstrap(a, b, nboot, jobs=jobs, seed=seed)
+    logger.info('%d bootstrap replicates in %.2f s', nboot, time.perf_counter() - t)
+
+    pa, pb = point(a), point(b)
+    diff = reps[1] - reps[0]
+    alpha = (1 - level)/2
+    with np.errstate(invalid='ignore'):
+        lo, hi = np.nanquantile(diff, [alpha, 1 - alpha], axis=0)
+
+    rows = []
+    for l, link in enumerate(links + ['all']):
+        name = link if link == 'all' else '{}->{}'.format(*link)
+        for m, metric in enumerate(METRICS):
+            rows.append({'link': name, 'metric': metric,
+                         'a': pa[m, l], 'b': pb[m, l], 'diff': pb[m, l] - pa[m, l],
+                         'lo': lo[m, l], 'hi': hi[m, l],
+                         'significant': bool(lo[m, l] > 0 or hi[m, l] < 0)})
+    return rows, a, b
+
+def write_windows(path, groups):
+    """Write per-window statistics of named groups to CSV"""
+    with open(path, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(['group', 'run', 'tstart', 'link'] + METRICS)
+        for name, g in groups:
+            stats = per_window(g)
+            links = ['{}->{}'.format(*l) for l in g.links] + ['all']
+            for i in range(g.nwin):
+                for l, link in enumerate(links):
+                    w.writerow([name, g.run[i], g.tstart[i], link] + list(stats[i, :, l]))
+
+def _runs(paths):
+    """Group command line paths into runs: each directory is a run and the
+    plain files given together are one more"""
+    runs = [find_logs(p) for p in paths if os.path.isdir(p)]
+    files = [p for p in paths if not os.path.isdir(p)]
+    if files:
+        runs.append(files)
+    return [r for r in runs if r]
+
+def _synthetic_run(dirname, nodes, duration, rate, jammed=(), jam_loss=0.5, seed=0):
+    """Write node logs of a synthetic run; links in jammed lose jam_loss more"""
+    rng = np.random.default_rng(seed)
+    send_dtype = np.dtype([('timestamp', '<f8'), ('curhop', 'u1'), ('src', 'u1'),
+                           ('dest', 'u1'), ('seq', '<u2'), ('size', '<u4')])
+    recv_dtype = np.dtype([('timestamp', '<f8'), ('payload_valid', 'u1'), ('src', 'u1'),
+                           ('dest', 'u1'), ('seq', '<u2'), ('size', '<u4'),
+                           ('evm', '<f4'), ('rssi', '<f4')])
+    sends = {n: [] for n in range(1, nodes + 1)}
+    recvs = {n: [] for n in range(1, nodes + 1)}
+    for src in range(1, nodes + 1):
+        for dest in range(1, nodes + 1):
+            if src == dest:
+                continue
+            n = rng.poisson(rate*duration)
+            t = np.sort(rng.uniform(0, duration, n))
+            s = np.zeros(n, dtype=send_dtype)
+            s['timestamp'] = t
+            s['curhop'] = s['src'] = src
+            s['dest'] = dest
+            s['seq'] = np.arange(n) % 65536
+            s['size'] = 1000
+            sends[src].append(s)
+
+            loss = 0.05 + (jam_loss if (src, dest) in jammed else 0.0)
+            ok = rng.random(n) > loss
+            r = np.zeros(ok.sum(), dtype=recv_dtype)
+            r['timestamp'] = t[ok] + rng.lognormal(np.log(5e-3), 0.5, ok.sum())
+            r['payload_valid'] = 1
+            r['src'] = src
+            r['dest'] = dest
+            r['seq'] = s['seq'][ok]
+            r['size'] = 1000
+            r['evm'] = rng.normal(-20 + (8 if (src, dest) in jammed else 0), 2, ok.sum())
+            r['rssi'] = rng.normal(-50, 3, ok.sum())
+            recvs[dest].append(r)
+
+    for n in range(1, nodes + 1):
+        d = os.path.join(dirname, 'node-{:03d}'.format(n))
+        os.makedirs(d, exist_ok=True)
+        with h5py.File(os.path.join(d, 'radio.h5'), 'w') as f:
+            f['send'] = np.sort(np.concatenate(sends[n]), order='timestamp')
+            f['recv'] = np.sort(np.concatenate(recvs[n]), order='timestamp')
+
+def bench(nodes=10, duration=3600.0, rate=2.0, window=10.0, nboot=1000, jobs=None):
+    """Time a comparison of two synthetic campaigns; in B two links are jammed"""
+    with tempfile.TemporaryDirectory() as tmp:
+        t = time.perf_counter()
+        _synthetic_run(os.path.join(tmp, 'a'), nodes, duration, rate, seed=1)
+        _synthetic_run(os.path.join(tmp, 'b'), nodes, duration, rate, jammed={(1, 2), (3, 4)}, seed=2)
+        logger.info('wrote synthetic campaigns in %.2f s', time.perf_counter() - t)
+
+        t = time.perf_counter()
+        rows, a, b = compare([find_logs(os.path.join(tmp, 'a'))], [find_logs(os.path.join(tmp, 'b'))],
+                             window=window, nboot=nboot, jobs=jobs)
+        elapsed = time.perf_counter() - t
+
+    packets = sum(len(s) for s, _ in a.loaded) + sum(len(s) for s, _ in b.loaded)
+    flagged = sorted({r['link'] for r in rows if r['metric'] == 'delivery_ratio' and r['significant']})
+    return {'elapsed': elapsed, 'packets': packets, 'windows': a.nwin + b.nwin,
+            'links': len(a.links), 'flagged': flagged}
+
+def print_rows(rows, all_rows=False):
+    print('{:<8} {:<15} {:>12} {:>12} {:>12} {:>25}'.format('link', 'metric', 'A', 'B', 'B - A', 'CI'))
+    for r in rows:
+        if not all_rows and not r['significant'] and r['link'] != 'all':
+            continue
+        print('{link:<8} {metric:<15} {a:12.4g} {b:12.4g} {diff:12.4g} [{lo:11.4g}, {hi:11.4g}]{flag}'.format(
+            flag=' *' if r['significant'] else '', **r))
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two groups of dragonradio runs with bootstrap confidence intervals.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-a', nargs='+', default=[], dest='a',
+                        help='run directories or node logs of group A')
+    parser.add_argument('-b', nargs='+', default=[], dest='b',
+                        help='run directories or node logs of group B')
+    parser.add_argument('--window', action='store', type=float, default=10.0,
+                        help='window length in seconds')
+    parser.add_argument('--bootstrap', action='store', type=int, default=1000, dest='nboot',
+                        help='number of bootstrap replicates')
+    parser.add_argument('--level', action='store', type=float, default=0.95,
+                        help='confidence level')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('--seed', action='store', type=int, default=0,
+                        help='random seed')
+    parser.add_argument('--all', action='store_true',
+                        help='print every link and metric, not only significant differences')
+    parser.add_argument('-o', '--output', action='store',
+                        help='write the comparison to CSV')
+    parser.add_argument('--windows', action='store',
+                        help='write per-window statistics of both groups to CSV')
+    parser.add_argument('--bench', action='store_true',
+                        help='time a comparison of two synthetic campaigns')
+    parser.add_argument('--nodes', action='store', type=int, default=10,
+                        help='nodes per synthetic campaign (--bench)')
+    parser.add_argument('--duration', action='store', type=float, default=3600.0,
+                        help='synthetic campaign length in seconds (--bench)')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    if args.bench:
+        r = bench(args.nodes, args.duration, window=args.window, nboot=args.nboot, jobs=args.jobs)
+        print('{packets} packets, {links} links, {windows} windows compared in {elapsed:.1f} s; '
+              'delivery ratio differs on {flagged}'.format(**r))
+        return
+
+    runs_a = _runs(args.a)
+    runs_b = _runs(args.b)
+    if not runs_a or not runs_b:
+        parser.error('both groups need at least one node log')
+
+    rows, a, b = compare(runs_a, runs_b, args.window, args.nboot, args.level, args.jobs, args.seed)
+    print_rows(rows, args.all)
+
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            w = csv.DictWriter(f, fieldnames=list(rows[0]))
+            w.writeheader()
+            w.writerows(rows)
+    if args.windows:
+        write_windows(args.windows, [('A', a), ('B', b)])
+
+if __name__ == '__main__':
+    main()
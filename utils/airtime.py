@@ -0,0 +1,434 @@
+# AIRTIME AND SCHEDULE COMPLIANCE
+""" airtime
+Check what actually went on air against the installed MAC schedule.
+
+The schedule is nchannels x nslots of node IDs (see notes.py and
+schedule.py); slot s of the run uses column s mod nslots and slot s starts
+at t0 + s*slot_size. Every packet in the 'send' logs of all nodes is a
+transmission by that node (curhop) on the channel its fc falls in, starting
+at its timestamp and lasting packet_time. All transmissions are binned into
+(slot, channel) cells in one pass, and from the cells we get per channel
+
+    utilization     fraction of the time the channel carried a transmission
+    busy            fraction of cells with at least one transmission
+    idle            fraction of cells nobody transmitted in
+    unused          fraction of cells the schedule granted to a node that
+                    then did not transmit (idle capacity of the schedule)
+    collisions      cells in which more than one node transmitted
+    violations      transmissions in a cell the schedule did not grant to
+                    the transmitting node
+
+and per node the number of transmissions, violations and its share of the
+used airtime against its share of the granted cells.
+
+'selftx' records (transmissions seen in snapshots, with exact start and end
+samples, from every node) give a second, on-air view inside the snapshot
+windows: the fraction of each channel's time occupied and the number of
+transmissions that overlapped another on the same channel.
+
+The schedule is not in the logs, so it comes from a file (numpy .npy or
+text, one row per channel) or is rebuilt with schedule.py from the node IDs
+found in the logs, the same way radiosim.py does. A run without a schedule
+(ALOHA) gets utilization and collisions only. The logs say when schedules
+were installed ('MAC: installed schedule' events); use --start/--end to
+analyze a period with one schedule.
+
+Usage:
+    python airtime.py runs/tdma --kind tdma --slots 4 [--slot-size 0.035]
+    python airtime.py runs/x/node-*/radio.h5 --schedule sched.npy [-o report.json] [--strict]
+    python airtime.py --bench [--nodes 10] [--duration 3600]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import h5py
+import numpy as np
+
+from abcompare import find_logs
+from hdf5_utils import node_id
+
+logger = logging.getLogger('airtime')
+
+SEND_FIELDS = ['timestamp', 'curhop', 'fc', 'bw']
+
+def load(paths):
+    """Transmissions in a run's node logs.
+
+    Returns (send, selftx, installs): send with fields t, node, fc, bw for
+    every packet sent; selftx with t0, t1, fc and node (-1 if not the
+    logging node) for every transmission seen in a snapshot; and the times
+    of schedule installs.
+    """
+    sends = []
+    selftxs = []
+    installs = []
+    for path in paths:
+        with h5py.File(path, 'r') as f:
+            s = f['send'].fields(SEND_FIELDS)[:] if 'send' in f else ()
+            if len(s):
+                sends.append(s)
+            # The logging node, from this log's own sends or its directory
+            node = node_id(path, s)
+            if node is None:
+                node = -1
+
+            if 'selftx' in f and f['selftx'].shape[0] and 'snapshots' in f and f['snapshots'].shape[0]:
+                tx = f['selftx'][:]
+                snaps = f['snapshots'].fields(['timestamp', 'fs'])[:]
+                # selftx start and end are samples of the snapshot taken at
+                # the record's timestamp
+                i = np.clip(np.searchsorted(snaps['timestamp'], tx['timestamp']), 0, len(snaps) - 1)
+                fs = snaps['fs'][i]
+                e = np.empty(len(tx), dtype=[('t0', 'f8'), ('t1', 'f8'), ('fc', 'f8'), ('node', 'i4')])
+                e['t0'] = tx['timestamp'] + tx['start']/fs
+                e['t1'] = tx['timestamp'] + tx['end']/fs
+                e['fc'] = tx['fc']
+                e['node'] = np.where(tx['is_local'] != 0, node, -1)
+                selftxs.append(e)
+
+            if 'event' in f:
+                ev = f['event'][:]
+                msgs = np.array([m.decode() if isinstance(m, bytes) else m for m in ev['event']])
+                installs.extend(ev['timestamp'][np.char.startswith(msgs.astype(str), 'MAC: installed schedule')])
+
+    send = np.empty(0, dtype=[('t', 'f8'), ('node', 'i4'), ('fc', 'f8'), ('bw', 'f8')])
+    if sends:
+        s = np.concatenate(sends)
+        send = np.empty(len(s), dtype=send.dtype)
+        send['t'] = s['timestamp']
+        send['node'] = s['curhop']
+        send['fc'] = s['fc']
+        send['bw'] = s['bw']
+    selftx = np.concatenate(selftxs) if selftxs else \
+        np.empty(0, dtype=[('t0', 'f8'), ('t1', 'f8'), ('fc', 'f8'), ('node', 'i4')])
+    return send, selftx, sorted(set(installs))
+
+def channel_index(fc, bw, nchannels):
+    """Channel of center frequency fc for nchannels channels of width bw
+    centered on 0 (radio.channels), or -1 outside the band"""
+    c = np.rint(np.asarray(fc)/bw + (nchannels - 1)/2).astype(np.int64)
+    return np.where((c >= 0) & (c < nchannels), c, -1)
+
+def analyze(send, sched=None, nchannels=None, slot_size=0.035, t0=0.0, bw=None,
+            packet_time=None, start=None, end=None, selftx=None):
+    """Bin transmissions into (slot, channel) cells and check them.
+
+    Parameters:
+        send        Transmissions with fields t, node, fc (and bw)
+        sched       nchannels x nslots schedule, or None (no compliance)
+        nchannels   Number of channels (default: schedule rows)
+        slot_size   Slot length in seconds
+        t0          Start of slot 0
+        bw          Channel bandwidth (default: most common send bw)
+        packet_time Airtime of one packet (default: slot_size divided by
+                    the most packets a node sent in one cell)
+        start, end  Time range to analyze (default: the transmissions')
+        selftx      Optional on-air transmissions with t0, t1, fc, node
+
+    Returns a dict of per-channel arrays, per-node arrays and totals.
+    """
+    if sched is not None:
+        sched = np.asarray(sched)
+        nchannels = sched.shape[0] if nchannels is None else nchannels
+    if nchannels is None:
+        raise ValueError('Need a schedule or the number of channels')
+    if bw is None:
+        vals, counts = np.unique(send['bw'], return_counts=True)
+        bw = float(vals[counts.argmax()]) if len(vals) else 1.0
+
+    t = send['t']
+    start = float(t.min()) if start is None and len(t) else (start or 0.0)
+    end = float(t.max()) if end is None and len(t) else (end or start)
+    keep = (t >= start) & (t <= end)
+    t = t[keep]
+    node = send['node'][keep].astype(np.int64)
+    chan = channel_index(send['fc'][keep], bw, nchannels)
+
+    # Absolute slot numbers; a small epsilon keeps transmissions logged at a
+    # slot boundary (with accumulated float error) in their own slot
+    s0 = int(np.floor((start - t0)/slot_size + 1e-6))
+    s1 = int(np.floor((end - t0)/slot_size + 1e-6)) + 1
+    nslots_run = s1 - s0
+    slot = np.floor((t - t0)/slot_size + 1e-6).astype(np.int64) - s0
+    ok = (chan >= 0) & (slot >= 0) & (slot < nslots_run)
+    outside = int(np.count_nonzero(~ok))
+    t, node, chan, slot = t[ok], node[ok], chan[ok], slot[ok]
+    cell = slot*nchannels + chan
+    ncells = nslots_run*nchannels
+
+    # Distinct transmitters per cell
+    pairs = np.unique((cell << 16) | node)
+    pcell = pairs >> 16
+    pnode = pairs & 0xFFFF
+    ntx = np.bincount(pcell, minlength=ncells).reshape(nslots_run, nchannels)
+
+    if packet_time is None:
+        per = np.bincount(np.searchsorted(pairs, (cell << 16) | node), minlength=len(pairs))
+        packet_time = slot_size/max(int(per.max()) if len(per) else 1, 1)
+
+    busy = ntx > 0
+    npk = np.bincount(chan, minlength=nchannels)
+    airtime = np.minimum(npk*packet_time, nslots_run*slot_size)
+    duration = nslots_run*slot_size
+
+    report = {
+        'start': start, 'end': end, 'slots': nslots_run, 'slot_size': slot_size,
+        'packet_time': packet_time, 'nchannels': nchannels, 'transmissions': int(len(t)),
+        'outside_band_or_range': outside,
+        'channel': {
+            'utilization': airtime/duration,
+            'busy': busy.mean(axis=0),
+            'idle': 1 - busy.mean(axis=0),
+            'collisions': (ntx > 1).sum(axis=0),
+        },
+    }
+
+    nodes = np.unique(node)
+    nidx = np.searchsorted(nodes, node)
+    report['node'] = {'id': nodes,
+                      'transmissions': np.bincount(nidx, minlength=len(nodes)),
+                      'airtime_share': np.bincount(nidx, minlength=len(nodes))/max(len(t), 1)}
+
+    if sched is not None:
+        nslots = sched.shape[1]
+        col = (slot + s0) % nslots
+        owner = sched[chan, col]
+        bad = owner != node
+        granted = sched[:, (np.arange(nslots_run) + s0) % nslots].T != 0
+        # A granted cell is used if its owner transmitted in it
+        powner = sched[pcell % nchannels, ((pcell//nchannels) + s0) % nslots]
+        used = np.zeros(ncells, dtype=bool)
+        used[pcell[powner == pnode]] = True
+        used = used.reshape(nslots_run, nchannels)
+
+        report['channel'].update({
+            'granted': granted.mean(axis=0),
+            'unused': (granted & ~used).sum(axis=0)/np.maximum(granted.sum(axis=0), 1),
+            'violations': np.bincount(chan[bad], minlength=nchannels),
+        })
+
+        gnodes, gcounts = np.unique(sched[sched != 0], return_counts=True)
+        share = np.zeros(len(nodes))
+        m = np.isin(nodes, gnodes)
+        share[m] = gcounts[np.searchsorted(gnodes, nodes[m])]/gcounts.sum()
+        report['node'].update({'violations': np.bincount(nidx[bad], minlength=len(nodes)),
+                               'granted_share': share})
+        report['violations'] = int(bad.sum())
+        report['unscheduled_nodes'] = np.setdiff1d(nodes, gnodes).tolist()
+
+    if selftx is not None and len(selftx):
+        report['onair'] = _onair(selftx, nchannels, bw, sched, slot_size, t0)
+
+    return report
+
+def _onair(tx, nchannels, bw, sched, slot_size, t0):
+    """Occupancy and overlaps of snapshot transmissions per channel"""
+    chan = channel_index(tx['fc'], bw, nchannels)
+    ok = chan >= 0
+    tx, chan = tx[ok], chan[ok]
+
+    # Sort by channel then start; a transmission overlaps an earlier one if
+    # it starts before the latest end so far on its channel
+    order = np.lexsort((tx['t0'], chan))
+    c = chan[order]
+    a = tx['t0'][order]
+    b = tx['t1'][order]
+    first = np.r_[True, c[1:] != c[:-1]]
+    # Running max of end times, restarted at each channel
+    offset = np.cumsum(first)*(b.max() - a.min() + 1.0)
+    runmax = np.maximum.accumulate(b + offset) - offset
+    prev_end = np.r_[-np.inf, runmax[:-1]]
+    overlap = ~first & (a < prev_end)
+    # The earlier transmission of an overlapping pair overlaps too
+    hit = overlap.copy()
+    hit[:-1] |= overlap[1:]
+
+    # Occupied time: union of intervals per channel
+    merged_start = ~overlap
+    seg_start = a[merged_start]
+    seg_end = np.maximum.reduceat(b, np.flatnonzero(merged_start)) if len(b) else b
+    seg_chan = c[merged_start]
+    occupied = np.bincount(seg_chan, weights=seg_end - seg_start, minlength=nchannels)
+
+    out = {'transmissions': np.bincount(c, minlength=nchannels),
+           'overlapping': np.bincount(c[hit], minlength=nchannels),
+           'occupied_s': occupied}
+    local = tx['node'][order] >= 0
+    if sched is not None and local.any():
+        slot = np.floor((a[local] - t0)/slot_size + 1e-6).astype(np.int64) % sched.shape[1]
+        out['local_violations'] = int(np.count_nonzero(sched[c[local], slot] != tx['node'][order][local]))
+    return out
+
+def _jsonable(x):
+    if isinstance(x, dict):
+        return {k: _jsonable(v) for k, v in x.items()}
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if isinstance(x, np.generic):
+        return x.item()
+    return x
+
+def print_report(r):
+    ch = r['channel']
+    print('{} transmissions in {} slots of {:g} s ({:.1f} s), packet time {:.4g} s'.format(
+        r['transmissions'], r['slots'], r['slot_size'], r['slots']*r['slot_size'], r['packet_time']))
+    cols = ['utilization', 'busy', 'idle', 'granted', 'unused', 'collisions', 'violations']
+    cols = [k for k in cols if k in ch]
+    print('{:>7} '.format('channel') + ' '.join('{:>11}'.format(k) for k in cols))
+    for c in range(r['nchannels']):
+        print('{:>7} '.format(c) + ' '.join(
+            '{:>11d}'.format(int(ch[k][c])) if k in ('collisions', 'violations')
+            else '{:>11.3f}'.format(ch[k][c]) for k in cols))
+
+    nd = r['node']
+    keys = [k for k in ('transmissions', 'violations', 'airtime_share', 'granted_share') if k in nd]
+    print('{:>7} '.format('node') + ' '.join('{:>14}'.format(k) for k in keys))
+    for i, n in enumerate(nd['id']):
+        print('{:>7} '.format(n) + ' '.join(
+            '{:>14d}'.format(int(nd[k][i])) if k in ('transmissions', 'violations')
+            else '{:>14.3f}'.format(nd[k][i]) for k in keys))
+
+    if 'violations' in r:
+        print('out-of-schedule transmissions: {}'.format(r['violations']))
+        if r['unscheduled_nodes']:
+            print('nodes transmitting without any grant: {}'.format(r['unscheduled_nodes']))
+    if 'onair' in r:
+        o = r['onair']
+        print('snapshots: {} transmissions, {} overlapping{}'.format(
+            int(o['transmissions'].sum()), int(o['overlapping'].sum()),
+            ', {} local out of schedule'.format(o['local_violations']) if 'local_violations' in o else ''))
+
+def _schedule():
+    """The schedule module, which lives at the top of the repository"""
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import schedule
+    return schedule
+
+def build_schedule(kind, nodes, nchannels, nslots):
+    """Rebuild a schedule the way radiosim.py does"""
+    schedule = _schedule()
+
+    nodes = sorted(int(n) for n in nodes)
+    if kind == 'simple':
+        return schedule.tdma(nodes, nchannels, max(len(nodes), 1))
+    return getattr(schedule, kind)(nodes, nchannels, nslots)
+
+def _synthetic(nodes, nchannels, nslots_run, sched, slot_size, pkts, violations, rng):
+    """Sends following sched, plus some out-of-schedule ones"""
+    s = np.repeat(np.arange(nslots_run), nchannels)
+    c = np.tile(np.arange(nchannels), nslots_run)
+    owner = sched[c, s % sched.shape[1]]
+    keep = (owner != 0) & (rng.random(len(s)) < 0.8)
+    s, c, owner = s[keep], c[keep], owner[keep]
+    k = np.tile(np.arange(pkts), len(s))
+    s, c, owner = np.repeat(s, pkts), np.repeat(c, pkts), np.repeat(owner, pkts)
+    bad = rng.choice(len(s), violations, replace=False)
+    owner = owner.copy()
+    owner[bad] = rng.integers(1, nodes + 1, violations)
+    send = np.empty(len(s), dtype=[('t', 'f8'), ('node', 'i4'), ('fc', 'f8'), ('bw', 'f8')])
+    send['t'] = s*slot_size + k*slot_size/pkts
+    send['node'] = owner
+    send['fc'] = (c - (nchannels - 1)/2)*100e3
+    send['bw'] = 100e3
+    return send, int(np.count_nonzero(owner[bad] != sched[c[bad], s[bad] % sched.shape[1]]))
+
+def bench(nodes=10, nchannels=10, duration=3600.0, slot_size=0.035, pkts=4, seed=0):
+    """Analyze an hour of synthetic TDMA sends with injected violations"""
+    schedule = _schedule()
+
+    rng = np.random.default_rng(seed)
+    sched = schedule.tdma(range(1, nodes + 1), nchannels, nodes)
+    nslots_run = int(duration/slot_size)
+    send, injected = _synthetic(nodes, nchannels, nslots_run, sched, slot_size, pkts, 1000, rng)
+
+    t = time.perf_counter()
+    r = analyze(send, sched, slot_size=slot_size)
+    elapsed = time.perf_counter() - t
+    return {'transmissions': len(send), 'elapsed': elapsed, 'injected': injected,
+            'found': r['violations'], 'collisions': int(r['channel']['collisions'].sum())}
+
+def main():
+    parser = argparse.ArgumentParser(description='Check airtime use against the MAC schedule.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--schedule', action='store',
+                        help='schedule file (.npy, or text with one row per channel)')
+    parser.add_argument('--kind', action='store', choices=['simple', 'tdma', 'fdma', 'hybrid'],
+                        help='rebuild the schedule of this kind from the nodes in the logs')
+    parser.add_argument('--slots', action='store', type=int, default=10,
+                        help='number of slots of a rebuilt schedule')
+    parser.add_argument('--num-channels', action='store', type=int, default=10, dest='num_channels',
+                        help='number of channels (without a schedule file)')
+    parser.add_argument('--channel-bandwidth', action='store', type=float, default=None,
+                        dest='channel_bandwidth',
+                        help='channel bandwidth in Hz (default: from the send logs)')
+    parser.add_argument('--slot-size', action='store', type=float, default=0.035, dest='slot_size',
+                        help='slot length in seconds')
+    parser.add_argument('--t0', action='store', type=float, default=0.0,
+                        help='start time of slot 0')
+    parser.add_argument('--packet-time', action='store', type=float, default=None, dest='packet_time',
+                        help='airtime of one packet in seconds (default: estimated)')
+    parser.add_argument('--start', action='store', type=float, default=None,
+                        help='analyze from this time')
+    parser.add_argument('--end', action='store', type=float, default=None,
+                        help='analyze up to this time')
+    parser.add_argument('-o', '--output', action='store',
+                        help='write the report as JSON')
+    parser.add_argument('--strict', action='store_true',
+                        help='exit with status 1 on out-of-schedule transmissions or collisions')
+    parser.add_argument('--bench', action='store_true',
+                        help='time the analysis of an hour of synthetic sends')
+    parser.add_argument('--nodes', action='store', type=int, default=10,
+                        help='number of nodes (--bench)')
+    parser.add_argument('--duration', action='store', type=float, default=3600.0,
+                        help='seconds of sends (--bench)')
+    parser.add_argument('paths', nargs='*',
+                        help='run directories or node logs')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    if args.bench:
+        r = bench(args.nodes, args.num_channels, args.duration, args.slot_size)
+        print('{transmissions} transmissions analyzed in {elapsed:.2f} s; '
+              '{found} of {injected} injected violations found, {collisions} collision cells'.format(**r))
+        return 0
+
+    paths = [p for path in args.paths for p in find_logs(path)]
+    if not paths:
+        parser.error('no node logs given')
+
+    t = time.perf_counter()
+    send, selftx, installs = load(paths)
+    logger.info('loaded %d sends and %d snapshot transmissions from %d logs in %.2f s',
+                len(send), len(selftx), len(paths), time.perf_counter() - t)
+    if len(installs) > 1 and args.start is None:
+        logger.warning('%d schedule installs in the logs (at %s); use --start/--end for one schedule',
+                       len(installs), ', '.join('{:.3f}'.format(x) for x in installs))
+
+    sched = None
+    if args.schedule:
+        sched = np.load(args.schedule) if args.schedule.endswith('.npy') else np.loadtxt(args.schedule, dtype=int, ndmin=2)
+    elif args.kind:
+        sched = build_schedule(args.kind, np.unique(send['node']), args.num_channels, args.slots)
+
+    t = time.perf_counter()
+    r = analyze(send, sched, None if sched is not None else args.num_channels, args.slot_size,
+                args.t0, args.channel_bandwidth, args.packet_time, args.start, args.end, selftx)
+    logger.info('analyzed in %.3f s', time.perf_counter() - t)
+    print_report(r)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(_jsonable(r), f, indent=1)
+
+    if args.strict and (r.get('violations', 0) or r['channel']['collisions'].sum()):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
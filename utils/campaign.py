@@ -0,0 +1,502 @@
+# CAMPAIGN ANALYSIS RUNNER
+""" campaign
+Run per-file analyses over a whole campaign of dragonradio logs with a
+content-addressed result cache, so re-running a sweep only computes what is
+new or changed.
+
+The runner walks directories of runs for node logs (radio.h5), and for every
+log and task looks up the task's result in the cache under the key
+
+    hash(task name, task code, parameters, hash of the datasets it reads)
+
+Only misses are computed, in a process pool; their results are stored in
+the cache as they come back. The dataset hash covers the raw storage of the
+datasets a task reads (contiguous storage or every chunk, read straight from
+the file) plus their shape and type, and the contents of variable-length
+fields, which live outside the dataset's own storage. Appending to the
+'recv' dataset therefore invalidates tasks that read 'recv' but not those
+that only read 'snapshots'. Dataset hashes are remembered per file with its
+size, mtime and inode, so unchanged files are not read at all.
+
+The code version of a task is the hash of its source plus an explicit
+version number, to be bumped when something it calls changes.
+
+Results are pickled one per file under the cache directory. Each hit
+touches its file, and once the cache grows past its size limit the least
+recently used results are evicted.
+
+Tasks are registered with the task decorator:
+
+    @campaign.task('mystat', datasets=['recv'])
+    def mystat(path, threshold=10):
+        ...
+
+Built-in tasks are 'stats' (packet counts, EVM and RSSI), 'spectrum' (mean
+snapshot power spectrum) and 'export' (hdf5_utils CSV export; the CSVs are
+cached and written out to --export-dir).
+
+Usage:
+    python campaign.py runs/ [--task stats] [--task spectrum -p spectrum.nfft=512] [-j 4]
+    python campaign.py runs/ --task export --export-dir csv/
+    python campaign.py --bench [--runs 100]
+"""
+import argparse
+import collections
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+
+from abcompare import find_logs
+
+logger = logging.getLogger('campaign')
+
+Task = collections.namedtuple('Task', ['name', 'fn', 'datasets', 'version'])
+Task.__doc__ = """A registered per-file analysis.
+
+    name        Task name
+    fn          fn(path, **params) returning a picklable result
+    datasets    Names of the datasets fn reads, or a function of the
+                parameters returning them
+    version     Bumped by hand when code fn calls changes
+"""
+
+TASKS = {}
+
+def task(name, datasets, version=1):
+    """Register a per-file analysis task"""
+    def register(fn):
+        TASKS[name] = Task(name, fn, datasets, version)
+        return fn
+    return register
+
+def code_version(t):
+    """Hash of a task's source and version"""
+    h = hashlib.sha256(inspect.getsource(t.fn).encode())
+    h.update(str(t.version).encode())
+    return h.hexdigest()[:16]
+
+def task_datasets(t, params):
+    return sorted(t.datasets(params) if callable(t.datasets) else t.datasets)
+
+def _vlen_fields(dtype):
+    if dtype.names is None:
+        return [None] if h5py.check_vlen_dtype(dtype) is not None else []
+    return [n for n in dtype.names if h5py.check_vlen_dtype(dtype[n]) is not None]
+
+def dataset_hash(path, name, block=1 << 16):
+    """Hash of a dataset's shape, type and stored contents"""
+    h = hashlib.blake2b(digest_size=16)
+    with h5py.File(path, 'r') as f:
+        if name not in f:
+            return 'absent'
+        ds = f[name]
+        h.update(repr((ds.shape, ds.dtype.descr if ds.dtype.names else str(ds.dtype))).encode())
+
+        dsid = ds.id
+        layout = dsid.get_create_plist().get_layout()
+        regions = []
+        if layout == h5py.h5d.CONTIGUOUS:
+            offset = dsid.get_offset()
+            if offset is not None:
+                regions.append((offset, dsid.get_storage_size()))
+        elif layout == h5py.h5d.CHUNKED:
+            for i in range(dsid.get_num_chunks()):
+                info = dsid.get_chunk_info(i)
+                regions.append((info.byte_offset, info.size))
+        else:
+            h.update(ds[()].tobytes())
+
+        if regions:
+            with open(path, 'rb') as raw:
+                for offset, size in regions:
+                    raw.seek(offset)
+                    h.update(raw.read(size))
+
+        # Variable-length data is in the file's global heap, not in the
+        # dataset's storage, which only holds references to it
+        for field in _vlen_fields(ds.dtype):
+            src = ds if field is None else ds.fields(field)
+            for i in range(0, ds.shape[0], block):
+                for x in src[i:i + block]:
+                    h.update(np.asarray(x).tobytes())
+
+    return h.hexdigest()
+
+class ResultCache:
+    """Pickled results in a directory, evicted least recently used first.
+
+    Parameters:
+        path        Cache directory
+        max_bytes   Size limit of the stored results
+    """
+    def __init__(self, path, max_bytes=1 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self.memo_path = os.path.join(path, 'fingerprints.json')
+        try:
+            with open(self.memo_path) as f:
+                self.memo = json.load(f)
+        except (OSError, ValueError):
+            self.memo = {}
+        self.size = sum(size for _, size, _ in self._entries())
+        self.evicted = 0
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key + '.pkl')
+
+    def _entries(self):
+        """(mtime, size, path) of every stored result"""
+        for d in os.scandir(self.path):
+            if d.is_dir():
+                for e in os.scandir(d.path):
+                    if e.name.endswith('.pkl'):
+                        st = e.stat()
+                        yield st.st_mtime_ns, st.st_size, e.path
+
+    def get(self, key):
+        """Return (True, result) on a hit, (False, None) otherwise"""
+        fn = self._file(key)
+        try:
+            with open(fn, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        os.utime(fn)
+        return True, value
+
+    def put(self, key, value):
+        fn = self._file(key)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fn), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        old = os.path.getsize(fn) if os.path.exists(fn) else 0
+        os.replace(tmp, fn)
+        self.size += os.path.getsize(fn) - old
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used results until under the size limit"""
+        entries = sorted(self._entries())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, fn in entries:
+            if self.size <= self.max_bytes:
+                break
+            os.unlink(fn)
+            self.size -= size
+            self.evicted += 1
+
+    def fingerprint(self, path, datasets):
+        """Hashes of datasets of a file, recomputed only if the file changed"""
+        st = os.stat(path)
+        stat = [st.st_size, st.st_mtime_ns, st.st_ino]
+        path = os.path.abspath(path)
+        entry = self.memo.get(path)
+        if entry is None or entry['stat'] != stat:
+            entry = self.memo[path] = {'stat': stat, 'datasets': {}}
+        hashes = entry['datasets']
+        for name in datasets:
+            if name not in hashes:
+                hashes[name] = dataset_hash(path, name)
+        return {name: hashes[name] for name in datasets}
+
+    def save(self):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.memo, f)
+        os.replace(tmp, self.memo_path)
+
+def cache_key(t, params, regions):
+    doc = json.dumps({'task': t.name, 'code': code_version(t), 'params': params,
+                      'data': regions}, sort_keys=True, default=str)
+    return hashlib.sha256(doc.encode()).hexdigest()
+
+def _compute(name, path, params):
+    return TASKS[name].fn(path, **params)
+
+Result = collections.namedtuple('Result', ['path', 'task', 'value', 'cached'])
+
+def run(paths, tasks, params=None, cache=None, jobs=None):
+    """Run tasks on every node log under paths.
+
+    Parameters:
+        paths       Run directories or node logs
+        tasks       Task names
+        params      Dict of task name -> parameters
+        cache       ResultCache, or None to compute everything
+        jobs        Number of worker processes (default: CPU count)
+
+    Returns (results, stats): a Result per log and task, in order, and
+    counts and times of the run.
+    """
+    params = params or {}
+    logs = [p for path in paths for p in find_logs(path)]
+    stats = {'logs': len(logs), 'hits': 0, 'misses': 0}
+
+    t = time.perf_counter()
+    work = []
+    results = {}
+    for path in logs:
+        for name in tasks:
+            t_ = TASKS[name]
+            p = params.get(name, {})
+            key = None
+            if cache is not None:
+                key = cache_key(t_, p, cache.fingerprint(path, task_datasets(t_, p)))
+                hit, value = cache.get(key)
+                if hit:
+                    results[(path, name)] = Result(path, name, value, True)
+                    stats['hits'] += 1
+                    continue
+            work.append((path, name, p, key))
+    stats['lookup_s'] = time.perf_counter() - t
+    if cache is not None:
+        cache.save()
+
+    t = time.perf_counter()
+    if work:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futs = [pool.submit(_compute, name, path, p) for path, name, p, _ in work]
+            for fut, (path, name, p, key) in zip(futs, work):
+                value = fut.result()
+                if cache is not None:
+                    cache.put(key, value)
+                results[(path, name)] = Result(path, name, value, False)
+    stats['misses'] = len(work)
+    stats['compute_s'] = time.perf_counter() - t
+    if cache is not None:
+        if cache.size > cache.max_bytes:
+            cache.evict()
+        stats['cache_bytes'] = cache.size
+        stats['evicted'] = cache.evicted
+
+    return [results[(path, name)] for path in logs for name in tasks], stats
+
+#
+# Built-in tasks
+#
+@task('stats', datasets=['send', 'recv'])
+def file_stats(path):
+    """Packet counts, duration, EVM and RSSI of one node log"""
+    out = {}
+    with h5py.File(path, 'r') as f:
+        for name in ('send', 'recv'):
+            out[name] = int(f[name].shape[0]) if name in f else 0
+        if 'recv' in f and f['recv'].shape[0]:
+            recv = f['recv']
+            names = [n for n in ('timestamp', 'header_valid', 'payload_valid', 'evm', 'rssi')
+                     if n in recv.dtype.names]
+            r = recv.fields(names)[:]
+            valid = r['payload_valid'] != 0
+            if 'header_valid' in names:
+                out['header_valid'] = float(np.mean(r['header_valid'] != 0))
+            out['payload_valid'] = float(np.mean(valid))
+            out['duration'] = float(r['timestamp'].max() - r['timestamp'].min())
+            for k in ('evm', 'rssi'):
+                x = r[k][valid] if k in names else []
+                if len(x):
+                    out[k + '_mean'] = float(np.mean(x))
+                    out[k + '_p10'], out[k + '_p50'], out[k + '_p90'] = \
+                        [float(v) for v in np.percentile(x, [10, 50, 90])]
+    return out
+
+@task('spectrum', datasets=['snapshots'])
+def snapshot_spectrum(path, nfft=256):
+    """Mean power spectrum (dB, fftshifted) over all snapshots of a log"""
+    from hdf5_utils import slot_rate, decode_snapshot
+    import spectral
+
+    scale = 1/np.sum(spectral.window(nfft)**2)
+    total = np.zeros(nfft)
+    nframes = 0
+    fs = None
+    with h5py.File(path, 'r') as f:
+        if 'snapshots' not in f:
+            return None
+        snapshots = f['snapshots']
+        for i in range(snapshots.shape[0]):
+            rec = snapshots[i:i+1]
+            iq = decode_snapshot(rec['iq_data'][0])
+            fs = float(slot_rate(rec)[0])
+            P = spectral.power(iq, nfft, workers=1)
+            total += np.sum(P, axis=0)*scale
+            nframes += len(P)
+    if nframes == 0:
+        return None
+    psd = total/nframes
+    return {'fs': fs, 'nfft': nfft, 'frames': nframes,
+            'psd_db': (10*np.log10(psd + 1e-20)).astype(np.float32)}
+
+EXPORTS = ['event', 'recv', 'selftx', 'send', 'slots']
+
+@task('export', datasets=lambda params: params.get('datasets', EXPORTS))
+def export_csv(path, datasets=EXPORTS):
+    """hdf5_utils CSV export of datasets, as zlib-compressed CSV text"""
+    from hdf5_utils import export_datafield
+
+    out = {}
+    with h5py.File(path, 'r') as f, tempfile.TemporaryDirectory() as tmp:
+        for name in datasets:
+            if name not in f:
+                continue
+            fn = os.path.join(tmp, name + '.csv')
+            export_datafield(f[name], fn)
+            with open(fn, 'rb') as csvf:
+                out[name] = zlib.compress(csvf.read(), 1)
+    return out
+
+def write_exports(results, outdir, root=None):
+    """Write cached CSV exports as <outdir>/<log path>_<dataset>.csv"""
+    written = 0
+    for r in results:
+        if r.task != 'export' or not r.value:
+            continue
+        rel = os.path.relpath(os.path.splitext(r.path)[0], root) if root else os.path.splitext(os.path.basename(r.path))[0]
+        base = os.path.join(outdir, rel.replace(os.sep, '_'))
+        for name, data in r.value.items():
+            with open('{}_{}.csv'.format(base, name), 'wb') as f:
+                f.write(zlib.decompress(data))
+            written += 1
+    return written
+
+def _parse_size(s):
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+    s = s.strip().lower()
+    if s and s[-1] in units:
+        return int(float(s[:-1])*units[s[-1]])
+    return int(s)
+
+def _parse_params(specs):
+    """task.key=value strings to {task: {key: value}}, values as JSON if
+    they parse"""
+    params = {}
+    for spec in specs:
+        name, value = spec.split('=', 1)
+        tname, key = name.split('.', 1)
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        params.setdefault(tname, {})[key] = value
+    return params
+
+def bench(nruns=100, changed=5, jobs=None):
+    """Cold, warm and partially changed sweeps over synthetic runs"""
+    from abcompare import _synthetic_run
+
+    out = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'runs')
+        for i in range(nruns):
+            _synthetic_run(os.path.join(root, 'run{:03d}'.format(i)), 2, 60.0, 20.0, seed=i)
+        cache = ResultCache(os.path.join(tmp, 'cache'))
+
+        for label in ('cold', 'warm'):
+            t = time.perf_counter()
+            _, stats = run([root], ['stats'], cache=cache, jobs=jobs)
+            out[label] = (time.perf_counter() - t, stats['misses'])
+
+        # Rewrite the recv dataset of a few logs
+        for i in range(changed):
+            fn = os.path.join(root, 'run{:03d}'.format(i), 'node-001', 'radio.h5')
+            with h5py.File(fn, 'a') as f:
+                r = f['recv'][:]
+                r['evm'] += 1
+                del f['recv']
+                f['recv'] = r
+        t = time.perf_counter()
+        _, stats = run([root], ['stats'], cache=cache, jobs=jobs)
+        out['changed'] = (time.perf_counter() - t, stats['misses'])
+    return out
+
+class _Append(argparse.Action):
+    """Like action='append', but the first value given replaces the default
+    instead of being appended to it"""
+    def __call__(self, parser, namespace, values, option_string=None):
+        items = getattr(namespace, self.dest)
+        if items is self.default:
+            items = []
+        setattr(namespace, self.dest, items + [values])
+
+def main():
+    parser = argparse.ArgumentParser(description='Run cached analyses over a campaign of dragonradio logs.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--task', action=_Append, default='stats', dest='tasks', choices=sorted(TASKS),
+                        help='task to run (repeatable)')
+    parser.add_argument('-p', '--param', action='append', default=[], dest='params',
+                        help='task parameter as task.key=value (repeatable)')
+    parser.add_argument('--cache', action='store',
+                        default=os.path.join(os.path.expanduser('~'), '.cache', 'dragonradio-campaign'),
+                        help='cache directory')
+    parser.add_argument('--max-size', action='store', default='2G', dest='max_size',
+                        help='cache size limit (e.g. 500M, 2G)')
+    parser.add_argument('--no-cache', action='store_true', dest='no_cache',
+                        help='compute everything and leave the cache alone')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('-o', '--output', action='store',
+                        help='write results as JSON')
+    parser.add_argument('--export-dir', action='store', dest='export_dir',
+                        help='directory to write the CSVs of the export task to')
+    parser.add_argument('--bench', action='store_true',
+                        help='time cold, warm and partially changed sweeps over synthetic runs')
+    parser.add_argument('--runs', action='store', type=int, default=100,
+                        help='number of synthetic runs (--bench)')
+    parser.add_argument('paths', nargs='*',
+                        help='run directories or node logs')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    if args.bench:
+        r = bench(args.runs, jobs=args.jobs)
+        for label, (elapsed, misses) in r.items():
+            print('{:<8} {:7.2f} s  {} computed'.format(label, elapsed, misses))
+        return
+
+    if not args.paths:
+        parser.error('no runs given')
+
+    tasks = [args.tasks] if isinstance(args.tasks, str) else args.tasks
+    cache = None if args.no_cache else ResultCache(args.cache, _parse_size(args.max_size))
+    results, stats = run(args.paths, tasks, _parse_params(args.params), cache, args.jobs)
+    logger.info('%d logs: %d cached, %d computed (lookup %.2f s, compute %.2f s)',
+                stats['logs'], stats['hits'], stats['misses'], stats['lookup_s'], stats['compute_s'])
+
+    if args.export_dir:
+        os.makedirs(args.export_dir, exist_ok=True)
+        root = args.paths[0] if len(args.paths) == 1 and os.path.isdir(args.paths[0]) else None
+        logger.info('wrote %d CSV files', write_exports(results, args.export_dir, root))
+
+    for r in results:
+        if r.task == 'stats':
+            print('{} {}'.format(r.path, ' '.join('{}={:.4g}'.format(k, v) for k, v in r.value.items())))
+
+    if args.output:
+        def jsonable(x):
+            if isinstance(x, dict):
+                return {k: jsonable(v) for k, v in x.items()}
+            if isinstance(x, np.ndarray):
+                return x.tolist()
+            if isinstance(x, bytes):
+                return None
+            return x
+        with open(args.output, 'w') as f:
+            json.dump([{'path': r.path, 'task': r.task, 'cached': r.cached,
+                        'value': jsonable(r.value)} for r in results], f, indent=1)
+
+if __name__ == '__main__':
+    main()
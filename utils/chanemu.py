@@ -0,0 +1,737 @@
+# STREAMING CHANNEL EMULATOR
+""" chanemu
+Generate a stream of multi-channel wideband IQ with realistic impairments and
+interference, in fixed-size blocks at a configurable sample rate, for
+feeding analysis code (jamdetect, pktfeatures, plotiq) at line rate.
+
+Each block is built in place as
+
+    sum of per-channel QPSK bursts        one per channel, unit power
+    -> multipath                          FIR taps, state carried over blocks
+    + jammers                             tone, sweep, pulsed, barrage, reactive
+    + AWGN                                SNR per channel
+    -> CFO                                receiver LO offset
+
+Oscillators, filter state, sweeps, pulse trains and reactive triggers all
+carry over block boundaries, so the stream is continuous.
+
+Jammers are pluggable: subclass Jammer, implement add(out, t0) and register
+the class in JAMMERS. On the command line they are given as
+kind:key=value,... with frequencies in Hz, times in seconds and power in dB
+relative to one channel's signal, e.g.
+
+    --jammer tone:fc=1.2e6,power=10
+    --jammer sweep:f0=-5e6,f1=5e6,period=1e-3
+    --jammer pulsed:fc=-2.5e6,bw=2e6,period=1e-3,duty=0.2
+    --jammer barrage:bw=8e6,power=0
+    --jammer reactive:fc=2.5e6,bw=2.5e6,threshold=-3,delay=50e-6,duration=1e-3
+
+Blocks are delivered zero-copy through a shared memory ring (shmring.py;
+the emulator writes straight into the ring slot) or over a local Unix
+socket, and the run reports whether it kept up with real time.
+
+To scale past one core the channels (and jammers) are partitioned across
+processes. Every stage is linear, so the sum of the partial streams of all
+processes is the full wideband stream; each process writes its own ring
+(<name>-<k>) and Combiner sums them. AWGN is only added by process 0. A
+reactive jammer only senses the channels of its own process.
+
+Usage:
+    python chanemu.py [--fs 10e6] [--channels 4] [--jammer tone:fc=1e6] [--ring iq] [--duration 10]
+    python chanemu.py --socket /tmp/iq.sock ...
+    python chanemu.py --procs 4 --ring iq ...
+    python chanemu.py --monitor iq
+"""
+import argparse
+import collections
+import logging
+import math
+import multiprocessing
+import os
+import socket
+import struct
+import time
+
+import numpy as np
+import scipy.fft as sfft
+
+import shmring
+
+logger = logging.getLogger('chanemu')
+
+QPSK = np.array([1+1j, -1+1j, -1-1j, 1-1j], dtype=np.complex64)/np.sqrt(2)
+
+def db2pow(db):
+    return 10.0**(db/10.0)
+
+class Oscillator:
+    """Complex oscillator at freq for fixed-size blocks.
+
+    The block-length phasor is computed once; each block only costs one
+    vector multiply plus a scalar phase update.
+    """
+    def __init__(self, freq, fs, n, amp=1.0):
+        w = 2*np.pi*freq/fs
+        self.base = (amp*np.exp(1j*w*np.arange(n))).astype(np.complex64)
+        self.step = complex(np.exp(1j*w*n))
+        self.phase = 1+0j
+
+    def _advance(self):
+        self.phase *= self.step
+        self.phase /= abs(self.phase)
+
+    def mix(self, x):
+        """Mix x with the oscillator in place"""
+        np.multiply(x, self.base, out=x)
+        x *= np.complex64(self.phase)
+        self._advance()
+
+    def generate(self, out):
+        """Write the next block of the oscillator to out"""
+        np.multiply(self.base, np.complex64(self.phase), out=out)
+        self._advance()
+        return out
+
+    def add(self, out, tmp, x=None):
+        """Add (x times) the oscillator to out"""
+        if x is None:
+            np.multiply(self.base, np.complex64(self.phase), out=tmp)
+        else:
+            np.multiply(x, self.base, out=tmp)
+            tmp *= np.complex64(self.phase)
+        out += tmp
+        self._advance()
+
+def awgn(rng, n, power):
+    """Complex white Gaussian noise of the given power"""
+    x = rng.standard_normal(2*n, dtype=np.float32).view(np.complex64)
+    x *= np.float32(math.sqrt(power/2))
+    return x
+
+def band_noise(rng, n, fs, fc, bw, power):
+    """Complex Gaussian noise of the given power in [fc-bw/2, fc+bw/2].
+
+    Built in the frequency domain with one inverse FFT, which is much
+    cheaper than filtering white noise at these block sizes.
+    """
+    if bw >= fs:
+        return awgn(rng, n, power)
+
+    k0 = int(round((fc - bw/2)/fs*n))
+    k1 = max(int(round((fc + bw/2)/fs*n)), k0 + 1)
+    idx = np.arange(k0, k1) % n
+
+    X = np.zeros(n, dtype=np.complex64)
+    X[idx] = awgn(rng, len(idx), power*n/len(idx))
+    return sfft.ifft(X, norm='ortho', overwrite_x=True)
+
+class NoisePool:
+    """Band noise for a jammer, generated once.
+
+    Each block is a random circular slice of the pool rather than fresh
+    noise, which costs nothing per block. A pool of many blocks is
+    indistinguishable from fresh noise to any of the detectors here.
+    """
+    def __init__(self, rng, fs, block, fc, bw, power, nblocks=16):
+        n = max(nblocks*block, 1 << 20)
+        noise = band_noise(rng, n, fs, fc, bw, power).astype(np.complex64)
+        # Extend by a block so that every slice is contiguous
+        self.pool = np.concatenate((noise, noise[:block]))
+        self.n = n
+        self.rng = rng
+
+    def take(self, k):
+        i = int(self.rng.integers(0, self.n))
+        return self.pool[i:i+k]
+
+class Multipath:
+    """FIR multipath channel with state carried over blocks.
+
+    The tap lists used here are short and sparse, so the filter is a few
+    shifted multiply-adds over the block rather than a general lfilter.
+    """
+    def __init__(self, taps, block):
+        self.taps = np.asarray(taps, dtype=np.complex64)
+        self.L = len(self.taps)
+        self.ext = np.zeros(block + self.L - 1, dtype=np.complex64)
+        self.tmp = np.empty(block, dtype=np.complex64)
+
+    def apply(self, out):
+        """Filter out in place"""
+        L, n = self.L, len(out)
+        ext = self.ext
+        ext[L-1:L-1+n] = out
+        out *= self.taps[0]
+        for k in range(1, L):
+            if self.taps[k] != 0:
+                np.multiply(ext[L-1-k:L-1-k+n], self.taps[k], out=self.tmp[:n])
+                out += self.tmp[:n]
+        ext[:L-1] = ext[n:n+L-1]
+
+class Jammer:
+    """Base class of jammer models.
+
+    Subclasses implement add(out, t0), adding the jammer's contribution to
+    the block out whose first sample is sample number t0 of the stream.
+    Jammers with senses = True see the network signal in out before any
+    jammer is added.
+    """
+    senses = False
+
+    def __init__(self, fs, block, rng):
+        self.fs = fs
+        self.block = block
+        self.rng = rng
+        self.tmp = np.empty(block, dtype=np.complex64)
+        self.pool = None
+
+    def add(self, out, t0):
+        raise NotImplementedError
+
+    def _noise(self, n):
+        """Return n samples of band noise from the jammer's noise pool"""
+        return self.pool.take(n)
+
+class ToneJammer(Jammer):
+    """Continuous tone at fc"""
+    def __init__(self, fs, block, rng, fc=0.0, power=0.0):
+        super().__init__(fs, block, rng)
+        self.osc = Oscillator(fc, fs, block, amp=math.sqrt(db2pow(power)))
+
+    def add(self, out, t0):
+        self.osc.add(out, self.tmp)
+
+class SweepJammer(Jammer):
+    """Tone sweeping from f0 to f1 every period seconds (sawtooth).
+
+    One period of the chirp is computed up front; each period after that is
+    the same table rotated by the phase the chirp accumulates per period.
+    """
+    def __init__(self, fs, block, rng, f0=None, f1=None, period=1e-3, power=0.0):
+        super().__init__(fs, block, rng)
+        f0 = -0.45*fs if f0 is None else f0
+        f1 = 0.45*fs if f1 is None else f1
+        self.period = max(int(round(period*fs)), 1)
+
+        f = f0 + (f1 - f0)*np.arange(self.period)/self.period
+        csum = np.cumsum(f)
+        ph = (2*np.pi/fs)*(csum - f)
+        amp = math.sqrt(db2pow(power))
+        self.table = (amp*np.exp(1j*ph)).astype(np.complex64)
+        self.step = complex(np.exp(2j*np.pi*csum[-1]/fs))
+
+    def add(self, out, t0):
+        n = len(out)
+        P = self.period
+        k = t0 // P
+        rot = self.step**k
+        for start in range(k*P, t0 + n, P):
+            a = max(start - t0, 0)
+            b = min(start + P - t0, n)
+            np.multiply(self.table[a + t0 - start:b + t0 - start], np.complex64(rot),
+                        out=self.tmp[a:b])
+            out[a:b] += self.tmp[a:b]
+            rot *= self.step
+            rot /= abs(rot)
+
+class PulsedJammer(Jammer):
+    """Tone (bw=0) or band noise gated on for duty*period every period"""
+    def __init__(self, fs, block, rng, fc=0.0, bw=0.0, period=1e-3, duty=0.1, power=0.0):
+        super().__init__(fs, block, rng)
+        self.fc = fc
+        self.bw = bw
+        self.power = db2pow(power)
+        self.period = max(int(round(period*fs)), 1)
+        self.on = max(int(round(duty*period*fs)), 1)
+        self.osc = None if bw else Oscillator(fc, fs, block, amp=math.sqrt(self.power))
+        if bw:
+            self.pool = NoisePool(rng, fs, block, fc, bw, self.power)
+
+    def add(self, out, t0):
+        n = len(out)
+        if self.osc is not None:
+            sig = self.osc.generate(self.tmp)
+        else:
+            sig = self._noise(n)
+
+        first = (t0 // self.period)*self.period
+        for start in range(first, t0 + n, self.period):
+            a = max(start - t0, 0)
+            b = min(start + self.on - t0, n)
+            if a < b:
+                out[a:b] += sig[a:b]
+
+class BarrageJammer(Jammer):
+    """Band noise over [fc-bw/2, fc+bw/2] (the whole band by default)"""
+    def __init__(self, fs, block, rng, fc=0.0, bw=None, power=0.0):
+        super().__init__(fs, block, rng)
+        self.fc = fc
+        self.bw = fs if bw is None else bw
+        self.power = db2pow(power)
+        self.pool = NoisePool(rng, fs, block, fc, self.bw, self.power)
+
+    def add(self, out, t0):
+        out += self._noise(len(out))
+
+class ReactiveJammer(Jammer):
+    """Band noise triggered by activity.
+
+    The network signal power is measured over windows of window seconds;
+    every window above threshold (dB relative to one channel's signal)
+    starts duration seconds of jamming delay seconds after the end of the
+    window. Triggers that overlap are merged and carry over blocks.
+    """
+    senses = True
+
+    def __init__(self, fs, block, rng, fc=0.0, bw=None, power=0.0,
+                 threshold=-3.0, delay=50e-6, duration=1e-3, window=100e-6):
+        super().__init__(fs, block, rng)
+        self.fc = fc
+        self.bw = fs if bw is None else bw
+        self.power = db2pow(power)
+        self.pool = NoisePool(rng, fs, block, fc, self.bw, self.power)
+        self.threshold = db2pow(threshold)
+        self.delay = int(round(delay*fs))
+        self.duration = max(int(round(duration*fs)), 1)
+        self.window = max(int(round(window*fs)), 1)
+        self.pending = collections.deque()
+        self.triggers = 0
+
+    def _sense(self, out, t0):
+        w = self.window
+        nw = len(out)//w
+        if nw == 0:
+            return
+        x = out[:nw*w].view(np.float32)
+        p = np.einsum('ij,ij->i', x.reshape(nw, 2*w), x.reshape(nw, 2*w))/w
+        hits = np.flatnonzero(p > self.threshold)
+        if len(hits) == 0:
+            return
+
+        self.triggers += len(hits)
+        starts = t0 + (hits + 1)*w + self.delay
+        ends = starts + self.duration
+        # Triggers all last the same time, so overlaps only chain forwards
+        breaks = np.flatnonzero(starts[1:] > ends[:-1]) + 1
+        for a, b in zip(np.r_[0, breaks], np.r_[breaks, len(starts)]):
+            s, e = int(starts[a]), int(ends[b-1])
+            if self.pending and s <= self.pending[-1][1]:
+                self.pending[-1] = (self.pending[-1][0], max(e, self.pending[-1][1]))
+            else:
+                self.pending.append((s, e))
+
+    def add(self, out, t0):
+        n = len(out)
+        self._sense(out, t0)
+
+        noise = None
+        for s, e in self.pending:
+            if s >= t0 + n:
+                break
+            a, b = max(s - t0, 0), min(e - t0, n)
+            if a < b:
+                if noise is None:
+                    noise = self._noise(n)
+                out[a:b] += noise[a:b]
+
+        while self.pending and self.pending[0][1] <= t0 + n:
+            self.pending.popleft()
+
+JAMMERS = {'tone': ToneJammer,
+           'sweep': SweepJammer,
+           'pulsed': PulsedJammer,
+           'barrage': BarrageJammer,
+           'reactive': ReactiveJammer}
+
+def parse_jammer(spec):
+    """Parse kind:key=value,... into (kind, kwargs)"""
+    kind, _, rest = spec.partition(':')
+    if kind not in JAMMERS:
+        raise ValueError('Unknown jammer {} (one of {})'.format(kind, ', '.join(JAMMERS)))
+
+    kwargs = {}
+    for item in filter(None, rest.split(',')):
+        key, _, value = item.partition('=')
+        kwargs[key.strip()] = float(value)
+    return kind, kwargs
+
+def parse_taps(spec):
+    """Parse comma-separated complex multipath taps, e.g. 1,0,0.3j,0.1"""
+    return np.array([complex(t) for t in spec.split(',')], dtype=np.complex64)
+
+class ChannelEmulator:
+    """Generate blocks of wideband IQ.
+
+    Parameters:
+        fs          Sample rate
+        block       Samples per block
+        nchannels   Number of equal channels the band is split into
+        snr         Per-channel SNR (dB); the noise power in one channel's
+                    bandwidth is snr dB below one channel's signal
+        cfo         Carrier frequency offset (Hz)
+        taps        Multipath FIR taps (None for a flat channel)
+        jammers     List of (kind, kwargs) jammers
+        activity    Probability a channel carries a burst in a block
+        sps         Samples per QPSK symbol (default 2.5*nchannels, which
+                    puts the main lobe inside the channel)
+        seed        Random seed
+        part        (k, nparts): emulate only channels and jammers k::nparts
+    """
+    def __init__(self, fs=10e6, block=65536, nchannels=4, snr=20.0, cfo=0.0,
+                 taps=None, jammers=(), activity=1.0, sps=None, seed=None,
+                 part=(0, 1)):
+        k, nparts = part
+        self.fs = fs
+        self.block = block
+        self.nchannels = nchannels
+        self.activity = activity
+        self.t = 0
+        self.part = part
+
+        self.rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(k,)))
+
+        bw = fs/nchannels
+        self.fcs = [-fs/2 + (i + 0.5)*bw for i in range(nchannels)]
+        self.channels = list(range(k, nchannels, nparts))
+        self.sps = sps or max(int(round(2.5*nchannels)), 1)
+        self.nsym = -(-block//self.sps)
+        self.oscs = [Oscillator(self.fcs[i], fs, block) for i in self.channels]
+
+        self.noise = db2pow(-snr)*nchannels if k == 0 else 0.0
+        self.cfo = Oscillator(cfo, fs, block) if cfo else None
+
+        self.multipath = Multipath(taps, block) if taps is not None else None
+
+        self.jammers = [JAMMERS[kind](fs, block, self.rng, **kwargs)
+                        for i, (kind, kwargs) in enumerate(jammers) if i % nparts == k]
+        self.jammers.sort(key=lambda j: not j.senses)
+
+        self.symbols = np.empty((self.nsym, self.sps), dtype=np.complex64)
+        self.tmp = np.empty(block, dtype=np.complex64)
+
+    def fill(self, out):
+        """Generate the next block into out (e.g. a ring slot)"""
+        out[:] = 0
+        bb = self.symbols.reshape(-1)[:self.block]
+        for osc in self.oscs:
+            if self.activity >= 1 or self.rng.random() < self.activity:
+                sym = self.rng.integers(0, 4, self.nsym, dtype=np.uint8)
+                self.symbols[:] = QPSK[sym][:, None]
+                osc.add(out, self.tmp, bb)
+            else:
+                osc._advance()
+
+        if self.multipath is not None:
+            self.multipath.apply(out)
+
+        for jammer in self.jammers:
+            jammer.add(out, self.t)
+
+        if self.noise:
+            out += awgn(self.rng, self.block, self.noise)
+
+        if self.cfo is not None:
+            self.cfo.mix(out)
+
+        self.t += self.block
+        return out
+
+    def next_block(self):
+        """Generate the next block into a new array"""
+        return self.fill(np.empty(self.block, dtype=np.complex64))
+
+# Socket block header: sequence number, first sample, number of samples
+HEADER = struct.Struct('<QQQ')
+
+class SocketSink:
+    """Send blocks to a SocketSource listening on a Unix socket at path"""
+    def __init__(self, path, block):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.buf = np.empty(block, dtype=np.complex64)
+        self.seq = 0
+
+    def next_slot(self):
+        return self.seq, self.buf
+
+    def commit(self, seq):
+        self.sock.sendall(HEADER.pack(seq, seq*len(self.buf), len(self.buf)))
+        self.sock.sendall(memoryview(self.buf).cast('B'))
+        self.seq = seq + 1
+
+    def close(self):
+        self.sock.close()
+
+class SocketSource:
+    """Receive blocks sent by SocketSink, straight into a reused buffer"""
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.path = path
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(1)
+        self.sock = None
+        self.hdr = bytearray(HEADER.size)
+        self.buf = None
+
+    def _recv_into(self, view):
+        while len(view):
+            n = self.sock.recv_into(view)
+            if n == 0:
+                raise EOFError
+            view = view[n:]
+
+    def read(self):
+        """Return (seq, t0, samples) of the next block or None at end of stream.
+
+        The samples are a view of a buffer that is reused by the next read.
+        """
+        if self.sock is None:
+            self.sock, _ = self.listener.accept()
+        try:
+            self._recv_into(memoryview(self.hdr))
+            seq, t0, n = HEADER.unpack(self.hdr)
+            if self.buf is None or len(self.buf) != n:
+                self.buf = np.empty(n, dtype=np.complex64)
+            self._recv_into(memoryview(self.buf).cast('B'))
+        except EOFError:
+            return None
+        return seq, t0, self.buf
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.listener.close()
+        os.unlink(self.path)
+
+class NullSink:
+    """Discard blocks (for benchmarking generation alone)"""
+    def __init__(self, block):
+        self.buf = np.empty(block, dtype=np.complex64)
+        self.seq = 0
+
+    def next_slot(self):
+        return self.seq, self.buf
+
+    def commit(self, seq):
+        self.seq = seq + 1
+
+    def close(self):
+        pass
+
+def run(emu, sink, duration, realtime=False, slack=4):
+    """Stream duration seconds of samples from emu into sink.
+
+    With realtime the stream is paced to the sample rate and blocks that
+    are finished after their deadline are counted as late; otherwise blocks
+    are generated as fast as possible. Returns a report dict; keeps_up is
+    whether generation (and delivery) ran at least as fast as the sample
+    rate and, when paced, no block finished more than slack block times
+    late (the consumer has to buffer that much anyway).
+    """
+    nblocks = max(int(math.ceil(duration*emu.fs/emu.block)), 1)
+    tblock = emu.block/emu.fs
+    late = 0
+    max_lag = 0.0
+    busy = 0.0
+
+    start = time.perf_counter()
+    for i in range(nblocks):
+        t = time.perf_counter()
+        seq, slot = sink.next_slot()
+        emu.fill(slot)
+        sink.commit(seq)
+        now = time.perf_counter()
+        busy += now - t
+
+        if realtime:
+            deadline = start + (i + 1)*tblock
+            if now > deadline:
+                late += 1
+                max_lag = max(max_lag, now - deadline)
+            else:
+                time.sleep(deadline - now)
+    elapsed = time.perf_counter() - start
+
+    nsamples = nblocks*emu.block
+    rate = nsamples/busy
+    return {'part': emu.part[0],
+            'blocks': nblocks,
+            'samples': nsamples,
+            'elapsed': elapsed,
+            'rate': rate,
+            'realtime_factor': rate/emu.fs,
+            'keeps_up': rate >= emu.fs and max_lag <= slack*tblock,
+            'late_blocks': late,
+            'max_lag': max_lag}
+
+def make_sink(emu, ring=None, nslots=64, sock=None):
+    if ring:
+        name = ring if emu.part[1] == 1 else '{}-{}'.format(ring, emu.part[0])
+        return shmring.ShmRing.create(name, nslots, emu.block)
+    if sock:
+        return SocketSink(sock, emu.block)
+    return NullSink(emu.block)
+
+def _run_part(kwargs, ring, nslots, sock, duration, realtime, linger):
+    emu = ChannelEmulator(**kwargs)
+    sink = make_sink(emu, ring, nslots, sock)
+    try:
+        return run(emu, sink, duration, realtime)
+    finally:
+        # Give readers time to drain the ring before it is unlinked
+        if ring:
+            time.sleep(linger)
+        sink.close()
+
+def run_parallel(nparts, emu_kwargs, ring=None, nslots=64, duration=10.0,
+                 realtime=False, linger=0.0):
+    """Run the emulator partitioned over nparts processes.
+
+    Process k emulates channels and jammers k::nparts into ring <ring>-<k>.
+    Returns the list of per-process reports.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(nparts) as pool:
+        jobs = [pool.apply_async(_run_part,
+                                 (dict(emu_kwargs, part=(k, nparts)), ring, nslots,
+                                  None, duration, realtime, linger))
+                for k in range(nparts)]
+        return [job.get() for job in jobs]
+
+class Combiner:
+    """Sum the rings written by run_parallel into the full wideband stream"""
+    def __init__(self, ring, nparts, start='latest'):
+        self.rings = [shmring.ShmRing.attach('{}-{}'.format(ring, k)) for k in range(nparts)]
+        self.readers = [shmring.Reader(r, start) for r in self.rings]
+        self.out = np.empty(self.rings[0].block, dtype=np.complex64)
+
+    def read(self, timeout=None):
+        """Return (seq, samples) of the next complete block or None on timeout"""
+        got = [r.read(timeout) for r in self.readers]
+        if any(g is None for g in got):
+            return None
+
+        # Realign if some reader skipped ahead after an overrun
+        seq = max(s for s, _ in got)
+        for i, (s, _) in enumerate(got):
+            if s != seq:
+                self.readers[i].seq = seq
+                got[i] = self.readers[i].read(timeout)
+                if got[i] is None:
+                    return None
+
+        np.copyto(self.out, got[0][1])
+        for _, view in got[1:]:
+            self.out += view
+        for reader in self.readers:
+            reader.check(seq)
+        return seq, self.out
+
+    def close(self):
+        for r in self.rings:
+            r.close()
+
+def monitor(name, duration, fs=None):
+    """Read ring name for duration seconds and report the rate and overruns"""
+    ring = shmring.ShmRing.attach(name)
+    reader = shmring.Reader(ring)
+    nblocks = 0
+    power = 0.0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        got = reader.read(timeout=1.0)
+        if got is None:
+            break
+        seq, view = got
+        x = view.view(np.float32)
+        power += float(np.dot(x, x))/ring.block
+        try:
+            reader.check(seq)
+        except shmring.Overrun:
+            continue
+        nblocks += 1
+    elapsed = time.perf_counter() - start
+    ring.close()
+
+    rate = nblocks*ring.block/elapsed
+    print('{}: {} blocks, {:.2f} MS/s{}, mean power {:.2f} dB, {} overruns'.format(
+        name, nblocks, rate/1e6,
+        '' if fs is None else ' ({:.2f}x real time)'.format(rate/fs),
+        10*np.log10(power/max(nblocks, 1) + 1e-30), reader.overruns))
+
+def report(reports, fs):
+    for r in reports:
+        print('part {part}: {blocks} blocks, {rate_ms:.2f} MS/s ({realtime_factor:.2f}x real time), '
+              '{late_blocks} late, max lag {lag_ms:.2f} ms'.format(
+                  rate_ms=r['rate']/1e6, lag_ms=1e3*r['max_lag'], **r))
+    keeps_up = all(r['keeps_up'] for r in reports)
+    print('{} real time at {:.2f} MS/s'.format('Keeps up with' if keeps_up else 'FALLS BEHIND',
+                                               fs/1e6))
+    return keeps_up
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream emulated multi-channel wideband IQ with impairments and jammers.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--fs', action='store', type=float, default=10e6,
+                        help='sample rate')
+    parser.add_argument('--block', action='store', type=int, default=65536,
+                        help='samples per block')
+    parser.add_argument('--channels', action='store', type=int, default=4,
+                        help='number of channels')
+    parser.add_argument('--snr', action='store', type=float, default=20.0,
+                        help='per-channel SNR (dB)')
+    parser.add_argument('--cfo', action='store', type=float, default=0.0,
+                        help='carrier frequency offset (Hz)')
+    parser.add_argument('--taps', action='store', type=parse_taps, default=None,
+                        help='comma-separated complex multipath taps')
+    parser.add_argument('--activity', action='store', type=float, default=1.0,
+                        help='probability a channel is busy in a block')
+    parser.add_argument('--jammer', action='append', type=parse_jammer, default=[],
+                        dest='jammers', metavar='KIND:KEY=VALUE,...',
+                        help='add a jammer ({})'.format(', '.join(JAMMERS)))
+    parser.add_argument('--seed', action='store', type=int, default=None,
+                        help='random seed')
+    parser.add_argument('--duration', action='store', type=float, default=10.0,
+                        help='seconds of samples to stream')
+    parser.add_argument('--realtime', action='store_true',
+                        help='pace the stream to the sample rate')
+    parser.add_argument('--ring', action='store', default=None,
+                        help='deliver blocks to the shared memory ring of this name')
+    parser.add_argument('--nslots', action='store', type=int, default=64,
+                        help='blocks in the ring')
+    parser.add_argument('--socket', action='store', default=None, dest='sock',
+                        help='deliver blocks to the Unix socket at this path')
+    parser.add_argument('--procs', action='store', type=int, default=1,
+                        help='partition channels over this many processes')
+    parser.add_argument('--linger', action='store', type=float, default=1.0,
+                        help='seconds to keep rings around after the run')
+    parser.add_argument('--monitor', action='store', default=None,
+                        help='read the ring of this name and report its rate')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    if args.monitor:
+        monitor(args.monitor, args.duration, args.fs)
+        return 0
+
+    emu_kwargs = dict(fs=args.fs, block=args.block, nchannels=args.channels,
+                      snr=args.snr, cfo=args.cfo, taps=args.taps,
+                      jammers=args.jammers, activity=args.activity, seed=args.seed)
+
+    if args.procs > 1:
+        if args.sock:
+            parser.error('--socket cannot be used with --procs')
+        reports = run_parallel(args.procs, emu_kwargs, args.ring, args.nslots,
+                               args.duration, args.realtime, args.linger)
+    else:
+        reports = [_run_part(emu_kwargs, args.ring, args.nslots, args.sock,
+                             args.duration, args.realtime, args.linger if args.ring else 0)]
+
+    return 0 if report(reports, args.fs) else 1
+
+if __name__ == '__main__':
+    raise SystemExit(main())
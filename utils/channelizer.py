@@ -0,0 +1,457 @@
+# POLYPHASE CHANNELIZER
+""" channelizer
+Split wideband IQ into the radio's channels offline, the same way the
+receive chain does (Front-end -> Channelizer -> PHY), so one channel can be
+looked at in isolation: per-channel PSD, jamming detection and demodulation
+all work on the channelizer output instead of on the wideband capture.
+
+The channelizer is a polyphase DFT filterbank. The channels must be equally
+spaced (as radio.channels and jamdetect.equal_channels are): with M =
+fs/spacing branches, channel k of the bank is centred on k*fs/M. If the
+channel centres sit between bins (an even number of channels centred on 0
+puts them on half bins) the input is first mixed down by the common offset.
+A lowpass prototype h of M*taps coefficients, with its cutoff at half the
+channel bandwidth, is split into M branches; every D = M/oversample input
+samples one output sample is produced for every channel with a single
+(window . prototype) product followed by one M-point FFT, so the cost per
+input sample is about taps*oversample multiplies plus the FFT.
+
+Blocks are processed as array operations: the windows of all the outputs in
+a block are a strided view of the input buffer, so the branch filters of a
+whole block are one einsum and the FFTs one batched FFT. The last M*taps-1
+input samples (and the position within the decimation) are carried over to
+the next block, so streaming a capture block by block gives exactly the
+same output as processing it at once.
+
+With the default oversample of 2 the output rate is twice the channel
+spacing, so the filter's transition band does not alias into the channel.
+Output sample n of every channel is the filter output at input sample n*D
+and lags the input by the filter delay (M*taps-1)/2 input samples.
+
+Logs are channelized into a file next to the log (radio.h5 ->
+radio.chan.h5) with one group per source:
+
+    /snapshots/timestamp    (nsnapshots,) snapshot timestamps
+    /snapshots/iq           (nsnapshots, nchannels) vlen complex64
+    /slots/iq               (nchannels, nout) complex64, slots streamed
+                            back to back with filter state carried over
+    /slots/offset           (nslots,) first output sample of each slot
+    /slots/timestamp        (nslots,) slot timestamps
+
+Each group has attributes fs (output rate), fc and bw (per channel), delay
+(in output samples) and the filter parameters. Snapshots are independent
+captures, so each starts with fresh filter state and they are channelized in
+parallel in a process pool; snapshots already in the output file are
+skipped, so re-running on a log that has grown only does the new ones.
+
+Usage:
+    python channelizer.py radio.h5 [--channels 10] [--source snapshots] [-j 4]
+    python channelizer.py --bench [--fs 10e6] [--channels 10]
+"""
+import argparse
+import logging
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+import scipy.fft as sfft
+import scipy.signal
+
+from chanemu import Oscillator
+from hdf5_utils import slot_rate, decode_snapshot
+from jamdetect import Channel, equal_channels
+
+SOURCES = ['snapshots', 'slots']
+
+def channelized_path(logpath):
+    """Return the channelizer output file name for a log file"""
+    root, _ = os.path.splitext(logpath)
+    return root + '.chan.h5'
+
+def plan(fs, channels, tol=1e-6):
+    """Polyphase layout for a list of equally spaced channels.
+
+    Returns (M, offset, bins): the number of branches, the frequency offset
+    common to every channel centre and each channel's bin in the bank.
+    """
+    fc = np.array([c.fc for c in channels], dtype=float)
+    if len(fc) == 1:
+        spacing = channels[0].bw
+    else:
+        steps = np.diff(np.sort(fc))
+        spacing = steps[0]
+        if spacing <= 0 or np.any(np.abs(steps - spacing) > tol*fs):
+            raise ValueError('Channels must be equally spaced')
+
+    M = int(round(fs/spacing))
+    if M < 1 or abs(M*spacing - fs) > tol*fs:
+        raise ValueError('Sample rate {:g} is not a multiple of the channel spacing {:g}'.format(fs, spacing))
+
+    offset = fc[0] - math.floor(fc[0]/spacing + 0.5)*spacing
+    k = np.round((fc - offset)/spacing)
+    return M, float(offset), (k.astype(int) % M)
+
+def prototype(M, taps, bw, fs, beta=8.0):
+    """Lowpass prototype of M*taps coefficients with unit DC gain"""
+    h = scipy.signal.firwin(M*taps, bw/fs, window=('kaiser', beta))
+    return (h/np.sum(h)).astype(np.float32)
+
+class Channelizer:
+    """Streaming polyphase filterbank channelizer.
+
+    Parameters:
+        fs          Input sample rate
+        channels    List of Channel (fc relative to the center frequency),
+                    equally spaced
+        taps        Prototype taps per branch
+        oversample  Output rate as a multiple of the channel spacing; must
+                    divide the number of branches
+        beta        Kaiser window parameter of the prototype
+    """
+    def __init__(self, fs, channels, taps=12, oversample=2, beta=8.0):
+        M, offset, bins = plan(fs, channels)
+        if M % oversample:
+            allowed = [d for d in range(1, M + 1) if M % d == 0]
+            raise ValueError('oversample {} does not divide {} branches (one of {})'.format(
+                             oversample, M, ', '.join(map(str, allowed))))
+
+        self.fs = fs
+        self.channels = list(channels)
+        self.M = M
+        self.D = M // oversample
+        self.taps = taps
+        self.oversample = oversample
+        self.offset = offset
+        self.bins = bins
+        self.fs_out = fs/self.D
+        self.L = M*taps
+
+        h = prototype(M, taps, max(c.bw for c in channels), fs, beta)
+        self.h = h
+
+        # Window sample j of an output multiplies h[L-1-j], so with the
+        # window reshaped to (taps, M) the branch sums come out in reverse
+        # branch order. Instead of reversing we fold that into the FFT: the
+        # reversed order costs a factor exp(-2j*pi*k/M) on bin k, and output
+        # n of bin k is rotated by exp(-2j*pi*k*n*D/M), which only depends
+        # on (n*D) mod M. The prototype is real, so the branch filters run
+        # on the float32 view of the samples with each coefficient repeated
+        # for I and Q, which is several times faster than a complex einsum.
+        self.H = np.repeat(h[::-1].reshape(taps, M), 2, axis=1)
+        r = np.arange(0, M, math.gcd(self.D, M))
+        self.rot = np.exp(-2j*np.pi*np.outer(r + 1, bins)/M).astype(np.complex64)
+        self._rot_step = math.gcd(self.D, M)
+
+        self._oscs = {}
+        self._phase = 1+0j
+        self.reset()
+
+    @property
+    def delay(self):
+        """Filter delay in output samples"""
+        return (self.L - 1)/2/self.D
+
+    def reset(self):
+        """Forget the filter state, e.g. before an unrelated capture"""
+        self.buf = np.zeros(self.L - 1, dtype=np.complex64)
+        self.nbuf = self.L - 1
+        self.nout = 0
+        self._phase = 1+0j
+
+    def _reserve(self, n):
+        if len(self.buf) < self.nbuf + n:
+            buf = np.empty(self.nbuf + n, dtype=np.complex64)
+            buf[:self.nbuf] = self.buf[:self.nbuf]
+            self.buf = buf
+
+    def _mix(self, x):
+        """Mix x in place down by the channels' common offset"""
+        osc = self._oscs.get(len(x))
+        if osc is None:
+            # Streams use one block size; captures add one for their tail
+            if len(self._oscs) >= 4:
+                self._oscs.clear()
+            osc = self._oscs[len(x)] = Oscillator(-self.offset, self.fs, len(x))
+        osc.phase = self._phase
+        osc.mix(x)
+        self._phase = osc.phase
+
+    def process(self, x):
+        """Channelize the next block of input.
+
+        Returns (nchannels, nout) complex64 output for the outputs that are
+        complete with this block; may be empty for a short block.
+        """
+        x = np.asarray(x, dtype=np.complex64)
+        self._reserve(len(x))
+        tail = self.buf[self.nbuf:self.nbuf + len(x)]
+        tail[:] = x
+        if self.offset:
+            self._mix(tail)
+        self.nbuf += len(x)
+
+        L, D, M = self.L, self.D, self.M
+        n = (self.nbuf - L)//D + 1 if self.nbuf >= L else 0
+        if n == 0:
+            return np.empty((len(self.bins), 0), dtype=np.complex64)
+
+        # Window i starts at sample i*D and is viewed as (taps, 2M) floats
+        buf = self.buf.view(np.float32)
+        s = buf.strides[0]
+        windows = np.lib.stride_tricks.as_strided(buf, (n, self.taps, 2*M),
+                                                  (2*D*s, 2*M*s, s), writeable=False)
+        v = np.einsum('npm,pm->nm', windows, self.H).view(np.complex64)
+        Y = sfft.fft(v, axis=1, overwrite_x=True)[:, self.bins]
+
+        idx = ((self.nout + np.arange(n))*D % M)//self._rot_step
+        Y *= self.rot[idx]
+
+        used = n*D
+        rest = self.nbuf - used
+        self.buf[:rest] = self.buf[used:self.nbuf]
+        self.nbuf = rest
+        self.nout += n
+        return np.ascontiguousarray(Y.T)
+
+    def __call__(self, x, block=65536):
+        """Channelize a whole capture in blocks, starting from fresh state"""
+        self.reset()
+        out = [self.process(x[i:i + block]) for i in range(0, len(x), block)]
+        return np.concatenate(out, axis=1) if out else np.empty((len(self.bins), 0), dtype=np.complex64)
+
+def _attrs(g, ch, channels):
+    g.attrs['fs'] = ch.fs_out
+    g.attrs['fs_in'] = ch.fs
+    g.attrs['fc'] = np.array([c.fc for c in channels])
+    g.attrs['bw'] = np.array([c.bw for c in channels])
+    g.attrs['delay'] = ch.delay
+    g.attrs['taps'] = ch.taps
+    g.attrs['oversample'] = ch.oversample
+
+def _snapshot_batch(logpath, i0, i1, channels, nchannels, taps, oversample):
+    """Channelize snapshots [i0, i1). Runs in a worker process."""
+    with h5py.File(logpath, 'r') as f:
+        recs = f['snapshots'][i0:i1]
+
+    chans = {}
+    out = []
+    for rec, fs in zip(recs, slot_rate(recs)):
+        fs = float(fs)
+        if fs not in chans:
+            chans[fs] = Channelizer(fs, channels or equal_channels(nchannels, fs), taps, oversample)
+        out.append(chans[fs](decode_snapshot(rec['iq_data'])))
+
+    return recs['timestamp'], out
+
+def _channelize_snapshots(f, out, channels, nchannels, taps, oversample, batch, jobs):
+    nrecs = f['snapshots'].shape[0]
+    if 'snapshots' in out:
+        g = out['snapshots']
+    else:
+        fs = float(slot_rate(f['snapshots'][0:1])[0])
+        chs = channels or equal_channels(nchannels, fs)
+        # Built first, so a bad layout leaves no half-made group behind
+        ch = Channelizer(fs, chs, taps, oversample)
+        g = out.create_group('snapshots')
+        _attrs(g, ch, chs)
+        g.create_dataset('timestamp', (0,), maxshape=(None,), dtype='f8')
+        g.create_dataset('iq', (0, len(chs)), maxshape=(None, len(chs)),
+                         dtype=h5py.vlen_dtype(np.complex64))
+
+    done = g['timestamp'].shape[0]
+    nch = g['iq'].shape[1]
+    ranges = [(i, min(i + batch, nrecs)) for i in range(done, nrecs, batch)]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futs = [pool.submit(_snapshot_batch, f.filename, i0, i1, channels, nchannels,
+                            taps, oversample)
+                for (i0, i1) in ranges]
+        for fut, (i0, i1) in zip(futs, ranges):
+            ts, ys = fut.result()
+            rows = np.empty((i1 - i0, nch), dtype=object)
+            for i, y in enumerate(ys):
+                rows[i, :] = list(y)
+            g['timestamp'].resize((i1,))
+            g['iq'].resize((i1, nch))
+            g['timestamp'][i0:i1] = ts
+            g['iq'][i0:i1] = rows
+
+    return nrecs - done
+
+def _channelize_slots(logpath, out, channels, nchannels, taps, oversample, block):
+    from slotstore import SlotStore
+
+    store = SlotStore.open(logpath)
+    fs = float(store.fs[0])
+    if np.any(store.fs != fs):
+        logging.warning('slots have more than one sample rate; channelizing all at %g', fs)
+    chs = channels or equal_channels(nchannels, fs)
+    ch = Channelizer(fs, chs, taps, oversample)
+
+    if 'slots' in out:
+        del out['slots']
+    g = out.create_group('slots')
+    _attrs(g, ch, chs)
+    g['timestamp'] = store.timestamp
+    g['offset'] = store.offsets[:-1]//ch.D
+    nout = (len(store.iq) - 1)//ch.D + 1 if len(store.iq) else 0
+    iq = g.create_dataset('iq', (len(chs), nout), dtype=np.complex64,
+                          chunks=(1, min(nout, 1 << 16)) if nout else None)
+
+    n = 0
+    for i in range(0, len(store.iq), block):
+        y = ch.process(store.iq[i:i + block])
+        iq[:, n:n + y.shape[1]] = y
+        n += y.shape[1]
+
+    return len(store)
+
+def channelize(logpath, outpath=None, sources=('snapshots',), channels=None,
+               nchannels=10, taps=12, oversample=2, batch=16, block=1 << 18,
+               jobs=None):
+    """Channelize the snapshots and/or slots of a log.
+
+    Parameters:
+        logpath     Path to dragonradio HDF5 log
+        outpath     Output file (default: next to log, see channelized_path)
+        sources     'snapshots' and/or 'slots', as one name or a list
+        channels    List of Channel, or None for nchannels equal channels
+        nchannels   Number of equal channels if channels is None
+        taps        Prototype taps per branch
+        oversample  Output rate as a multiple of the channel spacing
+        batch       Snapshots per worker task
+        block       Samples per block when streaming slots
+        jobs        Number of worker processes (default: CPU count)
+    """
+    if outpath is None:
+        outpath = channelized_path(logpath)
+    if isinstance(sources, str):
+        sources = [sources]
+
+    with h5py.File(logpath, 'r') as f, h5py.File(outpath, 'a') as out:
+        for source in sources:
+            if source not in f or f[source].shape[0] == 0:
+                continue
+
+            t = time.perf_counter()
+            if source == 'snapshots':
+                n = _channelize_snapshots(f, out, channels, nchannels, taps, oversample,
+                                          batch, jobs)
+            else:
+                n = _channelize_slots(logpath, out, channels, nchannels, taps, oversample, block)
+            logging.info('%s: %d records channelized in %.2f s', source, n, time.perf_counter() - t)
+
+    return outpath
+
+def channel_power(y):
+    """Mean power of each channel in dB, (nchannels,)"""
+    return 10*np.log10(np.mean(y.real**2 + y.imag**2, axis=1) + 1e-20)
+
+def bench(fs=10e6, nchannels=10, taps=12, oversample=2, block=1 << 16,
+          duration=1.0):
+    """Channelize a synthetic capture; return throughput and isolation.
+
+    The capture is a tone at the centre of every channel but channel 0, so
+    the power left in channel 0 relative to the others is how much of its
+    neighbours leaks through the filterbank.
+    """
+    channels = equal_channels(nchannels, fs)
+    nblocks = max(int(duration*fs)//block, 1)
+    oscs = [Oscillator(c.fc, fs, block) for c in channels[1:]]
+    tmp = np.empty(block, dtype=np.complex64)
+    blocks = []
+    for _ in range(nblocks):
+        x = np.zeros(block, dtype=np.complex64)
+        for osc in oscs:
+            osc.add(x, tmp)
+        blocks.append(x)
+
+    ch = Channelizer(fs, channels, taps, oversample)
+    ys = []
+    t = time.perf_counter()
+    for x in blocks:
+        ys.append(ch.process(x))
+    elapsed = time.perf_counter() - t
+
+    # Skip the filter's start-up transient
+    P = channel_power(np.concatenate(ys, axis=1)[:, int(2*ch.delay) + 1:])
+    rate = nblocks*block/elapsed
+    return {'fs': fs, 'channels': nchannels, 'branches': ch.M, 'taps': taps,
+            'oversample': oversample, 'samples_per_sec': rate,
+            'realtime': rate/fs, 'isolation_db': float(np.median(P[1:]) - P[0])}
+
+class _Append(argparse.Action):
+    """Like action='append', but the first value given replaces the default
+    instead of being appended to it"""
+    def __call__(self, parser, namespace, values, option_string=None):
+        items = getattr(namespace, self.dest)
+        if items is self.default:
+            items = []
+        setattr(namespace, self.dest, items + [values])
+
+def main():
+    parser = argparse.ArgumentParser(description='Channelize dragonradio logs with a polyphase filterbank.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--channels', action='store', type=int, default=10, dest='nchannels',
+                        help='number of equal channels across the band')
+    parser.add_argument('--channel', action='append', default=[], dest='channels',
+                        help='channel as fc:bw in Hz relative to the center frequency (repeatable)')
+    parser.add_argument('--source', action=_Append, choices=SOURCES, default='snapshots',
+                        dest='sources', help='dataset to channelize (repeatable)')
+    parser.add_argument('--taps', action='store', type=int, default=12,
+                        help='prototype taps per branch')
+    parser.add_argument('--oversample', action='store', type=int, default=2,
+                        help='output rate as a multiple of the channel spacing')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('--bench', action='store_true',
+                        help='benchmark on emulated IQ instead of channelizing logs')
+    parser.add_argument('--fs', action='store', type=float, default=10e6,
+                        help='sample rate for --bench')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='debug')
+    parser.add_argument('paths', nargs='*')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.DEBUG if args.debug else logging.INFO)
+
+    # Report channels and an oversample the bank cannot be built for, like
+    # the default oversample of 2 with an odd number of channels, as usage
+    # errors
+    if args.bench:
+        try:
+            r = bench(args.fs, args.nchannels, args.taps, args.oversample)
+        except ValueError as e:
+            parser.error(str(e))
+        print('{channels} channels, {branches} branches x {taps} taps, oversample {oversample}: '
+              '{samples_per_sec:.3g} samples/s ({realtime:.1f}x real time at fs={fs:g}), '
+              'isolation {isolation_db:.1f} dB'.format(**r))
+        return
+
+    channels = None
+    if args.channels:
+        channels = [Channel(*map(float, c.split(':'))) for c in args.channels]
+
+    for path in args.paths:
+        try:
+            out = channelize(path, sources=args.sources, channels=channels,
+                             nchannels=args.nchannels, taps=args.taps,
+                             oversample=args.oversample, jobs=args.jobs)
+        except ValueError as e:
+            parser.error(str(e))
+        with h5py.File(out, 'r') as f:
+            for source in f:
+                g = f[source]
+                if source == 'slots':
+                    P = channel_power(g['iq'][:])
+                else:
+                    P = np.mean([channel_power(np.stack(list(row))) for row in g['iq'][:]], axis=0) \
+                        if g['iq'].shape[0] else np.full(g['iq'].shape[1], np.nan)
+                print('{} {}: fs {:g}, channel power (dB) {}'.format(out, source, g.attrs['fs'],
+                      ' '.join('{:.1f}'.format(p) for p in P)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2 @@
+# A script over the radio.h5 in the working directory, not a test
+collect_ignore = ['test_hdf5utils.py']
@@ -0,0 +1,377 @@
+# EVENT LOG INDEX
+""" eventindex
+Inverted index over the 'event' dataset of dragonradio logs, for searching
+events by word, prefix and time without exporting them to CSV.
+
+Every event string is tokenized into its prefix, the tag before the first
+colon ('SYSTEM:', 'MAC:', 'ARQ:', ...), kept as is, and lowercase words.
+Events are numbered in time order, so the posting list of a token is
+sorted by time and a time range is a binary search into it. The index is
+kept next to the log (radio.h5 -> radio.events.npz):
+
+    nrows       number of 'event' rows indexed
+    timestamp   (n,) event timestamps, sorted
+    row         (n,) 'event' row of each event
+    vocab       (ntokens,) tokens, sorted
+    indptr      (ntokens+1,) start of each token's postings
+    postings    event numbers, grouped by token, sorted within a token
+
+Building is incremental: if the log has grown by events no older than the
+last indexed one, only the new events are tokenized. Identical strings,
+which most events are, are tokenized once.
+
+A query is a list of terms that must all match. A term ending in ':' is
+an event prefix, a term ending in '*' matches every word starting with
+it, and anything else is a word:
+
+    idx = EventIndex.open('radio.h5')
+    ev = idx.query('MAC: schedule', start=10.0, end=20.0)
+    for t, text in zip(*idx.events(ev)):
+        ...
+    search(['run1/'], 'MAC: sched*')    # every node, merged in time order
+
+Usage:
+    python eventindex.py radio.h5 [run/ ...] -q 'MAC: schedule' [--start T] [--end T]
+    python eventindex.py --bench [--events 5000000]
+"""
+import argparse
+import logging
+import os
+import re
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+logger = logging.getLogger('eventindex')
+
+PREFIX_RE = re.compile(r'^\s*([A-Za-z][A-Za-z0-9_]*):')
+WORD_RE = re.compile(r'[a-z0-9_]+')
+
+def index_path(logpath):
+    """Return the index file name for a log file"""
+    root, _ = os.path.splitext(logpath)
+    return root + '.events.npz'
+
+def tokenize(text):
+    """Return the set of tokens of an event string"""
+    tokens = set(WORD_RE.findall(text.lower()))
+    m = PREFIX_RE.match(text)
+    if m:
+        tokens.add(m.group(1).upper() + ':')
+    return tokens
+
+def _text(x):
+    return x.decode('utf-8', 'replace') if isinstance(x, bytes) else str(x)
+
+def _read_events(ds, start, block=1 << 18):
+    """Timestamps and strings of 'event' rows from start on"""
+    ts = []
+    texts = []
+    for i in range(start, ds.shape[0], block):
+        ts.append(ds.fields('timestamp')[i:i + block])
+        texts.extend(ds.fields('event')[i:i + block])
+    ts = np.concatenate(ts) if ts else np.zeros(0)
+    return ts.astype(np.float64), texts
+
+class EventIndex:
+    """Inverted index of a log's events. Use EventIndex.open."""
+    def __init__(self, logpath, nrows, timestamp, row, vocab, indptr, postings):
+        self.logpath = logpath
+        self.nrows = nrows
+        self.timestamp = timestamp
+        self.row = row
+        self.vocab = vocab
+        self.indptr = indptr
+        self.postings = postings
+        # Timestamps of the postings, so time ranges need no gather
+        self.ptimes = timestamp[postings]
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    @staticmethod
+    def open(logpath, build=True):
+        """Load the index of a log, building or extending it if out of date"""
+        path = index_path(logpath)
+        idx = None
+        if os.path.exists(path):
+            with np.load(path) as z:
+                idx = EventIndex(logpath, int(z['nrows']), z['timestamp'], z['row'],
+                                 z['vocab'], z['indptr'], z['postings'])
+        if build:
+            idx = EventIndex.build(logpath, idx)
+        elif idx is None:
+            raise FileNotFoundError(path)
+        return idx
+
+    @staticmethod
+    def build(logpath, idx=None):
+        """Index a log's events, extending idx if it covers a prefix of them"""
+        with h5py.File(logpath, 'r') as f:
+            if 'event' not in f:
+                nrows = 0
+                new_ts, texts = np.zeros(0), []
+            else:
+                ds = f['event']
+                nrows = ds.shape[0]
+                if idx is not None and not idx._extends(ds):
+                    idx = None
+                if idx is not None and idx.nrows == nrows:
+                    return idx
+                new_ts, texts = _read_events(ds, idx.nrows if idx else 0)
+
+        start = idx.nrows if idx else 0
+        if idx is not None and len(new_ts) and len(idx) and new_ts.min() < idx.timestamp[-1]:
+            # New events are older than indexed ones; renumber everything
+            return EventIndex.build(logpath)
+
+        t = time.perf_counter()
+        order = np.argsort(new_ts, kind='stable')
+        eid0 = len(idx) if idx else 0
+
+        # Tokenize unique strings once
+        ids = {}
+        cache = {}
+        tids = []
+        eids = []
+        for k, i in enumerate(order):
+            text = texts[i]
+            toks = cache.get(text)
+            if toks is None:
+                toks = cache[text] = [ids.setdefault(tok, len(ids)) for tok in tokenize(_text(text))]
+            tids.extend(toks)
+            eids.extend([eid0 + k]*len(toks))
+        tids = np.asarray(tids, dtype=np.int64)
+        eids = np.asarray(eids, dtype=np.int32)
+        words = np.array(list(ids), dtype=str) if ids else np.zeros(0, dtype='<U1')
+
+        timestamp = new_ts[order]
+        row = order.astype(np.int64) + start
+        if idx is not None:
+            # Merge with the existing postings; old events come first
+            old_tids = np.repeat(np.arange(len(idx.vocab)), np.diff(idx.indptr))
+            tids = np.concatenate([old_tids, tids + len(idx.vocab)])
+            eids = np.concatenate([idx.postings, eids])
+            words = np.concatenate([idx.vocab.astype(str), words])
+            timestamp = np.concatenate([idx.timestamp, timestamp])
+            row = np.concatenate([idx.row, row])
+
+        vocab, remap = np.unique(words, return_inverse=True)
+        tids = remap[tids]
+        perm = np.argsort(tids, kind='stable')
+        postings = eids[perm]
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tids, minlength=len(vocab)), out=indptr[1:])
+
+        idx = EventIndex(logpath, nrows, timestamp, row, vocab, indptr, postings)
+        idx.save()
+        logger.info('%s: indexed %d events (%d tokens) in %.2f s',
+                    logpath, len(new_ts), len(vocab), time.perf_counter() - t)
+        return idx
+
+    def _extends(self, ds):
+        """True if the indexed rows are still the first rows of ds"""
+        if self.nrows > ds.shape[0]:
+            return False
+        if self.nrows == 0:
+            return True
+        last = np.flatnonzero(self.row == self.nrows - 1)
+        return ds[self.nrows - 1]['timestamp'] == self.timestamp[last[0]]
+
+    def save(self):
+        path = index_path(self.logpath)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, nrows=self.nrows, timestamp=self.timestamp, row=self.row,
+                     vocab=self.vocab, indptr=self.indptr, postings=self.postings)
+        os.replace(tmp, path)
+
+    def _token_range(self, term):
+        """Range of vocabulary entries a query term matches"""
+        if term.endswith(':'):
+            term = term.upper()
+        else:
+            term = term.lower()
+        if term.endswith('*'):
+            stem = term[:-1]
+            lo = np.searchsorted(self.vocab, stem, 'left')
+            hi = np.searchsorted(self.vocab, stem + '\U0010ffff', 'left')
+            return lo, hi
+        lo = np.searchsorted(self.vocab, term, 'left')
+        hi = lo + 1 if lo < len(self.vocab) and self.vocab[lo] == term else lo
+        return lo, hi
+
+    def _postings(self, term, start, end):
+        lo, hi = self._token_range(term)
+        parts = []
+        for k in range(lo, hi):
+            i0, i1 = self.indptr[k], self.indptr[k + 1]
+            times = self.ptimes[i0:i1]
+            a = i0 + np.searchsorted(times, start, 'left') if start is not None else i0
+            b = i0 + np.searchsorted(times, end, 'left') if end is not None else i1
+            parts.append(self.postings[a:b])
+        if len(parts) == 1:
+            return parts[0]
+        return np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int32)
+
+    def query(self, q='', start=None, end=None):
+        """Event numbers, in time order, of events in [start, end) matching
+        every term of q"""
+        terms = q.split() if isinstance(q, str) else list(q)
+        if not terms:
+            lo = np.searchsorted(self.timestamp, start, 'left') if start is not None else 0
+            hi = np.searchsorted(self.timestamp, end, 'left') if end is not None else len(self)
+            return np.arange(lo, hi, dtype=np.int32)
+        # Intersect the shortest posting lists first
+        lists = sorted((self._postings(term, start, end) for term in terms), key=len)
+        ev = lists[0]
+        for p in lists[1:]:
+            if len(ev) == 0:
+                break
+            ev = np.intersect1d(ev, p, assume_unique=True)
+        return ev
+
+    def count(self, q='', start=None, end=None):
+        return len(self.query(q, start, end))
+
+    def events(self, ev):
+        """Timestamps and strings of events numbered ev"""
+        rows = self.row[ev]
+        if len(rows) == 0:
+            return self.timestamp[ev], []
+        order = np.argsort(rows)
+        texts = [None]*len(rows)
+        with h5py.File(self.logpath, 'r') as f:
+            ds = f['event'].fields('event')
+            lo, hi = rows[order[0]], rows[order[-1]] + 1
+            if hi - lo <= 4*len(rows):
+                block = ds[lo:hi]
+                for i in order:
+                    texts[i] = _text(block[rows[i] - lo])
+            else:
+                for i in order:
+                    texts[i] = _text(ds[rows[i]])
+        return self.timestamp[ev], texts
+
+def search(paths, q='', start=None, end=None, limit=None):
+    """Search the events of every node log under paths.
+
+    Returns a list of (timestamp, node, event) in time order.
+    """
+    from abcompare import find_logs
+    from hdf5_utils import node_id
+
+    out = []
+    for path in paths:
+        for log in find_logs(path):
+            idx = EventIndex.open(log)
+            ev = idx.query(q, start, end)
+            if limit is not None:
+                ev = ev[:limit]
+            node = node_id(log)
+            if node is None:
+                node = log
+            ts, texts = idx.events(ev)
+            out.extend(zip(ts.tolist(), [node]*len(texts), texts))
+    out.sort(key=lambda x: x[0])
+    return out[:limit] if limit is not None else out
+
+def _synthetic_log(path, nevents, seed=0):
+    """Write a log with nevents events in the style of dragonradio's"""
+    rng = np.random.default_rng(seed)
+    templates = ['ARQ: send ACK to {}', 'ARQ: retransmit seq {} to {}', 'MAC: installed schedule {}x{}',
+                 'PHY: set rx frequency offset {}', 'SYSTEM: ip tuntap add dev tap{} mode tap user root ({})',
+                 'TIMESYNC: offset {} us', 'SNAPSHOT: start']
+    p = np.array([0.5, 0.2, 0.001, 0.1, 0.001, 0.15, 0.048])
+    which = rng.choice(len(templates), nevents, p=p/p.sum())
+    args = rng.integers(0, 50, (nevents, 2))
+    texts = np.array([templates[w].format(*a) for w, a in zip(which, args.tolist())], dtype=object)
+    ts = np.cumsum(rng.exponential(1e-3, nevents))
+    dtype = np.dtype([('timestamp', '<f8'), ('event', h5py.string_dtype())])
+    ev = np.zeros(nevents, dtype=dtype)
+    ev['timestamp'] = ts
+    ev['event'] = texts
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('event', data=ev, maxshape=(None,), chunks=True)
+
+def bench(nevents=5000000, nqueries=100):
+    """Time building the index and queries against it"""
+    with tempfile.TemporaryDirectory() as tmp:
+        log = os.path.join(tmp, 'radio.h5')
+        _synthetic_log(log, nevents)
+        t = time.perf_counter()
+        idx = EventIndex.open(log)
+        build_s = time.perf_counter() - t
+        t = time.perf_counter()
+        idx = EventIndex.open(log)
+        load_s = time.perf_counter() - t
+
+        tmax = idx.timestamp[-1]
+        rng = np.random.default_rng(1)
+        results = {}
+        for q in ('MAC: schedule', 'ARQ: ack', 'retransmit 7', 'SYSTEM: tap*', ''):
+            t = time.perf_counter()
+            n = 0
+            for _ in range(nqueries):
+                t1 = rng.uniform(0, tmax)
+                n += idx.count(q, t1, t1 + tmax/10)
+            results[q] = ((time.perf_counter() - t)/nqueries, n/nqueries)
+
+        # Brute force: scan every string for the same thing
+        with h5py.File(log, 'r') as f:
+            t = time.perf_counter()
+            ts, texts = _read_events(f['event'], 0)
+            brute = sum(1 for x in texts if x.startswith(b'MAC:') and b'schedule' in x)
+            brute_s = time.perf_counter() - t
+        assert brute == idx.count('MAC: schedule')
+    return build_s, load_s, results, brute_s
+
+def main():
+    parser = argparse.ArgumentParser(description='Search dragonradio log events.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-q', '--query', action='store', default='',
+                        help="terms that must all match: 'PREFIX:', 'word' or 'stem*'")
+    parser.add_argument('--start', action='store', type=float,
+                        help='earliest timestamp')
+    parser.add_argument('--end', action='store', type=float,
+                        help='latest timestamp (exclusive)')
+    parser.add_argument('-n', '--limit', action='store', type=int,
+                        help='maximum number of events to print')
+    parser.add_argument('-c', '--count', action='store_true',
+                        help='only print the number of matches per log')
+    parser.add_argument('--bench', action='store_true',
+                        help='time index building and queries on a synthetic log')
+    parser.add_argument('--events', action='store', type=int, default=5000000,
+                        help='number of synthetic events (--bench)')
+    parser.add_argument('paths', nargs='*',
+                        help='node logs or run directories')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    if args.bench:
+        build_s, load_s, results, brute_s = bench(args.events)
+        print('{} events: build {:.2f} s, load {:.3f} s, full scan {:.2f} s'.format(
+              args.events, build_s, load_s, brute_s))
+        for q, (elapsed, n) in results.items():
+            print('{:<16} {:8.3f} ms  {:9.0f} matches'.format(repr(q), 1e3*elapsed, n))
+        return
+
+    if not args.paths:
+        parser.error('no logs given')
+
+    if args.count:
+        from abcompare import find_logs
+        for path in args.paths:
+            for log in find_logs(path):
+                print('{} {}'.format(log, EventIndex.open(log).count(args.query, args.start, args.end)))
+        return
+
+    for t, node, text in search(args.paths, args.query, args.start, args.end, args.limit):
+        print('{:.6f} {} {}'.format(t, node, text))
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 # HDF5 UTILS
 import h5py
 import csv 
+import re
+import numpy as np
 
 """ hdf_utils
 This is a collection of utilities that you can use to get information
@@ -22,6 +24,10 @@ Methods include [for datafield "X", (e.g. X=recv) and hd5 file 'file']:
     export_recv_iqdata(file,csvname,seqnumber,tmin=0.00)
     print_X_format(file)
     export_X(file,csvname)
+    slot_rate(slots)
+    node_id(path, send=None)
+    decode_snapshot(iq_data, start=0, stop=None, threads=1)
+    search_events(file, query, tmin=None, tmax=None)
 
 """
 
@@ -210,3 +216,80 @@ def export_recv_iqdata(f,csvname,seqnumber,tmin=0.00):
             writer.writerow([iq.real,iq.imag])
 
 
+
+""" slot_rate
+    Return the sample rate of the records in a slots or snapshots
+    dataset. Newer logs carry an 'fs' field, older ones only 'bw'.
+
+    Parameters:
+        datag   h5py dataset or numpy structured array
+"""
+def slot_rate(datag):
+    names = datag.dtype.names
+    if 'fs' in names:
+        return datag['fs']
+    return datag['bw']
+
+""" node_id
+    Return the ID of the node that wrote a log: the transmitter (curhop)
+    of most of its sends or, for a log without sends, the node-NNN
+    directory it is in. None if neither tells.
+
+    Parameters:
+        path    Log file name
+        send    The log's send records (anything with a curhop field), if
+                they are already read; None to read them from the log
+"""
+def node_id(path, send=None):
+    if send is None:
+        with h5py.File(path, 'r') as f:
+            send = f['send']['curhop'] if 'send' in f and f['send'].shape[0] else ()
+    else:
+        send = send['curhop'] if len(send) else ()
+    if len(send):
+        return int(np.bincount(send).argmax())
+    m = re.search(r'node-0*(\d+)', path)
+    return int(m.group(1)) if m else None
+
+""" decode_snapshot
+    Decode the iq_data field of a snapshot record to complex64 IQ.
+    Snapshots are normally FLAC compressed and need the dragonradio
+    extension to decode; logs that already hold raw complex samples are
+    returned as-is, and snapshots converted with iqcodec.py are decoded
+    block by block, only touching the blocks in [start, stop).
+
+    Parameters:
+        iq_data     iq_data field of one snapshots record
+        start       First sample to return
+        stop        End of the samples to return (None for all)
+        threads     Decoder threads (iqcodec snapshots only)
+"""
+def decode_snapshot(iq_data, start=0, stop=None, threads=1):
+    iq_data = np.asarray(iq_data)
+    if np.iscomplexobj(iq_data):
+        return iq_data[start:stop].astype(np.complex64, copy=False)
+
+    import iqcodec
+    if iqcodec.is_encoded(iq_data):
+        return iqcodec.decode(iq_data, start, stop, threads)
+
+    import dragonradio
+    return np.asarray(dragonradio.decompressFLAC(iq_data), dtype=np.complex64)[start:stop]
+
+""" search_events
+    Return the timestamps and strings of events matching all terms of
+    query, e.g. 'MAC: schedule', in [tmin, tmax). Terms ending in ':' match
+    the event prefix and terms ending in '*' any word starting with them.
+    Uses the inverted index from eventindex.py, which is built next to the
+    log (radio.events.npz) on first use and extended as the log grows.
+
+    Parameters:
+        f       h5py.File object or log file name
+        query   Search terms
+        tmin    Earliest timestamp (None for all)
+        tmax    Latest timestamp, exclusive (None for all)
+"""
+def search_events(f, query, tmin=None, tmax=None):
+    import eventindex
+    idx = eventindex.EventIndex.open(f if isinstance(f, str) else f.filename)
+    return idx.events(idx.query(query, tmin, tmax))
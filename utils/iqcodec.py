@@ -0,0 +1,442 @@
+# SNAPSHOT IQ CODEC
+""" iqcodec
+A block codec for IQ snapshots, as an alternative to FLAC. FLAC has to be
+decoded whole and serially to look at any part of a snapshot; here the
+samples are cut into blocks that are quantized and compressed on their own,
+so any time range can be decoded without touching the rest and blocks can
+be decoded on several threads at once.
+
+Each block of `block` samples is quantized to int16 or int12 with its own
+scale (the block's peak maps to full scale), then compressed with a fast
+general-purpose compressor. int16 blocks are byte-shuffled first (all low
+bytes, then all high bytes), which lets the compressor find the mostly
+constant high bytes of low-level signals; int12 blocks are packed into 3
+bytes per sample.
+
+Encoded layout, little endian:
+
+    header      magic 'DRIQ', version, bits, compressor, flags,
+                block (samples), nsamples, nblocks
+    table       (nblocks,) uint32 compressed block sizes
+                (nblocks,) float32 block scales
+    payload     compressed blocks back to back
+
+zlib is always available. zstd and lz4 are used if the zstandard or lz4
+packages are installed; both decode much faster than zlib. zlib, zstd and
+lz4 release the GIL while (de)compressing, as NumPy does for the
+dequantization, so threads decode in parallel.
+
+hdf5_utils.decode_snapshot recognizes encoded snapshots by their magic, so
+converted logs work with everything that reads snapshots.
+
+Usage:
+    python iqcodec.py convert radio.h5 [-o radio.iqc.h5] [--bits 12] [--compressor zstd]
+    python iqcodec.py bench [--log radio.h5] [--threads 4]
+"""
+import argparse
+import logging
+import math
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+
+MAGIC = b'DRIQ'
+VERSION = 1
+
+# magic, version, bits, compressor, flags, block, nsamples, nblocks
+HEADER = struct.Struct('<4sBBBBIQI')
+
+# Flags
+SHUFFLE = 1
+
+COMPRESSORS = ['none', 'zlib', 'zstd', 'lz4']
+
+def _codec(name):
+    """Return (compress(data, level), decompress(data)) for a compressor"""
+    if name == 'none':
+        return (lambda data, level: bytes(data)), bytes
+    elif name == 'zlib':
+        return zlib.compress, zlib.decompress
+    elif name == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('zstd compression needs the zstandard package')
+        return ((lambda data, level: zstandard.ZstdCompressor(level=level).compress(data)),
+                (lambda data: zstandard.ZstdDecompressor().decompress(data)))
+    elif name == 'lz4':
+        try:
+            import lz4.block
+        except ImportError:
+            raise ValueError('lz4 compression needs the lz4 package')
+        return ((lambda data, level: lz4.block.compress(data, compression=level)),
+                lz4.block.decompress)
+    else:
+        raise ValueError('Unknown compressor {}'.format(name))
+
+def available_compressors():
+    """Compressors usable in this environment"""
+    names = []
+    for name in COMPRESSORS:
+        try:
+            _codec(name)
+            names.append(name)
+        except ValueError:
+            pass
+    return names
+
+def _pack12(q):
+    """Pack int16 values in [-2048, 2047] pairwise into 3 bytes"""
+    a = q[..., 0::2].astype(np.uint16) & 0xFFF
+    b = q[..., 1::2].astype(np.uint16) & 0xFFF
+    out = np.empty(a.shape + (3,), dtype=np.uint8)
+    out[..., 0] = a
+    out[..., 1] = (a >> 8) | (b << 4)
+    out[..., 2] = b >> 4
+    return out.reshape(a.shape[:-1] + (3*a.shape[-1],))
+
+def _unpack12(raw, out):
+    """Unpack 3-byte pairs into int16 out"""
+    raw = raw.reshape(-1, 3).astype(np.int16)
+    out[0::2] = raw[:, 0] | ((raw[:, 1] & 0xF) << 8)
+    out[1::2] = (raw[:, 1] >> 4) | (raw[:, 2] << 4)
+    out ^= 0x800
+    out -= 0x800
+    return out
+
+def encode(iq, bits=16, block=4096, compressor='zlib', level=1, threads=1):
+    """Encode complex IQ; returns the encoded snapshot as a uint8 array.
+
+    Parameters:
+        iq          complex IQ samples
+        bits        Quantization, 16 or 12 bits per I and Q
+        block       Samples per independently decodable block
+        compressor  One of COMPRESSORS
+        level       Compression level
+        threads     Number of threads compressing blocks
+    """
+    if bits not in (12, 16):
+        raise ValueError('bits must be 12 or 16')
+    compress, _ = _codec(compressor)
+
+    iq = np.asarray(iq, dtype=np.complex64)
+    n = len(iq)
+    nblocks = -(-n//block)
+
+    # Quantize every block at once; the padding of the last block is zeros,
+    # which costs next to nothing once compressed.
+    f = np.zeros((nblocks, 2*block), dtype=np.float32)
+    f.reshape(-1)[:2*n] = iq.view(np.float32)
+    qmax = float(2**(bits - 1) - 1)
+    peak = np.max(np.abs(f), axis=1) if nblocks else np.empty(0, dtype=np.float32)
+    scale = np.where(peak > 0, peak/qmax, 1.0).astype(np.float32)
+    f /= scale[:, None]
+    q = np.rint(f, out=f).astype(np.int16)
+
+    if bits == 16:
+        flags = SHUFFLE
+        data = np.ascontiguousarray(q.view(np.uint8).reshape(nblocks, 2*block, 2).transpose(0, 2, 1))
+    else:
+        flags = 0
+        data = _pack12(q)
+
+    rows = [data[i].tobytes() for i in range(nblocks)]
+    if threads > 1 and nblocks > 1:
+        with ThreadPoolExecutor(threads) as pool:
+            blobs = list(pool.map(lambda r: compress(r, level), rows))
+    else:
+        blobs = [compress(r, level) for r in rows]
+
+    sizes = np.array([len(b) for b in blobs], dtype=np.uint32)
+    header = HEADER.pack(MAGIC, VERSION, bits, COMPRESSORS.index(compressor), flags,
+                         block, n, nblocks)
+    buf = b''.join([header, sizes.tobytes(), scale.tobytes()] + blobs)
+    return np.frombuffer(buf, dtype=np.uint8)
+
+def is_encoded(buf):
+    """True if buf (bytes or uint8 array) holds an encoded snapshot"""
+    buf = np.asarray(buf)
+    return buf.dtype == np.uint8 and len(buf) >= HEADER.size and buf[:4].tobytes() == MAGIC
+
+class EncodedIQ:
+    """Random access to an encoded snapshot.
+
+    Parameters:
+        buf     Encoded snapshot, bytes or uint8 array (e.g. the iq_data
+                field of a converted snapshots record)
+    """
+    def __init__(self, buf):
+        self.buf = np.frombuffer(buf, dtype=np.uint8) if isinstance(buf, bytes) else np.asarray(buf)
+        magic, version, bits, compressor, flags, block, n, nblocks = \
+            HEADER.unpack_from(self.buf[:HEADER.size].tobytes())
+        if magic != MAGIC:
+            raise ValueError('Not an encoded snapshot')
+        if version != VERSION:
+            raise ValueError('Unsupported snapshot codec version {}'.format(version))
+
+        self.bits = bits
+        self.compressor = COMPRESSORS[compressor]
+        self.flags = flags
+        self.block = block
+        self.nsamples = n
+        self.nblocks = nblocks
+
+        i = HEADER.size
+        self.sizes = np.frombuffer(self.buf[i:i + 4*nblocks].tobytes(), dtype=np.uint32)
+        i += 4*nblocks
+        self.scales = np.frombuffer(self.buf[i:i + 4*nblocks].tobytes(), dtype=np.float32)
+        i += 4*nblocks
+        self.offsets = i + np.concatenate(([0], np.cumsum(self.sizes, dtype=np.int64)))
+        self._decompress = _codec(self.compressor)[1]
+
+    def __len__(self):
+        return self.nsamples
+
+    def _decode_block(self, i, out, start, stop):
+        """Decode the part of block i in [start, stop) into out[0:stop-start]"""
+        raw = np.frombuffer(self._decompress(self.buf[self.offsets[i]:self.offsets[i + 1]]),
+                            dtype=np.uint8)
+        if self.bits == 16:
+            q = np.empty(2*self.block, dtype=np.int16)
+            if self.flags & SHUFFLE:
+                q.view(np.uint8).reshape(-1, 2).T[:] = raw.reshape(2, -1)
+            else:
+                q.view(np.uint8)[:] = raw
+        else:
+            q = _unpack12(raw, np.empty(2*self.block, dtype=np.int16))
+
+        b0 = i*self.block
+        np.multiply(q[2*(start - b0):2*(stop - b0)], self.scales[i], out=out.view(np.float32))
+
+    def read(self, start=0, stop=None, threads=1):
+        """Decode samples [start, stop) to complex64, touching only the
+        blocks that overlap them"""
+        stop = self.nsamples if stop is None else min(stop, self.nsamples)
+        start = max(start, 0)
+        out = np.empty(max(stop - start, 0), dtype=np.complex64)
+        if len(out) == 0:
+            return out
+
+        jobs = []
+        for i in range(start//self.block, -(-stop//self.block)):
+            a = max(i*self.block, start)
+            b = min((i + 1)*self.block, stop)
+            jobs.append((i, out[a - start:b - start], a, b))
+
+        if threads > 1 and len(jobs) > 1:
+            with ThreadPoolExecutor(threads) as pool:
+                for fut in [pool.submit(self._decode_block, *job) for job in jobs]:
+                    fut.result()
+        else:
+            for job in jobs:
+                self._decode_block(*job)
+        return out
+
+    def read_time(self, fs, tmin, tmax, threads=1):
+        """Decode the samples between tmin and tmax seconds into the snapshot"""
+        return self.read(int(math.floor(tmin*fs)), int(math.ceil(tmax*fs)), threads)
+
+def decode(buf, start=0, stop=None, threads=1):
+    """Decode samples [start, stop) of an encoded snapshot"""
+    return EncodedIQ(buf).read(start, stop, threads)
+
+def converted_path(logpath):
+    """Return the converted log file name for a log file"""
+    root, _ = os.path.splitext(logpath)
+    return root + '.iqc.h5'
+
+def convert(logpath, outpath=None, batch=64, **kwargs):
+    """Copy a log, re-encoding its snapshots with this codec.
+
+    Every other dataset is copied unchanged. Snapshots are converted batch
+    records at a time and keyword arguments are passed to encode. Returns
+    the output path.
+    """
+    from hdf5_utils import decode_snapshot
+
+    if outpath is None:
+        outpath = converted_path(logpath)
+
+    with h5py.File(logpath, 'r') as f, h5py.File(outpath, 'w') as out:
+        for name in f:
+            if name != 'snapshots':
+                f.copy(name, out)
+
+        if 'snapshots' not in f:
+            return outpath
+
+        snapshots = f['snapshots']
+        dtype = np.dtype([(name, h5py.vlen_dtype(np.uint8) if name == 'iq_data' else snapshots.dtype[name])
+                          for name in snapshots.dtype.names])
+        ds = out.create_dataset('snapshots', (snapshots.shape[0],), dtype=dtype,
+                                maxshape=(None,), chunks=True)
+        for k, v in snapshots.attrs.items():
+            ds.attrs[k] = v
+
+        raw = enc = 0
+        t = time.perf_counter()
+        for i0 in range(0, snapshots.shape[0], batch):
+            recs = snapshots[i0:i0 + batch]
+            rows = np.empty(len(recs), dtype=dtype)
+            for name in dtype.names:
+                if name != 'iq_data':
+                    rows[name] = recs[name]
+            for j, rec in enumerate(recs):
+                rows['iq_data'][j] = encode(decode_snapshot(rec['iq_data']), **kwargs)
+                raw += rec['iq_data'].nbytes
+                enc += len(rows['iq_data'][j])
+            ds[i0:i0 + len(recs)] = rows
+
+        logging.info('%s: %d snapshots, %.1f MB -> %.1f MB in %.2f s', logpath,
+                     snapshots.shape[0], raw/1e6, enc/1e6, time.perf_counter() - t)
+
+    return outpath
+
+def _snr(x, y):
+    """Reconstruction SNR of y in dB"""
+    err = np.mean(np.abs(x - y)**2)
+    return float('inf') if err == 0 else 10*np.log10(np.mean(np.abs(x)**2)/err)
+
+def _synthetic_snapshots(n=4, fs=10e6, duration=0.05, seed=0):
+    """Emulated wideband snapshots: busy channels, a jammer and noise"""
+    from chanemu import ChannelEmulator
+
+    block = 1 << 16
+    emu = ChannelEmulator(fs=fs, block=block, nchannels=8, snr=20.0, activity=0.5,
+                          jammers=[('pulsed', {'fc': fs/8, 'bw': fs/10, 'period': 1e-3,
+                                               'duty': 0.2, 'power': 10.0})],
+                          seed=seed)
+    nblocks = max(int(duration*fs)//block, 1)
+    return [np.concatenate([emu.next_block() for _ in range(nblocks)]) for _ in range(n)]
+
+def bench(snapshots, configs, threads=1, repeat=3):
+    """Compare codecs on a list of complex64 snapshots.
+
+    Parameters:
+        snapshots   List of complex64 arrays
+        configs     List of (name, encode kwargs) for this codec
+        threads     Threads for decoding
+        repeat      Timing repeats (best is kept)
+
+    Returns a list of dicts with the compression ratio against complex64,
+    encode and decode throughput in MB/s of complex64, the reconstruction
+    SNR in dB and the time to decode 1% of each snapshot. FLAC is included
+    when the dragonradio extension is available.
+    """
+    nbytes = sum(x.nbytes for x in snapshots)
+
+    def best(fn):
+        t = math.inf
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            r = fn()
+            t = min(t, time.perf_counter() - t0)
+        return t, r
+
+    results = []
+    for name, kwargs in configs:
+        tenc, encoded = best(lambda: [encode(x, **kwargs) for x in snapshots])
+        tdec, decoded = best(lambda: [decode(e, threads=threads) for e in encoded])
+        k = [len(x)//100 for x in snapshots]
+        tra, _ = best(lambda: [decode(e, len(x)//2, len(x)//2 + n)
+                               for e, x, n in zip(encoded, snapshots, k)])
+        results.append({'codec': name,
+                        'ratio': nbytes/sum(len(e) for e in encoded),
+                        'encode_mbps': nbytes/tenc/1e6,
+                        'decode_mbps': nbytes/tdec/1e6,
+                        'snr_db': min(_snr(x, y) for x, y in zip(snapshots, decoded)),
+                        'range_ms': tra/len(snapshots)*1e3})
+
+    try:
+        import dragonradio
+        compress = dragonradio.compressFLAC
+    except (ImportError, AttributeError):
+        logging.warning('dragonradio FLAC codec not available; FLAC not benchmarked')
+        return results
+
+    tenc, encoded = best(lambda: [np.asarray(compress(x)) for x in snapshots])
+    tdec, decoded = best(lambda: [np.asarray(dragonradio.decompressFLAC(e), dtype=np.complex64)
+                                  for e in encoded])
+    # FLAC has no random access, so a range costs a full decode
+    results.append({'codec': 'flac',
+                    'ratio': nbytes/sum(e.nbytes for e in encoded),
+                    'encode_mbps': nbytes/tenc/1e6,
+                    'decode_mbps': nbytes/tdec/1e6,
+                    'snr_db': min(_snr(x, y) for x, y in zip(snapshots, decoded)),
+                    'range_ms': tdec/len(snapshots)*1e3})
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Block IQ codec for dragonradio snapshots.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    def add_codec_arguments(p):
+        p.add_argument('--bits', action='store', type=int, choices=[12, 16], default=16,
+                       help='bits per I and Q sample')
+        p.add_argument('--block', action='store', type=int, default=4096,
+                       help='samples per block')
+        p.add_argument('--compressor', action='store', choices=COMPRESSORS, default='zlib',
+                       help='block compressor')
+        p.add_argument('--level', action='store', type=int, default=1,
+                       help='compression level')
+
+    p = subparsers.add_parser('convert', help='re-encode the snapshots of logs',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_codec_arguments(p)
+    p.add_argument('-o', '--output', action='store',
+                   help='output file (default: radio.h5 -> radio.iqc.h5; one log only)')
+    p.add_argument('paths', nargs='+')
+
+    p = subparsers.add_parser('bench', help='compare against FLAC on real and synthetic snapshots',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--log', action='append', default=[],
+                   help='also benchmark the snapshots of this log (repeatable)')
+    p.add_argument('--threads', action='store', type=int, default=1,
+                   help='decode threads')
+    p.add_argument('--block', action='store', type=int, default=4096,
+                   help='samples per block')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    if args.command == 'convert':
+        if args.output and len(args.paths) > 1:
+            parser.error('--output needs a single log')
+        for path in args.paths:
+            print(convert(path, args.output, bits=args.bits, block=args.block,
+                          compressor=args.compressor, level=args.level))
+        return
+
+    from hdf5_utils import decode_snapshot
+
+    sets = [('synthetic', _synthetic_snapshots())]
+    for path in args.log:
+        with h5py.File(path, 'r') as f:
+            sets.append((path, [decode_snapshot(rec['iq_data']) for rec in f['snapshots']]))
+
+    configs = []
+    for compressor in available_compressors():
+        for bits in (16, 12):
+            configs.append(('{}/int{}'.format(compressor, bits),
+                            {'bits': bits, 'block': args.block, 'compressor': compressor}))
+
+    for name, snapshots in sets:
+        print('{}: {} snapshots, {:.1f} MB complex64'.format(name, len(snapshots),
+              sum(x.nbytes for x in snapshots)/1e6))
+        print('{:<12} {:>6} {:>10} {:>10} {:>8} {:>10}'.format('codec', 'ratio',
+              'enc MB/s', 'dec MB/s', 'SNR dB', '1% (ms)'))
+        for r in bench(snapshots, configs, args.threads):
+            print('{codec:<12} {ratio:6.2f} {encode_mbps:10.0f} {decode_mbps:10.0f} '
+                  '{snr_db:8.1f} {range_ms:10.3f}'.format(**r))
+
+if __name__ == '__main__':
+    main()
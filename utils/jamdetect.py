@@ -0,0 +1,386 @@
+# JAMMER DETECTION
+""" jamdetect
+Detect jamming in the decoded 'snapshots' and the 'slots' IQ of a
+dragonradio log.
+
+Each record is turned into a spectrogram of non-overlapping nfft frames.
+Cells covered by a known transmission in 'selftx' (start, end, fc, fs, both
+our own and other nodes in the network) are masked out, and the remaining
+power is averaged per channel and per detection window of win frames. All
+of this is done as array operations over every channel and window of a
+record at once.
+
+Detection is ordered-statistic CFAR. The reference level of a window is the
+q-quantile of the channel powers in that window, so a jammer on some
+channels does not raise its own threshold. The noise floor follows the
+reference down at once but rises by at most `rise` dB per second, so a
+jammer sitting on most of the band is still detected for alpha/rise
+seconds, while the floor recovers from a window whose reference happened
+to be low instead of keeping it forever. A channel is jammed in a window
+when its power is more than alpha dB above the noise floor.
+
+Jammed windows are merged into a per-channel timeline of events and each
+record with jamming in it is classified as
+
+    tone        narrowband, fixed frequency
+    sweep       narrowband, frequency moving steadily across the band
+    pulsed      on/off in time
+    barrage     most of the band at once
+
+Usage:
+    python jamdetect.py radio.h5 [--channels 10] [--source snapshots] [-o events.csv]
+"""
+import argparse
+import collections
+import csv
+import logging
+import time
+
+import h5py
+import numpy as np
+
+from hdf5_utils import slot_rate, decode_snapshot
+import spectral
+
+Channel = collections.namedtuple('Channel', ['fc', 'bw'])
+Channel.__doc__ = """A channel, with center frequency relative to the receive center frequency"""
+
+Detection = collections.namedtuple('Detection',
+    ['timestamp', 't', 'power', 'floor', 'jammed', 'cls', 'elapsed'])
+Detection.__doc__ = """Detection result for one record.
+
+    timestamp   Record timestamp
+    t           Start time of each window (nwin,)
+    power       Channel power in dB (nwin, nchannels), NaN where masked
+    floor       Noise floor in dB (nwin,)
+    jammed      Jammed flags (nwin, nchannels)
+    cls         Jammer class or None
+    elapsed     Processing time in seconds
+"""
+
+CLASSES = ['tone', 'sweep', 'pulsed', 'barrage']
+
+def equal_channels(nchannels, fs):
+    """Split the band [-fs/2, fs/2) into nchannels equal channels"""
+    bw = fs/nchannels
+    return [Channel(-fs/2 + (i + 0.5)*bw, bw) for i in range(nchannels)]
+
+def spectrogram(iq, nfft, scale=1.0, workers=None):
+    """Power of consecutive non-overlapping Hann-windowed frames, scaled by
+    scale, float32 of shape (nframes, nfft)"""
+    P = spectral.power(np.asarray(iq, dtype=np.complex64), nfft, workers=workers)
+    P *= np.float32(scale)
+    return P
+
+def selftx_mask(nframes, nfft, fs, selftx):
+    """Mask of spectrogram cells covered by known transmissions.
+
+    Parameters:
+        nframes     Number of spectrogram frames
+        nfft        Number of FFT points
+        fs          Sample rate of the record
+        selftx      Structured array with start, end (samples), fc, fs (Hz)
+    """
+    if selftx is None or len(selftx) == 0:
+        return np.zeros((nframes, nfft), dtype=bool)
+
+    frame = np.arange(nframes)
+    f = (np.arange(nfft) - nfft//2)*(fs/nfft)
+
+    start = selftx['start'][:, None]//nfft
+    end = (selftx['end'][:, None] + nfft - 1)//nfft
+    in_time = (frame[None, :] >= start) & (frame[None, :] < end)
+
+    half = 0.5*selftx['fs'][:, None]
+    in_freq = np.abs(f[None, :] - selftx['fc'][:, None]) <= half
+
+    # (nselftx, nframes) x (nselftx, nfft) -> (nframes, nfft)
+    return np.einsum('st,sf->tf', in_time.astype(np.float32), in_freq.astype(np.float32)) > 0
+
+def channel_matrix(channels, nfft, fs):
+    """0/1 matrix selecting the FFT bins of each channel, (nchannels, nfft)"""
+    f = (np.arange(nfft) - nfft//2)*(fs/nfft)
+    fc = np.array([c.fc for c in channels])[:, None]
+    bw = np.array([c.bw for c in channels])[:, None]
+    return (np.abs(f[None, :] - fc) < bw/2).astype(np.float32)
+
+def channel_power(S, mask, C, win):
+    """Mean unmasked power per window and channel, NaN if fully masked"""
+    nwin = S.shape[0] // win
+    S = S[:nwin*win]
+    valid = ~mask[:nwin*win]
+
+    # Sum over the frames of each window, then over the bins of each channel
+    psum = np.where(valid, S, 0).reshape(nwin, win, -1).sum(axis=1) @ C.T
+    count = valid.reshape(nwin, win, -1).sum(axis=1).astype(np.float32) @ C.T
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return psum/count
+
+class JamDetector:
+    """Stateful jammer detector over a sequence of records.
+
+    Parameters:
+        channels    List of Channel, or None to split the band in nchannels
+        nchannels   Number of equal channels if channels is None
+        nfft        Number of FFT points per spectrogram frame
+        win         Number of frames per detection window
+        alpha       Detection threshold above the noise floor (dB)
+        q           Quantile of channel powers used as the CFAR reference
+        floor       Initial noise floor in dB, or None to learn it
+        rise        Most the noise floor rises, in dB per second
+        workers     FFT threads (default: the spectral module's)
+    """
+    def __init__(self, channels=None, nchannels=10, nfft=256, win=8, alpha=10.0,
+                 q=0.25, floor=None, rise=1.0, workers=None):
+        self.channels = channels
+        self.nchannels = nchannels
+        self.nfft = nfft
+        self.win = win
+        self.alpha = alpha
+        self.q = q
+        self.rise = rise
+        self.workers = workers
+        # Noise floor in dB and the time of the window it was last set for
+        self.floor = np.inf if floor is None else floor
+        self._floor_t = None
+
+        # Normalize to a unit-energy window
+        self.scale = 1/np.sum(spectral.window(nfft)**2)
+
+        self._C = {}
+
+    def _channels(self, fs):
+        if fs not in self._C:
+            channels = self.channels or equal_channels(self.nchannels, fs)
+            self._C[fs] = (channels, channel_matrix(channels, self.nfft, fs))
+        return self._C[fs]
+
+    def process(self, timestamp, fs, iq, selftx=None):
+        """Run detection over one record and return a Detection"""
+        start = time.perf_counter()
+
+        channels, C = self._channels(fs)
+        S = spectrogram(iq, self.nfft, self.scale, self.workers)
+        mask = selftx_mask(len(S), self.nfft, fs, selftx)
+        P = channel_power(S, mask, C, self.win)
+        nwin = len(P)
+
+        with np.errstate(invalid='ignore'):
+            ref = np.nanquantile(P, self.q, axis=1) if nwin else np.empty(0)
+        with np.errstate(divide='ignore'):
+            refdB = np.where(np.isnan(ref), np.inf, 10*np.log10(ref))
+
+        # The floor at window k is the least over windows j <= k (and the
+        # previous floor) of ref_j + rise*(t_k - t_j): tilting the
+        # references by the rise turns this into a running minimum.
+        t = timestamp + np.arange(nwin)*(self.win*self.nfft/fs)
+        tilt = self.rise*(t - timestamp)
+        prev = self.floor
+        if self._floor_t is not None:
+            prev += self.rise*max(timestamp - self._floor_t, 0.0)
+        floordB = tilt + np.minimum.accumulate(np.r_[prev, refdB - tilt])[1:]
+        if nwin:
+            self.floor = floordB[-1]
+            self._floor_t = t[-1]
+        floor = 10**(floordB/10)
+
+        thresh = floor*10**(self.alpha/10)
+        with np.errstate(invalid='ignore'):
+            jammed = P > thresh[:, None]
+
+        cls = classify(S[:nwin*self.win], mask[:nwin*self.win], jammed, floor, self.win,
+                       self.alpha) if jammed.any() else None
+
+        with np.errstate(divide='ignore'):
+            PdB = 10*np.log10(P)
+
+        return Detection(timestamp, t, PdB, floordB, jammed, cls,
+                         time.perf_counter() - start)
+
+def classify(S, mask, jammed, floor, win, alpha):
+    """Classify the jammer in one record.
+
+    Parameters:
+        S           Spectrogram (nframes, nfft)
+        mask        Known-transmission mask (nframes, nfft)
+        jammed      Jammed flags (nwin, nchannels)
+        floor       Linear noise floor per window (nwin,)
+        win         Number of frames per window
+        alpha       Detection threshold (dB)
+    """
+    nframes, nfft = S.shape
+    thresh = np.repeat(floor, win)*10**(alpha/10)
+
+    Sm = np.where(mask, 0, S)
+    hot = Sm > thresh[:, None]
+    active = hot.any(axis=1)
+    if not active.any():
+        return None
+
+    # Wideband: a large part of the band is hot in the active frames, or
+    # most channels are jammed in most jammed windows
+    hot_frac = hot[active].mean(axis=1)
+    jammed_frac = jammed[jammed.any(axis=1)].mean(axis=1)
+    if np.median(hot_frac) > 0.5 or np.median(jammed_frac) >= 0.75:
+        return 'barrage'
+
+    # On/off in time: active for part of the record with several transitions
+    duty = active.mean()
+    transitions = np.count_nonzero(np.diff(active.astype(np.int8)))
+    if duty < 0.6 and transitions >= 2:
+        return 'pulsed'
+
+    # Narrowband: follow the peak bin of the active frames
+    peak = np.argmax(Sm[active], axis=1)
+    if len(peak) > 2 and np.ptp(peak) > max(2, nfft//32):
+        t = np.flatnonzero(active)
+        with np.errstate(invalid='ignore'):
+            r = np.corrcoef(t, peak)[0, 1]
+        # A sweep that wraps around the band shows up as a sawtooth, so
+        # look at the peak steps as well as the overall trend
+        steps = np.diff(peak)
+        steps = steps[steps != 0]
+        if abs(r) > 0.8 or (len(steps) and np.mean(np.sign(steps) == np.sign(np.median(steps))) > 0.8):
+            return 'sweep'
+
+    return 'tone'
+
+def timeline_events(detections, tol=1e-6):
+    """Merge jammed windows into (channel, start, end, class) events.
+
+    Runs of jammed windows are found for every channel at once; a run is
+    broken by an unjammed window or by a gap in time between records.
+    """
+    dets = [d for d in detections if len(d.t)]
+    if not dets:
+        return []
+
+    t = np.concatenate([d.t for d in dets])
+    dt = np.concatenate([np.full(len(d.t), d.t[1] - d.t[0] if len(d.t) > 1 else 0) for d in dets])
+    jam = np.concatenate([d.jammed for d in dets])
+    cls = np.concatenate([np.full(len(d.t), d.cls, dtype=object) for d in dets])
+
+    gap = np.r_[True, t[1:] > t[:-1] + dt[:-1] + tol]
+    prev = np.vstack([np.zeros((1, jam.shape[1]), dtype=bool), jam[:-1]]) & ~gap[:, None]
+    nxt = np.vstack([jam[1:], np.zeros((1, jam.shape[1]), dtype=bool)]) & ~np.r_[gap[1:], True][:, None]
+
+    # Transpose so nonzero() returns runs ordered by channel, then time
+    starts = np.nonzero((jam & ~prev).T)
+    ends = np.nonzero((jam & ~nxt).T)
+
+    events = [(int(c), float(t[i]), float(t[j] + dt[j]), cls[i])
+              for c, i, j in zip(starts[0], starts[1], ends[1])]
+    events.sort(key=lambda e: (e[1], e[0]))
+    return events
+
+def records(f, source):
+    """Yield (timestamp, fs, iq, selftx) for each record of a log source"""
+    selftx = f['selftx'][:] if source == 'snapshots' and 'selftx' in f else None
+    ds = f[source]
+    rates = slot_rate(ds.fields(['fs'] if 'fs' in ds.dtype.names else ['bw'])[:])
+    for i in range(ds.shape[0]):
+        rec = ds[i]
+        if source == 'snapshots':
+            iq = decode_snapshot(rec['iq_data'])
+            sel = selftx[selftx['timestamp'] == rec['timestamp']] if selftx is not None else None
+        else:
+            iq = np.asarray(rec['iq_data'], dtype=np.complex64)
+            sel = None
+        yield rec['timestamp'], float(rates[i]), iq, sel
+
+def detect_log(path, source='snapshots', **kwargs):
+    """Run the detector over a log.
+
+    Returns (detector, detections, duration) where duration is the total
+    signal time processed in seconds.
+    """
+    detector = JamDetector(**kwargs)
+    detections = []
+    duration = 0.0
+    with h5py.File(path, 'r') as f:
+        for timestamp, fs, iq, sel in records(f, source):
+            detections.append(detector.process(timestamp, fs, iq, sel))
+            duration += len(iq)/fs
+
+    return detector, detections, duration
+
+def latency_report(detections, duration):
+    """Summarize processing time and per-window detection latency.
+
+    The latency of a window is the time to fill it with samples plus the
+    processing time of that window's share of its record.
+    """
+    elapsed = sum(d.elapsed for d in detections)
+    per_window = []
+    for d in detections:
+        nwin = len(d.t)
+        if nwin:
+            wdur = d.t[1] - d.t[0] if nwin > 1 else 0
+            per_window.append(np.full(nwin, wdur + d.elapsed/nwin))
+    lat = np.concatenate(per_window) if per_window else np.empty(0)
+
+    return {'records': len(detections),
+            'windows': len(lat),
+            'signal_sec': duration,
+            'elapsed_sec': elapsed,
+            'realtime_factor': duration/elapsed if elapsed else float('inf'),
+            'latency_p50_ms': 1e3*np.percentile(lat, 50) if len(lat) else float('nan'),
+            'latency_p95_ms': 1e3*np.percentile(lat, 95) if len(lat) else float('nan'),
+            'latency_max_ms': 1e3*np.max(lat) if len(lat) else float('nan')}
+
+def main():
+    parser = argparse.ArgumentParser(description='Detect jamming in dragonradio logs.')
+    parser.add_argument('--source', action='store', choices=['snapshots', 'slots'],
+                        default='snapshots',
+                        help='dataset to run detection on')
+    parser.add_argument('--channels', action='store', type=int, default=10, dest='nchannels',
+                        help='number of equal channels across the band')
+    parser.add_argument('--channel', action='append', default=[], dest='channels',
+                        metavar='FC:BW',
+                        help='channel center frequency and bandwidth in Hz, relative to center (repeatable)')
+    parser.add_argument('--nfft', action='store', type=int, default=256,
+                        help='set number of FFT points')
+    parser.add_argument('--win', action='store', type=int, default=8,
+                        help='frames per detection window')
+    parser.add_argument('--alpha', action='store', type=float, default=10.0,
+                        help='threshold above noise floor (dB)')
+    parser.add_argument('--floor', action='store', type=float, default=None,
+                        help='initial noise floor (dB)')
+    parser.add_argument('--rise', action='store', type=float, default=1.0,
+                        help='most the noise floor rises (dB per second)')
+    parser.add_argument('-j', '--workers', action='store', type=int, default=None,
+                        help='FFT threads (default: CPU count)')
+    parser.add_argument('-o', '--output', action='store', default=None,
+                        help='write jamming events to CSV file')
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    channels = None
+    if args.channels:
+        channels = [Channel(*map(float, c.split(':'))) for c in args.channels]
+
+    for path in args.paths:
+        detector, detections, duration = detect_log(path, source=args.source,
+            channels=channels, nchannels=args.nchannels, nfft=args.nfft,
+            win=args.win, alpha=args.alpha, floor=args.floor, rise=args.rise,
+            workers=args.workers)
+        events = timeline_events(detections)
+
+        for (c, start, end, cls) in events:
+            print('{}: channel {} jammed {:.6f}-{:.6f} ({})'.format(path, c, start, end, cls))
+
+        if args.output:
+            with open(args.output, 'w', newline='') as csvf:
+                writer = csv.writer(csvf, delimiter=',')
+                writer.writerow(['channel', 'start', 'end', 'class'])
+                writer.writerows(events)
+
+        report = latency_report(detections, duration)
+        print(', '.join('{} {:g}'.format(k, v) for k, v in report.items()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+# PACKET FEATURE EXTRACTION
+""" pktfeatures
+Compute signal-quality features for every received packet in a dragonradio
+log, for training and testing anti-jamming detectors.
+
+Packets are read from the 'recv' dataset in batches. The signal of each
+packet is either its logged iq_data or, with source='slots', the samples
+between start_samples and end_samples of the slot the packet was
+demodulated from, taken as views from the log's slot store (see
+slotstore.py). Each batch is grouped into length buckets (multiples of
+the PSD bin count), zero-padded to the bucket length, and every feature is computed for a whole
+bucket at once:
+
+    energy      Sum of |x|^2
+    power       Mean of |x|^2 (dB)
+    papr        Peak-to-average power ratio (dB)
+    obw         Occupied bandwidth holding obw_frac of the power (Hz, or
+                fraction of the sample rate if the rate is unknown)
+    flatness    Spectral flatness, geometric over arithmetic mean of the PSD
+    snr         Blind M2M4 SNR estimate (dB)
+    evm         Error vector magnitude against the nearest point of the
+                reference constellation (dB)
+
+Batches are spread over a process pool and the result is written as a
+columnar HDF5 table, one 1-D dataset per column, next to the log
+(radio.h5 -> radio.features.h5).
+
+Throughput is bounded by the FFT of every padded packet, so it is a rate
+in samples rather than packets: about 50 Msamples/s per core. That is over
+100k packets/s for packets of up to 256 samples, about 90k up to 512,
+50k for the 200-1500 sample packets of --bench and 6k for whole
+8750-sample slots. Use -j to go faster.
+
+Usage:
+    python pktfeatures.py radio.h5 [--source slots] [-j 4] [--bench]
+"""
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+import scipy.fft as sfft
+
+from slotstore import SlotStore
+
+FEATURES = ['energy', 'power', 'papr', 'obw', 'flatness', 'snr', 'evm']
+
+# Packet metadata copied from 'recv' into the feature table
+META = ['timestamp', 'seq', 'src', 'dest', 'header_valid', 'payload_valid',
+        'ms', 'evm', 'rssi', 'fc', 'bw']
+
+QPSK = (np.array([1+1j, -1+1j, -1-1j, 1-1j])/np.sqrt(2)).astype(np.complex64)
+
+def features_path(logpath):
+    """Return the feature table file name for a log file"""
+    root, _ = os.path.splitext(logpath)
+    return root + '.features.h5'
+
+def bucket_lengths(lengths, step=256):
+    """Round each length up to a multiple of step.
+
+    Padding to the next multiple of the PSD bin count wastes far fewer
+    samples than padding to a power of two, and the FFT sizes stay smooth.
+    """
+    lengths = np.maximum(np.asarray(lengths, dtype=np.int64), 1)
+    return -(-lengths // step)*step
+
+def pad_batch(sigs, n):
+    """Zero-pad a list of signals into an (len(sigs), n) complex64 array"""
+    X = np.zeros((len(sigs), n), dtype=np.complex64)
+    for i, sig in enumerate(sigs):
+        X[i, :len(sig)] = sig
+    return X
+
+def _evm_error(X, M2, L, constellation):
+    """Summed squared error vector of each row of X against constellation.
+
+    Rows are normalized to unit power first. Padding is excluded: a padded
+    zero sample is always at distance min|p|^2 from the constellation.
+    """
+    n = X.shape[1]
+
+    if constellation is QPSK:
+        # For QPSK the nearest point is the sign of I and Q, so
+        # |x - ref|^2 = |x|^2 - sqrt(2)(|I| + |Q|) + 1, and summed over a
+        # normalized row this only needs the sum of |I| + |Q|.
+        A = np.abs(X.view(np.float32)).sum(axis=1)
+        return 2*L - np.sqrt(2)*A/np.sqrt(M2)
+
+    Xn = X/np.sqrt(M2)[:, None]
+    best = None
+    for p in constellation:
+        e = Xn - p
+        d = e.real**2 + e.imag**2
+        best = d if best is None else np.minimum(best, d)
+    pad = np.min(np.abs(constellation)**2)
+    return best.sum(axis=1) - (n - L)*pad
+
+def batch_features(X, lengths, fs=None, nbins=256, obw_frac=0.99, constellation=QPSK):
+    """Compute features of zero-padded packets.
+
+    Parameters:
+        X           (npkts, n) complex64 array, n a multiple of nbins
+        lengths     Number of valid samples in each row of X
+        fs          Sample rate of each packet (scalar or array) or None
+        nbins       Number of PSD bins used for obw and flatness
+        obw_frac    Fraction of power inside the occupied bandwidth
+        constellation   Reference points for EVM (unit average power)
+
+    Returns a dict of 1-D float32 arrays keyed by FEATURES.
+    """
+    npkts, n = X.shape
+    L = np.maximum(np.asarray(lengths, dtype=np.float32), 1)
+
+    # Padding is zero, so it drops out of every sum and of the peak
+    P = X.real**2 + X.imag**2
+    energy = P.sum(axis=1)
+    M2 = energy/L
+    M4 = np.einsum('ij,ij->i', P, P)/L
+    peak = P.max(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        power = 10*np.log10(M2)
+        papr = 10*np.log10(peak/M2)
+
+        # M2M4 estimator: S = sqrt(2*M2^2 - M4), N = M2 - S
+        S = np.sqrt(np.maximum(2*M2*M2 - M4, 0))
+        snr = 10*np.log10(S/np.maximum(M2 - S, 1e-20))
+
+        evm = 10*np.log10(np.maximum(_evm_error(X, M2, L, constellation), 0)/L)
+
+    # PSD from one FFT over the padded packet, reduced to nbins bins. In the
+    # float32 view of the FFT the parts of a bin's frequencies are adjacent,
+    # so a bin is the sum of a run of 2n/nbins squares; that sum is a
+    # matrix-vector product, as NumPy reductions over a short last axis are
+    # slow. Since n/2 is a multiple of the bin width, shifting after the
+    # reduction is the same as shifting the full spectrum.
+    F = sfft.fft(X, axis=1).view(np.float32)
+    np.square(F, out=F)
+    psd = (F.reshape(-1, 2*n//nbins) @ np.ones(2*n//nbins, dtype=np.float32)).reshape(npkts, nbins)
+    psd = np.roll(psd, nbins//2, axis=1)
+    # The cumulative power is increasing, so the first bin reaching a
+    # threshold is the number of bins below it
+    total = psd.sum(axis=1, keepdims=True)
+    cum = np.cumsum(psd, axis=1)
+    tail = (1 - obw_frac)/2
+    lo = np.count_nonzero(cum < tail*total, axis=1)
+    hi = np.minimum(np.count_nonzero(cum < (1 - tail)*total, axis=1), nbins - 1)
+    obw = (hi - lo + 1)/nbins
+    if fs is not None:
+        obw = obw*np.asarray(fs)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logpsd = np.log(np.maximum(psd, 1e-30))
+        flatness = np.exp(logpsd.mean(axis=1))/np.maximum(psd.mean(axis=1), 1e-30)
+
+    return {'energy': energy.astype(np.float32),
+            'power': power.astype(np.float32),
+            'papr': papr.astype(np.float32),
+            'obw': np.asarray(obw, dtype=np.float32),
+            'flatness': flatness.astype(np.float32),
+            'snr': snr.astype(np.float32),
+            'evm': evm.astype(np.float32)}
+
+def grouped_features(sigs, fs=None, nbins=256, max_samples=1 << 18, **kwargs):
+    """Compute features of a list of signals by grouping them by length.
+
+    Each length bucket is processed in chunks of at most max_samples padded
+    samples. The default keeps a chunk and its temporaries in cache, which
+    makes the several passes over it about twice as fast as chunks that
+    stream from memory.
+    """
+    lengths = np.array([len(s) for s in sigs], dtype=np.int64)
+    buckets = bucket_lengths(lengths, nbins)
+    fs = None if fs is None else np.broadcast_to(np.asarray(fs, dtype=np.float64), lengths.shape)
+
+    out = {name: np.full(len(sigs), np.nan, dtype=np.float32) for name in FEATURES}
+    for n in np.unique(buckets):
+        rows = max(max_samples // n, 1)
+        bucket = np.flatnonzero(buckets == n)
+        for k in range(0, len(bucket), rows):
+            idx = bucket[k:k+rows]
+            X = pad_batch([sigs[i] for i in idx], n)
+            feats = batch_features(X, lengths[idx],
+                                   fs=None if fs is None else fs[idx],
+                                   nbins=nbins, **kwargs)
+            for name in FEATURES:
+                out[name][idx] = feats[name]
+
+    return out
+
+def _extract_batch(logpath, i0, i1, source, nbins, obw_frac):
+    """Compute the feature table rows for packets [i0, i1). Runs in a worker."""
+    with h5py.File(logpath, 'r') as f:
+        recs = f['recv'][i0:i1]
+    if source == 'slots':
+        # Views into the memory-mapped slot store built by extract()
+        sigs, fs = SlotStore.open(logpath, build=False).packets(recs)
+    else:
+        sigs = [np.asarray(iq, dtype=np.complex64) for iq in recs['iq_data']]
+        fs = None
+
+    cols = grouped_features(sigs, fs=fs, nbins=nbins, obw_frac=obw_frac)
+    cols['length'] = np.array([len(s) for s in sigs], dtype=np.int64)
+    # The receiver's own EVM estimate is kept alongside ours as rx_evm
+    for name in META:
+        if name in recs.dtype.names:
+            key = 'rx_evm' if name == 'evm' else name
+            cols[key] = recs[name]
+
+    return cols
+
+def write_table(path, cols):
+    """Write a dict of equal-length 1-D arrays as a columnar HDF5 table"""
+    with h5py.File(path, 'w') as f:
+        for name, col in cols.items():
+            f.create_dataset(name, data=col, chunks=True, compression='lzf')
+
+def read_table(path, columns=None):
+    """Read some or all columns of a feature table into a dict of arrays"""
+    with h5py.File(path, 'r') as f:
+        if columns is None:
+            columns = list(f.keys())
+        return {name: f[name][:] for name in columns}
+
+def extract(logpath, outpath=None, source='iq', batch=4096, jobs=None,
+            nbins=256, obw_frac=0.99):
+    """Compute features for every received packet in a log.
+
+    Parameters:
+        logpath     Path to dragonradio HDF5 log
+        outpath     Feature table (default: next to log, see features_path)
+        source      'iq' to use the logged iq_data, 'slots' to use slot samples
+        batch       Number of packets per worker task
+        jobs        Number of worker processes (default: CPU count)
+        nbins       Number of PSD bins used for obw and flatness
+        obw_frac    Fraction of power inside the occupied bandwidth
+
+    Returns (outpath, number of packets).
+    """
+    if outpath is None:
+        outpath = features_path(logpath)
+
+    with h5py.File(logpath, 'r') as f:
+        npkts = f['recv'].shape[0] if 'recv' in f else 0
+
+    if source == 'slots' and npkts:
+        SlotStore.build(logpath)
+
+    ranges = [(i, min(i + batch, npkts)) for i in range(0, npkts, batch)]
+    parts = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futs = [pool.submit(_extract_batch, logpath, i0, i1, source, nbins, obw_frac)
+                for (i0, i1) in ranges]
+        for fut in futs:
+            parts.append(fut.result())
+
+    if parts:
+        cols = {name: np.concatenate([p[name] for p in parts]) for name in parts[0]}
+    else:
+        cols = {name: np.empty(0, dtype=np.float32) for name in FEATURES}
+
+    write_table(outpath, cols)
+
+    return outpath, npkts
+
+def bench(npkts=20000, minlen=200, maxlen=1500, nbins=256, repeat=3):
+    """Measure single-core feature throughput on synthetic QPSK packets.
+
+    Returns (packets/s, samples/s) of the best of repeat runs.
+    """
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(minlen, maxlen, npkts)
+    sigs = []
+    for L in lengths:
+        sym = QPSK[rng.integers(0, 4, L)]
+        sigs.append(sym + 0.05*(rng.standard_normal(L) + 1j*rng.standard_normal(L)).astype(np.complex64))
+
+    elapsed = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        grouped_features(sigs, nbins=nbins)
+        elapsed = min(elapsed, time.perf_counter() - start)
+
+    return npkts/elapsed, lengths.sum()/elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract per-packet signal features from dragonradio logs.')
+    parser.add_argument('--source', action='store', choices=['iq', 'slots'], default='iq',
+                        help='use logged packet iq_data or slot samples')
+    parser.add_argument('--batch', action='store', type=int, default=4096,
+                        help='packets per worker task')
+    parser.add_argument('--nbins', action='store', type=int, default=256,
+                        help='number of PSD bins')
+    parser.add_argument('--obw-frac', action='store', type=float, default=0.99, dest='obw_frac',
+                        help='fraction of power inside occupied bandwidth')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('--bench', action='store_true',
+                        help='report single-core throughput on synthetic packets')
+    parser.add_argument('paths', nargs='*')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    if args.bench:
+        pps, sps = bench(nbins=args.nbins)
+        print('{:.0f} packets/s ({:.1f} Msamples/s) per core'.format(pps, sps/1e6))
+
+    for path in args.paths:
+        start = time.perf_counter()
+        out, npkts = extract(path, source=args.source, batch=args.batch,
+                             jobs=args.jobs, nbins=args.nbins, obw_frac=args.obw_frac)
+        elapsed = time.perf_counter() - start
+        print('{}: {} packets in {:.2f} sec ({:.0f} packets/s)'.format(out, npkts, elapsed, npkts/max(elapsed, 1e-9)))
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,8 @@ import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from scipy import signal
-from scipy import fftpack
+
+import spectral
 
 # Open IQ data, store as Cdata (complex data)
 iqdata_all = []
@@ -18,12 +19,13 @@ with open('iqdatatest.dat','r') as csvfile:
     for row in datareader:
         Idata.append(float(row[0]))
         Qdata.append(float(row[1]))
-Cdata = Idata + np.multiply(Qdata,1j)
-# Now we have Idata and Qdata as lists of float data, as well as full complex data
+Cdata = np.asarray(Idata, dtype=np.float32) + 1j*np.asarray(Qdata, dtype=np.float32)
+# Now we have Idata and Qdata as lists of float data, as well as full complex
+# (complex64) data
 
 # Take FFT of IQ data
 N = len(Idata)
-X_k = fftpack.fft(Cdata)/N # Note: 1/N scaling factor
+X_k = spectral.fft(Cdata)/N # Note: 1/N scaling factor
 #X_k = fftpack.fftshift(Cdata)
 
 # Now need to shift the FFT to get only the upper half of the spectrum
@@ -0,0 +1,193 @@
+# SHARED MEMORY RING BUFFER
+""" shmring
+Single-writer, many-reader ring of fixed-size numpy blocks in POSIX shared
+memory. Readers in other processes attach by name and get numpy views
+straight into the shared segment, so a block is never copied between
+processes.
+
+Layout of the segment:
+
+    header      magic, nslots, block size, dtype string, write_seq
+    stamps      sequence number of the block held by each slot
+    slots       nslots blocks of `block` items of `dtype`
+
+The writer fills slot (seq % nslots) and then bumps write_seq. A reader
+holding block seq is valid as long as the writer has not started on
+seq + nslots, i.e. while write_seq < seq + nslots; Reader.check() tests this
+after the block has been used so overruns are detected rather than silently
+returning torn data. Slot stamps and write_seq are aligned 8-byte words, so
+they are read and written atomically on the platforms we run on.
+
+Usage:
+    ring = ShmRing.create('iq', nslots=64, block=65536)
+    ring.write(samples)
+
+    ring = ShmRing.attach('iq')
+    reader = Reader(ring)
+    seq, block = reader.read()
+    ... use block ...
+    reader.check(seq)
+"""
+import struct
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+MAGIC = 0x52494e47 # 'RING'
+HEADER_FMT = '<IIQ16sQ'
+HEADER_SIZE = 64
+WRITE_SEQ_OFFSET = struct.calcsize('<IIQ16s')
+
+class Overrun(Exception):
+    """The writer overwrote a block before the reader was done with it"""
+    def __init__(self, seq, write_seq):
+        super().__init__('Block {} overwritten (writer at {})'.format(seq, write_seq))
+        self.seq = seq
+        self.write_seq = write_seq
+
+class ShmRing:
+    """Ring of nslots blocks of block items of dtype in shared memory.
+
+    Use ShmRing.create() in the writer and ShmRing.attach() in readers.
+    """
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+
+        magic, nslots, block, dtype, _ = struct.unpack_from(HEADER_FMT, shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a ring buffer'.format(shm.name))
+
+        self.nslots = nslots
+        self.block = block
+        self.dtype = np.dtype(dtype.rstrip(b'\0').decode())
+
+        self._write_seq = np.ndarray((1,), dtype='<u8', buffer=shm.buf, offset=WRITE_SEQ_OFFSET)
+        self.stamps = np.ndarray((nslots,), dtype='<u8', buffer=shm.buf, offset=HEADER_SIZE)
+        offset = HEADER_SIZE + 8*nslots
+        self.slots = np.ndarray((nslots, block), dtype=self.dtype, buffer=shm.buf, offset=offset)
+
+    @staticmethod
+    def size(nslots, block, dtype):
+        return HEADER_SIZE + 8*nslots + nslots*block*np.dtype(dtype).itemsize
+
+    @classmethod
+    def create(cls, name, nslots, block, dtype=np.complex64):
+        """Create a new ring (unlinking a stale one of the same name)"""
+        dtype = np.dtype(dtype)
+        try:
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+
+        shm = shared_memory.SharedMemory(name=name, create=True,
+                                         size=cls.size(nslots, block, dtype))
+        struct.pack_into(HEADER_FMT, shm.buf, 0, MAGIC, nslots, block,
+                         dtype.str.encode(), 0)
+        ring = cls(shm, owner=True)
+        ring.stamps[:] = np.iinfo(np.uint64).max
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to an existing ring created by another process"""
+        shm = shared_memory.SharedMemory(name=name)
+        # The resource tracker would unlink the segment when this process
+        # exits even though the writer owns it
+        try:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+        return cls(shm, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def write_seq(self):
+        """Sequence number of the next block to be written"""
+        return int(self._write_seq[0])
+
+    def slot(self, seq):
+        """View of the slot that holds (or will hold) block seq"""
+        return self.slots[seq % self.nslots]
+
+    def next_slot(self):
+        """(seq, view) of the slot to fill next; call commit() when done"""
+        seq = self.write_seq
+        return seq, self.slots[seq % self.nslots]
+
+    def commit(self, seq):
+        """Publish block seq filled through next_slot()"""
+        self.stamps[seq % self.nslots] = seq
+        self._write_seq[0] = seq + 1
+
+    def write(self, data):
+        """Copy data into the next slot and publish it"""
+        seq, view = self.next_slot()
+        n = min(len(data), self.block)
+        view[:n] = data[:n]
+        if n < self.block:
+            view[n:] = 0
+        self.commit(seq)
+        return seq
+
+    def close(self):
+        # Views into the buffer must go before the segment can be closed
+        self._write_seq = None
+        self.stamps = None
+        self.slots = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class Reader:
+    """Sequential reader of a ring.
+
+    Parameters:
+        ring        ShmRing
+        start       'latest' to start with the next block written, 'oldest'
+                    to start with the oldest block still in the ring
+    """
+    def __init__(self, ring, start='latest'):
+        self.ring = ring
+        w = ring.write_seq
+        self.seq = w if start == 'latest' else max(w - ring.nslots + 1, 0)
+        self.overruns = 0
+
+    def read(self, timeout=None, poll=0.0005):
+        """Return (seq, view) of the next block, waiting for it if needed.
+
+        If the reader has fallen more than a ring behind it skips ahead to
+        the oldest block still available and counts an overrun. Returns None
+        on timeout.
+        """
+        ring = self.ring
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            w = ring.write_seq
+            if w - self.seq >= ring.nslots:
+                self.overruns += 1
+                self.seq = w - ring.nslots + 1
+            if self.seq < w:
+                seq = self.seq
+                self.seq += 1
+                return seq, ring.slot(seq)
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(poll)
+
+    def valid(self, seq):
+        """True if block seq has not been overwritten"""
+        return self.ring.write_seq < seq + self.ring.nslots
+
+    def check(self, seq):
+        """Raise Overrun if block seq was overwritten while in use"""
+        w = self.ring.write_seq
+        if w >= seq + self.ring.nslots:
+            self.overruns += 1
+            raise Overrun(seq, w)
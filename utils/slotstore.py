@@ -0,0 +1,324 @@
+# SLOT SAMPLE STORE
+""" slotstore
+Slot IQ from a dragonradio log in one contiguous buffer with a sample-offset
+index, so packet signals and multi-slot windows are views instead of
+concatenations.
+
+The 'slots' dataset stores every slot's IQ as its own variable-length
+record, so the signal of a packet crossing a slot boundary, or the window
+of slots around it, had to be concatenated for every packet viewed or
+analyzed. The store copies each slot once into a raw complex64 file next
+to the log (radio.h5 -> radio.slots.iq) and keeps the index in
+radio.slots.npz:
+
+    offsets     (nslots+1,) int64 first sample of each slot in the buffer
+    timestamp   (nslots,) slot timestamps
+    fs          (nslots,) slot sample rates
+
+Opening a store memory-maps the buffer, so every access after the first
+build is zero-copy and worker processes share the OS page cache. Building
+is incremental: if the log has grown, only the new slots are appended.
+
+A packet's start_samples and end_samples are relative to the first sample
+of its reference slot, the last slot starting at or before the packet
+timestamp, and may reach into neighbouring slots.
+
+    store = SlotStore.open('radio.h5')
+    w = store.window(store.find(t), before=1, after=1)
+    w.sig, w.ts, w.bw               # as drlog's slots, but views
+    w.sigrange(start, end)          # packet samples relative to its slot
+    sigs, fs = store.packets(recs)  # views for a batch of 'recv' records
+    X = store.gather(recs, 2048, out=X)     # zero-padded into a reused buffer
+
+Usage:
+    python slotstore.py radio.h5 [--bench]
+"""
+import argparse
+import logging
+import os
+import time
+
+import h5py
+import numpy as np
+
+from hdf5_utils import slot_rate
+
+logger = logging.getLogger('slotstore')
+
+def store_paths(logpath):
+    """Return the (buffer, index) file names for a log file"""
+    root, _ = os.path.splitext(logpath)
+    return root + '.slots.iq', root + '.slots.npz'
+
+class SlotWindow:
+    """Slots [i0, i1) of a store around reference slot ref, with the sig,
+    sigrange, ts and bw of drlog's slots. All arrays are views."""
+    __slots__ = ['store', 'i0', 'i1', 'ref']
+
+    def __init__(self, store, i0, i1, ref):
+        self.store = store
+        self.i0 = i0
+        self.i1 = i1
+        self.ref = ref
+
+    @property
+    def sig(self):
+        off = self.store.offsets
+        return self.store.iq[off[self.i0]:off[self.i1]]
+
+    @property
+    def ts(self):
+        return self.store.timestamp[self.i0:self.i1]
+
+    @property
+    def bw(self):
+        return self.store.fs[self.ref]
+
+    def sigrange(self, start, end):
+        """Samples [start, end) relative to the reference slot, clipped to
+        the window"""
+        off = self.store.offsets
+        base = off[self.ref]
+        lo = min(max(base + start, off[self.i0]), off[self.i1])
+        hi = min(max(base + end, lo), off[self.i1])
+        return self.store.iq[lo:hi]
+
+class SlotStore:
+    """Contiguous slot IQ with a sample-offset index.
+
+    Parameters:
+        iq          complex64 samples of every slot back to back (array or
+                    memmap)
+        offsets     (nslots+1,) first sample of each slot, then len(iq)
+        timestamp   Slot timestamps
+        fs          Slot sample rates
+    """
+    def __init__(self, iq, offsets, timestamp, fs):
+        self.iq = iq
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.timestamp = np.asarray(timestamp)
+        self.fs = np.asarray(fs)
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    @classmethod
+    def from_records(cls, slots):
+        """Build an in-memory store from slot records (structured array or
+        h5py dataset), copying each slot once into a single allocation"""
+        slots = slots[:]
+        iqs = slots['iq_data']
+        offsets = np.zeros(len(iqs) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in iqs], out=offsets[1:])
+        iq = np.empty(offsets[-1], dtype=np.complex64)
+        for x, a, b in zip(iqs, offsets[:-1], offsets[1:]):
+            iq[a:b] = x
+        return cls(iq, offsets, slots['timestamp'], slot_rate(slots))
+
+    @staticmethod
+    def build(logpath, chunk=1024):
+        """Create or extend the store files of a log; returns the number of
+        slots added"""
+        iqpath, idxpath = store_paths(logpath)
+        with h5py.File(logpath, 'r') as f:
+            if 'slots' not in f:
+                return 0
+            slots = f['slots']
+            nslots = slots.shape[0]
+
+            offsets, timestamp, fs = [np.zeros(1, np.int64)], [], []
+            n0 = 0
+            if os.path.exists(idxpath) and os.path.exists(iqpath):
+                with np.load(idxpath) as idx:
+                    n0 = len(idx['timestamp'])
+                    # A shorter or different log than we indexed: start over
+                    if n0 > nslots or (n0 and slots[0]['timestamp'] != idx['timestamp'][0]) or \
+                       os.path.getsize(iqpath) != 8*idx['offsets'][-1]:
+                        n0 = 0
+                    else:
+                        offsets, timestamp, fs = [idx['offsets']], [idx['timestamp']], [idx['fs']]
+            if n0 == nslots and n0 > 0:
+                return 0
+
+            with open(iqpath, 'ab' if n0 else 'wb') as out:
+                end = offsets[0][-1]
+                for i in range(n0, nslots, chunk):
+                    block = slots[i:i+chunk]
+                    lengths = np.empty(len(block), dtype=np.int64)
+                    for k, x in enumerate(block['iq_data']):
+                        x = np.asarray(x, dtype=np.complex64)
+                        x.tofile(out)
+                        lengths[k] = len(x)
+                    offsets.append(end + np.cumsum(lengths))
+                    end = offsets[-1][-1] if len(lengths) else end
+                    timestamp.append(block['timestamp'])
+                    fs.append(slot_rate(block))
+
+        tmp = idxpath + '.tmp.npz'
+        np.savez(tmp, offsets=np.concatenate(offsets),
+                 timestamp=np.concatenate(timestamp) if timestamp else np.empty(0),
+                 fs=np.concatenate(fs) if fs else np.empty(0))
+        os.replace(tmp, idxpath)
+        return nslots - n0
+
+    @classmethod
+    def open(cls, logpath, build=True):
+        """Open the store of a log, building or extending it first unless
+        build is False, and memory-map its buffer"""
+        if build:
+            cls.build(logpath)
+        iqpath, idxpath = store_paths(logpath)
+        if not os.path.exists(idxpath):
+            # The log has no slots dataset
+            return cls(np.empty(0, dtype=np.complex64), np.zeros(1, dtype=np.int64),
+                       np.empty(0), np.empty(0))
+        with np.load(idxpath) as idx:
+            offsets, timestamp, fs = idx['offsets'], idx['timestamp'], idx['fs']
+        if offsets[-1] == 0:
+            iq = np.empty(0, dtype=np.complex64)
+        else:
+            iq = np.memmap(iqpath, dtype=np.complex64, mode='r', shape=(int(offsets[-1]),))
+        return cls(iq, offsets, timestamp, fs)
+
+    def find(self, timestamps):
+        """Reference slot of each timestamp: the last slot starting at or
+        before it (clipped to the first slot)"""
+        ref = np.searchsorted(self.timestamp, timestamps, side='right') - 1
+        return np.maximum(ref, 0)
+
+    def window(self, ref, before=1, after=1):
+        """The slots from before ref to after it, as a SlotWindow"""
+        ref = int(ref)
+        return SlotWindow(self, max(ref - before, 0), min(ref + after + 1, len(self)), ref)
+
+    def ranges(self, recs):
+        """Buffer sample ranges (lo, hi) and rates of 'recv' records, from
+        their timestamp, start_samples and end_samples"""
+        if len(self) == 0:
+            # No slots were logged, so every packet is empty
+            lo = np.zeros(len(recs), dtype=np.int64)
+            return lo, lo.copy(), np.full(len(recs), np.nan)
+        ref = self.find(recs['timestamp'])
+        base = self.offsets[ref]
+        n = len(self.iq)
+        lo = np.clip(base + np.asarray(recs['start_samples'], dtype=np.int64), 0, n)
+        hi = np.clip(base + np.asarray(recs['end_samples'], dtype=np.int64), lo, n)
+        return lo, hi, self.fs[ref]
+
+    def packets(self, recs):
+        """Signals of 'recv' records as views into the buffer, and their
+        sample rates"""
+        lo, hi, fs = self.ranges(recs)
+        iq = self.iq
+        return [iq[a:b] for a, b in zip(lo.tolist(), hi.tolist())], fs
+
+    def gather(self, recs, n, out=None):
+        """Copy the signals of 'recv' records (or a (lo, hi) pair of sample
+        ranges) into rows of an (len, n) complex64 array, truncated or
+        zero-padded to n samples.
+
+        Only the samples of each packet and its padding are written, so with
+        a reused out the cost is the copy itself.
+        """
+        lo, hi = recs if isinstance(recs, tuple) else self.ranges(recs)[:2]
+        lengths = np.minimum(hi - lo, n)
+        if out is None:
+            out = np.empty((len(lo), n), dtype=np.complex64)
+        else:
+            out = out[:len(lo), :n]
+
+        iq = self.iq
+        for row, a, L in zip(out, lo.tolist(), lengths.tolist()):
+            row[:L] = iq[a:a+L]
+            row[L:] = 0
+        return out
+
+def _synthetic(nslots, slot_len, npkts, seed=0):
+    rng = np.random.default_rng(seed)
+    slots = np.empty(nslots, dtype=[('timestamp', '<f8'), ('bw', '<f4'), ('iq_data', object)])
+    slots['timestamp'] = np.arange(nslots)*0.01
+    slots['bw'] = 1e6
+    for i in range(nslots):
+        slots['iq_data'][i] = (rng.standard_normal(slot_len) + 1j*rng.standard_normal(slot_len)).astype(np.complex64)
+    recs = np.empty(npkts, dtype=[('timestamp', '<f8'), ('start_samples', '<i8'), ('end_samples', '<i8')])
+    ref = rng.integers(1, nslots - 1, npkts)
+    recs['timestamp'] = slots['timestamp'][ref] + 0.001
+    recs['start_samples'] = rng.integers(-slot_len//8, slot_len, npkts)
+    recs['end_samples'] = recs['start_samples'] + rng.integers(200, 1500, npkts)
+    return slots, recs
+
+def _concatenate_per_packet(slots, recs):
+    """What the viewer does: concatenate the slots around every packet"""
+    ts = slots['timestamp']
+    sigs = []
+    for t, start, end in zip(recs['timestamp'], recs['start_samples'], recs['end_samples']):
+        ref = np.searchsorted(ts, t, side='right') - 1
+        i0 = max(ref - 1, 0)
+        window = np.concatenate(slots['iq_data'][i0:ref+2])
+        base = sum(len(x) for x in slots['iq_data'][i0:ref])
+        sigs.append(window[max(base + start, 0):max(base + end, 0)])
+    return sigs
+
+def bench(nslots=1000, slot_len=16384, npkts=50000, n=1536):
+    """Time per-packet slot concatenation against store views and gathers.
+
+    Returns a dict of packets/s for each method and GB/s for the gather and
+    a plain copy of the same number of bytes.
+    """
+    slots, recs = _synthetic(nslots, slot_len, npkts)
+    store = SlotStore.from_records(slots)
+    results = {}
+
+    nconcat = min(npkts, 2000)
+    start = time.perf_counter()
+    _concatenate_per_packet(slots, recs[:nconcat])
+    results['concatenate_pkts_per_s'] = nconcat/(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    store.packets(recs)
+    results['views_pkts_per_s'] = npkts/(time.perf_counter() - start)
+
+    batch = 4096
+    out = np.empty((batch, n), dtype=np.complex64)
+    lo, hi, _ = store.ranges(recs)
+    start = time.perf_counter()
+    for i in range(0, npkts, batch):
+        store.gather((lo[i:i+batch], hi[i:i+batch]), n, out=out)
+    elapsed = time.perf_counter() - start
+    results['gather_pkts_per_s'] = npkts/elapsed
+    results['gather_gb_per_s'] = npkts*n*8/elapsed/1e9
+
+    src = np.ones(batch*n, dtype=np.complex64)
+    dst = out.reshape(-1)
+    start = time.perf_counter()
+    for i in range(0, npkts, batch):
+        np.copyto(dst, src)
+    results['memcpy_gb_per_s'] = (-(-npkts//batch))*batch*n*8/(time.perf_counter() - start)/1e9
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the contiguous slot sample store of dragonradio logs.')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='debug')
+    parser.add_argument('--bench', action='store_true',
+                        help='benchmark packet extraction on synthetic slots')
+    parser.add_argument('logs', nargs='*')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.DEBUG if args.debug else logging.INFO)
+
+    if args.bench:
+        for name, value in bench().items():
+            print('{:<24} {:12.1f}'.format(name, value))
+
+    for path in args.logs:
+        start = time.perf_counter()
+        added = SlotStore.build(path)
+        store = SlotStore.open(path, build=False)
+        logger.info('%s: %d slots (%d new), %d samples in %.2f s', path, len(store), added,
+                    len(store.iq), time.perf_counter() - start)
+
+if __name__ == '__main__':
+    main()
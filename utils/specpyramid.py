@@ -0,0 +1,342 @@
+# SPECTROGRAM TILE PYRAMID
+""" specpyramid
+Build a multi-resolution spectrogram pyramid from the 'slots' IQ and the
+decoded 'snapshots' of a dragonradio log, so a whole run can be viewed at
+once and zoomed into without recomputing any FFTs.
+
+The pyramid lives next to the log (radio.h5 -> radio.pyr.h5) and holds one
+group per source:
+
+    /slots/level0     (ncols, nfft) float32 mean power, chunked in tiles
+    /slots/level1     level0 decimated 2x in time
+    ...
+    /slots/count0     number of FFT frames averaged into each level0 column
+
+Level 0 is a uniform time grid with column width dt (seconds), so column i
+always covers [t0 + i*dt, t0 + (i+1)*dt). Columns with no data are NaN, which
+shows gaps in the recording as gaps in the waterfall. Each level above halves
+the time resolution, and a viewer only ever reads the columns of the level
+that matches its current zoom.
+
+Building is incremental: the number of source records already consumed is
+kept in the group attributes, so re-running on a log that has grown only
+processes the new records. FFTs are computed in a process pool, one batch
+of records per task.
+
+Usage:
+    python specpyramid.py radio.h5 [--nfft 256] [--dt 0.001] [-j 4]
+"""
+import argparse
+import logging
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+
+from hdf5_utils import slot_rate, decode_snapshot
+import spectral
+
+SOURCES = ['slots', 'snapshots']
+
+def pyramid_path(logpath):
+    """Return the pyramid file name for a log file"""
+    root, _ = os.path.splitext(logpath)
+    return root + '.pyr.h5'
+
+def _frames_power(iq, nfft, scale):
+    """Power spectrum of consecutive non-overlapping nfft frames of iq"""
+    # One FFT thread: batches already run one per worker process
+    P = spectral.power(iq, nfft, workers=1).astype(np.float32, copy=False)
+    P *= scale
+    return P
+
+def _power_batch(logpath, source, i0, i1, nfft, t0, dt, fs):
+    """Compute binned power for records [i0, i1) of a source.
+
+    Runs in a worker process. Returns (bins, sums, counts) where bins are the
+    sorted level0 column indices touched by these records, sums the summed
+    frame power per column and counts the number of frames per column.
+    """
+    # Normalize to a unit-energy window
+    scale = np.float32(1/np.sum(spectral.window(nfft)**2))
+
+    with h5py.File(logpath, 'r') as f:
+        recs = f[source][i0:i1]
+
+    rates = slot_rate(recs)
+    powers = []
+    idx = []
+    for rec, rate in zip(recs, rates):
+        if rate != fs:
+            logging.warning('Skipping %s record at %f with sample rate %g (pyramid is %g)',
+                            source, rec['timestamp'], rate, fs)
+            continue
+
+        if source == 'snapshots':
+            iq = decode_snapshot(rec['iq_data'])
+        else:
+            iq = np.asarray(rec['iq_data'], dtype=np.complex64)
+
+        P = _frames_power(iq, nfft, scale)
+        if len(P) == 0:
+            continue
+
+        t = rec['timestamp'] + np.arange(len(P))*(nfft/fs)
+        powers.append(P)
+        idx.append(np.floor((t - t0)/dt).astype(np.int64))
+
+    if not powers:
+        return (np.empty(0, dtype=np.int64),
+                np.empty((0, nfft), dtype=np.float32),
+                np.empty(0, dtype=np.int64))
+
+    P = np.concatenate(powers)
+    idx = np.concatenate(idx)
+
+    # Records may overlap or arrive slightly out of order, so sort frames by
+    # column before reducing runs of equal column index.
+    order = np.argsort(idx, kind='stable')
+    P = P[order]
+    idx = idx[order]
+    keep = idx >= 0
+    P = P[keep]
+    idx = idx[keep]
+
+    starts = np.flatnonzero(np.r_[True, idx[1:] != idx[:-1]])
+    sums = np.add.reduceat(P, starts, axis=0) if len(P) else P
+    counts = np.diff(np.r_[starts, len(idx)])
+
+    return idx[starts], sums, counts
+
+def _init_group(g, nfft, t0, dt, fs, tile):
+    g.attrs['nfft'] = nfft
+    g.attrs['t0'] = t0
+    g.attrs['dt'] = dt
+    g.attrs['fs'] = fs
+    g.attrs['tile'] = tile
+    g.attrs['records'] = 0
+    g.attrs['levels'] = 1
+    g.create_dataset('level0', shape=(0, nfft), maxshape=(None, nfft),
+                     dtype=np.float32, chunks=(tile, nfft), fillvalue=np.nan,
+                     compression='lzf')
+    g.create_dataset('count0', shape=(0,), maxshape=(None,),
+                     dtype=np.int64, chunks=(tile,))
+
+def _merge(g, bins, sums, counts):
+    """Merge binned power into level0, returning the first column changed"""
+    if len(bins) == 0:
+        return None
+
+    level0 = g['level0']
+    count0 = g['count0']
+
+    lo, hi = int(bins[0]), int(bins[-1]) + 1
+    if level0.shape[0] < hi:
+        old = level0.shape[0]
+        level0.resize(hi, axis=0)
+        count0.resize(hi, axis=0)
+        level0[old:hi] = np.nan
+        count0[old:hi] = 0
+
+    # Running mean over everything merged into a column so far
+    mean = level0[lo:hi]
+    n = count0[lo:hi]
+    k = bins - lo
+    total = np.where(np.isnan(mean[k]), 0, mean[k])*n[k, None] + sums
+    n[k] += counts
+    mean[k] = total/n[k, None]
+
+    level0[lo:hi] = mean
+    count0[lo:hi] = n
+
+    return lo
+
+def _rebuild_levels(g, start, min_cols):
+    """Recompute every level above 0 from column start of level0 onwards"""
+    nfft = g.attrs['nfft']
+    tile = g.attrs['tile']
+    level = 0
+    prev = g['level0']
+
+    while prev.shape[0] > min_cols:
+        level += 1
+        name = 'level{}'.format(level)
+        ncols = (prev.shape[0] + 1) // 2
+        if name not in g:
+            g.create_dataset(name, shape=(0, nfft), maxshape=(None, nfft),
+                             dtype=np.float32, chunks=(tile, nfft),
+                             fillvalue=np.nan, compression='lzf')
+        cur = g[name]
+        old = cur.shape[0]
+        cur.resize(ncols, axis=0)
+
+        # Columns past the old end of this level were never computed, which
+        # happens when the level is new or its parent grew
+        start = min(start // 2, old)
+        # Work through the dirty region one tile at a time to bound memory
+        for c0 in range(start, ncols, tile):
+            c1 = min(c0 + tile, ncols)
+            src = prev[2*c0:min(2*c1, prev.shape[0])]
+            if len(src) % 2:
+                src = np.concatenate([src, np.full((1, nfft), np.nan, np.float32)])
+            pairs = src.reshape(-1, 2, nfft)
+            with np.errstate(invalid='ignore'):
+                # Mean of the available pair members; NaN only if both are
+                valid = ~np.isnan(pairs)
+                s = np.where(valid, pairs, 0).sum(axis=1)
+                c = valid.sum(axis=1)
+                cur[c0:c1] = np.where(c > 0, s/np.maximum(c, 1), np.nan)
+
+        prev = cur
+
+    g.attrs['levels'] = level + 1
+
+def build(logpath, outpath=None, sources=SOURCES, nfft=256, dt=None, tile=256,
+          batch=64, jobs=None, min_cols=1024):
+    """Build or extend the spectrogram pyramid for a log.
+
+    Parameters:
+        logpath     Path to dragonradio HDF5 log
+        outpath     Pyramid file (default: next to log, see pyramid_path)
+        sources     Datasets to build pyramids for
+        nfft        Number of FFT points per frame
+        dt          Level 0 column width in seconds (default nfft/fs)
+        tile        Number of columns per stored chunk
+        batch       Number of source records per worker task
+        jobs        Number of worker processes (default: CPU count)
+        min_cols    Stop adding levels once a level has this few columns
+    """
+    if outpath is None:
+        outpath = pyramid_path(logpath)
+
+    with h5py.File(logpath, 'r') as f, h5py.File(outpath, 'a') as out:
+        for source in sources:
+            if source not in f or f[source].shape[0] == 0:
+                continue
+
+            nrecs = f[source].shape[0]
+            if source in out:
+                g = out[source]
+                if g.attrs['nfft'] != nfft:
+                    raise ValueError('{} pyramid was built with nfft={}'.format(source, g.attrs['nfft']))
+            else:
+                first = f[source][0]
+                fs = float(slot_rate(f[source][0:1])[0])
+                g = out.create_group(source)
+                _init_group(g, nfft, float(first['timestamp']),
+                            dt if dt else nfft/fs, fs, tile)
+
+            done = int(g.attrs['records'])
+            if done >= nrecs:
+                continue
+
+            args = (g.attrs['t0'], g.attrs['dt'], g.attrs['fs'])
+            ranges = [(i, min(i + batch, nrecs)) for i in range(done, nrecs, batch)]
+
+            dirty = None
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                futs = [pool.submit(_power_batch, logpath, source, i0, i1, nfft, *args)
+                        for (i0, i1) in ranges]
+                for fut, (_, i1) in zip(futs, ranges):
+                    lo = _merge(g, *fut.result())
+                    if lo is not None:
+                        dirty = lo if dirty is None else min(dirty, lo)
+                    g.attrs['records'] = i1
+
+            if dirty is not None:
+                _rebuild_levels(g, dirty, min_cols)
+
+            logging.info('%s: %d records, %d level0 columns, %d levels',
+                         source, nrecs - done, g['level0'].shape[0], g.attrs['levels'])
+
+    return outpath
+
+class PyramidReader:
+    """Read tiles of a spectrogram pyramid for a time window.
+
+    Parameters:
+        path        Pyramid file
+        source      'slots' or 'snapshots'
+    """
+    def __init__(self, path, source='slots'):
+        self.f = h5py.File(path, 'r')
+        self.g = self.f[source]
+        self.nfft = int(self.g.attrs['nfft'])
+        self.t0 = float(self.g.attrs['t0'])
+        self.dt = float(self.g.attrs['dt'])
+        self.fs = float(self.g.attrs['fs'])
+        self.levels = int(self.g.attrs['levels'])
+
+    def close(self):
+        self.f.close()
+
+    @property
+    def tstart(self):
+        return self.t0
+
+    @property
+    def tend(self):
+        return self.t0 + self.g['level0'].shape[0]*self.dt
+
+    @property
+    def freqs(self):
+        """Frequency of each bin relative to the center frequency"""
+        return np.fft.fftshift(np.fft.fftfreq(self.nfft, 1/self.fs))
+
+    def level_for(self, tmin, tmax, max_cols):
+        """Return the finest level showing [tmin, tmax) in at most max_cols columns"""
+        span = max(tmax - tmin, self.dt)
+        level = math.ceil(math.log2(max(span/(self.dt*max_cols), 1)))
+        return min(level, self.levels - 1)
+
+    def read(self, tmin, tmax, max_cols=2048):
+        """Read power (dB) for [tmin, tmax).
+
+        Returns (level, t, P) where t holds the start time of each column and
+        P is (ncols, nfft). Only the tiles of the selected level that overlap
+        the window are read from disk.
+        """
+        level = self.level_for(tmin, tmax, max_cols)
+        ds = self.g['level{}'.format(level)]
+        width = self.dt*2**level
+
+        c0 = max(int(math.floor((tmin - self.t0)/width)), 0)
+        c1 = min(int(math.ceil((tmax - self.t0)/width)), ds.shape[0])
+        if c1 <= c0:
+            return level, np.empty(0), np.empty((0, self.nfft), dtype=np.float32)
+
+        P = ds[c0:c1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            PdB = 10*np.log10(P)
+
+        return level, self.t0 + np.arange(c0, c1)*width, PdB
+
+def main():
+    parser = argparse.ArgumentParser(description='Build spectrogram tile pyramid for dragonradio logs.')
+    parser.add_argument('--nfft', action='store', type=int, default=256,
+                        help='set number of FFT points')
+    parser.add_argument('--dt', action='store', type=float, default=None,
+                        help='level 0 column width in seconds (default nfft/fs)')
+    parser.add_argument('--tile', action='store', type=int, default=256,
+                        help='columns per stored tile')
+    parser.add_argument('--source', action='append', choices=SOURCES, dest='sources',
+                        help='dataset to build pyramid for (default: all)')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='debug')
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.DEBUG if args.debug else logging.INFO)
+
+    for path in args.paths:
+        out = build(path, sources=args.sources or SOURCES, nfft=args.nfft,
+                    dt=args.dt, tile=args.tile, jobs=args.jobs)
+        print(out)
+
+if __name__ == '__main__':
+    main()
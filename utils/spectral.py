@@ -0,0 +1,234 @@
+# SPECTRAL ESTIMATION
+""" spectral
+Batched FFT, STFT, spectrogram and Welch PSD shared by the log viewer and
+the analysis scripts, so spectra are computed one way everywhere and only
+finished arrays are handed to matplotlib.
+
+Compared to matplotlib's psd/specgram and numpy.fft this:
+
+    - keeps complex64 IQ in single precision end to end (mlab, like
+      numpy.fft before numpy 2, upcasts everything to complex128)
+    - runs the transforms on several threads (workers, default all CPUs)
+    - frames signals as strided views instead of copies, and transforms
+      all frames, or a whole batch of equal-length signals, in one call
+    - caches windows, and FFT plans when the backend has them
+
+The scaling of psd, welch and spectrogram is that of matplotlib's mlab
+(density, Hann window, no detrending, two-sided and centred for complex
+input), so plots look the same as with ax.psd and ax.specgram.
+
+Backends are 'scipy' (scipy.fft; pocketfft keeps its own plan cache),
+'pyfftw' (FFTW plans built once per shape and type and cached here, if
+pyFFTW is installed) and 'numpy' (single-threaded):
+
+    spectral.set_backend('pyfftw', workers=4)
+    f, Pxx = spectral.welch(iq, fs, nfft=256)
+    f, t, Sxx = spectral.spectrogram(iq, fs, nfft=256, noverlap=128)
+
+Usage:
+    python spectral.py [--bench] [--nfft 256] [-n 4000000]
+"""
+import argparse
+import functools
+import os
+import threading
+import time
+
+import numpy as np
+
+_backend = 'scipy'
+_workers = os.cpu_count() or 1
+
+# pyFFTW plans keyed by (shape, dtype, axis); FFTW objects are not
+# re-entrant, so each holds a lock
+_plans = {}
+_plans_lock = threading.Lock()
+
+def set_backend(name, workers=None):
+    """Select the FFT backend ('scipy', 'pyfftw' or 'numpy') and default
+    number of worker threads"""
+    global _backend, _workers
+    if name == 'pyfftw':
+        try:
+            import pyfftw
+        except ImportError:
+            raise ValueError('pyfftw backend needs pyFFTW installed')
+    elif name not in ('scipy', 'numpy'):
+        raise ValueError('Unknown FFT backend: {}'.format(name))
+    _backend = name
+    if workers is not None:
+        _workers = workers
+
+def backend():
+    return _backend
+
+def _dtype(x):
+    """Complex type of the transform of x: complex64 for single precision"""
+    if x.dtype in (np.complex64, np.float32, np.float16):
+        return np.complex64
+    return np.complex128
+
+def _fftw_plan(shape, dtype, axis, workers):
+    import pyfftw
+
+    key = (shape, np.dtype(dtype).str, axis, workers)
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is None:
+            a = pyfftw.empty_aligned(shape, dtype=dtype)
+            plan = (pyfftw.builders.fft(a, axis=axis, threads=workers,
+                                        planner_effort='FFTW_MEASURE',
+                                        avoid_copy=False),
+                    threading.Lock())
+            _plans[key] = plan
+    return plan
+
+def fft(x, axis=-1, workers=None):
+    """FFT of x along axis, complex64 for single-precision input"""
+    x = np.asarray(x)
+    workers = workers or _workers
+    if _backend == 'scipy':
+        import scipy.fft
+        return scipy.fft.fft(x, axis=axis, workers=workers)
+    if _backend == 'pyfftw':
+        dtype = _dtype(x)
+        plan, lock = _fftw_plan(x.shape, dtype, axis % x.ndim, workers)
+        with lock:
+            return plan(x.astype(dtype, copy=False)).copy()
+    return np.fft.fft(x, axis=axis)
+
+@functools.lru_cache(maxsize=32)
+def window(nfft, name='hann'):
+    """A cached, read-only float32 window of length nfft. 'hann' is numpy's
+    (and matplotlib's) symmetric Hann window."""
+    if name == 'hann':
+        w = np.hanning(nfft)
+    elif name in ('boxcar', 'none'):
+        w = np.ones(nfft)
+    else:
+        import scipy.signal
+        w = scipy.signal.get_window(name, nfft, fftbins=False)
+    w = w.astype(np.float32)
+    w.flags.writeable = False
+    return w
+
+def frames(x, nfft, noverlap=0):
+    """Strided (..., nframes, nfft) view of consecutive frames of x along its
+    last axis, each starting nfft-noverlap samples after the previous"""
+    step = nfft - noverlap
+    if step <= 0:
+        raise ValueError('noverlap must be less than nfft')
+    x = np.asarray(x)
+    if x.shape[-1] < nfft:
+        return np.empty(x.shape[:-1] + (0, nfft), dtype=x.dtype)
+    return np.lib.stride_tricks.sliding_window_view(x, nfft, axis=-1)[..., ::step, :]
+
+def freqs(nfft, fs=1.0):
+    """Centred frequencies of an fftshifted nfft-point transform"""
+    return np.fft.fftshift(np.fft.fftfreq(nfft, 1/fs))
+
+def stft(x, nfft=256, noverlap=0, win='hann', workers=None):
+    """Windowed, fftshifted FFTs of the frames of x: (..., nframes, nfft)"""
+    x = np.asarray(x)
+    if x.dtype == np.complex128 or x.dtype == np.float64:
+        w = window(nfft, win).astype(np.float64)
+    else:
+        w = window(nfft, win)
+    F = frames(x, nfft, noverlap)
+    if F.shape[-2] == 0:
+        return np.empty(F.shape, dtype=_dtype(x))
+    X = fft(F*w, axis=-1, workers=workers)
+    return np.fft.fftshift(X, axes=-1)
+
+def power(x, nfft=256, noverlap=0, win='hann', workers=None):
+    """Unscaled |STFT|^2 of x, (..., nframes, nfft), float32 for
+    single-precision input"""
+    X = stft(x, nfft, noverlap, win, workers)
+    return X.real**2 + X.imag**2
+
+def _density_scale(fs, nfft, win):
+    w = window(nfft, win)
+    return 1.0/(fs*float(np.sum(w.astype(np.float64)**2)))
+
+def spectrogram(x, fs=1.0, nfft=256, noverlap=128, win='hann', workers=None):
+    """Power spectral density of each frame of x, scaled like mlab.specgram.
+
+    Returns (f, t, Sxx) with Sxx of shape (..., nfft, nframes) and t the
+    frame centres in seconds.
+    """
+    P = power(x, nfft, noverlap, win, workers)
+    P *= P.dtype.type(_density_scale(fs, nfft, win))
+    step = nfft - noverlap
+    t = (nfft/2 + step*np.arange(P.shape[-2]))/fs
+    return freqs(nfft, fs), t, np.swapaxes(P, -1, -2)
+
+def welch(x, fs=1.0, nfft=256, noverlap=0, win='hann', workers=None):
+    """Welch power spectral density of x, scaled like mlab.psd.
+
+    Returns (f, Pxx) with Pxx of shape (..., nfft). A signal shorter than
+    nfft is zero-padded to one frame, as matplotlib does.
+    """
+    x = np.asarray(x)
+    if x.shape[-1] < nfft:
+        pad = [(0, 0)]*(x.ndim - 1) + [(0, nfft - x.shape[-1])]
+        x = np.pad(x, pad)
+    P = power(x, nfft, noverlap, win, workers)
+    Pxx = P.mean(axis=-2)
+    Pxx *= Pxx.dtype.type(_density_scale(fs, nfft, win))
+    return freqs(nfft, fs), Pxx
+
+def db(P, floor=1e-20):
+    """10*log10(P), with P clipped to floor"""
+    return 10*np.log10(np.maximum(P, floor))
+
+def bench(n=4000000, nfft=256, noverlap=128, repeat=3):
+    """Time spectrogram and PSD against matplotlib's mlab"""
+    from matplotlib import mlab
+
+    rng = np.random.default_rng(0)
+    iq = (rng.standard_normal(n) + 1j*rng.standard_normal(n)).astype(np.complex64)
+    fs = 10e6
+
+    def best(f):
+        times = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            out = f()
+            times.append(time.perf_counter() - t)
+        return min(times), out
+
+    rows = []
+    t_ref, (S_ref, f_ref, _) = best(lambda: mlab.specgram(iq, NFFT=nfft, Fs=fs, noverlap=noverlap))
+    t_new, (f, _, S) = best(lambda: spectrogram(iq, fs, nfft, noverlap))
+    err = np.max(np.abs(S - S_ref))/np.max(S_ref)
+    rows.append(('specgram', t_ref, t_new, err, S.dtype))
+
+    t_ref, (P_ref, _) = best(lambda: mlab.psd(iq, NFFT=nfft, Fs=fs))
+    t_new, (_, P) = best(lambda: welch(iq, fs, nfft))
+    err = np.max(np.abs(P - P_ref))/np.max(P_ref)
+    rows.append(('psd', t_ref, t_new, err, P.dtype))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the spectral layer against matplotlib.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--bench', action='store_true',
+                        help='time spectrogram and PSD against matplotlib')
+    parser.add_argument('--backend', action='store', default='scipy',
+                        choices=['scipy', 'pyfftw', 'numpy'],
+                        help='FFT backend')
+    parser.add_argument('-j', '--workers', action='store', type=int, default=None,
+                        help='FFT threads (default: CPU count)')
+    parser.add_argument('--nfft', action='store', type=int, default=256,
+                        help='FFT size')
+    parser.add_argument('-n', '--samples', action='store', type=int, default=4000000,
+                        help='number of samples')
+    args = parser.parse_args()
+
+    set_backend(args.backend, args.workers)
+    for name, t_ref, t_new, err, dtype in bench(args.samples, args.nfft):
+        print('{:<9} mlab {:7.3f} s  spectral {:7.3f} s  ({:4.1f}x, {}, max rel err {:.1e})'.format(
+              name, t_ref, t_new, t_ref/t_new, dtype, err))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import numpy as np
+
+from abcompare import match
+
+# The fields match() uses, of both 'send' and 'recv' rows
+PACKET = [('timestamp', 'f8'), ('src', 'i4'), ('dest', 'i4'), ('seq', 'i4')]
+
+def records(rows):
+    return np.array([tuple(r) for r in rows], dtype=PACKET)
+
+def brute(send, recv, max_latency):
+    """match() one reception and send at a time"""
+    n = len(send)
+    first = np.zeros(n, dtype=bool)
+    head = np.arange(n)
+    by_key = {}
+    for i in sorted(range(n), key=lambda i: send['timestamp'][i]):
+        key = (send['src'][i], send['dest'][i], send['seq'][i])
+        prev = by_key.get(key)
+        if prev is None or send['timestamp'][i] - send['timestamp'][prev] > max_latency:
+            first[i] = True
+        else:
+            head[i] = head[prev]
+        by_key[key] = i
+
+    j = np.full(len(recv), -1)
+    latency = np.full(len(recv), np.nan)
+    for k, r in enumerate(recv):
+        cand = [i for i in range(n) if (send['src'][i], send['dest'][i], send['seq'][i]) ==
+                (r['src'], r['dest'], r['seq']) and send['timestamp'][i] <= r['timestamp']]
+        if not cand:
+            continue
+        i = head[max(cand, key=lambda i: send['timestamp'][i])]
+        lat = r['timestamp'] - send['timestamp'][i]
+        if lat <= max_latency:
+            j[k] = i
+            latency[k] = lat
+    return first, j, latency
+
+def test_retransmissions_and_wrap():
+    send = records([(0.0, 1, 2, 7),   # first transmission
+                    (0.5, 1, 2, 7),   # retransmission
+                    (1.0, 1, 3, 7),   # same seq, other link
+                    (100.0, 1, 2, 7), # seq wrapped: a new packet
+                    (0.2, 2, 1, 7)])
+    recv = records([(0.7, 1, 2, 7),   # after the retransmission
+                    (0.8, 1, 2, 7),   # duplicate
+                    (1.5, 1, 3, 7),
+                    (100.25, 1, 2, 7),
+                    (0.1, 2, 1, 7),   # before it was sent
+                    (1.0, 1, 2, 8),   # never sent
+                    (50.0, 1, 3, 7)]) # too late
+    first, j, latency = match(send, recv)
+    assert first.tolist() == [True, False, True, True, True]
+    assert j.tolist() == [0, 0, 2, 3, -1, -1, -1]
+    np.testing.assert_allclose(latency, [0.7, 0.8, 0.5, 0.25, np.nan, np.nan, np.nan])
+
+def test_max_latency_splits_retransmissions():
+    send = records([(0.0, 1, 2, 0), (2.0, 1, 2, 0), (2.5, 1, 2, 0)])
+    recv = records([(1.0, 1, 2, 0), (3.0, 1, 2, 0)])
+    first, j, latency = match(send, recv, max_latency=1.5)
+    assert first.tolist() == [True, True, False]
+    assert j.tolist() == [0, 1]
+    np.testing.assert_allclose(latency, [1.0, 1.0])
+
+def test_empty():
+    first, j, latency = match(records([]), records([(1.0, 1, 2, 0)]))
+    assert len(first) == 0
+    assert j.tolist() == [-1]
+    first, j, latency = match(records([(0.0, 1, 2, 0)]), records([]))
+    assert first.tolist() == [True]
+    assert len(j) == len(latency) == 0
+
+def test_random_against_brute_force():
+    rng = np.random.default_rng(0)
+    n = 400
+    # Few sequence numbers over a long time, so keys repeat both as
+    # retransmissions and as wrapped sequence numbers
+    send = np.zeros(n, dtype=PACKET)
+    send['timestamp'] = rng.uniform(0, 100, n)
+    send['src'] = rng.integers(1, 4, n)
+    send['dest'] = rng.integers(1, 4, n)
+    send['seq'] = rng.integers(0, 8, n)
+    pick = rng.integers(0, n, 300)
+    recv = np.zeros(300, dtype=PACKET)
+    for k in ('src', 'dest', 'seq'):
+        recv[k] = send[k][pick]
+    recv['timestamp'] = send['timestamp'][pick] + rng.exponential(2.0, 300)
+    recv['seq'][:20] = 9
+
+    first, j, latency = match(send, recv, max_latency=5.0)
+    bfirst, bj, blatency = brute(send, recv, 5.0)
+    assert np.array_equal(first, bfirst)
+    assert np.array_equal(j, bj)
+    np.testing.assert_allclose(latency, blatency)
+    assert 0 < np.count_nonzero(j >= 0) < len(recv)
+    assert 0 < np.count_nonzero(~first)
@@ -0,0 +1,149 @@
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+import eventindex
+from eventindex import EventIndex
+
+EVENT = np.dtype([('timestamp', '<f8'), ('event', h5py.string_dtype())])
+
+def append(path, events):
+    """Append (timestamp, text) events to a log's 'event' dataset"""
+    ev = np.zeros(len(events), dtype=EVENT)
+    ev['timestamp'] = [t for t, _ in events]
+    ev['event'] = [text for _, text in events]
+    with h5py.File(path, 'a') as f:
+        if 'event' not in f:
+            f.create_dataset('event', data=ev, maxshape=(None,), chunks=True)
+        else:
+            ds = f['event']
+            n = ds.shape[0]
+            ds.resize((n + len(ev),))
+            ds[n:] = ev
+
+def events(n, t0=0.0, seed=0):
+    rng = np.random.default_rng(seed)
+    templates = ['ARQ: send ACK to {}', 'MAC: installed schedule {}', 'PHY: set rx frequency offset {}',
+                 'SNAPSHOT: start', 'TIMESYNC: offset {} us']
+    which = rng.integers(0, len(templates), n)
+    args = rng.integers(0, 5, n)
+    ts = t0 + np.cumsum(rng.exponential(0.01, n))
+    return [(t, templates[w].format(a)) for t, w, a in zip(ts.tolist(), which, args)]
+
+def brute(evs, q, start=None, end=None):
+    """Timestamps and texts of the events matching every term of q"""
+    out = []
+    for t, text in sorted(evs, key=lambda e: e[0]):
+        toks = eventindex.tokenize(text)
+        if start is not None and t < start or end is not None and t >= end:
+            continue
+        ok = True
+        for term in q.split():
+            if term.endswith(':'):
+                ok &= term.upper() in toks
+            elif term.endswith('*'):
+                ok &= any(tok.startswith(term[:-1].lower()) for tok in toks)
+            else:
+                ok &= term.lower() in toks
+        if ok:
+            out.append((t, text))
+    return out
+
+QUERIES = [('', None, None), ('MAC:', None, None), ('ack 3', None, None), ('arq: send', 1.0, 2.0),
+           ('sched*', None, 1.5), ('of*', 0.5, None), ('offset us', None, None), ('nothing', None, None)]
+
+def check(idx, evs):
+    for q, start, end in QUERIES:
+        ts, texts = idx.events(idx.query(q, start, end))
+        assert list(zip(ts.tolist(), texts)) == brute(evs, q, start, end), q
+        assert idx.count(q, start, end) == len(ts)
+
+def test_tokenize():
+    assert eventindex.tokenize('MAC: installed schedule 10x3') == {'MAC:', 'mac', 'installed', 'schedule', '10x3'}
+    assert eventindex.tokenize('no prefix here') == {'no', 'prefix', 'here'}
+
+def test_query(tmp_path):
+    path = str(tmp_path/'radio.h5')
+    evs = events(500)
+    append(path, evs)
+    idx = EventIndex.open(path)
+    assert len(idx) == idx.nrows == 500
+    assert os.path.exists(eventindex.index_path(path))
+    check(idx, evs)
+
+def test_incremental_build(tmp_path, monkeypatch):
+    path = str(tmp_path/'radio.h5')
+    evs = events(300)
+    append(path, evs)
+    EventIndex.open(path)
+
+    more = events(200, t0=evs[-1][0], seed=1)
+    append(path, more)
+    starts = []
+    read_events = eventindex._read_events
+    monkeypatch.setattr(eventindex, '_read_events',
+                        lambda ds, start: starts.append(start) or read_events(ds, start))
+    idx = EventIndex.open(path)
+    # Only the new rows were read, and the result is what a fresh build gives
+    assert starts == [300]
+    assert idx.nrows == 500
+    check(idx, evs + more)
+
+    fresh = EventIndex.build(path)
+    for name in ('timestamp', 'row', 'vocab', 'indptr', 'postings'):
+        assert np.array_equal(getattr(idx, name), getattr(fresh, name)), name
+
+    # An index that is up to date is loaded as is
+    starts.clear()
+    EventIndex.open(path)
+    assert starts == []
+
+def test_older_events_renumber(tmp_path):
+    path = str(tmp_path/'radio.h5')
+    evs = events(100, t0=1.0)
+    append(path, evs)
+    EventIndex.open(path)
+
+    early = [(0.5, 'MAC: installed schedule 9'), (0.25, 'SNAPSHOT: start')]
+    append(path, early)
+    idx = EventIndex.open(path)
+    assert idx.timestamp[:2].tolist() == [0.25, 0.5]
+    assert idx.row[:2].tolist() == [101, 100]
+    check(idx, evs + early)
+
+def test_rewritten_log_is_reindexed(tmp_path):
+    path = str(tmp_path/'radio.h5')
+    append(path, events(100))
+    EventIndex.open(path)
+
+    os.remove(path)
+    evs = events(150, seed=2)
+    append(path, evs)
+    idx = EventIndex.open(path)
+    assert idx.nrows == 150
+    check(idx, evs)
+
+def test_open_without_build(tmp_path):
+    path = str(tmp_path/'radio.h5')
+    append(path, events(10))
+    with pytest.raises(FileNotFoundError):
+        EventIndex.open(path, build=False)
+    EventIndex.open(path)
+    append(path, events(10, t0=10.0))
+    # A stale index is returned as it is
+    assert EventIndex.open(path, build=False).nrows == 10
+
+def test_search_merges_nodes(tmp_path):
+    evs = {}
+    for node in (1, 2):
+        path = tmp_path/'node-{:03d}'.format(node)/'radio.h5'
+        path.parent.mkdir()
+        evs[node] = events(50, seed=node)
+        append(str(path), evs[node])
+    out = eventindex.search([str(tmp_path)], 'MAC:')
+    expect = sorted([(t, node, text) for node in evs for t, text in brute(evs[node], 'MAC:')],
+                    key=lambda x: x[0])
+    assert out == expect
+    assert eventindex.search([str(tmp_path)], 'MAC:', limit=3) == expect[:3]
@@ -0,0 +1,86 @@
+import zlib
+
+import numpy as np
+import pytest
+
+import iqcodec
+
+def signal(n, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(n)
+    iq = 0.5*np.exp(2j*np.pi*0.01*t) + 0.01*(rng.standard_normal(n) + 1j*rng.standard_normal(n))
+    # A quiet stretch, so the block scales differ by orders of magnitude
+    iq[n//3:n//2] *= 1e-3
+    return iq.astype(np.complex64)
+
+def max_error(iq, enc, bits):
+    """Largest error quantization to bits can cause in each sample, with
+    room for float32 rounding"""
+    block = enc.block
+    f = np.zeros(-(-len(iq)//block)*block, dtype=np.complex64)
+    f[:len(iq)] = iq
+    f = f.view(np.float32).reshape(-1, 2*block)
+    peak = np.abs(f).max(axis=1)/(2**(bits - 1) - 1)
+    return np.repeat(peak, block)[:len(iq)]*(0.5 + 1e-2)
+
+@pytest.mark.parametrize('compressor', iqcodec.available_compressors())
+@pytest.mark.parametrize('bits', [16, 12])
+def test_round_trip(bits, compressor):
+    iq = signal(10000)
+    buf = iqcodec.encode(iq, bits=bits, block=1024, compressor=compressor)
+    assert iqcodec.is_encoded(buf)
+    enc = iqcodec.EncodedIQ(buf)
+    assert (len(enc), enc.nblocks, enc.bits, enc.compressor) == (10000, 10, bits, compressor)
+
+    out = iqcodec.decode(buf)
+    assert out.dtype == np.complex64
+    bound = max_error(iq, enc, bits)
+    assert (np.abs(out.real - iq.real) <= bound).all()
+    assert (np.abs(out.imag - iq.imag) <= bound).all()
+
+def test_zero_and_empty():
+    assert (iqcodec.decode(iqcodec.encode(np.zeros(100))) == 0).all()
+    buf = iqcodec.encode(np.zeros(0))
+    assert len(iqcodec.EncodedIQ(buf)) == 0
+    assert len(iqcodec.decode(buf)) == 0
+
+@pytest.mark.parametrize('bits', [16, 12])
+def test_random_access(bits):
+    iq = signal(10000, seed=1)
+    buf = iqcodec.encode(iq, bits=bits, block=1000)
+    full = iqcodec.decode(buf)
+    enc = iqcodec.EncodedIQ(buf)
+    rng = np.random.default_rng(2)
+    for start, stop in [(0, 10000), (0, 1), (999, 1001), (1000, 2000), (9999, 10000),
+                        (-5, 50), (9000, 20000), (500, 500), (700, 600)] + \
+                       [tuple(sorted(rng.integers(0, 10000, 2))) for _ in range(20)]:
+        assert np.array_equal(enc.read(start, stop), full[max(start, 0):stop])
+        assert np.array_equal(enc.read(start, stop, threads=3), full[max(start, 0):stop])
+
+def test_read_time():
+    iq = signal(10000)
+    enc = iqcodec.EncodedIQ(iqcodec.encode(iq, block=1000))
+    fs = 1e6
+    assert np.array_equal(enc.read_time(fs, 2.5e-3, 3.2505e-3), enc.read(2500, 3251))
+
+def test_read_touches_only_its_blocks():
+    iq = signal(8000)
+    buf = iqcodec.encode(iq, block=1000).copy()
+    expect = iqcodec.decode(buf, 2500, 3500)
+    enc = iqcodec.EncodedIQ(buf)
+    # Corrupt every block except 2 and 3
+    for i in [0, 1, 4, 5, 6, 7]:
+        buf[enc.offsets[i]:enc.offsets[i + 1]] = 0
+    enc = iqcodec.EncodedIQ(buf)
+    assert np.array_equal(enc.read(2500, 3500), expect)
+    with pytest.raises(zlib.error):
+        enc.read(1500, 2500)
+
+def test_bad_input():
+    with pytest.raises(ValueError):
+        iqcodec.encode(np.zeros(10), bits=8)
+    with pytest.raises(ValueError):
+        iqcodec.encode(np.zeros(10), compressor='flac')
+    with pytest.raises(ValueError):
+        iqcodec.EncodedIQ(b'FLAC' + bytes(iqcodec.HEADER.size))
+    assert not iqcodec.is_encoded(np.zeros(100, dtype=np.complex64))
@@ -0,0 +1,75 @@
+import os
+import uuid
+
+import numpy as np
+import pytest
+
+from shmring import Overrun, Reader, ShmRing
+
+@pytest.fixture
+def ring():
+    ring = ShmRing.create('test-{}-{}'.format(os.getpid(), uuid.uuid4().hex[:8]),
+                          nslots=4, block=16, dtype=np.int32)
+    yield ring
+    ring.close()
+
+def block(seq):
+    return np.full(16, seq, dtype=np.int32)
+
+def test_reads_in_order(ring):
+    reader = Reader(ring)
+    assert reader.read(timeout=0) is None
+    for seq in range(3):
+        ring.write(block(seq))
+    for seq in range(3):
+        got, view = reader.read(timeout=0)
+        assert got == seq
+        assert (view == seq).all()
+        reader.check(seq)
+    assert reader.read(timeout=0) is None
+    assert reader.overruns == 0
+
+def test_short_write_is_zero_padded(ring):
+    ring.write(block(5))
+    seq = ring.write(np.arange(1, 4, dtype=np.int32))
+    assert ring.slot(seq).tolist() == [1, 2, 3] + [0]*13
+    assert ring.stamps[seq % ring.nslots] == seq
+
+def test_oldest_start(ring):
+    for seq in range(6):
+        ring.write(block(seq))
+    seq, view = Reader(ring, start='oldest').read(timeout=0)
+    assert seq == 3
+    assert (view == 3).all()
+
+def test_read_skips_overwritten_blocks(ring):
+    reader = Reader(ring)
+    for seq in range(10):
+        ring.write(block(seq))
+    # Blocks 0-5 are gone, and block 6 is the one the writer fills next
+    seq, view = reader.read(timeout=0)
+    assert seq == 7
+    assert (view == 7).all()
+    assert reader.overruns == 1
+    assert [reader.read(timeout=0)[0] for _ in range(2)] == [8, 9]
+    assert reader.overruns == 1
+
+def test_check_detects_overrun_in_use(ring):
+    reader = Reader(ring)
+    ring.write(block(0))
+    seq, view = reader.read(timeout=0)
+    for i in range(1, ring.nslots - 1):
+        ring.write(block(i))
+        assert reader.valid(seq)
+    reader.check(seq)
+
+    # Block 0 is invalid as soon as its slot is the next one to be filled
+    ring.write(block(ring.nslots - 1))
+    assert not reader.valid(seq)
+    with pytest.raises(Overrun) as e:
+        reader.check(seq)
+    assert (e.value.seq, e.value.write_seq) == (0, ring.nslots)
+    assert reader.overruns == 1
+
+    ring.write(block(ring.nslots))
+    assert (view == ring.nslots).all()
@@ -0,0 +1,751 @@
+# FEC RELAY FOR VIDEO STREAMING
+#
+# A UDP relay pair that sits between ffmpeg and VLC and protects the
+# MPEG-TS stream with packet-level forward error correction:
+#
+#   ffmpeg -> encode (127.0.0.1:54546) ---- radio ----> decode (:54545) -> VLC (127.0.0.1:54547)
+#                 ^------------------- loss feedback ------------|
+#
+# The encoder forwards every packet immediately and groups them into blocks
+# of k packets interleaved depth deep (packet n of a group goes to block
+# n % depth), so a burst of up to depth consecutive losses costs each block
+# at most one packet. When a block is full, r parity packets are sent for
+# it: plain XOR for r = 1, otherwise a systematic Cauchy Reed-Solomon code
+# over GF(256), so any k of the k + r packets recover the block. Groups are
+# also closed after flush seconds so a stalled source does not hold up
+# recovery; a block closed early gets parity in proportion to its size.
+#
+# Each coded symbol carries the packet's sequence number, send time and
+# length, so recovered packets are exact. The decoder delivers packets in
+# order. Parity packets also carry the sequence numbers their block covers,
+# so a missing packet is skipped as soon as its block is known to be
+# unrecoverable, and otherwise after at most max_delay.
+#
+# With --adaptive the decoder reports the raw (pre-FEC) loss rate back to
+# the encoder, which picks the smallest r whose probability of more than r
+# losses in a block of k + r is below target.
+#
+# `link` is a lossy-link emulator for testing without radios: a periodic
+# jammer drops packets for duty of every period seconds, on top of random
+# loss and a fixed delay. `bench` runs traffic.py's video flow through the
+# link with and without the relay pair and reports complete video frames per
+# second and latency for each jamming duty cycle.
+#
+# Usage:
+#   python fecrelay.py encode --listen 127.0.0.1:54546 --dest 10.10.10.1:54545 [--adaptive]
+#   python fecrelay.py decode --listen 0.0.0.0:54545 --dest 127.0.0.1:54547 --feedback 10.10.10.2:54544
+#   python fecrelay.py link --listen 127.0.0.1:54550 --dest 127.0.0.1:54545 --duty 0.2
+#   python fecrelay.py bench --duty 0,0.1,0.2,0.3
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import struct
+import sys
+import time
+
+import numpy as np
+from scipy.stats import binom
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import traffic
+
+logger = logging.getLogger('fecrelay')
+
+SOURCE = 0
+PARITY = 1
+
+# kind, k, r, index in block, block
+HEADER = struct.Struct('<BBBBI')
+
+# Start of every coded symbol: sequence number, send time (ns), payload length
+SYMBOL = struct.Struct('<IQH')
+
+# After the header of a parity packet: sequence number of the block's first
+# packet and the sequence stride between its packets
+BLOCK_SEQS = struct.Struct('<IB')
+
+# Loss feedback: magic, raw loss rate, packets in window
+FEEDBACK = struct.Struct('<4sdI')
+FEEDBACK_MAGIC = b'FECF'
+
+def _gf_tables(poly=0x11d):
+    exp = np.zeros(512, dtype=np.uint8)
+    log = np.zeros(256, dtype=np.int64)
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= poly
+    exp[255:510] = exp[:255]
+
+    a = np.arange(1, 256)
+    mul = np.zeros((256, 256), dtype=np.uint8)
+    mul[1:, 1:] = exp[log[a][:, None] + log[a][None, :]]
+    return exp, log, mul
+
+GF_EXP, GF_LOG, GF_MUL = _gf_tables()
+
+def gf_inv(a):
+    return int(GF_EXP[255 - GF_LOG[a]])
+
+def gf_matmul(A, B):
+    """Product of GF(256) matrices A (m x k) and B (k x L)"""
+    out = np.empty((A.shape[0], B.shape[1]), dtype=np.uint8)
+    for j in range(A.shape[0]):
+        out[j] = np.bitwise_xor.reduce(GF_MUL[A[j][:, None], B], axis=0)
+    return out
+
+def gf_invert(A):
+    """Inverse of a k x k GF(256) matrix by Gauss-Jordan elimination"""
+    k = len(A)
+    M = np.concatenate((A.astype(np.uint8), np.eye(k, dtype=np.uint8)), axis=1)
+    for c in range(k):
+        nz = np.flatnonzero(M[c:, c])
+        if len(nz) == 0:
+            raise ValueError('Singular matrix')
+        p = c + nz[0]
+        if p != c:
+            M[[c, p]] = M[[p, c]]
+        M[c] = GF_MUL[gf_inv(M[c, c])][M[c]]
+        for i in np.flatnonzero(M[:, c]):
+            if i != c:
+                M[i] ^= GF_MUL[M[i, c]][M[c]]
+    return M[:, k:]
+
+@functools.lru_cache(maxsize=None)
+def parity_matrix(k, r):
+    """r x k parity rows of the systematic code: XOR for r = 1, Cauchy
+    otherwise (any k rows of [I; C] are independent)"""
+    if r == 1:
+        return np.ones((1, k), dtype=np.uint8)
+    x = np.arange(k, k + r)
+    y = np.arange(k)
+    return np.vectorize(gf_inv, otypes=[np.uint8])(x[:, None] ^ y[None, :])
+
+def choose_r(k, loss, target=1e-3, rmin=1, rmax=8):
+    """Smallest r with P(more than r of k + r packets lost) <= target"""
+    loss = min(max(loss, 1e-6), 0.99)
+    for r in range(rmin, rmax + 1):
+        if binom.sf(r, k + r, loss) <= target:
+            return r
+    return rmax
+
+class Encoder:
+    """Add interleaved FEC to a packet stream.
+
+    Parameters:
+        send        Function called with every packet to send
+        k           Source packets per block
+        r           Parity packets per block
+        depth       Interleaving depth (blocks per group)
+        flush       Close a partly filled group after this many seconds
+        adaptive    Choose r from loss feedback
+        target      Residual block loss probability for adaptive r
+        rmin, rmax  Range of adaptive r
+    """
+    def __init__(self, send, k=8, r=2, depth=8, flush=0.2, adaptive=False,
+                 target=1e-3, rmin=1, rmax=8):
+        if k + rmax > 255:
+            raise ValueError('k + rmax must be at most 255')
+        self.send = send
+        self.k = k
+        self.r = r
+        self.depth = depth
+        self.flush = flush
+        self.adaptive = adaptive
+        self.target = target
+        self.rmin = rmin
+        self.rmax = rmax
+
+        self.seq = 0
+        self.base = 0
+        self.first_seq = 0
+        self.pos = 0
+        self.opened = None
+        self.blocks = [[] for _ in range(depth)]
+
+        self.source_packets = 0
+        self.parity_packets = 0
+        self.loss = 0.0
+
+    def packet(self, payload, now):
+        """Forward a source packet and add it to its block"""
+        if self.pos == 0:
+            self.opened = now
+            self.first_seq = self.seq
+        i = self.pos % self.depth
+        index = self.pos // self.depth
+        block = (self.base + i) & 0xffffffff
+
+        sym = SYMBOL.pack(self.seq & 0xffffffff, time.time_ns(), len(payload)) + payload
+        self.blocks[i].append(sym)
+        self.send(HEADER.pack(SOURCE, self.k, self.r, index, block) + sym)
+        self.seq += 1
+        self.source_packets += 1
+
+        self.pos += 1
+        if self.pos == self.k*self.depth:
+            self.close()
+
+    def poll(self, now):
+        """Close the current group if it has been open longer than flush"""
+        if self.pos and now - self.opened >= self.flush:
+            self.close()
+
+    def close(self):
+        """Send parity for every block of the current group"""
+        for i, syms in enumerate(self.blocks):
+            if syms:
+                self._parity((self.base + i) & 0xffffffff, syms,
+                             (self.first_seq + i) & 0xffffffff)
+        self.base += self.depth
+        self.pos = 0
+        self.blocks = [[] for _ in range(self.depth)]
+
+    def _parity(self, block, syms, first):
+        k = len(syms)
+        L = max(len(s) for s in syms)
+        D = np.zeros((k, L), dtype=np.uint8)
+        for i, s in enumerate(syms):
+            D[i, :len(s)] = np.frombuffer(s, dtype=np.uint8)
+
+        # A block closed early gets parity in proportion to its size
+        r = max(-(-self.r*k//self.k), 1)
+        if r == 1:
+            P = np.bitwise_xor.reduce(D, axis=0)[None, :]
+        else:
+            P = gf_matmul(parity_matrix(k, r), D)
+        for j, p in enumerate(P):
+            self.send(HEADER.pack(PARITY, k, r, j, block) +
+                      BLOCK_SEQS.pack(first, self.depth) + p.tobytes())
+        self.parity_packets += len(P)
+
+    def feedback(self, loss):
+        """Update r from the decoder's raw loss estimate"""
+        self.loss = loss
+        if self.adaptive:
+            r = choose_r(self.k, loss, self.target, self.rmin, self.rmax)
+            if r != self.r:
+                logger.info('Loss %.3f: r %d -> %d', loss, self.r, r)
+                self.r = r
+
+    def report(self):
+        return {'source_packets': self.source_packets,
+                'parity_packets': self.parity_packets,
+                'overhead': self.parity_packets/max(self.source_packets, 1),
+                'r': self.r,
+                'loss_feedback': self.loss}
+
+class _Block:
+    __slots__ = ['src', 'par', 'k', 'r', 'first', 'stride', 'done']
+
+    def __init__(self):
+        self.src = {}
+        self.par = {}
+        self.k = None
+        self.r = None
+        self.first = None
+        self.stride = None
+        self.done = False
+
+    def missing_seqs(self):
+        return [(self.first + self.stride*i) & 0xffffffff
+                for i in range(self.k) if i not in self.src]
+
+class Decoder:
+    """Recover lost packets and deliver the stream in order.
+
+    Parameters:
+        deliver     Function called with every payload, in order
+        max_delay   Seconds to wait for a missing packet before skipping it
+        nblocks     Number of recent blocks kept for recovery
+    """
+    def __init__(self, deliver, max_delay=0.25, nblocks=1024):
+        self.deliver = deliver
+        self.max_delay = max_delay
+        self.nblocks = nblocks
+        self.blocks = {}
+
+        self.next_seq = None
+        self.pending = {}
+        self.hole_since = None
+        # Blocks with parity that could not be decoded yet, and sequence
+        # numbers known to be unrecoverable
+        self.undecoded = {}
+        self.lost = set()
+
+        self.received = 0
+        self.recovered = 0
+        self.duplicates = 0
+        self.skipped = 0
+        self.delivered = 0
+        self.hold = []
+        self.latency = []
+
+        # Raw loss over the current feedback window
+        self.win_first = None
+        self.win_max = None
+        self.win_received = 0
+
+    def packet(self, data, now):
+        kind, k, r, index, block = HEADER.unpack_from(data)
+        b = self.blocks.get(block)
+        if b is None:
+            b = self.blocks[block] = _Block()
+            if len(self.blocks) > self.nblocks:
+                del self.blocks[next(iter(self.blocks))]
+
+        if kind == SOURCE:
+            if index in b.src:
+                self.duplicates += 1
+                return
+            sym = data[HEADER.size:]
+            b.src[index] = sym
+            self.received += 1
+            seq = SYMBOL.unpack_from(sym)[0]
+            self._window(seq)
+            self._receive(sym, now)
+        else:
+            b.first, b.stride = BLOCK_SEQS.unpack_from(data, HEADER.size)
+            b.par[index] = data[HEADER.size + BLOCK_SEQS.size:]
+            b.k = k
+            b.r = r
+            # All surviving parity of older blocks has arrived by now
+            for old in [x for x in self.undecoded if x != block]:
+                self._give_up(self.undecoded.pop(old))
+
+        if b.k is not None and not b.done:
+            self._decode(b, now)
+            if not b.done and len(b.par) == b.r:
+                self._give_up(b)
+            if b.done:
+                self.undecoded.pop(block, None)
+            else:
+                self.undecoded[block] = b
+        self.release(now)
+
+    def _give_up(self, b):
+        """Mark the missing packets of an undecodable block as lost"""
+        if not b.done:
+            self.lost.update(b.missing_seqs())
+            b.done = True
+
+    def _window(self, seq):
+        if self.win_first is None:
+            self.win_first = seq
+            self.win_max = seq
+        self.win_max = max(self.win_max, seq)
+        self.win_received += 1
+
+    def raw_loss(self):
+        """Pre-FEC loss over the window since the last call"""
+        if self.win_first is None:
+            return 0.0, 0
+        expected = self.win_max - self.win_first + 1
+        loss = max(1 - self.win_received/expected, 0.0)
+        self.win_first = None
+        self.win_received = 0
+        return loss, expected
+
+    def _decode(self, b, now):
+        k = b.k
+        missing = [i for i in range(k) if i not in b.src]
+        if not missing:
+            b.done = True
+            return
+        if len(b.src) + len(b.par) < k:
+            return
+
+        L = len(next(iter(b.par.values())))
+        C = parity_matrix(k, b.r)
+        A = np.zeros((k, k), dtype=np.uint8)
+        Y = np.zeros((k, L), dtype=np.uint8)
+        rows = [(i, b.src[i]) for i in b.src if i < k] + [(k + j, p) for j, p in b.par.items()]
+        for n, (row, sym) in enumerate(rows[:k]):
+            if row < k:
+                A[n, row] = 1
+            else:
+                A[n] = C[row - k]
+            Y[n, :len(sym)] = np.frombuffer(sym, dtype=np.uint8)
+
+        X = gf_matmul(gf_invert(A)[missing], Y)
+        for m, x in zip(missing, X):
+            n = SYMBOL.unpack_from(x)[2]
+            sym = x[:SYMBOL.size + n].tobytes()
+            b.src[m] = sym
+            self.recovered += 1
+            self._receive(sym, now)
+        b.done = True
+
+    def _receive(self, sym, now):
+        seq = SYMBOL.unpack_from(sym)[0]
+        # The stream starts at the first packet to arrive; anything before it
+        # was sent before the decoder joined
+        if self.next_seq is None:
+            self.next_seq = seq
+        if seq < self.next_seq or seq in self.pending:
+            return
+        self.pending[seq] = (sym, now)
+
+    def release(self, now):
+        """Deliver everything in order, skipping packets known to be lost or
+        missing for max_delay"""
+        while self.pending:
+            if self.next_seq in self.pending:
+                sym, arrival = self.pending.pop(self.next_seq)
+                _, ts, n = SYMBOL.unpack_from(sym)
+                self.deliver(sym[SYMBOL.size:SYMBOL.size + n])
+                self.delivered += 1
+                self.hold.append(now - arrival)
+                self.latency.append((time.time_ns() - ts)/1e9)
+                self.lost.discard(self.next_seq)
+                self.next_seq += 1
+                self.hole_since = None
+            elif self.next_seq in self.lost:
+                self.lost.discard(self.next_seq)
+                self.skipped += 1
+                self.next_seq += 1
+                self.hole_since = None
+            elif self.hole_since is None:
+                self.hole_since = now
+                break
+            elif now - self.hole_since >= self.max_delay:
+                first = min(self.pending)
+                self.skipped += first - self.next_seq
+                self.lost.difference_update(range(self.next_seq, first))
+                self.next_seq = first
+                self.hole_since = None
+            else:
+                break
+
+    def report(self):
+        hold = 1e3*np.asarray(self.hold)
+        lat = 1e3*np.asarray(self.latency)
+        r = {'received': self.received,
+             'recovered': self.recovered,
+             'duplicates': self.duplicates,
+             'skipped': self.skipped,
+             'delivered': self.delivered}
+        if len(hold):
+            r.update({'hold_p50_ms': float(np.percentile(hold, 50)),
+                      'hold_p99_ms': float(np.percentile(hold, 99)),
+                      'latency_p50_ms': float(np.percentile(lat, 50)),
+                      'latency_p99_ms': float(np.percentile(lat, 99))})
+        return r
+
+class _Callback(asyncio.DatagramProtocol):
+    def __init__(self, fn):
+        self.fn = fn
+
+    def datagram_received(self, data, addr):
+        self.fn(data, addr)
+
+async def _endpoint(fn=None, local_addr=None, remote_addr=None):
+    loop = asyncio.get_event_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _Callback(fn or (lambda data, addr: None)),
+        local_addr=local_addr, remote_addr=remote_addr)
+    return transport
+
+async def _every(period, fn):
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            await asyncio.sleep(period)
+            fn(loop.time())
+    except asyncio.CancelledError:
+        pass
+
+async def run_encoder(listen, dest, bind=('0.0.0.0', 0), **kwargs):
+    """Relay packets arriving at listen to dest with FEC until cancelled"""
+    loop = asyncio.get_event_loop()
+    # Not connected to dest, so feedback from the decoder gets through
+    net = await _endpoint(lambda data, addr: _on_feedback(encoder, data), local_addr=bind)
+    encoder = Encoder(lambda data: net.sendto(data, dest), **kwargs)
+    src = await _endpoint(lambda data, addr: encoder.packet(data, loop.time()),
+                          local_addr=listen)
+    try:
+        await _every(encoder.flush/2, encoder.poll)
+    finally:
+        src.close()
+        net.close()
+    return encoder
+
+def _on_feedback(encoder, data):
+    if len(data) == FEEDBACK.size:
+        magic, loss, n = FEEDBACK.unpack(data)
+        if magic == FEEDBACK_MAGIC:
+            encoder.feedback(loss)
+
+async def run_decoder(listen, dest, feedback=None, feedback_period=0.5, **kwargs):
+    """Relay packets arriving at listen to dest, recovering losses, until
+    cancelled"""
+    loop = asyncio.get_event_loop()
+    out = await _endpoint(remote_addr=dest)
+    decoder = Decoder(out.sendto, **kwargs)
+    net = await _endpoint(lambda data, addr: decoder.packet(data, loop.time()),
+                          local_addr=listen)
+
+    def send_feedback(now):
+        loss, n = decoder.raw_loss()
+        if feedback is not None and n:
+            net.sendto(FEEDBACK.pack(FEEDBACK_MAGIC, loss, n), feedback)
+
+    feedback_task = asyncio.ensure_future(_every(feedback_period, send_feedback))
+    try:
+        await _every(min(decoder.max_delay/4, 0.01), decoder.release)
+    finally:
+        feedback_task.cancel()
+        await feedback_task
+        net.close()
+        out.close()
+    return decoder
+
+class LossyLink:
+    """Forward datagrams, dropping them while a periodic jammer is on.
+
+    Parameters:
+        period      Jammer period (s)
+        duty        Fraction of each period the jammer is on
+        jam_loss    Drop probability while the jammer is on
+        loss        Drop probability otherwise
+        delay       Fixed one-way delay (s)
+        seed        Random seed (the jammer phase is random too)
+    """
+    def __init__(self, send, period=0.23, duty=0.0, jam_loss=1.0, loss=0.0,
+                 delay=0.005, seed=None):
+        self.send = send
+        self.period = period
+        self.duty = duty
+        self.jam_loss = jam_loss
+        self.loss = loss
+        self.delay = delay
+        self.rng = random.Random(seed)
+        self.start = asyncio.get_event_loop().time() - self.rng.uniform(0, period)
+        self.forwarded = 0
+        self.dropped = 0
+
+    def jammed(self, now):
+        return ((now - self.start) % self.period) < self.duty*self.period
+
+    def packet(self, data, now):
+        p = self.jam_loss if self.jammed(now) else self.loss
+        if p and self.rng.random() < p:
+            self.dropped += 1
+            return
+        self.forwarded += 1
+        if self.delay:
+            asyncio.get_event_loop().call_later(self.delay, self.send, data)
+        else:
+            self.send(data)
+
+async def run_link(listen, dest, **kwargs):
+    """Run a LossyLink from listen to dest until cancelled"""
+    loop = asyncio.get_event_loop()
+    out = await _endpoint(remote_addr=dest)
+    link = LossyLink(out.sendto, **kwargs)
+    src = await _endpoint(lambda data, addr: link.packet(data, loop.time()), local_addr=listen)
+    try:
+        await asyncio.Event().wait()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        src.close()
+        out.close()
+    return link
+
+async def bench_one(duty, fec, duration, port, rate=2e6, seed=0, link_kwargs=None,
+                    encoder_kwargs=None, decoder_kwargs=None):
+    """Send a video flow through the lossy link, with or without FEC, and
+    return frame delivery and latency statistics"""
+    host = '127.0.0.1'
+    recv_port, dec_port, link_port, enc_port, fb_port = range(port, port + 5)
+
+    loop = asyncio.get_event_loop()
+    recv, proto = await loop.create_datagram_endpoint(traffic.Receiver,
+                                                      local_addr=(host, recv_port))
+    link_dest = (host, dec_port) if fec else (host, recv_port)
+    link_task = asyncio.ensure_future(run_link((host, link_port), link_dest, duty=duty,
+                                               seed=seed, **(link_kwargs or {})))
+    tasks = [link_task]
+    if fec:
+        dec_task = asyncio.ensure_future(run_decoder((host, dec_port), (host, recv_port),
+                                                     feedback=(host, fb_port),
+                                                     **(decoder_kwargs or {})))
+        enc_task = asyncio.ensure_future(run_encoder((host, enc_port), (host, link_port),
+                                                     bind=(host, fb_port),
+                                                     **(encoder_kwargs or {})))
+        tasks += [dec_task, enc_task]
+    await asyncio.sleep(0.1)
+
+    sender = traffic.FlowSender(0, traffic.Flow('video', {'rate': rate}),
+                                (host, enc_port if fec else link_port), duration, seed)
+    await sender.run()
+    await asyncio.sleep(0.5)
+
+    for task in tasks:
+        task.cancel()
+    results = [await task for task in tasks]
+    recv.close()
+
+    packets = proto.packets.get(0, [])
+    stats = traffic.flow_stats(0, packets, sender.sent)
+    nframes, complete = traffic.frame_stats(sender.frames, [p[0] for p in packets])
+
+    r = {'duty': duty,
+         'fec': fec,
+         'frames': nframes,
+         'complete_frames': complete,
+         'frames_per_sec': complete/duration,
+         'loss': stats.get('loss'),
+         'latency_p50_ms': stats.get('latency_p50_ms'),
+         'latency_p99_ms': stats.get('latency_p99_ms'),
+         'link_dropped': results[0].dropped}
+    if fec:
+        r['decoder'] = results[1].report()
+        r['encoder'] = results[2].report()
+    return r
+
+async def bench(duties, duration, port=55000, **kwargs):
+    results = []
+    for duty in duties:
+        for fec in (False, True):
+            results.append(await bench_one(duty, fec, duration, port, **kwargs))
+            port += 5
+    return results
+
+def print_bench(results):
+    print('{:>5} {:>4} {:>8} {:>8} {:>8} {:>9} {:>9} {:>9}'.format(
+        'duty', 'fec', 'frames/s', 'complete', 'loss', 'lat p50', 'lat p99', 'overhead'))
+    for r in results:
+        print('{:5.2f} {:>4} {:8.1f} {:8.1%} {:8.1%} {:8.1f}ms {:8.1f}ms {:>9}'.format(
+            r['duty'], 'yes' if r['fec'] else 'no', r['frames_per_sec'],
+            r['complete_frames']/max(r['frames'], 1), r['loss'] or 0.0,
+            r['latency_p50_ms'] or float('nan'), r['latency_p99_ms'] or float('nan'),
+            '{:.0%}'.format(r['encoder']['overhead']) if r['fec'] else '-'))
+
+def parse_addr(s):
+    host, _, port = s.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+def main():
+    parser = argparse.ArgumentParser(description='FEC relay pair and lossy link for UDP video streaming.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    sub = parser.add_subparsers(dest='cmd')
+
+    def add_encoder_args(p):
+        p.add_argument('-k', action='store', type=int, default=8,
+                       help='source packets per block')
+        p.add_argument('-r', action='store', type=int, default=2,
+                       help='parity packets per block')
+        p.add_argument('--depth', action='store', type=int, default=8,
+                       help='interleaving depth')
+        p.add_argument('--flush', action='store', type=float, default=0.2,
+                       help='seconds before a partly filled group is closed')
+        p.add_argument('--adaptive', action='store_true',
+                       help='adapt r to the loss reported by the decoder')
+        p.add_argument('--target', action='store', type=float, default=1e-3,
+                       help='residual block loss target for adaptive r')
+        p.add_argument('--rmax', action='store', type=int, default=8,
+                       help='maximum adaptive r')
+
+    def add_link_args(p):
+        p.add_argument('--period', action='store', type=float, default=0.23,
+                       help='jammer period (s)')
+        p.add_argument('--jam-loss', action='store', type=float, default=1.0,
+                       help='drop probability while jammed')
+        p.add_argument('--loss', action='store', type=float, default=0.0,
+                       help='drop probability while not jammed')
+        p.add_argument('--delay', action='store', type=float, default=0.005,
+                       help='one-way delay (s)')
+
+    p = sub.add_parser('encode', help='add FEC to packets from ffmpeg')
+    p.add_argument('--listen', action='store', type=parse_addr, default=('127.0.0.1', 54546))
+    p.add_argument('--dest', action='store', type=parse_addr, default=('10.10.10.1', 54545))
+    p.add_argument('--bind', action='store', type=parse_addr, default=('0.0.0.0', 54544),
+                   help='address packets are sent from and feedback arrives at')
+    add_encoder_args(p)
+
+    p = sub.add_parser('decode', help='recover packets and forward to VLC')
+    p.add_argument('--listen', action='store', type=parse_addr, default=('0.0.0.0', 54545))
+    p.add_argument('--dest', action='store', type=parse_addr, default=('127.0.0.1', 54547))
+    p.add_argument('--feedback', action='store', type=parse_addr, default=None,
+                   help='encoder address for loss feedback')
+    p.add_argument('--max-delay', action='store', type=float, default=0.25,
+                   help='seconds to wait for recovery of a missing packet')
+
+    p = sub.add_parser('link', help='lossy link emulator')
+    p.add_argument('--listen', action='store', type=parse_addr, default=('127.0.0.1', 54550))
+    p.add_argument('--dest', action='store', type=parse_addr, default=('127.0.0.1', 54545))
+    p.add_argument('--duty', action='store', type=float, default=0.0,
+                   help='fraction of each period the jammer is on')
+    add_link_args(p)
+
+    p = sub.add_parser('bench', help='compare frame delivery with and without FEC')
+    p.add_argument('--duty', action='store', default='0,0.05,0.1,0.2,0.3',
+                   help='comma-separated jamming duty cycles')
+    p.add_argument('-t', '--duration', action='store', type=float, default=10.0,
+                   help='seconds per run')
+    p.add_argument('--rate', action='store', type=traffic.parse_rate, default=2e6,
+                   help='video bit rate')
+    p.add_argument('--max-delay', action='store', type=float, default=0.25,
+                   help='seconds to wait for recovery of a missing packet')
+    p.add_argument('-o', '--output', action='store', default=None,
+                   help='JSON results file')
+    add_encoder_args(p)
+    add_link_args(p)
+
+    args = parser.parse_args()
+    if args.cmd is None:
+        parser.error('one of encode, decode, link or bench is required')
+
+    logging.basicConfig(format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
+                        level=logging.INFO)
+
+    loop = asyncio.get_event_loop()
+    if args.cmd == 'bench':
+        enc = dict(k=args.k, r=args.r, depth=args.depth, flush=args.flush,
+                   adaptive=args.adaptive, target=args.target, rmax=args.rmax)
+        link = dict(period=args.period, jam_loss=args.jam_loss, loss=args.loss,
+                    delay=args.delay)
+        duties = [float(d) for d in args.duty.split(',')]
+        results = loop.run_until_complete(bench(duties, args.duration, rate=args.rate,
+                                                link_kwargs=link, encoder_kwargs=enc,
+                                                decoder_kwargs={'max_delay': args.max_delay}))
+        print_bench(results)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        loop.close()
+        return
+
+    if args.cmd == 'encode':
+        coro = run_encoder(args.listen, args.dest, args.bind, k=args.k, r=args.r,
+                           depth=args.depth, flush=args.flush, adaptive=args.adaptive,
+                           target=args.target, rmax=args.rmax)
+    elif args.cmd == 'decode':
+        coro = run_decoder(args.listen, args.dest, args.feedback, max_delay=args.max_delay)
+    else:
+        coro = run_link(args.listen, args.dest, period=args.period, duty=args.duty,
+                        jam_loss=args.jam_loss, loss=args.loss, delay=args.delay)
+
+    task = asyncio.ensure_future(coro)
+    try:
+        result = loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        result = loop.run_until_complete(task)
+    finally:
+        loop.close()
+
+    if hasattr(result, 'report'):
+        print(json.dumps(result.report(), indent=2))
+
+if __name__ == '__main__':
+    main()
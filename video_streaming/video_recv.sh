@@ -5,3 +5,6 @@ sudo apt-get install vlc # Install VLC
 sed -i 's/geteuid/getppid/' /usr/bin/vlc # Allow vlc to run when root (just a bit of magic here)
 vlc udp://@:54545
 
+# With the FEC relay on the transmitting side, decode and play from the relay instead:
+# python fecrelay.py decode --listen 0.0.0.0:54545 --dest 127.0.0.1:54547 --feedback <tx ip>:54544 &
+# vlc udp://@:54547
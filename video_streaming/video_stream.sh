@@ -6,3 +6,6 @@
 sudo apt-get install ffmpeg
 ffmpeg -re -i temp.mp4 -movflags +frag_keyframe -f mpegts udp://10.10.10.1:54545
 
+# To protect the stream against jamming with FEC, run the relay and send to it instead:
+# python fecrelay.py encode --dest 10.10.10.1:54545 --adaptive &
+# ffmpeg -re -i temp.mp4 -movflags +frag_keyframe -f mpegts udp://127.0.0.1:54546